@@ -0,0 +1,143 @@
+"""
+Grouped cost aggregation for organization reports.
+
+GroupedCosts sums the pages of a UsageScan (see usage_queries) by any mix of
+these dimensions:
+
+    user    user_id, with any write shard suffix removed
+    model   model_name
+    day     UTC day, "YYYY-MM-DD"
+    hour    UTC hour, "YYYY-MM-DDTHH"
+
+Each page is first turned into a column of group keys, which is reduced
+against the page's costs to one sum and count per group. Only those per-page
+sums are converted to integer nano-dollars and added to the running totals.
+Group keys are interned once and the totals are kept in two array('q')
+columns indexed by group, so memory follows the number of groups rather than
+rows, and totals are exact.
+"""
+from array import array
+from collections import Counter
+
+import pricing
+import rollups
+import sharding
+
+DIMENSIONS = ('user', 'model', 'day', 'hour')
+# Response field holding each dimension's value
+FIELDS = {'user': 'user_id', 'model': 'model_name', 'day': 'day', 'hour': 'hour'}
+
+
+def parse_group_by(value):
+    """
+    Dimensions from a comma-separated group_by parameter, 'user' by default.
+    Raises ValueError for unknown or repeated dimensions.
+    """
+    dimensions = tuple(part.strip() for part in (value or 'user').split(',') if part.strip())
+    for dimension in dimensions:
+        if dimension not in DIMENSIONS:
+            raise ValueError(f"Unknown group_by dimension: {dimension}. Supported dimensions are: {', '.join(DIMENSIONS)}")
+    if not dimensions or len(set(dimensions)) != len(dimensions):
+        raise ValueError('group_by must name each dimension at most once')
+    return dimensions
+
+
+def _users(source, items):
+    if source['kind'] == 'rollup':
+        return [item['user_id'] for item in items]
+    return [
+        sharding.base_key(item['user_id'], int(item['write_shard'])) if item.get('write_shard') else item['user_id']
+        for item in items
+    ]
+
+
+def _models(source, items):
+    # Rollups file records without a model under 'unknown' too
+    return [item.get('model_name', 'unknown') for item in items]
+
+
+def _days(source, items):
+    field = 'bucket_key' if source['kind'] == 'rollup' else 'timestamp'
+    return [item[field][:10] for item in items]
+
+
+def _hours(source, items):
+    if source['kind'] == 'rollup' and source['granularity'] != rollups.HOURLY:
+        raise ValueError('Daily rollups cannot be grouped by hour')
+    field = 'bucket_key' if source['kind'] == 'rollup' else 'timestamp'
+    return [item[field][:13] for item in items]
+
+
+_COLUMNS = {'user': _users, 'model': _models, 'day': _days, 'hour': _hours}
+
+
+class GroupedCosts:
+    """Total cost and usage count per group of dimension values."""
+
+    def __init__(self, dimensions):
+        self.dimensions = tuple(dimensions)
+        self._columns = [_COLUMNS[dimension] for dimension in self.dimensions]
+        self._codes = {}
+        self.keys = []
+        self.cost_nanos = array('q')
+        self.counts = array('q')
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add_page(self, source, items):
+        """Add one page of raw records or rollup rows read from `source`."""
+        if not items:
+            return
+        keys = list(zip(*(column(source, items) for column in self._columns)))
+        page_costs = {}
+        for key, item in zip(keys, items):
+            if key in page_costs:
+                page_costs[key] += item['total_cost']
+            else:
+                page_costs[key] = item['total_cost']
+        if source['kind'] == 'rollup':
+            page_counts = Counter()
+            for key, item in zip(keys, items):
+                page_counts[key] += int(item['usage_count'])
+        else:
+            page_counts = Counter(keys)
+        for key, cost in page_costs.items():
+            self._add(key, pricing.to_nanos(cost), page_counts[key])
+
+    def _add(self, key, cost, count):
+        code = self._codes.get(key)
+        if code is None:
+            code = self._codes[key] = len(self.keys)
+            self.keys.append(key)
+            self.cost_nanos.append(0)
+            self.counts.append(0)
+        self.cost_nanos[code] += cost
+        self.counts[code] += count
+
+    def partial(self):
+        """The groups so far, as JSON for a continuation token."""
+        return [[list(key), cost, count] for key, cost, count in zip(self.keys, self.cost_nanos, self.counts)]
+
+    def add_partial(self, groups):
+        """Add groups saved by partial(). Raises ValueError if they don't fit these dimensions."""
+        for key, cost, count in groups:
+            if len(key) != len(self.dimensions):
+                raise ValueError('Partial groups do not match the dimensions')
+            self._add(tuple(str(value) for value in key), int(cost), int(count))
+
+    def total_cost(self):
+        return pricing.to_decimal(sum(self.cost_nanos))
+
+    def rows(self):
+        """Response rows, costliest first, and by key among equal costs so responses are stable."""
+        fields = [FIELDS[dimension] for dimension in self.dimensions]
+        order = sorted(range(len(self.keys)), key=lambda code: (-self.cost_nanos[code], self.keys[code]))
+        return [
+            dict(
+                zip(fields, self.keys[code]),
+                total_cost=float(pricing.to_decimal(self.cost_nanos[code])),
+                usage_count=self.counts[code]
+            )
+            for code in order
+        ]
@@ -0,0 +1,31 @@
+import os
+import logging
+
+import metrics
+import retention
+
+# Initialize logging
+logger = logging.getLogger()
+logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO'))
+
+# The archive store (ARCHIVE_BUCKET or ARCHIVE_DIR)
+archive = retention.archive
+
+@metrics.instrumented('archive')
+def lambda_handler(event, context):
+    """
+    Consume usage table stream records and archive the records TTL removed.
+    Returns a partial batch response so Lambda retries only from a failed segment.
+    """
+    records = event.get('Records', [])
+    with metrics.stage('write'):
+        response = retention.archive_records(records, archive)
+    metrics.count('records', len(records))
+
+    logger.info({
+        'action': 'usage_archive_batch',
+        'records': len(records),
+        'failed_from': [failure['itemIdentifier'] for failure in response['batchItemFailures']]
+    })
+
+    return response
@@ -0,0 +1,193 @@
+import os
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+import storage
+
+# Initialize logging
+logger = logging.getLogger()
+logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO'))
+
+# Organization storage, connected on first use
+org_table_name = os.environ.get('ORG_TABLE_NAME', 'chatgpt_organizations')
+store = storage.open_storage(org_table_name=org_table_name)
+
+# Cache settings. AUTH_CACHE_TTL_SECONDS bounds how long a suspended
+# organization can keep using a cached token.
+AUTH_CACHE_SIZE = int(os.environ.get('AUTH_CACHE_SIZE', '10000'))
+AUTH_CACHE_TTL_SECONDS = float(os.environ.get('AUTH_CACHE_TTL_SECONDS', '60'))
+AUTH_NEGATIVE_TTL_SECONDS = float(os.environ.get('AUTH_NEGATIVE_TTL_SECONDS', '10'))
+AUTH_PREFETCH = os.environ.get('AUTH_PREFETCH', 'false').lower() == 'true'
+
+# Organization attributes kept in the cache
+CACHED_ORG_FIELDS = ('organization_id', 'status')
+
+
+class TokenCache:
+    """
+    Bounded LRU cache mapping auth tokens to organization records.
+
+    Entries expire after `ttl` seconds. Unknown tokens are cached as None
+    for `negative_ttl` seconds so repeated bad tokens do not reach the GSI.
+    The cache lives at module level and therefore survives warm invocations.
+    """
+
+    def __init__(self, max_entries, ttl, negative_ttl, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, token):
+        """Return (found, org). `org` is None for a cached unknown token."""
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                self.misses += 1
+                return False, None
+            expires_at, org = entry
+            if expires_at <= self.clock():
+                del self._entries[token]
+                self.misses += 1
+                return False, None
+            self._entries.move_to_end(token)
+            self.hits += 1
+            return True, org
+
+    def put(self, token, org):
+        """Cache an organization record, or None for an unknown token."""
+        ttl = self.ttl if org is not None else self.negative_ttl
+        if ttl <= 0 or self.max_entries <= 0:
+            return
+        if org is not None:
+            org = {field: org[field] for field in CACHED_ORG_FIELDS if field in org}
+        with self._lock:
+            self._entries[token] = (self.clock() + ttl, org)
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, token=None):
+        """Drop one token, or every entry when no token is given."""
+        with self._lock:
+            if token is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(token, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+token_cache = TokenCache(AUTH_CACHE_SIZE, AUTH_CACHE_TTL_SECONDS, AUTH_NEGATIVE_TTL_SECONDS)
+
+
+def prefetch_active_organizations(cache=None, org_store=None):
+    """
+    Load active organizations into the token cache.
+    Stops once the cache is full. Returns the number of tokens cached.
+    """
+    # An empty cache is falsy, so test for None
+    cache = token_cache if cache is None else cache
+    org_store = store if org_store is None else org_store
+    loaded = 0
+    for org in org_store.organizations():
+        if loaded >= cache.max_entries:
+            break
+        if org.get('status') == 'active' and org.get('auth_token'):
+            cache.put(org['auth_token'], org)
+            loaded += 1
+    return loaded
+
+
+def lookup_organization(auth_token):
+    """
+    Resolve an auth token to its organization record, using the cache first.
+    Returns None if no organization owns the token.
+    Query errors propagate and are never cached.
+    """
+    found, org = token_cache.get(auth_token)
+    if found:
+        return org
+
+    # Look the token up in storage (the auth token index on DynamoDB)
+    org = store.find_organization(auth_token)
+    metrics.debug("Auth token lookup %s an organization", 'found' if org else 'did not find')
+
+    token_cache.put(auth_token, org)
+    return org
+
+
+def authorize_request(event, organization_id):
+    """
+    Validate the auth token against the organization ID.
+    Returns True if authorized, False otherwise.
+    """
+    try:
+        # Get the Authorization header. Neither the event nor the token is
+        # logged: both carry credentials.
+        headers = event.get('headers') or {}
+        if not headers:
+            logger.error("No headers present")
+            return False
+
+        # Handle different possible header key formats
+        auth_header = None
+        for key in headers:
+            if key.lower() == 'authorization' or key.lower() == '"authorization"':
+                auth_header = headers[key]
+                break
+
+        if not auth_header:
+            logger.error("No Authorization header present")
+            return False
+
+        # Clean up the auth token - remove quotes and extra spaces
+        auth_token = auth_header.replace('"', '').strip()
+        if auth_token.lower().startswith('bearer '):
+            auth_token = auth_token[7:].strip()
+
+        try:
+            org = lookup_organization(auth_token)
+        except Exception as e:
+            logger.error(f"Organization lookup error: {str(e)}")
+            return False
+
+        # Check if we found a matching organization
+        if not org:
+            logger.error("No organization found for the provided auth token")
+            return False
+
+        # Verify the organization ID matches
+        metrics.debug("Token belongs to organization %s", org.get('organization_id'))
+
+        if org.get('organization_id') != organization_id:
+            logger.error(f"Organization ID mismatch. Expected: {organization_id}, Found: {org.get('organization_id')}")
+            return False
+
+        # Verify the organization is active
+        if org.get('status') != 'active':
+            logger.error("Organization is not active")
+            return False
+
+        metrics.debug("Authorization successful for %s", organization_id)
+        return True
+
+    except Exception as e:
+        logger.error(f"Error during authorization: {str(e)}")
+        return False
+
+
+# Warm the cache at cold start when configured
+if AUTH_PREFETCH:
+    try:
+        logger.info(f"Prefetched {prefetch_active_organizations()} organization tokens")
+    except Exception as e:
+        logger.error(f"Auth cache prefetch failed: {str(e)}")
@@ -0,0 +1,149 @@
+import logging
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import bootstrap
+
+# Initialize logging
+logger = logging.getLogger()
+
+# DynamoDB rejects BatchWriteItem calls with more than 25 requests
+BATCH_WRITE_LIMIT = 25
+
+# Error codes of a throttled request
+THROTTLING_ERRORS = {
+    'ProvisionedThroughputExceededException',
+    'ThrottlingException',
+    'RequestLimitExceeded',
+}
+
+# Error codes worth retrying; anything else fails the whole chunk
+RETRYABLE_ERRORS = THROTTLING_ERRORS | {'InternalServerError'}
+
+# Reported for items DynamoDB kept handing back as unprocessed
+UNPROCESSED_ERROR = 'Item left unprocessed after retries'
+
+# Prefix of the error reported for an item that can't be serialized
+INVALID_ITEM_ERROR = 'Invalid item'
+
+def chunked(items, size=BATCH_WRITE_LIMIT):
+    """Yield successive slices of at most `size` items."""
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def error_code(error):
+    response = getattr(error, 'response', None) or {}
+    return response.get('Error', {}).get('Code')
+
+
+# Request type -> the member holding its item or key
+_REQUEST_BODIES = {'PutRequest': 'Item', 'DeleteRequest': 'Key'}
+
+
+def _write_chunk(client, table_name, key_fields, chunk, max_attempts, base_delay, request_type='PutRequest'):
+    """
+    Write one chunk of (position, item) pairs, retrying UnprocessedItems.
+    Returns a dict mapping position -> error message for the items that failed.
+    An item that can't be serialized fails on its own.
+    """
+    body = _REQUEST_BODIES[request_type]
+    positions = {}
+    requests = []
+    invalid = {}
+    for position, item in chunk:
+        try:
+            requests.append({request_type: {body: {k: bootstrap.serialize(v) for k, v in item.items()}}})
+        except (TypeError, ValueError, ArithmeticError) as e:
+            invalid[position] = f'{INVALID_ITEM_ERROR}: {str(e)}'
+            continue
+        positions[tuple(item[field] for field in key_fields)] = position
+
+    attempt = 0
+    last_error = UNPROCESSED_ERROR
+    while requests:
+        attempt += 1
+        try:
+            response = client.batch_write_item(RequestItems={table_name: requests})
+            requests = response.get('UnprocessedItems', {}).get(table_name, [])
+        except Exception as e:
+            if error_code(e) not in RETRYABLE_ERRORS:
+                logger.error(f"BatchWriteItem failed: {str(e)}")
+                invalid.update((position, str(e)) for position in positions.values())
+                return invalid
+            last_error = str(e)
+
+        if requests and attempt >= max_attempts:
+            break
+        if requests:
+            # Full jitter exponential backoff before resubmitting what is left
+            time.sleep(random.uniform(0, base_delay * (2 ** attempt)))
+
+    failures = invalid
+    for request in requests:
+        item = request[request_type][body]
+        key = tuple(bootstrap.deserialize(item[field]) for field in key_fields)
+        failures[positions[key]] = last_error
+    return failures
+
+
+def batch_put_items(client, table_name, items, key_fields, max_workers=8, max_attempts=5, base_delay=0.05,
+                    request_type='PutRequest'):
+    """
+    Store `items` with BatchWriteItem, 25 at a time, running chunks in parallel.
+
+    Unprocessed items are retried with jittered exponential backoff.
+    Returns a list aligned with `items` holding None for every stored item
+    and an error message for every item that could not be written.
+    """
+    results = [None] * len(items)
+    if not items:
+        return results
+
+    chunks = list(chunked(list(enumerate(items))))
+    workers = max(1, min(max_workers, len(chunks)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(_write_chunk, client, table_name, key_fields, chunk, max_attempts, base_delay, request_type)
+            for chunk in chunks
+        ]
+        for future in futures:
+            for position, error in future.result().items():
+                results[position] = error
+    return results
+
+
+def batch_delete_keys(client, table_name, keys, key_fields, max_workers=8, max_attempts=5, base_delay=0.05):
+    """Delete items by key with BatchWriteItem. Returns errors like batch_put_items."""
+    return batch_put_items(
+        client, table_name, keys, key_fields, max_workers, max_attempts, base_delay, request_type='DeleteRequest'
+    )
+
+
+# DynamoDB rejects BatchGetItem calls with more than 100 keys
+BATCH_GET_LIMIT = 100
+
+
+def batch_get_items(client, table_name, keys, key_fields, max_attempts=5, base_delay=0.05):
+    """
+    Read the items of `keys` with BatchGetItem, 100 at a time, retrying
+    unprocessed keys. Returns a list aligned with `keys` holding each item,
+    or None where it doesn't exist. Raises if keys are still left unread.
+    """
+    found = {}
+    for chunk in chunked(keys, BATCH_GET_LIMIT):
+        requests = [{field: bootstrap.serialize(key[field]) for field in key_fields} for key in chunk]
+        attempt = 0
+        while requests:
+            attempt += 1
+            response = client.batch_get_item(RequestItems={table_name: {'Keys': requests}})
+            for item in response.get('Responses', {}).get(table_name, []):
+                item = {k: bootstrap.deserialize(v) for k, v in item.items()}
+                found[tuple(item[field] for field in key_fields)] = item
+            requests = response.get('UnprocessedKeys', {}).get(table_name, {}).get('Keys', [])
+            if requests and attempt >= max_attempts:
+                raise RuntimeError(f'{len(requests)} keys left unprocessed after retries')
+            if requests:
+                time.sleep(random.uniform(0, base_delay * (2 ** attempt)))
+    return [found.get(tuple(key[field] for field in key_fields)) for key in keys]
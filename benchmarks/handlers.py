@@ -0,0 +1,269 @@
+"""
+In-process throughput benchmark for the Lambda handlers.
+
+Each handler runs against a storage backend preloaded with an organization's
+usage records: the in-memory DynamoDB fake from tests/fake_dynamodb, or an
+SQLite database in a temporary directory (see storage). For every backend,
+handler and data size the suite reports:
+
+    rps          requests per second over the timed requests
+    p50_ms       median request latency
+    p99_ms       99th percentile request latency
+    peak_kb      peak memory allocated during one request (tracemalloc)
+
+Both backends return --page-items records per query page (about 1 MB of
+usage records on DynamoDB), so multi-page scans, parallel slices and
+continuation behave as they do in production. Network time is not included.
+Cases on SQLite are named "sqlite:<handler>@<size>".
+
+Cost queries over settled hours are answered from the result cache after the
+first request (see result_cache), so the cache is off unless --result-cache
+is given. Cases run with it are named "<case>+cache".
+
+    python benchmarks/handlers.py
+    python benchmarks/handlers.py --backends dynamodb sqlite --sizes 10000
+    python benchmarks/handlers.py --sizes 1000 100000 --save benchmarks/baseline.json
+    python benchmarks/handlers.py --baseline benchmarks/baseline.json --max-regression 0.25
+
+With --baseline, every result is compared to the saved one. The command
+exits with status 1 when rps falls, or p99 rises, by more than
+--max-regression. Baselines are machine-specific, so record a new one on
+the host you compare on.
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import ExitStack
+from decimal import Decimal
+from unittest.mock import patch
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import auth
+import get_costs_function
+import get_org_costs_function
+import lambda_function
+import metrics
+import record_keys
+import result_cache
+import sharding
+import storage
+from tests.fake_dynamodb import make_tables
+
+BACKENDS = ['dynamodb', 'sqlite']
+DEFAULT_SIZES = [1000, 10000, 100000]
+DEFAULT_PAGE_ITEMS = 4000
+USERS = 50
+MODELS = ['gpt-4', 'gpt-4o', 'gpt-3.5-turbo', 'claude-3-sonnet']
+# Records are spread over March 2025
+RANGE_START_MS = 1740787200000
+RANGE_MS = 31 * 86400 * 1000
+
+HEADERS = {'Authorization': 'Bearer bench-token'}
+COST_PARAMS = {'organization_id': 'org_bench', 'start_date': '2025-03-01', 'end_date': '2025-03-31T23:59:59'}
+
+
+class _NullSink:
+    def emit(self, document):
+        pass
+
+
+def _usage_item(rng, n):
+    ts = RANGE_START_MS + rng.randrange(RANGE_MS)
+    timestamp, ts = record_keys.normalize_timestamp(ts)
+    return {
+        'organization_id': 'org_bench',
+        'record_id': record_keys.new_record_id(ts, seed=str(n)),
+        'user_id': f'user_{n % USERS}',
+        'timestamp': timestamp,
+        'ts': ts,
+        'model_name': MODELS[n % len(MODELS)],
+        'total_cost': Decimal(rng.randint(1, 100000)) / 1000000
+    }
+
+
+def load_tables(size, page_items=DEFAULT_PAGE_ITEMS, seed=7):
+    """Fake usage and organization tables holding `size` records of one organization."""
+    _, usage, orgs = make_tables(page_size=page_items)
+    orgs.put_item(Item={'organization_id': 'org_bench', 'auth_token': 'bench-token', 'status': 'active'})
+    rng = random.Random(seed)
+    for n in range(size):
+        usage.put_item(Item=_usage_item(rng, n))
+    return usage, orgs
+
+
+def load_store(backend, size, directory, page_items=DEFAULT_PAGE_ITEMS, seed=7):
+    """Storage of either backend holding the same records as load_tables."""
+    if backend == 'dynamodb':
+        return storage.DynamoDBStorage(*load_tables(size, page_items, seed))
+    store = storage.SQLiteStorage(os.path.join(directory, f'bench-{size}.db'), page_items=page_items)
+    store.put_organization({'organization_id': 'org_bench', 'auth_token': 'bench-token', 'status': 'active'})
+    rng = random.Random(seed)
+    store.put_usage_batch([_usage_item(rng, n) for n in range(size)])
+    return store
+
+
+def _track_event(n):
+    record = {'model_name': MODELS[n % len(MODELS)], 'input_tokens': 1200, 'output_tokens': 300,
+              'user_id': f'user_{n % USERS}', 'organization_id': 'org_bench'}
+    return {'headers': HEADERS, 'body': json.dumps(record)}
+
+
+def _batch_event(n):
+    records = [json.loads(_track_event(n + i)['body']) for i in range(100)]
+    return {'resource': '/track/batch', 'headers': HEADERS,
+            'body': json.dumps({'organization_id': 'org_bench', 'records': records})}
+
+
+# name -> (handler, event for the n-th request)
+HANDLERS = {
+    'track': (lambda_function.lambda_handler, _track_event),
+    'track_batch_100': (lambda_function.lambda_handler, _batch_event),
+    'get_costs': (get_costs_function.lambda_handler,
+                  lambda n: {'headers': HEADERS, 'queryStringParameters': dict(COST_PARAMS, user_id=f'user_{n % USERS}')}),
+    'get_org_costs': (get_org_costs_function.lambda_handler,
+                      lambda n: {'headers': HEADERS, 'queryStringParameters': COST_PARAMS}),
+}
+
+
+def _patched(stack, store, cache_results=False):
+    """Point every handler at the loaded store, with a warm token cache."""
+    stack.enter_context(patch.object(metrics, 'sink', _NullSink()))
+    stack.enter_context(patch.object(auth, 'token_cache', auth.TokenCache(1000, 3600, 60)))
+    cache_bytes = result_cache.RESULT_CACHE_BYTES if cache_results else 0
+    stack.enter_context(patch.object(result_cache, 'cache', result_cache.ResultCache(cache_bytes)))
+    stack.enter_context(patch.object(sharding, 'write_rates', sharding.WriteRateTracker()))
+    stack.enter_context(patch.object(lambda_function, 'queue', None))
+    for module in (auth, lambda_function, get_costs_function, get_org_costs_function):
+        stack.enter_context(patch.object(module, 'store', store))
+
+
+def _percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def bench(name, size, requests=200, max_seconds=5.0, page_items=DEFAULT_PAGE_ITEMS, backend='dynamodb',
+          cache_results=False):
+    """Time one handler at one data size on one backend and return its results."""
+    handler, make_event = HANDLERS[name]
+    with ExitStack() as stack:
+        directory = tempfile.mkdtemp(prefix='handler-bench-')
+        stack.callback(shutil.rmtree, directory, True)
+        store = load_store(backend, size, directory, page_items)
+        if backend == 'sqlite':
+            stack.callback(store.close)
+        _patched(stack, store, cache_results)
+        # Warm up caches and lazily built state
+        for n in range(3):
+            response = handler(make_event(n), None)
+            if response['statusCode'] >= 300 and response['statusCode'] != 207:
+                raise RuntimeError(f'{name} returned {response["statusCode"]}: {response["body"][:200]}')
+
+        latencies = []
+        started = time.perf_counter()
+        for n in range(requests):
+            began = time.perf_counter()
+            handler(make_event(n), None)
+            latencies.append((time.perf_counter() - began) * 1000)
+            if time.perf_counter() - started > max_seconds:
+                break
+        elapsed = time.perf_counter() - started
+
+        tracemalloc.start()
+        try:
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+            handler(make_event(0), None)
+            peak = tracemalloc.get_traced_memory()[1] - base
+        finally:
+            tracemalloc.stop()
+
+    return {
+        'requests': len(latencies),
+        'rps': round(len(latencies) / elapsed, 2),
+        'p50_ms': round(statistics.median(latencies), 3),
+        'p99_ms': round(_percentile(latencies, 0.99), 3),
+        'peak_kb': round(peak / 1024, 1)
+    }
+
+
+def compare(results, baseline, max_regression):
+    """
+    Compare results to a baseline. Returns a list of (case, field, old, new,
+    change) rows and the subset that regressed by more than max_regression.
+    """
+    rows, regressions = [], []
+    for case, result in results.items():
+        old = baseline.get(case)
+        if not old:
+            continue
+        for field, worse_when_higher in (('rps', False), ('p99_ms', True), ('p50_ms', True), ('peak_kb', True)):
+            if not old.get(field):
+                continue
+            change = (result[field] - old[field]) / old[field]
+            row = (case, field, old[field], result[field], change)
+            rows.append(row)
+            regressed = change > max_regression if worse_when_higher else change < -max_regression
+            if regressed and field in ('rps', 'p99_ms'):
+                regressions.append(row)
+    return rows, regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the handlers in-process against the DynamoDB fake.')
+    parser.add_argument('--handlers', nargs='+', choices=sorted(HANDLERS), default=list(HANDLERS))
+    parser.add_argument('--backends', nargs='+', choices=BACKENDS, default=['dynamodb'])
+    parser.add_argument('--sizes', nargs='+', type=int, default=DEFAULT_SIZES, help='Usage records preloaded')
+    parser.add_argument('--requests', type=int, default=200, help='Timed requests per case')
+    parser.add_argument('--max-seconds', type=float, default=5.0, help='Stop timing a case after this long')
+    parser.add_argument('--page-items', type=int, default=DEFAULT_PAGE_ITEMS, help='Items per query page')
+    parser.add_argument('--result-cache', action='store_true', help='Cache cost results for settled hours')
+    parser.add_argument('--save', help='Write the results to this JSON file')
+    parser.add_argument('--baseline', help='Compare against results saved with --save')
+    parser.add_argument('--max-regression', type=float, default=0.25,
+                        help='Fractional rps drop or p99 rise tolerated against the baseline')
+    args = parser.parse_args(argv)
+
+    results = {}
+    print(f"{'case':<35}{'requests':>9}{'rps':>11}{'p50 ms':>10}{'p99 ms':>10}{'peak KB':>10}")
+    for backend in args.backends:
+        for name in args.handlers:
+            for size in args.sizes:
+                case = f'{name}@{size}' if backend == 'dynamodb' else f'{backend}:{name}@{size}'
+                if args.result_cache:
+                    case += '+cache'
+                result = bench(name, size, args.requests, args.max_seconds, args.page_items, backend,
+                               args.result_cache)
+                results[case] = result
+                print(f"{case:<35}{result['requests']:>9}{result['rps']:>11.1f}{result['p50_ms']:>10.2f}"
+                      f"{result['p99_ms']:>10.2f}{result['peak_kb']:>10.1f}")
+
+    if args.save:
+        with open(args.save, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+            output.write('\n')
+
+    if not args.baseline:
+        return 0
+    with open(args.baseline) as saved:
+        baseline = json.load(saved)
+    rows, regressions = compare(results, baseline, args.max_regression)
+    print(f"\n{'case':<35}{'metric':>9}{'baseline':>12}{'now':>12}{'change':>9}")
+    for case, field, old, new, change in rows:
+        print(f"{case:<35}{field:>9}{old:>12.2f}{new:>12.2f}{change:>+9.0%}")
+    for case, field, old, new, change in regressions:
+        print(f"REGRESSION {case} {field}: {old} -> {new} ({change:+.0%})")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,165 @@
+"""
+Cold-start benchmark for the Lambda handlers.
+
+Every run starts a fresh Python process, as a new Lambda execution
+environment would. The process measures:
+
+    import_ms         importing the handler module
+    first_request_ms  the first invocation, including loading boto3 and
+                      creating clients
+    warm_request_ms   a second invocation on the same clients
+    cold_ms           import_ms + first_request_ms
+
+DynamoDB never sees the requests. A botocore before-send hook answers each
+call with a canned response, so the numbers cover everything else on the
+client side: imports, model loading, serialization, signing and parsing.
+
+    python benchmarks/startup.py --runs 10
+    python benchmarks/startup.py --handlers track get_costs --json
+
+Results vary with the machine, so compare them against runs on the same host.
+The Lambda figure at 128 MB is several times larger.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_ORG = {'organization_id': 'org_bench', 'auth_token': 'bench-token', 'status': 'active'}
+_USAGE = {
+    'organization_id': 'org_bench', 'record_id': '01JNTK5180000000000000000A', 'user_id': 'user_1',
+    'timestamp': '2025-03-08T10:00:00.000000+00:00', 'ts': 1741428000000, 'model_name': 'gpt-4',
+    'total_cost': '0.06'
+}
+_RECORD = {'model_name': 'gpt-4', 'input_tokens': 1000, 'output_tokens': 500,
+           'user_id': 'user_1', 'organization_id': 'org_bench'}
+_HEADERS = {'Authorization': 'Bearer bench-token'}
+_COST_PARAMS = {'organization_id': 'org_bench', 'start_date': '2025-03-01', 'end_date': '2025-03-31'}
+
+# handler -> (module, event)
+HANDLERS = {
+    'track': ('lambda_function', {'headers': _HEADERS, 'body': json.dumps(_RECORD)}),
+    'get_costs': ('get_costs_function', {'headers': _HEADERS, 'queryStringParameters': dict(_COST_PARAMS, user_id='user_1')}),
+    'get_org_costs': ('get_org_costs_function', {'headers': _HEADERS, 'queryStringParameters': _COST_PARAMS}),
+    'register_org': ('register_org_function', {'body': json.dumps({'organization_name': 'Bench'})}),
+    'router': ('router', {'resource': '/costs', 'httpMethod': 'GET', 'headers': _HEADERS,
+                          'queryStringParameters': dict(_COST_PARAMS, user_id='user_1')}),
+    'rollup': ('rollup_function', {'Records': [{
+        'eventName': 'INSERT',
+        'dynamodb': {'SequenceNumber': '1', 'NewImage': {
+            k: {'N': str(v)} if isinstance(v, int) else {'N': v} if k == 'total_cost' else {'S': v}
+            for k, v in _USAGE.items()
+        }}
+    }]}),
+    'ingest_worker': ('ingest_worker', {'Records': [{
+        'messageId': 'bench-1',
+        'body': json.dumps({'record_id': _USAGE['record_id'], 'record': dict(_RECORD, timestamp=_USAGE['timestamp'])})
+    }]}),
+}
+
+
+def _canned_response(request, **kwargs):
+    """before-send hook: answer a DynamoDB call without sending it."""
+    from botocore.awsrequest import AWSResponse
+
+    class _Raw:
+        def __init__(self, body):
+            self.body = body
+
+        def stream(self, **kwargs):
+            yield self.body
+
+    target = request.headers.get('X-Amz-Target', b'')
+    operation = (target.decode() if isinstance(target, bytes) else target).split('.')[-1]
+    payload = json.loads(request.body or b'{}')
+    if operation == 'Query' and payload.get('IndexName') == 'AuthTokenIndex':
+        body = {'Items': [{k: {'S': v} for k, v in _ORG.items()}], 'Count': 1, 'ScannedCount': 1}
+    elif operation == 'Query':
+        body = {'Items': [], 'Count': 0, 'ScannedCount': 0}
+    elif operation == 'BatchWriteItem':
+        body = {'UnprocessedItems': {}}
+    else:
+        body = {}
+    return AWSResponse(request.url, 200, {'x-amzn-RequestId': 'bench'}, _Raw(json.dumps(body).encode()))
+
+
+def measure(handler):
+    """Run in a fresh process: time the import and two invocations of one handler."""
+    module_name, event = HANDLERS[handler]
+    sys.path.insert(0, ROOT)
+
+    started = time.perf_counter()
+    module = __import__(module_name)
+    imported = time.perf_counter()
+
+    # Registered on the default session, which the first client is built
+    # from. The handler would load boto3 and create that session itself, so
+    # both count towards the first request.
+    import boto3
+    boto3.setup_default_session()
+    boto3.DEFAULT_SESSION.events.register('before-send.dynamodb', _canned_response)
+
+    response = module.lambda_handler(json.loads(json.dumps(event)), None)
+    first = time.perf_counter()
+    module.lambda_handler(json.loads(json.dumps(event)), None)
+    warm = time.perf_counter()
+
+    status = response.get('statusCode', 200) if isinstance(response, dict) else 200
+    if status >= 500 or response.get('batchItemFailures'):
+        raise SystemExit(f'{handler} failed: {response}')
+    return {
+        'import_ms': (imported - started) * 1000,
+        'first_request_ms': (first - imported) * 1000,
+        'warm_request_ms': (warm - first) * 1000,
+        'cold_ms': (first - started) * 1000
+    }
+
+
+def run(handler, runs):
+    """Median timings of `runs` fresh processes for one handler."""
+    env = dict(
+        os.environ,
+        AWS_ACCESS_KEY_ID='bench', AWS_SECRET_ACCESS_KEY='bench', AWS_DEFAULT_REGION='us-east-1',
+        AWS_EC2_METADATA_DISABLED='true', ROLLUP_TABLE_NAME='chatgpt_usage_rollups', METRICS_ENABLED='false',
+        LOG_LEVEL='WARNING', PYTHONDONTWRITEBYTECODE='1'
+    )
+    samples = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--child', handler],
+            env=env, cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout
+        samples.append(json.loads(output.strip().splitlines()[-1]))
+    return {name: round(statistics.median(sample[name] for sample in samples), 2) for name in samples[0]}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Measure handler import and first-request time in fresh processes.')
+    parser.add_argument('--handlers', nargs='+', choices=sorted(HANDLERS), default=list(HANDLERS))
+    parser.add_argument('--runs', type=int, default=5, help='Fresh processes per handler; the median is reported')
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        print(json.dumps(measure(args.child)))
+        return 0
+
+    results = {handler: run(handler, args.runs) for handler in args.handlers}
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{'handler':<16}{'import':>10}{'first req':>12}{'warm req':>11}{'cold':>10}  (ms, median of {args.runs})")
+        for handler, timings in results.items():
+            print(f"{handler:<16}{timings['import_ms']:>10.1f}{timings['first_request_ms']:>12.1f}"
+                  f"{timings['warm_request_ms']:>11.1f}{timings['cold_ms']:>10.1f}")
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,140 @@
+"""
+Shared, lazily created AWS clients for the Lambda handlers.
+
+Building a boto3 resource loads and parses its service models, which is a
+large part of a cold start at 128 MB. Handler modules therefore never create
+clients at import. They declare the tables they use with table(), which
+returns a LazyTable, and the single DynamoDB resource behind every table is
+built on first use. It lives at module level, so warm invocations reuse it
+together with its open connections.
+
+Every client shares one tuned botocore config: short connect and read
+timeouts, TCP keep-alive, retries and a connection pool sized for the
+largest reserve_connections() request. AWS_RETRY_MODE=adaptive adds
+botocore's client-side rate limiting, which slows every call down while
+DynamoDB throttles and speeds back up as capacity returns. Call reserve_connections() at
+import time, before the first request creates the resource.
+
+serialize() and deserialize() convert between Python values and DynamoDB's
+typed attribute values. Their boto3 import, which loads botocore, is also
+put off until first use.
+"""
+import os
+import threading
+
+REGION = os.environ.get('AWS_DEFAULT_REGION', 'us-east-1')
+CONNECT_TIMEOUT_SECONDS = float(os.environ.get('AWS_CONNECT_TIMEOUT_SECONDS', '2'))
+READ_TIMEOUT_SECONDS = float(os.environ.get('AWS_READ_TIMEOUT_SECONDS', '5'))
+MAX_ATTEMPTS = int(os.environ.get('AWS_MAX_ATTEMPTS', '3'))
+RETRY_MODE = os.environ.get('AWS_RETRY_MODE', 'standard')
+
+# botocore's default pool size
+DEFAULT_POOL_CONNECTIONS = 10
+
+_pool_connections = DEFAULT_POOL_CONNECTIONS
+_resources = {}
+_clients = {}
+_converters = []
+_lock = threading.Lock()
+
+
+def reserve_connections(count):
+    """Make the connection pool at least `count` connections large."""
+    global _pool_connections
+    _pool_connections = max(_pool_connections, count)
+
+
+def client_config():
+    """The botocore config shared by every client."""
+    from botocore.config import Config
+    return Config(
+        region_name=REGION,
+        connect_timeout=CONNECT_TIMEOUT_SECONDS,
+        read_timeout=READ_TIMEOUT_SECONDS,
+        tcp_keepalive=True,
+        max_pool_connections=_pool_connections,
+        retries={'max_attempts': MAX_ATTEMPTS, 'mode': RETRY_MODE}
+    )
+
+
+def resource(service='dynamodb'):
+    """The shared boto3 resource for a service, created on first use."""
+    found = _resources.get(service)
+    if found is not None:
+        return found
+    with _lock:
+        if service not in _resources:
+            import boto3
+            _resources[service] = boto3.resource(service, config=client_config())
+        return _resources[service]
+
+
+def client(service):
+    """
+    The shared low-level client for a service, created on first use.
+    DynamoDB's is the resource's own client, so both share one pool.
+    """
+    if service == 'dynamodb':
+        return resource('dynamodb').meta.client
+    found = _clients.get(service)
+    if found is not None:
+        return found
+    with _lock:
+        if service not in _clients:
+            import boto3
+            _clients[service] = boto3.client(service, config=client_config())
+        return _clients[service]
+
+
+def _type_converters():
+    if not _converters:
+        with _lock:
+            if not _converters:
+                from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+                _converters.extend((TypeSerializer(), TypeDeserializer()))
+    return _converters
+
+
+def serialize(value):
+    """The DynamoDB attribute value of a Python value."""
+    return _type_converters()[0].serialize(value)
+
+
+def deserialize(value):
+    """The Python value of a DynamoDB attribute value."""
+    return _type_converters()[1].deserialize(value)
+
+
+class LazyTable:
+    """
+    Stands in for a boto3 DynamoDB Table until it is first used.
+    `name` is available without creating anything.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._table = None
+
+    def _load(self):
+        if self._table is None:
+            self._table = resource('dynamodb').Table(self.name)
+        return self._table
+
+    def __getattr__(self, attribute):
+        return getattr(self._load(), attribute)
+
+    def __repr__(self):
+        return f'LazyTable({self.name!r})'
+
+
+def table(name):
+    return LazyTable(name)
+
+
+def reset():
+    """Drop every cached client, as a new execution environment would."""
+    global _pool_connections
+    with _lock:
+        _resources.clear()
+        _clients.clear()
+        _pool_connections = DEFAULT_POOL_CONNECTIONS
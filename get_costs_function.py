@@ -1,99 +1,275 @@
 import json
-import boto3
 import os
-from datetime import datetime, timezone
 from decimal import Decimal
-from boto3.dynamodb.conditions import Key, Attr
 import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from auth import authorize_request, org_table_name
+import bootstrap
+import metrics
+import result_cache
+import sharding
+import storage
+import usage_queries
 
 # Initialize logging
 logger = logging.getLogger()
-logger.setLevel(logging.INFO)
+logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO'))
 
-# Initialize DynamoDB client
-region = os.environ.get('AWS_DEFAULT_REGION', 'us-east-1')
-dynamodb = boto3.resource('dynamodb', region_name=region)
+# Storage, connected on first use. Parallel scans share the connection
+# pool, so it is sized for every query worker.
+bootstrap.reserve_connections(usage_queries.QUERY_WORKERS)
 table_name = os.environ.get('DYNAMODB_TABLE', 'chatgpt_usage_tracking')
-org_table_name = os.environ.get('ORG_TABLE_NAME', 'chatgpt_organizations')
-table = dynamodb.Table(table_name)
-org_table = dynamodb.Table(org_table_name)
 
-def authorize_request(event, organization_id):
+# Pre-aggregated rollups are used when a rollup table is configured.
+# Buckets before ROLLUP_START (when the stream consumer was deployed) are read raw.
+rollup_table_name = os.environ.get('ROLLUP_TABLE_NAME')
+ROLLUP_START = os.environ.get('ROLLUP_START') or None
+store = storage.open_storage(table_name, org_table_name, rollup_table_name)
+
+# Largest user list accepted by POST /costs/batch
+MAX_BULK_USERS = int(os.environ.get('MAX_BULK_USERS', '1000'))
+
+def is_bulk_request(event):
+    """Return True when the event was routed to POST /costs/batch."""
+    path = event.get('resource') or event.get('path') or ''
+    return path.rstrip('/').endswith('/costs/batch')
+
+def user_costs(organization_id, user_id, start_date, end_date, boundary, shards, deadline, late, invocation=None):
     """
-    Validate the auth token against the organization ID.
-    Returns True if authorized, False otherwise.
+    Sum one user's cost and usage count for [start_date, end_date], reading
+    settled time from the result cache when it can, as GET /costs does.
+    `late` is the request's result_cache.LateRecords. Returns (total,
+    usage_count), or None when time ran out first.
     """
-    try:
-        # Log the full event for debugging
-        logger.info(f"Full event: {json.dumps(event)}")
-        
-        # Get the Authorization header
-        headers = event.get('headers', {})
-        logger.info(f"Headers received: {json.dumps(headers)}")
-        
-        if not headers:
-            logger.error("No headers present")
-            return False
-
-        # Handle different possible header key formats
-        auth_header = None
-        for key in headers:
-            if key.lower() == 'authorization' or key.lower() == '"authorization"':
-                auth_header = headers[key]
-                break
-
-        if not auth_header:
-            logger.error("No Authorization header present")
-            return False
-
-        # Clean up the auth token - remove quotes and extra spaces
-        auth_token = auth_header.replace('"', '').strip()
-        if auth_token.lower().startswith('bearer '):
-            auth_token = auth_token[7:].strip()
-
-        logger.info(f"Cleaned auth token: {auth_token}")
-        logger.info(f"Organization table name: {org_table_name}")
-
-        # Query the organization table using the auth token index
+    settled, live = result_cache.plan(
+        'user', user_id, start_date, end_date, boundary, store.has_rollups, ROLLUP_START, shards,
+        organization_id=organization_id
+    )
+    cache_key = result_cache.cache_key('costs', settled, params=organization_id)
+    total = Decimal('0')
+    usage_count = 0
+    settled_total = None
+    cached = result_cache.lookup(cache_key) if settled else None
+    if cached is not None and late.stale(cached[1], user_id):
+        metrics.count('result_cache_stale', invocation=invocation)
+        cached = None
+    if cached is not None:
+        metrics.count('result_cache_hits', invocation=invocation)
+        total = Decimal(cached[0][0])
+        usage_count = int(cached[0][1])
+        result_cache.remember(cache_key, cached[0], late.through)
+        sources = live
+    else:
+        if settled:
+            metrics.count('result_cache_misses', invocation=invocation)
+            settled_total = [Decimal('0'), 0]
+        sources = settled + live
+
+    # Users are queried in parallel, so each reads its shards in turn, on
+    # the client shared by the worker threads
+    scan = usage_queries.UsageScan(sources, store, None, deadline, max_workers=1, shared=True)
+    for source, items in scan.item_pages():
+        # User indexes and rollups span organizations
+        items = [item for item in items if sharding.unshard_item(item)['organization_id'] == organization_id]
+        for _, cost, count in scan.rows_of(source, items):
+            total += cost
+            usage_count += count
+            if settled_total is not None and source.get('settled'):
+                settled_total[0] += cost
+                settled_total[1] += count
+    scan.count_metrics(invocation)
+    if not scan.complete:
+        return None
+    if settled_total is not None:
+        result_cache.remember(cache_key, [str(settled_total[0]), settled_total[1]], late.through)
+    return total, usage_count
+
+def handle_bulk(event, context):
+    """
+    Costs of many users of one organization over a shared date range.
+
+    The organization is authorized once and the users are queried
+    concurrently, at most QUERY_WORKERS at a time on the shared connection
+    pool. The response lists the totals of every user answered and an error
+    for every other one; users that time ran out for can be asked again.
+    """
+    body = json.loads(event['body']) if event.get('body') else {}
+    for field in ('organization_id', 'start_date', 'end_date'):
+        if not body.get(field):
+            return {
+                'statusCode': 400,
+                'body': json.dumps({
+                    'error': f'Missing required field: {field}'
+                })
+            }
+    user_ids = body.get('user_ids')
+    if not isinstance(user_ids, list) or not user_ids or not all(isinstance(user_id, str) and user_id for user_id in user_ids):
+        return {
+            'statusCode': 400,
+            'body': json.dumps({
+                'error': 'Field user_ids must be a non-empty list of user IDs'
+            })
+        }
+    user_ids = list(dict.fromkeys(user_ids))
+    if len(user_ids) > MAX_BULK_USERS:
+        return {
+            'statusCode': 400,
+            'body': json.dumps({
+                'error': f'Too many users: {len(user_ids)}. The maximum per request is {MAX_BULK_USERS}'
+            })
+        }
+
+    organization_id = body['organization_id']
+    start_date = body['start_date']
+    end_date = body['end_date']
+
+    # Authorize once for every user
+    metrics.set_dimension('organization_id', organization_id)
+    with metrics.stage('auth'):
+        authorized = authorize_request(event, organization_id)
+    if not authorized:
+        return {
+            'statusCode': 403,
+            'body': json.dumps({
+                'error': 'Unauthorized access'
+            })
+        }
+
+    with metrics.stage('plan'):
+        shards = sharding.read_shards(store, organization_id)
+        boundary = result_cache.settled_before()
+        late = result_cache.LateRecords(
+            store, organization_id, shards, start_date, boundary, usage_queries.current_watermark(), shared=True
+        )
+    deadline = usage_queries.deadline_reached(context)
+    invocation = metrics.current()
+
+    def query(user_id):
+        if deadline():
+            return None
         try:
-            response = org_table.query(
-                IndexName='AuthTokenIndex',
-                KeyConditionExpression='auth_token = :token',
-                ExpressionAttributeValues={':token': auth_token}
-            )
-            logger.info(f"DynamoDB query response: {json.dumps(response)}")
+            return user_costs(organization_id, user_id, start_date, end_date, boundary, shards, deadline, late, invocation)
         except Exception as e:
-            logger.error(f"DynamoDB query error: {str(e)}")
-            return False
-
-        # Check if we found a matching organization
-        if not response.get('Items'):
-            logger.error("No organization found for the provided auth token")
-            return False
-
-        # Verify the organization ID matches
-        org = response['Items'][0]
-        logger.info(f"Found organization: {json.dumps(org)}")
-        
-        if org.get('organization_id') != organization_id:
-            logger.error(f"Organization ID mismatch. Expected: {organization_id}, Found: {org.get('organization_id')}")
-            return False
-
-        # Verify the organization is active
-        if org.get('status') != 'active':
-            logger.error("Organization is not active")
-            return False
-
-        logger.info("Authorization successful")
-        return True
+            logger.error(f"Bulk cost query failed for {user_id}: {str(e)}")
+            return e
 
-    except Exception as e:
-        logger.error(f"Error during authorization: {str(e)}")
-        logger.error(f"Full error details: {str(e.__dict__)}")
-        return False
+    with metrics.stage('query'):
+        with ThreadPoolExecutor(max_workers=min(usage_queries.QUERY_WORKERS, len(user_ids))) as executor:
+            outcomes = list(executor.map(query, user_ids))
+
+    users = []
+    errors = []
+    total = Decimal('0')
+    for user_id, outcome in zip(user_ids, outcomes):
+        if outcome is None:
+            errors.append({'user_id': user_id, 'error': 'Query time exhausted; request this user again'})
+        elif isinstance(outcome, Exception):
+            errors.append({'user_id': user_id, 'error': f'Internal server error: {str(outcome)}'})
+        else:
+            total += outcome[0]
+            users.append({'user_id': user_id, 'total_cost': float(outcome[0]), 'usage_count': outcome[1]})
+    metrics.count('users', len(user_ids))
+    metrics.count('failed_users', len(errors))
+
+    with metrics.stage('serialize'):
+        return {
+            'statusCode': 200,
+            'body': json.dumps({
+                'organization_id': organization_id,
+                'start_date': start_date,
+                'end_date': end_date,
+                'total_cost': float(total),
+                'users': users,
+                'errors': errors,
+                'complete': not errors
+            })
+        }
+
+def handle_delta(query_params, context):
+    """
+    The change in a user's cost and usage count for [start_date, end_date]
+    since the watermark of an earlier response, with the watermark to send
+    next time (see usage_queries.delta_sources). Clients add the changes to
+    the totals they keep.
+    """
+    organization_id = query_params['organization_id']
+    user_id = query_params['user_id']
+    start_date = query_params['start_date']
+    end_date = query_params['end_date']
+    try:
+        watermark = usage_queries.parse_watermark(query_params['watermark'])
+    except ValueError:
+        return {
+            'statusCode': 400,
+            'body': json.dumps({
+                'error': 'Invalid watermark'
+            })
+        }
 
+    # A resumed query reads up to the watermark it started with
+    token = query_params.get('continuation_token')
+    try:
+        through = usage_queries.peek_continuation(token)['through'] if token else usage_queries.current_watermark()
+        with metrics.stage('plan'):
+            shards = sharding.read_shards(store, organization_id)
+            sources = usage_queries.delta_sources(
+                'user', user_id, organization_id, start_date, end_date, watermark, through, shards
+            )
+        total = Decimal('0')
+        usage_count = 0
+        cursor = None
+        if token:
+            cursor, partial = usage_queries.decode_continuation(token, sources)
+            total = Decimal(partial['total_cost'])
+            usage_count = int(partial['usage_count'])
+    except (ValueError, KeyError, TypeError, ArithmeticError):
+        return {
+            'statusCode': 400,
+            'body': json.dumps({
+                'error': 'Invalid continuation_token'
+            })
+        }
+
+    scan = usage_queries.UsageScan(
+        sources, store, cursor, usage_queries.deadline_reached(context),
+        max_workers=usage_queries.QUERY_WORKERS if shards > 1 else 1
+    )
+    with metrics.stage('query'):
+        for _, cost, count in scan.rows():
+            total += cost
+            usage_count += count
+
+    stats = scan.count_metrics()
+    logger.info(f"Delta query stats: {json.dumps(stats)}")
+
+    body = {
+        'organization_id': organization_id,
+        'user_id': user_id,
+        'start_date': start_date,
+        'end_date': end_date,
+        'since': watermark
+    }
+    if not scan.complete:
+        partial = {'total_cost': str(total), 'usage_count': usage_count, 'through': through}
+        body['complete'] = False
+        body['continuation_token'] = usage_queries.encode_continuation(sources, scan.cursor(), partial)
+    else:
+        body['watermark'] = max(watermark, through)
+        body['total_cost'] = float(total)
+        body['usage_count'] = usage_count
+        body['complete'] = True
+    return {
+        'statusCode': 200,
+        'body': json.dumps(body)
+    }
+
+@metrics.instrumented('get_costs')
 def lambda_handler(event, context):
     try:
+        if is_bulk_request(event):
+            return handle_bulk(event, context)
+
         # Get query parameters
         query_params = event.get('queryStringParameters', {})
         if not query_params:
@@ -121,7 +297,10 @@ def lambda_handler(event, context):
         end_date = query_params['end_date']
 
         # Authorize the request
-        if not authorize_request(event, organization_id):
+        metrics.set_dimension('organization_id', organization_id)
+        with metrics.stage('auth'):
+            authorized = authorize_request(event, organization_id)
+        if not authorized:
             return {
                 'statusCode': 403,
                 'body': json.dumps({
@@ -129,33 +308,134 @@ def lambda_handler(event, context):
                 })
             }
 
-        # Query DynamoDB for usage data
-        response = table.query(
-            IndexName='UserTimestampIndex',
-            KeyConditionExpression='user_id = :uid AND #ts BETWEEN :start AND :end',
-            ExpressionAttributeNames={'#ts': 'timestamp'},
-            ExpressionAttributeValues={
-                ':uid': user_id,
-                ':start': start_date,
-                ':end': end_date
+        # Delta queries only read what was stored since the client's watermark
+        if 'watermark' in query_params:
+            return handle_delta(query_params, context)
+
+        # Plan the queries: whole hours and days come from rollups when enabled,
+        # and raw ranges are gathered from every write shard of the organization.
+        # The range is split where settled time ends; a resumed query keeps the
+        # split it started with.
+        token = query_params.get('continuation_token')
+        try:
+            resumed = usage_queries.peek_continuation(token)['split'] if token else None
+            boundary = result_cache.settled_before()
+            watermark = usage_queries.current_watermark()
+            if resumed:
+                # A split can only fall on time that is settled by now
+                if not isinstance(resumed['at'], str) or resumed['at'] > boundary:
+                    raise ValueError('Split after the settled boundary')
+                boundary = resumed['at']
+                watermark = resumed.get('watermark')
+        except (ValueError, KeyError, TypeError):
+            return {
+                'statusCode': 400,
+                'body': json.dumps({
+                    'error': 'Invalid continuation_token'
+                })
             }
+        with metrics.stage('plan'):
+            shards = sharding.read_shards(store, organization_id)
+            settled, live = result_cache.plan(
+                'user', user_id, start_date, end_date, boundary, store.has_rollups, ROLLUP_START, shards,
+                organization_id=organization_id
+            )
+            cache_key = result_cache.cache_key('costs', settled, params=organization_id)
+
+        # Settled totals come from the result cache when they can, and are
+        # otherwise summed apart from the live tail so they can be cached
+        total = Decimal('0')
+        usage_count = 0
+        settled_total = None
+        cursor = None
+        if token:
+            try:
+                sources = live if resumed['cached'] else settled + live
+                cursor, partial = usage_queries.decode_continuation(token, sources)
+                total = Decimal(partial['total_cost'])
+                usage_count = int(partial['usage_count'])
+                if not resumed['cached']:
+                    settled_total = [Decimal(resumed['settled'][0]), int(resumed['settled'][1])]
+            except (ValueError, KeyError, TypeError, IndexError, ArithmeticError):
+                return {
+                    'statusCode': 400,
+                    'body': json.dumps({
+                        'error': 'Invalid continuation_token'
+                    })
+                }
+        else:
+            cached = result_cache.lookup(cache_key) if settled else None
+            if cached is not None and result_cache.LateRecords(
+                    store, organization_id, shards, start_date, boundary, watermark).stale(cached[1], user_id):
+                metrics.count('result_cache_stale')
+                cached = None
+            if cached is not None:
+                metrics.count('result_cache_hits')
+                total = Decimal(cached[0][0])
+                usage_count = int(cached[0][1])
+                result_cache.remember(cache_key, cached[0], watermark)
+                sources = live
+            else:
+                if settled:
+                    metrics.count('result_cache_misses')
+                    settled_total = [Decimal('0'), 0]
+                sources = settled + live
+
+        # Sum every page as it arrives, stopping early if time runs short.
+        # Write shards are gathered in parallel.
+        scan = usage_queries.UsageScan(
+            sources, store, cursor, usage_queries.deadline_reached(context),
+            max_workers=usage_queries.QUERY_WORKERS if shards > 1 else 1
         )
+        with metrics.stage('query'):
+            for source, items in scan.item_pages():
+                for _, cost, count in scan.rows_of(source, items):
+                    total += cost
+                    usage_count += count
+                    if settled_total is not None and source.get('settled'):
+                        settled_total[0] += cost
+                        settled_total[1] += count
 
-        # Calculate total cost
-        total_cost = sum(float(item['total_cost']) for item in response['Items'])
-        usage_count = len(response['Items'])
+        stats = scan.count_metrics()
+        logger.info(f"Cost query stats: {json.dumps(stats)}")
 
-        return {
-            'statusCode': 200,
-            'body': json.dumps({
+        if not scan.complete:
+            partial = {
+                'total_cost': str(total),
+                'usage_count': usage_count,
+                'split': {
+                    'at': boundary,
+                    'watermark': watermark,
+                    'cached': settled_total is None,
+                    'settled': [str(settled_total[0]), settled_total[1]] if settled_total is not None else None
+                }
+            }
+            return {
+                'statusCode': 200,
+                'body': json.dumps({
+                    'organization_id': organization_id,
+                    'user_id': user_id,
+                    'start_date': start_date,
+                    'end_date': end_date,
+                    'complete': False,
+                    'continuation_token': usage_queries.encode_continuation(sources, scan.cursor(), partial)
+                })
+            }
+
+        # Totals resumed from a token of an older version have no watermark
+        if settled_total is not None and watermark:
+            result_cache.remember(cache_key, [str(settled_total[0]), settled_total[1]], watermark)
+
+        with metrics.stage('serialize'):
+            return result_cache.respond(event, {
                 'organization_id': organization_id,
                 'user_id': user_id,
                 'start_date': start_date,
                 'end_date': end_date,
-                'total_cost': total_cost,
-                'usage_count': usage_count
-            })
-        }
+                'total_cost': float(total),
+                'usage_count': usage_count,
+                'complete': True
+            }, settled=not live)
 
     except Exception as e:
         logger.error(f"Error: {str(e)}")
@@ -1,97 +1,265 @@
 import json
-import boto3
 import os
-from datetime import datetime, timezone
 import logging
-from decimal import Decimal
-from boto3.dynamodb.conditions import Key, Attr
+from datetime import datetime, timedelta
+
+from auth import authorize_request, org_table_name
+import aggregation
+import bootstrap
+import metrics
+import pricing
+import raw_export
+import result_cache
+import sharding
+import storage
+import usage_queries
+from sketches import TOP_K, UsageSketch
 
 # Initialize logging
 logger = logging.getLogger()
-logger.setLevel(logging.INFO)
+logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO'))
 
-# Initialize DynamoDB client
-region = os.environ.get('AWS_DEFAULT_REGION', 'us-east-1')
-dynamodb = boto3.resource('dynamodb', region_name=region)
+# Storage, connected on first use. Parallel scans share the connection
+# pool, so it is sized for every query worker.
+bootstrap.reserve_connections(usage_queries.QUERY_WORKERS)
 table_name = os.environ.get('DYNAMODB_TABLE', 'chatgpt_usage_tracking')
-org_table_name = os.environ.get('ORG_TABLE_NAME', 'chatgpt_organizations')
-table = dynamodb.Table(table_name)
-org_table = dynamodb.Table(org_table_name)
 
-def authorize_request(event, organization_id):
+# Pre-aggregated rollups are used when a rollup table is configured.
+# Buckets before ROLLUP_START (when the stream consumer was deployed) are read raw.
+rollup_table_name = os.environ.get('ROLLUP_TABLE_NAME')
+ROLLUP_START = os.environ.get('ROLLUP_START') or None
+store = storage.open_storage(table_name, org_table_name, rollup_table_name)
+
+# Daily usage sketches are kept with the rollups from SKETCH_START on (when the
+# sketching consumer was deployed). Earlier days are sketched from raw records.
+SKETCH_START = os.environ.get('SKETCH_START') or None
+DEFAULT_PERCENTILES = '50,90,99'
+DEFAULT_TOP = 10
+
+def is_stats_request(event):
+    """Return True when the event was routed to GET /organization-stats."""
+    path = event.get('resource') or event.get('path') or ''
+    return path.rstrip('/').endswith('/organization-stats')
+
+def parse_percentiles(value):
+    """Percentiles from a comma-separated parameter. Raises ValueError."""
+    percentiles = [float(part) for part in (value or DEFAULT_PERCENTILES).split(',') if part.strip()]
+    if not percentiles or not all(0 < percentile < 100 for percentile in percentiles):
+        raise ValueError('percentiles must be numbers between 0 and 100')
+    return percentiles
+
+def shift_day(day, days):
+    return (datetime.strptime(day, '%Y-%m-%d') + timedelta(days=days)).strftime('%Y-%m-%d')
+
+def first_sketched_day(sketch_start):
+    """Earliest day whose records all went into its stored sketch."""
+    if not sketch_start:
+        return None
+    return sketch_start if len(sketch_start) == 10 else shift_day(sketch_start[:10], 1)
+
+def add_raw_records(sketch, items):
+    for item in items:
+        user_id = item['user_id']
+        if item.get('write_shard'):
+            user_id = sharding.base_key(user_id, int(item['write_shard']))
+        sketch.add(user_id, item.get('model_name', 'unknown'), pricing.to_nanos(item['total_cost']))
+
+def handle_stats(organization_id, query_params):
     """
-    Validate the auth token against the organization ID.
-    Returns True if authorized, False otherwise.
+    Distinct users, cost percentiles and top spenders of an organization over
+    whole UTC days, merged from daily usage sketches. Estimates carry their
+    error bounds (see sketches).
     """
     try:
-        # Log the full event for debugging
-        logger.info(f"Full event: {json.dumps(event)}")
-        
-        # Get the Authorization header
-        headers = event.get('headers', {})
-        logger.info(f"Headers received: {json.dumps(headers)}")
-        
-        if not headers:
-            logger.error("No headers present")
-            return False
-
-        # Handle different possible header key formats
-        auth_header = None
-        for key in headers:
-            if key.lower() == 'authorization' or key.lower() == '"authorization"':
-                auth_header = headers[key]
-                break
-
-        if not auth_header:
-            logger.error("No Authorization header present")
-            return False
-
-        # Clean up the auth token - remove quotes and extra spaces
-        auth_token = auth_header.replace('"', '').strip()
-        if auth_token.lower().startswith('bearer '):
-            auth_token = auth_token[7:].strip()
-
-        logger.info(f"Cleaned auth token: {auth_token}")
-        logger.info(f"Organization table name: {org_table_name}")
-
-        # Query the organization table using the auth token index
-        try:
-            response = org_table.query(
-                IndexName='AuthTokenIndex',
-                KeyConditionExpression='auth_token = :token',
-                ExpressionAttributeValues={':token': auth_token}
+        first_day = datetime.strptime(query_params['start_date'][:10], '%Y-%m-%d').strftime('%Y-%m-%d')
+        last_day = datetime.strptime(query_params['end_date'][:10], '%Y-%m-%d').strftime('%Y-%m-%d')
+        percentiles = parse_percentiles(query_params.get('percentiles'))
+        top = int(query_params.get('top', DEFAULT_TOP))
+        if first_day > last_day:
+            raise ValueError('start_date must not be after end_date')
+        if not 1 <= top <= TOP_K:
+            raise ValueError(f'top must be between 1 and {TOP_K}')
+    except ValueError as e:
+        return {
+            'statusCode': 400,
+            'body': json.dumps({
+                'error': str(e)
+            })
+        }
+
+    sketch = UsageSketch()
+    raw_last = last_day
+    with metrics.stage('query'):
+        if store.has_rollups:
+            sketched_from = max(first_day, first_sketched_day(SKETCH_START) or first_day)
+            for day, data in store.usage_sketches(organization_id, sketched_from, last_day):
+                sketch.merge(UsageSketch.from_bytes(data))
+            raw_last = min(last_day, shift_day(sketched_from, -1))
+        if raw_last >= first_day:
+            # Days without stored sketches are sketched from raw records
+            sources = usage_queries.build_sources(
+                'organization', organization_id, first_day, f'{raw_last}T24',
+                shards=sharding.read_shards(store, organization_id)
             )
-            logger.info(f"DynamoDB query response: {json.dumps(response)}")
-        except Exception as e:
-            logger.error(f"DynamoDB query error: {str(e)}")
-            return False
-
-        # Check if we found a matching organization
-        if not response.get('Items'):
-            logger.error("No organization found for the provided auth token")
-            return False
-
-        # Verify the organization ID matches
-        org = response['Items'][0]
-        logger.info(f"Found organization: {json.dumps(org)}")
-        
-        if org.get('organization_id') != organization_id:
-            logger.error(f"Organization ID mismatch. Expected: {organization_id}, Found: {org.get('organization_id')}")
-            return False
-
-        # Verify the organization is active
-        if org.get('status') != 'active':
-            logger.error("Organization is not active")
-            return False
-
-        logger.info("Authorization successful")
-        return True
+            scan = usage_queries.UsageScan(sources, store, max_workers=usage_queries.QUERY_WORKERS)
+            for source, items in scan.item_pages():
+                add_raw_records(sketch, items)
+            scan.count_metrics()
 
-    except Exception as e:
-        logger.error(f"Error during authorization: {str(e)}")
-        logger.error(f"Full error details: {str(e.__dict__)}")
-        return False
+    with metrics.stage('serialize'):
+        top_users, top_models = sketch.top_spenders(top)
+        response_body = json.dumps({
+            'organization_id': organization_id,
+            'start_date': first_day,
+            'end_date': last_day,
+            'usage_count': sketch.count,
+            'total_organization_cost': float(pricing.to_decimal(sketch.cost_nanos)),
+            'distinct_users': round(sketch.users.estimate()),
+            'distinct_users_relative_error': round(sketch.users.relative_error(), 4),
+            'cost_percentiles': [
+                {
+                    'percentile': percentile,
+                    'cost': sketch.costs.quantile(percentile / 100),
+                    'rank_error': round(sketch.costs.rank_error(percentile / 100), 6)
+                }
+                for percentile in percentiles
+            ],
+            'top_users': [
+                {'user_id': user_id, 'total_cost': float(pricing.to_decimal(nanos))} for user_id, nanos in top_users
+            ],
+            'top_models': [
+                {'model_name': model_name, 'total_cost': float(pricing.to_decimal(nanos))} for model_name, nanos in top_models
+            ],
+            # Top spender costs may be overstated by up to this much, never understated
+            'top_cost_max_overestimate': float(pricing.to_decimal(round(sketch.spend.error(sketch.cost_nanos))))
+        })
+    return {
+        'statusCode': 200,
+        'body': response_body
+    }
 
+def handle_export(event, organization_id, query_params, context):
+    """
+    One part of an NDJSON export of the raw records of an organization, or
+    of the user named by user_id, in [start_date, end_date] (see raw_export).
+    The X-Export-Cursor header continues it; the last part has none.
+    """
+    compress = raw_export.accepts_gzip(event)
+    with metrics.stage('plan'):
+        sources = raw_export.export_sources(
+            organization_id, query_params['start_date'], query_params['end_date'],
+            sharding.read_shards(store, organization_id), query_params.get('user_id')
+        )
+    token = query_params.get('cursor')
+    try:
+        cursor, exported = raw_export.decode_cursor(token, sources) if token else (None, 0)
+    except ValueError:
+        return {
+            'statusCode': 400,
+            'body': json.dumps({
+                'error': 'Invalid cursor'
+            })
+        }
+
+    with metrics.stage('query'):
+        body, records, scan = raw_export.export(
+            sources, store, organization_id, cursor, usage_queries.deadline_reached(context), compress
+        )
+    exported += records
+    scan.count_metrics()
+    metrics.count('exported_records', records)
+    logger.info(f"Export stats: {json.dumps(dict(scan.stats(), records=records, bytes=len(body)))}")
+
+    with metrics.stage('serialize'):
+        token = None if scan.complete else raw_export.encode_cursor(sources, scan, exported)
+        return raw_export.response(body, records, exported, token, compress)
+
+def add_groups(report, dimensions, costs):
+    """Add the total and the groups, costliest first, to a report."""
+    report['total_organization_cost'] = float(costs.total_cost())
+    if dimensions == ('user',):
+        report['total_users'] = len(costs)
+        report['user_costs'] = costs.rows()
+    else:
+        report['group_by'] = list(dimensions)
+        report['total_groups'] = len(costs)
+        report['groups'] = costs.rows()
+    return report
+
+def handle_delta(organization_id, dimensions, query_params, context):
+    """
+    The change in an organization's grouped costs for [start_date, end_date]
+    since the watermark of an earlier response, with the watermark to send
+    next time (see usage_queries.delta_sources). Only groups that changed are
+    listed; clients add them to the totals they keep.
+    """
+    start_date = query_params['start_date']
+    end_date = query_params['end_date']
+    try:
+        watermark = usage_queries.parse_watermark(query_params['watermark'])
+    except ValueError:
+        return {
+            'statusCode': 400,
+            'body': json.dumps({
+                'error': 'Invalid watermark'
+            })
+        }
+
+    # A resumed query reads up to the watermark it started with
+    token = query_params.get('continuation_token')
+    costs = aggregation.GroupedCosts(dimensions)
+    try:
+        through = usage_queries.peek_continuation(token)['through'] if token else usage_queries.current_watermark()
+        with metrics.stage('plan'):
+            sources = usage_queries.delta_sources(
+                'organization', organization_id, organization_id, start_date, end_date, watermark, through,
+                sharding.read_shards(store, organization_id)
+            )
+        cursor = None
+        if token:
+            cursor, partial = usage_queries.decode_continuation(token, sources)
+            if partial['group_by'] != list(dimensions):
+                raise ValueError('Continuation token does not match this query')
+            costs.add_partial(partial['groups'])
+    except (ValueError, KeyError, TypeError, ArithmeticError):
+        return {
+            'statusCode': 400,
+            'body': json.dumps({
+                'error': 'Invalid continuation_token'
+            })
+        }
+
+    scan = usage_queries.UsageScan(
+        sources, store, cursor, usage_queries.deadline_reached(context),
+        max_workers=usage_queries.QUERY_WORKERS
+    )
+    with metrics.stage('query'):
+        for source, items in scan.item_pages():
+            costs.add_page(source, items)
+
+    stats = scan.count_metrics()
+    logger.info(f"Delta query stats: {json.dumps(stats)}")
+
+    report = {
+        'organization_id': organization_id,
+        'start_date': start_date,
+        'end_date': end_date,
+        'since': watermark
+    }
+    if not scan.complete:
+        partial = {'group_by': list(dimensions), 'groups': costs.partial(), 'through': through}
+        report['complete'] = False
+        report['continuation_token'] = usage_queries.encode_continuation(sources, scan.cursor(), partial)
+    else:
+        report['watermark'] = max(watermark, through)
+        add_groups(report, dimensions, costs)
+        report['complete'] = True
+    return {
+        'statusCode': 200,
+        'body': json.dumps(report)
+    }
+
+@metrics.instrumented('get_org_costs')
 def lambda_handler(event, context):
     try:
         # Get query parameters
@@ -119,8 +287,22 @@ def lambda_handler(event, context):
         start_date = query_params['start_date']
         end_date = query_params['end_date']
 
+        # Costs are grouped by user unless group_by names other dimensions
+        try:
+            dimensions = aggregation.parse_group_by(query_params.get('group_by'))
+        except ValueError as e:
+            return {
+                'statusCode': 400,
+                'body': json.dumps({
+                    'error': str(e)
+                })
+            }
+
         # Authorize the request
-        if not authorize_request(event, organization_id):
+        metrics.set_dimension('organization_id', organization_id)
+        with metrics.stage('auth'):
+            authorized = authorize_request(event, organization_id)
+        if not authorized:
             return {
                 'statusCode': 403,
                 'body': json.dumps({
@@ -128,61 +310,134 @@ def lambda_handler(event, context):
                 })
             }
 
-        # Query DynamoDB for usage data
-        response = table.query(
-            IndexName='OrgTimestampIndex',
-            KeyConditionExpression='organization_id = :oid AND #ts BETWEEN :start AND :end',
-            ExpressionAttributeNames={'#ts': 'timestamp'},
-            ExpressionAttributeValues={
-                ':oid': organization_id,
-                ':start': start_date,
-                ':end': end_date
+        if is_stats_request(event):
+            return handle_stats(organization_id, query_params)
+        if raw_export.is_export_request(event):
+            return handle_export(event, organization_id, query_params, context)
+
+        # Delta queries only read what was stored since the client's watermark
+        if 'watermark' in query_params:
+            return handle_delta(organization_id, dimensions, query_params, context)
+
+        # Plan the queries: whole hours and days come from rollups when enabled,
+        # and raw ranges are gathered from every write shard of the organization.
+        # The range is split where settled time ends; a resumed query keeps the
+        # split it started with.
+        token = query_params.get('continuation_token')
+        try:
+            resumed = usage_queries.peek_continuation(token)['split'] if token else None
+            boundary = result_cache.settled_before()
+            watermark = usage_queries.current_watermark()
+            if resumed:
+                # A split can only fall on time that is settled by now
+                if not isinstance(resumed['at'], str) or resumed['at'] > boundary:
+                    raise ValueError('Split after the settled boundary')
+                boundary = resumed['at']
+                watermark = resumed.get('watermark')
+        except (ValueError, KeyError, TypeError):
+            return {
+                'statusCode': 400,
+                'body': json.dumps({
+                    'error': 'Invalid continuation_token'
+                })
             }
-        )
+        with metrics.stage('plan'):
+            shards = sharding.read_shards(store, organization_id)
+            settled, live = result_cache.plan(
+                'organization', organization_id, start_date, end_date, boundary, store.has_rollups, ROLLUP_START,
+                shards, hourly='hour' in dimensions
+            )
+            cache_key = result_cache.cache_key('organization-costs', settled, params=list(dimensions))
 
-        # Process results by user
-        user_costs = {}
-        for item in response['Items']:
-            user_id = item['user_id']
-            cost = Decimal(str(item['total_cost']))
-            
-            if user_id not in user_costs:
-                user_costs[user_id] = {
-                    'total_cost': cost,
-                    'usage_count': 1
+        # Settled totals come from the result cache when they can, and are
+        # otherwise summed apart from the live tail so they can be cached
+        costs = aggregation.GroupedCosts(dimensions)
+        settled_costs = None
+        cursor = None
+        if token:
+            try:
+                sources = live if resumed['cached'] else settled + live
+                cursor, partial = usage_queries.decode_continuation(token, sources)
+                if partial['group_by'] != list(dimensions):
+                    raise ValueError('Continuation token does not match this query')
+                costs.add_partial(partial['groups'])
+                if not resumed['cached']:
+                    settled_costs = aggregation.GroupedCosts(dimensions)
+                    settled_costs.add_partial(resumed['settled'])
+            except (ValueError, KeyError, TypeError, ArithmeticError):
+                return {
+                    'statusCode': 400,
+                    'body': json.dumps({
+                        'error': 'Invalid continuation_token'
+                    })
                 }
+        else:
+            cached = result_cache.lookup(cache_key) if settled else None
+            if cached is not None and result_cache.LateRecords(
+                    store, organization_id, shards, start_date, boundary, watermark).stale(cached[1]):
+                metrics.count('result_cache_stale')
+                cached = None
+            if cached is not None:
+                metrics.count('result_cache_hits')
+                costs.add_partial(cached[0])
+                result_cache.remember(cache_key, cached[0], watermark)
+                sources = live
             else:
-                user_costs[user_id]['total_cost'] += cost
-                user_costs[user_id]['usage_count'] += 1
-
-        # Convert to sorted list
-        user_costs_list = [
-            {
-                'user_id': user_id,
-                'total_cost': float(data['total_cost']),
-                'usage_count': data['usage_count']
-            }
-            for user_id, data in user_costs.items()
-        ]
+                if settled:
+                    metrics.count('result_cache_misses')
+                    settled_costs = aggregation.GroupedCosts(dimensions)
+                sources = settled + live
 
-        # Sort by total cost (highest first)
-        user_costs_list.sort(key=lambda x: x['total_cost'], reverse=True)
+        # Aggregate each page as it arrives, stopping early if time runs short.
+        # Large ranges are split into time slices that are queried in parallel.
+        scan = usage_queries.UsageScan(
+            sources, store, cursor, usage_queries.deadline_reached(context),
+            max_workers=usage_queries.QUERY_WORKERS
+        )
+        with metrics.stage('query'):
+            for source, items in scan.item_pages():
+                costs.add_page(source, items)
+                if settled_costs is not None and source.get('settled'):
+                    settled_costs.add_page(source, items)
 
-        # Calculate organization totals
-        total_org_cost = sum(float(data['total_cost']) for data in user_costs.values())
-        total_users = len(user_costs)
+        stats = scan.count_metrics()
+        logger.info(f"Cost query stats: {json.dumps(stats)}")
 
-        return {
-            'statusCode': 200,
-            'body': json.dumps({
+        if not scan.complete:
+            partial = {
+                'group_by': list(dimensions),
+                'groups': costs.partial(),
+                'split': {
+                    'at': boundary,
+                    'watermark': watermark,
+                    'cached': settled_costs is None,
+                    'settled': settled_costs.partial() if settled_costs is not None else None
+                }
+            }
+            return {
+                'statusCode': 200,
+                'body': json.dumps({
+                    'organization_id': organization_id,
+                    'start_date': start_date,
+                    'end_date': end_date,
+                    'complete': False,
+                    'continuation_token': usage_queries.encode_continuation(sources, scan.cursor(), partial)
+                })
+            }
+
+        # Totals resumed from a token of an older version have no watermark
+        if settled_costs is not None and watermark:
+            result_cache.remember(cache_key, settled_costs.partial(), watermark)
+
+        with metrics.stage('serialize'):
+            # Groups sorted by total cost (highest first)
+            report = add_groups({
                 'organization_id': organization_id,
                 'start_date': start_date,
-                'end_date': end_date,
-                'total_organization_cost': total_org_cost,
-                'total_users': total_users,
-                'user_costs': user_costs_list
-            })
-        }
+                'end_date': end_date
+            }, dimensions, costs)
+            report['complete'] = True
+            return result_cache.respond(event, report, settled=not live)
 
     except Exception as e:
         logger.error(f"Error: {str(e)}")
@@ -0,0 +1,224 @@
+"""
+Queues for asynchronous usage ingestion.
+
+In async mode POST /track validates a record, puts it on a queue and returns
+202. ingest_worker drains the queue in large batches. Every queue offers the
+same small interface:
+
+    send(body)                  enqueue one JSON-serializable message, return its id
+    send_batch(bodies)          enqueue several messages, return their ids in
+                                order, None for a message that was not sent
+    receive(max_messages)       take up to max_messages visible messages, each a
+                                dict with 'id', 'receipt', 'body' and 'receive_count'
+    delete(receipts)            acknowledge processed messages
+    release(receipts)           make unprocessed messages visible again
+
+SQSQueue is used in AWS. There, the worker is driven by an SQS event source
+mapping, and messages that keep failing are moved to the dead-letter queue by
+the queue's redrive policy. MemoryQueue and FileQueue are local stand-ins for
+tests and development. They emulate the redrive with `max_receives` and a
+`dead_letters` queue.
+"""
+import itertools
+import json
+import logging
+import os
+import threading
+import uuid
+
+import bootstrap
+
+# Initialize logging
+logger = logging.getLogger()
+
+# SendMessageBatch accepts at most 10 entries
+SQS_BATCH_LIMIT = 10
+
+
+class SQSQueue:
+    """Amazon SQS queue, using the shared client unless one is given."""
+
+    def __init__(self, queue_url, client=None):
+        self.queue_url = queue_url
+        self._client = client
+
+    @property
+    def client(self):
+        return self._client or bootstrap.client('sqs')
+
+    def send(self, body):
+        response = self.client.send_message(QueueUrl=self.queue_url, MessageBody=json.dumps(body, default=str))
+        return response['MessageId']
+
+    def send_batch(self, bodies):
+        bodies = list(bodies)
+        message_ids = [None] * len(bodies)
+        for start in range(0, len(bodies), SQS_BATCH_LIMIT):
+            chunk = bodies[start:start + SQS_BATCH_LIMIT]
+            try:
+                response = self.client.send_message_batch(QueueUrl=self.queue_url, Entries=[
+                    {'Id': str(n), 'MessageBody': json.dumps(body, default=str)}
+                    for n, body in enumerate(chunk)
+                ])
+            except Exception as e:
+                logger.error(f"Failed to send {len(chunk)} messages: {str(e)}")
+                continue
+            for entry in response.get('Successful', []):
+                message_ids[start + int(entry['Id'])] = entry['MessageId']
+            for entry in response.get('Failed', []):
+                logger.error(f"Failed to send a message: {entry.get('Code')} {entry.get('Message')}")
+        return message_ids
+
+    def receive(self, max_messages=SQS_BATCH_LIMIT, wait_seconds=0):
+        response = self.client.receive_message(
+            QueueUrl=self.queue_url,
+            MaxNumberOfMessages=min(max_messages, SQS_BATCH_LIMIT),
+            WaitTimeSeconds=wait_seconds,
+            AttributeNames=['ApproximateReceiveCount']
+        )
+        return [
+            {
+                'id': message['MessageId'],
+                'receipt': message['ReceiptHandle'],
+                'body': message['Body'],
+                'receive_count': int(message.get('Attributes', {}).get('ApproximateReceiveCount', 1))
+            }
+            for message in response.get('Messages', [])
+        ]
+
+    def delete(self, receipts):
+        receipts = list(receipts)
+        for start in range(0, len(receipts), SQS_BATCH_LIMIT):
+            self.client.delete_message_batch(QueueUrl=self.queue_url, Entries=[
+                {'Id': str(n), 'ReceiptHandle': receipt}
+                for n, receipt in enumerate(receipts[start:start + SQS_BATCH_LIMIT])
+            ])
+
+    def release(self, receipts):
+        receipts = list(receipts)
+        for start in range(0, len(receipts), SQS_BATCH_LIMIT):
+            self.client.change_message_visibility_batch(QueueUrl=self.queue_url, Entries=[
+                {'Id': str(n), 'ReceiptHandle': receipt, 'VisibilityTimeout': 0}
+                for n, receipt in enumerate(receipts[start:start + SQS_BATCH_LIMIT])
+            ])
+
+
+class MemoryQueue:
+    """
+    In-process queue. A message received `max_receives` times without being
+    deleted is moved to `dead_letters` on its next release, like an SQS
+    redrive policy.
+    """
+
+    def __init__(self, max_receives=5, dead_letters=None):
+        self.max_receives = max_receives
+        self.dead_letters = dead_letters
+        self._messages = {}
+        self._visible = []
+        self._in_flight = {}
+        self._receipts = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        """Messages not yet deleted, visible or in flight."""
+        with self._lock:
+            return len(self._messages)
+
+    def _enqueue(self, message_id, body, receive_count=0):
+        self._messages[message_id] = {'id': message_id, 'body': body, 'receive_count': receive_count}
+        self._visible.append(message_id)
+
+    def send(self, body):
+        message_id = str(uuid.uuid4())
+        with self._lock:
+            self._enqueue(message_id, json.dumps(body, default=str))
+        return message_id
+
+    def send_batch(self, bodies):
+        return [self.send(body) for body in bodies]
+
+    def receive(self, max_messages=SQS_BATCH_LIMIT, wait_seconds=0):
+        with self._lock:
+            taken, self._visible = self._visible[:max_messages], self._visible[max_messages:]
+            messages = []
+            for message_id in taken:
+                message = self._messages[message_id]
+                message['receive_count'] += 1
+                receipt = f'{message_id}:{next(self._receipts)}'
+                self._in_flight[receipt] = message_id
+                messages.append(dict(message, receipt=receipt))
+            return messages
+
+    def delete(self, receipts):
+        with self._lock:
+            for receipt in receipts:
+                message_id = self._in_flight.pop(receipt, None)
+                if message_id is not None:
+                    self._messages.pop(message_id, None)
+
+    def release(self, receipts):
+        redriven = []
+        with self._lock:
+            for receipt in receipts:
+                message_id = self._in_flight.pop(receipt, None)
+                if message_id is None:
+                    continue
+                message = self._messages[message_id]
+                if self.dead_letters is not None and message['receive_count'] >= self.max_receives:
+                    del self._messages[message_id]
+                    redriven.append(message)
+                else:
+                    self._visible.append(message_id)
+        for message in redriven:
+            self.dead_letters.send(json.loads(message['body']))
+
+
+class FileQueue(MemoryQueue):
+    """
+    MemoryQueue persisted to a JSON-lines log, so pending messages survive a
+    restart. Sends and deletes are appended to the log. Messages in flight
+    when the process stopped become visible again when the queue is reopened.
+    """
+
+    def __init__(self, path, max_receives=5, dead_letters=None):
+        super().__init__(max_receives, dead_letters)
+        self.path = path
+        if os.path.exists(path):
+            with open(path) as log:
+                for line in log:
+                    entry = json.loads(line)
+                    if entry['op'] == 'send':
+                        self._enqueue(entry['id'], entry['body'])
+                    elif entry['id'] in self._messages:
+                        del self._messages[entry['id']]
+                        self._visible.remove(entry['id'])
+
+    def _append(self, entries):
+        with open(self.path, 'a') as log:
+            for entry in entries:
+                log.write(json.dumps(entry) + '\n')
+
+    def send(self, body):
+        message_id = str(uuid.uuid4())
+        with self._lock:
+            self._enqueue(message_id, json.dumps(body, default=str))
+            self._append([{'op': 'send', 'id': message_id, 'body': self._messages[message_id]['body']}])
+        return message_id
+
+    def delete(self, receipts):
+        receipts = list(receipts)
+        with self._lock:
+            gone = [self._in_flight[receipt] for receipt in receipts if receipt in self._in_flight]
+            self._append([{'op': 'delete', 'id': message_id} for message_id in gone])
+        super().delete(receipts)
+
+    def release(self, receipts):
+        receipts = list(receipts)
+        with self._lock:
+            redriven = [
+                self._in_flight[receipt] for receipt in receipts
+                if receipt in self._in_flight and self.dead_letters is not None
+                and self._messages[self._in_flight[receipt]]['receive_count'] >= self.max_receives
+            ]
+            self._append([{'op': 'delete', 'id': message_id} for message_id in redriven])
+        super().release(receipts)
@@ -0,0 +1,183 @@
+import json
+import os
+import logging
+import random
+
+import ingest_queue
+import lambda_function
+import metrics
+import pricing
+import sharding
+from batch_write import INVALID_ITEM_ERROR
+
+# Initialize logging
+logger = logging.getLogger()
+logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO'))
+
+# Dead-letter queue for records that can never be stored
+INGEST_DLQ_URL = os.environ.get('INGEST_DLQ_URL', '')
+dead_letters = ingest_queue.SQSQueue(INGEST_DLQ_URL) if INGEST_DLQ_URL else None
+
+# Messages taken per receive by drain()
+DRAIN_BATCH_SIZE = int(os.environ.get('DRAIN_BATCH_SIZE', '1000'))
+
+def process_messages(messages, dead_letter_queue=None):
+    """
+    Price and store a batch of queued usage records.
+
+    `messages` are dicts with 'id', 'body' and optionally 'receive_count'.
+    Every valid record is priced in one pass and written with one batch
+    write, on the write shard it was queued with. Records that fail
+    validation, or that can't be serialized for the table, are sent to
+    `dead_letter_queue` with the reason and count as handled; the rest of
+    the batch is stored as usual. Records whose write failed are returned
+    so they are delivered again.
+    Returns (stored, dead_lettered, failed_ids).
+    """
+    entries = []
+    dead = []
+    with metrics.stage('parse'):
+        for message in messages:
+            try:
+                body = json.loads(message['body'])
+                record, error = lambda_function.parse_usage_record(body['record'])
+            except (TypeError, ValueError, KeyError) as e:
+                body, record, error = message['body'], None, f'Malformed message: {str(e)}'
+            if not error and not _valid_shard(body.get('write_shard', 0)):
+                error = f"Invalid write_shard: {body['write_shard']}"
+            if error:
+                dead.append({'message_id': message['id'], 'error': error, 'message': body})
+            else:
+                entries.append((message['id'], body, record))
+
+    with metrics.stage('pricing'):
+        costs = pricing.price_many([record for _, _, record in entries])
+        built = []
+        for entry, nanos in zip(entries, costs):
+            message_id, body, record = entry
+            try:
+                built.append((entry, lambda_function.build_item(record, pricing.to_decimal(nanos), body['record_id'])))
+            except (TypeError, ValueError, ArithmeticError) as e:
+                dead.append({'message_id': message_id, 'error': f'Invalid record: {str(e)}', 'message': body})
+        entries = [entry for entry, _ in built]
+        items = [item for _, item in built]
+
+    # The track handler picked the write shard when it queued the record, so
+    # every delivery of a message is written to the same key.
+    with metrics.stage('write'):
+        sharded = [
+            sharding.item_on_shard(item, _message_shard(body, item))
+            for (_, body, _), item in zip(entries, items)
+        ]
+
+        # A message delivered again may already have been stored by an attempt
+        # that didn't get to delete it. Such records are left as they are, so
+        # they keep their ingest_key and delta queries don't count them twice.
+        # The same record twice in one batch is written once: a batch write
+        # can't hold two requests for one key.
+        redelivered = {message['id'] for message in messages if message.get('receive_count', 1) > 1}
+        first = {}
+        for index, item in enumerate(sharded):
+            first.setdefault((item['organization_id'], item['record_id']), index)
+        pending = [
+            index for index, ((message_id, _, _), item) in enumerate(zip(entries, sharded))
+            if first[(item['organization_id'], item['record_id'])] == index
+            and (message_id not in redelivered
+                 or lambda_function.store.get_usage(item['organization_id'], item['record_id']) is None)
+        ]
+        write_errors = [None] * len(sharded)
+        errors = lambda_function.store.put_usage_batch(
+            [sharded[index] for index in pending], max_workers=lambda_function.BATCH_WRITE_WORKERS
+        )
+        for index, error in zip(pending, errors):
+            write_errors[index] = error
+        # Duplicates share the outcome of their first copy
+        for index, item in enumerate(sharded):
+            write_errors[index] = write_errors[first[(item['organization_id'], item['record_id'])]]
+
+    # An item the table can't take fails the same way on every delivery
+    failed_ids = []
+    for (message_id, body, _), error in zip(entries, write_errors):
+        if error and error.startswith(INVALID_ITEM_ERROR):
+            dead.append({'message_id': message_id, 'error': error, 'message': body})
+        elif error:
+            logger.error(f"Write failed for queued record {message_id}: {error}")
+            failed_ids.append(message_id)
+
+    for entry in dead:
+        if dead_letter_queue is None:
+            logger.error(f"Dropping queued record {entry['message_id']}: {entry['error']}")
+            continue
+        try:
+            dead_letter_queue.send(entry)
+        except Exception as e:
+            logger.error(f"Dead-letter send failed for {entry['message_id']}: {str(e)}")
+            failed_ids.append(entry['message_id'])
+
+    stored = sum(1 for error in write_errors if not error)
+    return stored, len(dead), failed_ids
+
+def _valid_shard(shard):
+    return isinstance(shard, int) and not isinstance(shard, bool) and shard >= 0
+
+def _message_shard(body, item):
+    """
+    The write shard a message was queued with. Messages queued before the
+    shard was part of the message get it from their record id.
+    """
+    if 'write_shard' in body:
+        return body['write_shard']
+    shards = sharding.write_shards_for(lambda_function.store, item['organization_id'], 1)
+    return sharding.pick_shard(shards, random.Random(item['record_id']))
+
+def drain(queue, dead_letter_queue=None, batch_size=DRAIN_BATCH_SIZE, max_batches=None):
+    """
+    Process messages from a local queue until it is empty.
+    Stored and dead-lettered messages are deleted, failed ones released for
+    another attempt. Returns the summed counts.
+    """
+    totals = {'stored': 0, 'dead_lettered': 0, 'failed': 0}
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        messages = queue.receive(batch_size)
+        if not messages:
+            break
+        batches += 1
+        stored, dead_lettered, failed_ids = process_messages(messages, dead_letter_queue)
+        failed_ids = set(failed_ids)
+        queue.delete([message['receipt'] for message in messages if message['id'] not in failed_ids])
+        queue.release([message['receipt'] for message in messages if message['id'] in failed_ids])
+        totals['stored'] += stored
+        totals['dead_lettered'] += dead_lettered
+        totals['failed'] += len(failed_ids)
+    return totals
+
+@metrics.instrumented('ingest_worker')
+def lambda_handler(event, context):
+    """
+    Drain a batch of SQS messages from the ingest queue.
+    Returns a partial batch response so only the failed records are retried;
+    the queue's redrive policy dead-letters those that keep failing.
+    """
+    messages = [
+        {
+            'id': record['messageId'],
+            'body': record['body'],
+            'receive_count': int(record.get('attributes', {}).get('ApproximateReceiveCount', 1))
+        }
+        for record in event.get('Records', [])
+    ]
+    stored, dead_lettered, failed_ids = process_messages(messages, dead_letters)
+    metrics.count('records', len(messages))
+    metrics.count('dead_lettered', dead_lettered)
+    metrics.count('failed_records', len(failed_ids))
+
+    logger.info({
+        'action': 'usage_ingest',
+        'records': len(messages),
+        'stored': stored,
+        'dead_lettered': dead_lettered,
+        'failed': len(failed_ids)
+    })
+
+    return {'batchItemFailures': [{'itemIdentifier': message_id} for message_id in failed_ids]}
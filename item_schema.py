@@ -0,0 +1,240 @@
+"""
+Compact DynamoDB items for usage records.
+
+DynamoDB bills reads, writes and storage by item size, and attribute names
+count towards it. Every record is written to the base table and to each GSI
+that projects it. With COMPACT_ITEMS enabled, DynamoDBStorage stores records
+as compact items:
+
+    organization_id, record_id, user_id, timestamp, ingest_key
+        unchanged; they are table and index keys
+    expires_at
+        unchanged; it is the table's TTL (see retention)
+    c   total_cost as integer nano-dollars (see pricing)
+    m   model_name
+    s   write_shard, only on sharded records
+    t   ts, only when it can't be read from a ULID record_id
+    x   the record's extra fields, as a map
+
+Extra fields are the ones a client sends beyond the schema. Only those named
+in EXTRA_FIELDS are stored ('*' allows any), up to EXTRA_FIELDS_MAX_BYTES of
+them; the rest are dropped. This applies to every record, compact or not.
+
+expand_item() turns a compact item back into the usual record, and leaves
+records written before this change as they are, so readers handle both.
+migrate_compact_items.py converts existing records. Slim GSIs, which
+project only INDEX_ATTRIBUTES, the attributes the cost queries aggregate,
+can then replace the usage GSIs that hold whole items. A GSI's projection
+can't be changed, so each is added under a new name (SLIM_INDEX_NAMES), and
+readers query it once SLIM_INDEXES includes the index it replaces.
+"""
+import math
+import os
+from decimal import Clamped, Context, Decimal, DecimalException, Inexact, Overflow, Rounded, Underflow
+
+import pricing
+import record_keys
+
+COMPACT_ITEMS = os.environ.get('COMPACT_ITEMS', 'false').lower() == 'true'
+EXTRA_FIELDS = [field.strip() for field in os.environ.get('EXTRA_FIELDS', '*').split(',') if field.strip()]
+EXTRA_FIELDS_MAX_BYTES = int(os.environ.get('EXTRA_FIELDS_MAX_BYTES', '1024'))
+
+# Usage GSI -> its replacement projecting only INDEX_ATTRIBUTES (SlimIndexes
+# in template.yaml). Whole records read through one are fetched from the table.
+SLIM_INDEX_NAMES = {
+    'UserTimestampIndex': 'UserTimestampSlimIndex',
+    'OrgTimestampIndex': 'OrgTimestampSlimIndex',
+    'OrgIngestIndex': 'OrgIngestSlimIndex'
+}
+# GSIs whose slim replacements are queried instead (SlimIndexReads)
+_SLIM_INDEX_SETTINGS = {
+    'none': (),
+    'user': ('UserTimestampIndex',),
+    'org': ('UserTimestampIndex', 'OrgTimestampIndex'),
+    'all': ('UserTimestampIndex', 'OrgTimestampIndex', 'OrgIngestIndex')
+}
+SLIM_INDEXES = _SLIM_INDEX_SETTINGS[os.environ.get('SLIM_INDEXES', 'none').lower()]
+
+# The numbers DynamoDB can store, checked the way boto3 serializes them
+_NUMBER_CONTEXT = Context(Emin=-128, Emax=126, prec=38, traps=[Clamped, Overflow, Inexact, Rounded, Underflow])
+
+# Long attribute name -> compact name
+SHORT_NAMES = {'total_cost': 'c', 'model_name': 'm', 'write_shard': 's', 'ts': 't'}
+LONG_NAMES = {short: name for name, short in SHORT_NAMES.items()}
+EXTRA_ATTRIBUTE = 'x'
+
+# Attributes of a record that are not extra fields
+SCHEMA_FIELDS = (
+    'organization_id', 'record_id', 'user_id', 'timestamp', 'ingest_key', 'migrated_from', 'expires_at'
+) + tuple(SHORT_NAMES)
+
+# Key attributes of the usage table and its GSIs
+TABLE_KEYS = ('organization_id', 'record_id')
+INDEX_KEYS = {
+    'OrgTimestampIndex': ('organization_id', 'timestamp'),
+    'UserTimestampIndex': ('user_id', 'timestamp'),
+    'OrgIngestIndex': ('organization_id', 'ingest_key')
+}
+INDEX_KEYS.update({SLIM_INDEX_NAMES[name]: keys for name, keys in list(INDEX_KEYS.items())})
+# Non-key attributes the GSIs project (INCLUDE), in both forms
+INDEX_ATTRIBUTES = ('user_id', 'timestamp', 'total_cost', 'model_name', 'write_shard', 'c', 'm', 's')
+
+# Index projections before and after the GSIs are slimmed; None is ALL
+FULL_PROJECTIONS = {'OrgTimestampIndex': None, 'UserTimestampIndex': None, 'OrgIngestIndex': INDEX_ATTRIBUTES}
+SLIM_PROJECTIONS = {name: INDEX_ATTRIBUTES for name in SLIM_INDEX_NAMES.values()}
+
+# DynamoDB counts this much per item, in the table and in each index
+_ITEM_OVERHEAD_BYTES = 100
+
+
+def index_name(name):
+    """The GSI to query for the usage GSI `name`: its slim replacement once read."""
+    return SLIM_INDEX_NAMES[name] if name in SLIM_INDEXES else name
+
+
+def projects_whole_items(index_name):
+    """Whether a GSI holds whole records rather than INDEX_ATTRIBUTES."""
+    return index_name in FULL_PROJECTIONS and FULL_PROJECTIONS[index_name] is None
+
+
+def is_compact(item):
+    return 'total_cost' not in item and 'c' in item
+
+
+def extra_fields(record, skip=SCHEMA_FIELDS):
+    """
+    The allowed extra fields of `record`, in EXTRA_FIELDS order, within
+    EXTRA_FIELDS_MAX_BYTES. Returns (fields, names of the dropped ones).
+    """
+    candidates = [name for name in record if name not in skip]
+    if '*' not in EXTRA_FIELDS:
+        allowed = [name for name in EXTRA_FIELDS if name in record and name not in skip]
+        dropped = [name for name in candidates if name not in allowed]
+        candidates = allowed
+    else:
+        dropped = []
+    fields = {}
+    size = 0
+    for name in candidates:
+        size += attribute_size(name, record[name])
+        if size > EXTRA_FIELDS_MAX_BYTES:
+            dropped.extend(candidates[len(fields):])
+            break
+        fields[name] = record[name]
+    return fields, dropped
+
+
+def storable(value):
+    """
+    `value` as DynamoDB stores it, with floats as Decimal. Raises ValueError
+    for a value it can't store, such as NaN or a number of over 38 digits.
+    """
+    if value is None or isinstance(value, (bool, str)):
+        return value
+    if isinstance(value, (int, float, Decimal)):
+        try:
+            number = _NUMBER_CONTEXT.create_decimal(str(value) if isinstance(value, float) else value)
+        except DecimalException:
+            raise ValueError(f'{value} is out of the range DynamoDB can store')
+        if not number.is_finite():
+            raise ValueError(f'{value} is not a finite number')
+        return value if isinstance(value, int) else number
+    if isinstance(value, dict):
+        return {str(k): storable(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [storable(v) for v in value]
+    raise ValueError(f'{type(value).__name__} values can not be stored')
+
+
+def compact_item(item):
+    """The compact form of a usage record. Compact items are returned as they are."""
+    if is_compact(item):
+        return item
+    compact = {name: item[name] for name in SCHEMA_FIELDS if name in item and name not in SHORT_NAMES}
+    if 'total_cost' in item:
+        compact['c'] = pricing.to_nanos(item['total_cost'])
+    if item.get('model_name') is not None:
+        compact['m'] = item['model_name']
+    if item.get('write_shard'):
+        compact['s'] = item['write_shard']
+    ts = item.get('ts')
+    if ts is not None and not (record_keys.is_record_id(item['record_id'])
+                               and record_keys.record_id_ms(item['record_id']) == int(ts)):
+        compact['t'] = ts
+    extras, _ = extra_fields(item)
+    if extras:
+        compact[EXTRA_ATTRIBUTE] = extras
+    return compact
+
+
+def expand_item(item):
+    """
+    The usual form of a compact item, or of the attributes a query projected
+    from one. Other items are returned as they are.
+    """
+    if not is_compact(item):
+        return item
+    expanded = {}
+    for name, value in item.items():
+        if name == 'c':
+            expanded['total_cost'] = pricing.to_decimal(int(value))
+        elif name == EXTRA_ATTRIBUTE:
+            expanded.update(value)
+        else:
+            expanded[LONG_NAMES.get(name, name)] = value
+    if 'ts' not in expanded and record_keys.is_record_id(item.get('record_id')):
+        expanded['ts'] = record_keys.record_id_ms(item['record_id'])
+    return expanded
+
+
+def attribute_size(name, value):
+    """Bytes DynamoDB counts for one attribute, its name included."""
+    return len(name.encode('utf-8')) + value_size(value)
+
+
+def value_size(value):
+    if value is None or isinstance(value, bool):
+        return 1
+    if isinstance(value, str):
+        return len(value.encode('utf-8'))
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, (int, float, Decimal)):
+        # Up to 38 significant digits, two per byte, plus one
+        digits = Decimal(str(value)).normalize().as_tuple().digits
+        return math.ceil(len(digits) / 2) + 1
+    if isinstance(value, dict):
+        return 3 + sum(attribute_size(str(k), v) + 1 for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return 3 + sum(value_size(v) + 1 for v in value)
+    if isinstance(value, (set, frozenset)):
+        return sum(value_size(v) for v in value)
+    return len(str(value).encode('utf-8'))
+
+
+def item_size(item):
+    return sum(attribute_size(name, value) for name, value in item.items())
+
+
+def usage_units(item, projections):
+    """
+    (write units, storage bytes) for putting `item` into the usage table and
+    every GSI of `projections` that it belongs to.
+    """
+    size = item_size(item)
+    write_units = max(1, math.ceil(size / 1024))
+    storage = size + _ITEM_OVERHEAD_BYTES
+    for index, keys in INDEX_KEYS.items():
+        if index not in projections or not all(key in item for key in keys):
+            continue
+        projected = projections[index]
+        if projected is None:
+            entry = size
+        else:
+            entry = item_size({
+                name: value for name, value in item.items()
+                if name in keys or name in TABLE_KEYS or name in projected
+            })
+        write_units += max(1, math.ceil(entry / 1024))
+        storage += entry + _ITEM_OVERHEAD_BYTES
+    return write_units, storage
@@ -1,256 +1,482 @@
 import json
-import boto3
-import uuid
 import os
-from datetime import datetime, timezone
 import logging
-from decimal import Decimal
+
+from auth import authorize_request, org_table_name
+import bootstrap
+import ingest_queue
+import item_schema
+import metrics
+import pricing
+import rate_limits
+import record_keys
+import retention
+import sharding
+import storage
+import write_guard
 
 # Initialize logging
 logger = logging.getLogger()
-logger.setLevel(logging.INFO)
+logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO'))
 
-# Initialize DynamoDB client
-region = os.environ.get('AWS_DEFAULT_REGION', 'us-east-1')
-dynamodb = boto3.resource('dynamodb', region_name=region)
+# Usage and organization storage, connected on first use
 table_name = os.environ.get('DYNAMODB_TABLE', 'chatgpt_usage_tracking')
-org_table_name = os.environ.get('ORG_TABLE_NAME', 'chatgpt_organizations')
-table = dynamodb.Table(table_name)
-org_table = dynamodb.Table(org_table_name)
+store = storage.open_storage(table_name, org_table_name)
+
+# Batch ingestion settings
+MAX_BATCH_RECORDS = int(os.environ.get('MAX_BATCH_RECORDS', '5000'))
+BATCH_WRITE_WORKERS = int(os.environ.get('BATCH_WRITE_WORKERS', '8'))
+bootstrap.reserve_connections(BATCH_WRITE_WORKERS)
+
+# Ingest mode: 'sync' stores each record before responding, 'async' queues it
+# for ingest_worker and responds 202
+INGEST_MODE = os.environ.get('INGEST_MODE', 'sync').lower()
+INGEST_QUEUE_URL = os.environ.get('INGEST_QUEUE_URL', '')
+queue = ingest_queue.SQSQueue(INGEST_QUEUE_URL) if INGEST_MODE == 'async' else None
+# In sync mode, records the table throttles past every retry are spilled to
+# the same queue (see write_guard)
+spillover = ingest_queue.SQSQueue(INGEST_QUEUE_URL) if INGEST_QUEUE_URL else None
+
+# Fields consumed by pricing that are not copied onto the stored item
+PRICING_FIELDS = ['input_tokens', 'output_tokens', 'cached_input_tokens', 'reasoning_tokens']
+
+def check_rate_limits(organization_id, records):
+    """
+    Take the requests and tokens of validated `records` from the rate limits
+    of the organization and its users. Returns None when the call may go
+    ahead, or the seconds to wait before retrying.
+    """
+    if not rate_limits.RATE_LIMITING:
+        return None
+    return rate_limits.limiter.acquire(organization_id, rate_usage(records)) or None
+
+def release_rate_limits(organization_id, records):
+    """Give back what check_rate_limits took for `records` that were not stored."""
+    if rate_limits.RATE_LIMITING and records:
+        rate_limits.limiter.release(organization_id, rate_usage(records))
+
+def rate_usage(records):
+    """(requests, tokens) of `records` per user_id."""
+    usage = {}
+    for record in records:
+        requests, tokens = usage.get(record['user_id'], (0, 0))
+        usage[record['user_id']] = (requests + 1, tokens + record['input_tokens'] + record['output_tokens'])
+    return usage
+
+def count_spend(organization_id, records, costs=None):
+    """Count the cost in nano-dollars of `records` towards the monthly spend caps."""
+    if not rate_limits.RATE_LIMITING:
+        return
+    if costs is None:
+        costs = pricing.price_many(records)
+    spend = {}
+    for record, nanos in zip(records, costs):
+        spend[record['user_id']] = spend.get(record['user_id'], 0) + nanos
+    rate_limits.limiter.record_spend(organization_id, spend)
+
+def rate_limited(retry_after):
+    """The 429 response for a call over its limits."""
+    metrics.count('rate_limited', 1)
+    return {
+        'statusCode': 429,
+        'headers': {'Retry-After': str(retry_after)},
+        'body': json.dumps({
+            'error': f'Rate limit exceeded. Retry after {retry_after} seconds'
+        })
+    }
 
-def authorize_request(event, organization_id):
+def saturated_error(retry_after):
+    return f'Usage storage is saturated. Retry after {retry_after} seconds'
+
+def write_saturated(retry_after):
+    """The 503 response for a throttled record that could not be spilled."""
+    return {
+        'statusCode': 503,
+        'headers': {'Retry-After': str(retry_after)},
+        'body': json.dumps({
+            'error': saturated_error(retry_after)
+        })
+    }
+
+def parse_usage_record(body):
     """
-    Validate the auth token against the organization ID.
-    Returns True if authorized, False otherwise.
+    Validate a usage record and convert its token counts.
+    Returns (record, None) on success or (None, error_message) on failure.
     """
+    # Validate required fields
+    required_fields = ['model_name', 'input_tokens', 'output_tokens', 'user_id', 'organization_id']
+    for field in required_fields:
+        if field not in body:
+            return None, f'Missing required field: {field}'
+
+    # Keys and the model name are strings
+    for field in ('model_name', 'user_id', 'organization_id'):
+        if not isinstance(body[field], str) or not body[field]:
+            return None, f'{field} must be a non-empty string'
+
+    record = dict(body)
     try:
-        # Log the full event for debugging
-        logger.info(f"Full event: {json.dumps(event)}")
-        
-        # Get the Authorization header
-        headers = event.get('headers', {})
-        logger.info(f"Headers received: {json.dumps(headers)}")
-        
-        if not headers:
-            logger.error("No headers present")
-            return False
-
-        # Handle different possible header key formats
-        auth_header = None
-        for key in headers:
-            if key.lower() == 'authorization' or key.lower() == '"authorization"':
-                auth_header = headers[key]
-                break
-
-        if not auth_header:
-            logger.error("No Authorization header present")
-            return False
-
-        # Clean up the auth token - remove quotes and extra spaces
-        auth_token = auth_header.replace('"', '').strip()
-        if auth_token.lower().startswith('bearer '):
-            auth_token = auth_token[7:].strip()
-
-        logger.info(f"Cleaned auth token: {auth_token}")
-        logger.info(f"Organization table name: {org_table_name}")
-
-        # Query the organization table using the auth token index
+        record['input_tokens'] = int(body['input_tokens'])
+        record['output_tokens'] = int(body['output_tokens'])
+        # Optional token counts
+        record['cached_input_tokens'] = int(body.get('cached_input_tokens', 0))
+        record['reasoning_tokens'] = int(body.get('reasoning_tokens', 0))
+    except (TypeError, ValueError):
+        return None, 'Token counts must be integers'
+    # A negative count would take its tokens off the cost of the others
+    if any(record[field] < 0 for field in PRICING_FIELDS):
+        return None, 'Token counts must not be negative'
+
+    # Normalize the timestamp to UTC ISO 8601 with microseconds
+    if 'timestamp' in body:
         try:
-            response = org_table.query(
-                IndexName='AuthTokenIndex',
-                KeyConditionExpression='auth_token = :token',
-                ExpressionAttributeValues={':token': auth_token}
-            )
-            logger.info(f"DynamoDB query response: {json.dumps(response)}")
-        except Exception as e:
-            logger.error(f"DynamoDB query error: {str(e)}")
-            return False
-
-        # Check if we found a matching organization
-        if not response.get('Items'):
-            logger.error("No organization found for the provided auth token")
-            return False
-
-        # Verify the organization ID matches
-        org = response['Items'][0]
-        logger.info(f"Found organization: {json.dumps(org)}")
-        
-        if org.get('organization_id') != organization_id:
-            logger.error(f"Organization ID mismatch. Expected: {organization_id}, Found: {org.get('organization_id')}")
-            return False
-
-        # Verify the organization is active
-        if org.get('status') != 'active':
-            logger.error("Organization is not active")
-            return False
-
-        logger.info("Authorization successful")
-        return True
+            record['timestamp'], record['ts'] = record_keys.normalize_timestamp(body['timestamp'])
+        except ValueError:
+            return None, f'Invalid timestamp: {body["timestamp"]}'
 
-    except Exception as e:
-        logger.error(f"Error during authorization: {str(e)}")
-        logger.error(f"Full error details: {str(e.__dict__)}")
-        return False
+    # Extra fields must be storable, so one bad record can't fail a batch write
+    for name, value in body.items():
+        if name not in required_fields and name not in PRICING_FIELDS and name != 'timestamp':
+            try:
+                item_schema.storable(value)
+            except ValueError as e:
+                return None, f'Invalid value for {name}: {str(e)}'
+
+    # Check if the model is supported
+    if not pricing.is_supported(record['model_name']):
+        return None, f'Unsupported model: {record["model_name"]}. Supported models are: {", ".join(pricing.SUPPORTED_MODELS)}'
+
+    return record, None
+
+def calculate_cost(record):
+    """Calculate the USD cost of a validated usage record."""
+    nanos = pricing.price(
+        record['model_name'],
+        record['input_tokens'],
+        record['output_tokens'],
+        record['cached_input_tokens'],
+        record['reasoning_tokens']
+    )
+    return pricing.to_decimal(nanos)
+
+def build_item(record, total_cost, record_id=None):
+    """
+    Create the DynamoDB item for a priced usage record, just before it is
+    stored. Queued records pass the record_id assigned when they were accepted.
+    """
+    # Use the current time if no timestamp was provided
+    if 'timestamp' in record:
+        timestamp, ts = record['timestamp'], record['ts']
+    else:
+        timestamp, ts = record_keys.now()
+
+    # Create item to store in DynamoDB with organization and record_id as keys
+    item = {
+        'organization_id': record['organization_id'],  # Partition key
+        'record_id': record_id or record_keys.new_record_id(ts),  # Sort key, ordered by time
+        'user_id': record['user_id'],                 # For GSI
+        'timestamp': timestamp,                       # For GSI and time-based queries
+        'ts': ts,                                     # Epoch milliseconds
+        'model_name': record['model_name'],           # For per-model rollups
+        'total_cost': total_cost,
+        'ingest_key': record_keys.new_record_id(record_keys.now()[1])  # When it was stored, for delta queries
+    }
+
+    # Expire the record from the table into the archive (see retention)
+    expires_at = retention.expires_at(ts)
+    if expires_at is not None:
+        item[retention.TTL_ATTRIBUTE] = expires_at
+
+    # Add the allowed extra fields from the request, within their size budget.
+    # Clients can't set the TTL.
+    extras, dropped = item_schema.extra_fields(
+        record, skip=item.keys() | set(PRICING_FIELDS) | {retention.TTL_ATTRIBUTE}
+    )
+    item.update({name: item_schema.storable(value) for name, value in extras.items()})
+    if dropped:
+        metrics.count('dropped_fields', len(dropped))
+        metrics.debug("Dropped extra fields of %s/%s: %s", item['organization_id'], item['user_id'], dropped)
+
+    return item
+
+def enqueue_record(record):
+    """
+    Queue a validated record for ingest_worker and return its record_id.
+
+    The time, record_id and write shard are fixed here, so a message
+    delivered twice is written to the same key instead of being stored twice.
+    """
+    if 'timestamp' not in record:
+        record['timestamp'], record['ts'] = record_keys.now()
+    record_id = record_keys.new_record_id(record['ts'])
+    shard = sharding.pick_shard(sharding.write_shards_for(store, record['organization_id'], 1))
+    queue.send({'record_id': record_id, 'write_shard': shard, 'record': record})
+    return record_id
+
+def spill_records(records, items):
+    """
+    Queue records the table throttled past every retry for ingest_worker.
+    The messages keep the time, record_id and write shard of the items, so
+    the worker stores each record under the key it was accepted with.
+    Returns whether each record was queued; none are without a queue.
+    """
+    if spillover is None:
+        queued = [False] * len(items)
+    else:
+        message_ids = spillover.send_batch([
+            {
+                'record_id': item['record_id'],
+                'write_shard': item.get('write_shard', 0),
+                'record': dict(record, timestamp=item['timestamp'], ts=item['ts'])
+            }
+            for record, item in zip(records, items)
+        ])
+        queued = [message_id is not None for message_id in message_ids]
+    spilled = sum(queued)
+    if spilled:
+        metrics.count('spilled_records', spilled)
+    if spilled < len(queued):
+        metrics.count('rejected_records', len(queued) - spilled)
+    return queued
+
+def is_batch_request(event):
+    """Return True when the event was routed to POST /track/batch."""
+    path = event.get('resource') or event.get('path') or ''
+    return path.rstrip('/').endswith('/track/batch')
 
-# Simplified function that always returns True (no rate limiting)
-def check_rate_limits(organization_id):
-    # Rate limiting removed
-    return True
+def handle_batch(event, body):
+    """
+    Record many usage records for one organization in a single request.
 
+    The organization is authorized once, every record is priced in one pass
+    and the valid ones are stored with one batch write (parallel
+    BatchWriteItem calls on DynamoDB).
+    The response reports the outcome of each record by its position.
+    """
+    organization_id = body.get('organization_id')
+    records = body.get('records')
+    if not organization_id:
+        return {
+            'statusCode': 400,
+            'body': json.dumps({
+                'error': 'Missing required field: organization_id'
+            })
+        }
+    if not isinstance(records, list) or not records:
+        return {
+            'statusCode': 400,
+            'body': json.dumps({
+                'error': 'Field records must be a non-empty list'
+            })
+        }
+    if len(records) > MAX_BATCH_RECORDS:
+        return {
+            'statusCode': 400,
+            'body': json.dumps({
+                'error': f'Too many records: {len(records)}. The maximum per request is {MAX_BATCH_RECORDS}'
+            })
+        }
+
+    # Authorize once for the whole batch
+    metrics.set_dimension('organization_id', organization_id)
+    with metrics.stage('auth'):
+        authorized = authorize_request(event, organization_id)
+    if not authorized:
+        return {
+            'statusCode': 403,
+            'body': json.dumps({
+                'error': 'Unauthorized access. Organizations can only access their own data.'
+            })
+        }
+
+    # Validate every record, then price the valid ones in one pass
+    results = [None] * len(records)
+    valid_records = []
+    positions = []
+    with metrics.stage('parse'):
+        for position, raw in enumerate(records):
+            if not isinstance(raw, dict):
+                results[position] = {'index': position, 'status': 'error', 'error': 'Record must be an object'}
+                continue
+            raw = dict(raw)
+            raw.setdefault('organization_id', organization_id)
+            if raw['organization_id'] != organization_id:
+                results[position] = {'index': position, 'status': 'error', 'error': 'Record belongs to a different organization'}
+                continue
+            record, error = parse_usage_record(raw)
+            if error:
+                results[position] = {'index': position, 'status': 'error', 'error': error}
+                continue
+            valid_records.append(record)
+            positions.append(position)
+
+    with metrics.stage('rate_limit'):
+        retry_after = check_rate_limits(organization_id, valid_records)
+    if retry_after:
+        return rate_limited(retry_after)
+
+    with metrics.stage('pricing'):
+        costs = pricing.price_many(valid_records)
+        items = [build_item(record, pricing.to_decimal(nanos)) for record, nanos in zip(valid_records, costs)]
+
+    # Store the valid records, spread over the organization's write shards.
+    # Records throttled past every retry are spilled to the ingest queue.
+    with metrics.stage('write'):
+        shards = sharding.write_shards_for(store, organization_id, len(items)) if items else 1
+        sharded = [sharding.shard_item(item, shards) for item in items]
+        write_errors = write_guard.guard.put_batch(store, sharded, max_workers=BATCH_WRITE_WORKERS)
+        throttled = [index for index, error in enumerate(write_errors) if error == write_guard.THROTTLED]
+        spilled = set()
+        if throttled:
+            queued = spill_records([valid_records[index] for index in throttled], [sharded[index] for index in throttled])
+            spilled = {index for index, ok in zip(throttled, queued) if ok}
+            retry_after = write_guard.guard.breaker.retry_after()
+            for index in throttled:
+                write_errors[index] = None if index in spilled else saturated_error(retry_after)
+    accepted = [not error for error in write_errors]
+    release_rate_limits(organization_id, [record for record, ok in zip(valid_records, accepted) if not ok])
+    count_spend(
+        organization_id,
+        [record for record, ok in zip(valid_records, accepted) if ok],
+        [nanos for nanos, ok in zip(costs, accepted) if ok]
+    )
+    for index, (position, item, error) in enumerate(zip(positions, items, write_errors)):
+        if error:
+            results[position] = {'index': position, 'status': 'error', 'error': error}
+        else:
+            results[position] = {
+                'index': position,
+                'status': 'accepted' if index in spilled else 'ok',
+                'record_id': item['record_id'],
+                'total_cost': float(item['total_cost'])
+            }
+
+    succeeded = sum(1 for result in results if result['status'] != 'error')
+    failed = len(results) - succeeded
+    metrics.count('records', len(records))
+    metrics.count('failed_records', failed)
+
+    # Log the usage
+    logger.info({
+        'action': 'batch_usage_tracking',
+        'organization_id': organization_id,
+        'records': len(records),
+        'succeeded': succeeded,
+        'failed': failed
+    })
+
+    with metrics.stage('serialize'):
+        response_body = json.dumps({
+            'message': 'Batch processed',
+            'organization_id': organization_id,
+            'succeeded': succeeded,
+            'failed': failed,
+            'results': results
+        })
+    return {
+        'statusCode': 200 if failed == 0 else 207,
+        'body': response_body
+    }
+
+@metrics.instrumented('track')
 def lambda_handler(event, context):
     try:
         # Parse the incoming JSON body
-        if 'body' in event:
-            body = json.loads(event['body'])
-        else:
-            body = event
-        
-        # Validate required fields
-        required_fields = ['model_name', 'input_tokens', 'output_tokens', 'user_id', 'organization_id']
-        for field in required_fields:
-            if field not in body:
-                return {
-                    'statusCode': 400,
-                    'body': json.dumps({
-                        'error': f'Missing required field: {field}'
-                    })
-                }
-        
-        # Extract data from the request
-        model_name = body['model_name']
-        input_tokens = int(body['input_tokens'])
-        output_tokens = int(body['output_tokens'])
-        user_id = body['user_id']
-        organization_id = body['organization_id']
-        
-        # Optional token counts
-        cached_input_tokens = int(body.get('cached_input_tokens', 0))
-        reasoning_tokens = int(body.get('reasoning_tokens', 0))
-        
+        with metrics.stage('parse'):
+            if 'body' in event:
+                body = json.loads(event['body'])
+            else:
+                body = event
+
+        if is_batch_request(event):
+            return handle_batch(event, body)
+
+        # Validate the record and convert token counts
+        with metrics.stage('parse'):
+            record, error = parse_usage_record(body)
+        if error:
+            return {
+                'statusCode': 400,
+                'body': json.dumps({
+                    'error': error
+                })
+            }
+
+        user_id = record['user_id']
+        organization_id = record['organization_id']
+        metrics.set_dimension('organization_id', organization_id)
+        metrics.set_dimension('model_name', record['model_name'])
+
         # Authorize the request - ensure organization can only access their own data
-        if not authorize_request(event, organization_id):
+        with metrics.stage('auth'):
+            authorized = authorize_request(event, organization_id)
+        if not authorized:
             return {
                 'statusCode': 403,
                 'body': json.dumps({
                     'error': 'Unauthorized access. Organizations can only access their own data.'
                 })
             }
-        
-        # Calculate cost based on model and token usage
-        # Pricing rates per 1,000,000 tokens (in USD) - update these as needed
-        model_pricing = {
-            # GPT-4 models
-            'gpt-4': {'input': Decimal('30.0'), 'output': Decimal('60.0')},
-            'gpt-4-32k': {'input': Decimal('60.0'), 'output': Decimal('120.0')},
-            'gpt-4-turbo': {'input': Decimal('10.0'), 'output': Decimal('30.0'), 'cached_input': Decimal('1.5')},
-            'gpt-4-turbo-preview': {'input': Decimal('10.0'), 'output': Decimal('30.0'), 'cached_input': Decimal('1.5')},
-            'gpt-4-vision-preview': {'input': Decimal('10.0'), 'output': Decimal('30.0')},
-            'gpt-4-1106-preview': {'input': Decimal('10.0'), 'output': Decimal('30.0'), 'cached_input': Decimal('1.5')},
-            'gpt-4-0125-preview': {'input': Decimal('10.0'), 'output': Decimal('30.0'), 'cached_input': Decimal('1.5')},
-            'gpt-4o': {'input': Decimal('5.0'), 'output': Decimal('15.0'), 'cached_input': Decimal('0.75')},
-            'gpt-4o-2024-05-13': {'input': Decimal('5.0'), 'output': Decimal('15.0'), 'cached_input': Decimal('0.75')},
-            
-            # GPT-3.5 models
-            'gpt-3.5-turbo': {'input': Decimal('1.5'), 'output': Decimal('2.0'), 'cached_input': Decimal('0.3')},
-            'gpt-3.5-turbo-16k': {'input': Decimal('3.0'), 'output': Decimal('4.0'), 'cached_input': Decimal('0.6')},
-            'gpt-3.5-turbo-instruct': {'input': Decimal('1.5'), 'output': Decimal('2.0')},
-            'gpt-3.5-turbo-0125': {'input': Decimal('0.5'), 'output': Decimal('1.5'), 'cached_input': Decimal('0.1')},
-            'gpt-3.5-turbo-0613': {'input': Decimal('1.5'), 'output': Decimal('2.0'), 'cached_input': Decimal('0.3')},
-            'gpt-3.5-turbo-1106': {'input': Decimal('1.0'), 'output': Decimal('2.0'), 'cached_input': Decimal('0.2')},
-            
-            # Claude models
-            'claude-3-opus-20240229': {'input': Decimal('15.0'), 'output': Decimal('75.0')},
-            'claude-3-sonnet-20240229': {'input': Decimal('3.0'), 'output': Decimal('15.0')},
-            'claude-3-haiku-20240307': {'input': Decimal('0.25'), 'output': Decimal('1.25')},
-            'claude-2.1': {'input': Decimal('8.0'), 'output': Decimal('24.0')},
-            'claude-2.0': {'input': Decimal('8.0'), 'output': Decimal('24.0')},
-            'claude-instant-1.2': {'input': Decimal('0.8'), 'output': Decimal('2.4')},
-            
-            # Mistral models
-            'mistral-tiny': {'input': Decimal('0.14'), 'output': Decimal('0.42')},
-            'mistral-small': {'input': Decimal('0.6'), 'output': Decimal('1.8')},
-            'mistral-medium': {'input': Decimal('2.7'), 'output': Decimal('8.1'), 'reasoning': Decimal('0.9')},
-            'mistral-large': {'input': Decimal('8.0'), 'output': Decimal('24.0'), 'reasoning': Decimal('2.7')},
-            
-            # Llama models
-            'llama-2-7b': {'input': Decimal('0.2'), 'output': Decimal('0.2')},
-            'llama-2-13b': {'input': Decimal('0.3'), 'output': Decimal('0.4')},
-            'llama-2-70b': {'input': Decimal('0.8'), 'output': Decimal('0.9')},
-            'llama-3-8b': {'input': Decimal('0.3'), 'output': Decimal('0.3')},
-            'llama-3-70b': {'input': Decimal('0.9'), 'output': Decimal('0.9')}
-        }
-        
-        # Check if the model is supported
-        if model_name not in model_pricing:
+
+        with metrics.stage('rate_limit'):
+            retry_after = check_rate_limits(organization_id, [record])
+        if retry_after:
+            return rate_limited(retry_after)
+
+        # In async mode the drain worker prices and stores the record
+        if queue is not None:
+            with metrics.stage('enqueue'):
+                try:
+                    record_id = enqueue_record(record)
+                except Exception:
+                    release_rate_limits(organization_id, [record])
+                    raise
+            count_spend(organization_id, [record])
+            metrics.debug("Usage queued: %s/%s record %s", organization_id, user_id, record_id)
             return {
-                'statusCode': 400,
+                'statusCode': 202,
                 'body': json.dumps({
-                    'error': f'Unsupported model: {model_name}. Supported models are: {", ".join(model_pricing.keys())}'
+                    'message': 'Usage data accepted',
+                    'organization_id': organization_id,
+                    'user_id': user_id,
+                    'record_id': record_id
                 })
             }
-        
-        # Get pricing for the model
-        model_rates = model_pricing[model_name]
-        
-        # Calculate costs
-        input_cost = (Decimal(str(input_tokens)) / Decimal('1000000')) * model_rates['input']
-        output_cost = (Decimal(str(output_tokens)) / Decimal('1000000')) * model_rates['output']
-        
-        # Calculate cached input cost if applicable
-        cached_input_cost = Decimal('0')
-        if cached_input_tokens > 0 and 'cached_input' in model_rates:
-            cached_input_cost = (Decimal(str(cached_input_tokens)) / Decimal('1000000')) * model_rates['cached_input']
-            
-        # Calculate reasoning tokens cost if applicable
-        reasoning_cost = Decimal('0')
-        if reasoning_tokens > 0 and 'reasoning' in model_rates:
-            reasoning_cost = (Decimal(str(reasoning_tokens)) / Decimal('1000000')) * model_rates['reasoning']
-            
-        total_cost = input_cost + output_cost + cached_input_cost + reasoning_cost
-        
-        # Generate timestamp if not provided
-        timestamp = body.get('timestamp', datetime.now(timezone.utc).isoformat())
-        
-        # Generate a unique record ID
-        record_id = str(uuid.uuid4())
-        
-        # Create item to store in DynamoDB with organization and record_id as keys
-        item = {
-            'organization_id': organization_id,  # Partition key
-            'record_id': record_id,             # Sort key
-            'user_id': user_id,                 # For GSI
-            'timestamp': timestamp,             # For GSI and time-based queries
-            'total_cost': total_cost
-        }
-        
-        # Add any additional fields from the request
-        for key, value in body.items():
-            # Skip fields we've already processed or don't want to store
-            if key not in item and key not in ['model_name', 'input_tokens', 'output_tokens', 'cached_input_tokens', 'reasoning_tokens']:
-                item[key] = value
-        
-        # Store the data in DynamoDB
-        table.put_item(Item=item)
-        
+
+        # Calculate cost based on model and token usage
+        with metrics.stage('pricing'):
+            total_cost = calculate_cost(record)
+            item = build_item(record, total_cost)
+        timestamp = item['timestamp']
+
+        # Store the record, on one of the organization's write shards. A
+        # record throttled past every retry is spilled to the ingest queue.
+        with metrics.stage('write'):
+            shards = sharding.write_shards_for(store, organization_id, 1)
+            sharded = sharding.shard_item(item, shards)
+            try:
+                spilled = write_guard.guard.put(store, sharded, context) == write_guard.THROTTLED
+                if spilled and not spill_records([record], [sharded])[0]:
+                    release_rate_limits(organization_id, [record])
+                    return write_saturated(write_guard.guard.breaker.retry_after())
+            except Exception:
+                release_rate_limits(organization_id, [record])
+                raise
+        count_spend(organization_id, [record], [pricing.to_nanos(total_cost)])
+
         # Log the usage
-        logger.info({
-            'action': 'usage_tracking',
-            'organization_id': organization_id,
-            'user_id': user_id,
-            'total_cost': str(total_cost),  # Convert to string for logging to preserve precision
-            'timestamp': timestamp
-        })
-        
+        metrics.debug("Usage recorded: %s/%s cost %s at %s", organization_id, user_id, total_cost, timestamp)
+
         return {
-            'statusCode': 200,
+            'statusCode': 202 if spilled else 200,
             'body': json.dumps({
-                'message': 'Usage data recorded successfully',
+                'message': 'Usage data accepted' if spilled else 'Usage data recorded successfully',
                 'organization_id': organization_id,
                 'user_id': user_id,
                 'total_cost': float(total_cost)  # Convert to float for JSON serialization
             }, default=str)  # Use default=str to handle Decimal serialization
         }
-    
+
     except Exception as e:
         logger.error(f"Error: {str(e)}")
         return {
@@ -0,0 +1,78 @@
+"""
+Local stand-in for DynamoDB Streams.
+
+LocalStream wraps a table (a boto3 Table, a moto-backed Table or an
+in-memory fake) and records the stream events DynamoDB would emit for the
+writes made through it, using the NEW_AND_OLD_IMAGES view. drain() returns
+them in the shape a stream-triggered Lambda receives, so stream consumers can
+be exercised without AWS.
+"""
+import itertools
+
+import bootstrap
+
+
+def _image(item):
+    return {k: bootstrap.serialize(v) for k, v in item.items()}
+
+
+class LocalStream:
+    """Table wrapper that captures INSERT, MODIFY and REMOVE events."""
+
+    def __init__(self, table, key_fields, stream_arn='arn:aws:dynamodb:local:000000000000:table/local/stream/local'):
+        self.table = table
+        self.key_fields = tuple(key_fields)
+        self.stream_arn = stream_arn
+        self.records = []
+        self._sequence = itertools.count(100000000000000000000)
+
+    def __getattr__(self, name):
+        # Reads and anything not intercepted go straight to the wrapped table
+        return getattr(self.table, name)
+
+    def _key(self, item):
+        return {field: item[field] for field in self.key_fields}
+
+    def _emit(self, event_name, key, new_image=None, old_image=None, user_identity=None):
+        change = {
+            'Keys': _image(key),
+            'SequenceNumber': str(next(self._sequence)),
+            'StreamViewType': 'NEW_AND_OLD_IMAGES',
+        }
+        if new_image is not None:
+            change['NewImage'] = _image(new_image)
+        if old_image is not None:
+            change['OldImage'] = _image(old_image)
+        record = {
+            'eventID': change['SequenceNumber'],
+            'eventName': event_name,
+            'eventSource': 'aws:dynamodb',
+            'eventSourceARN': self.stream_arn,
+            'dynamodb': change,
+        }
+        if user_identity:
+            record['userIdentity'] = user_identity
+        self.records.append(record)
+
+    def put_item(self, Item, **kwargs):
+        key = self._key(Item)
+        old = self.table.get_item(Key=key).get('Item')
+        response = self.table.put_item(Item=Item, **kwargs)
+        stored = self.table.get_item(Key=key).get('Item', Item)
+        self._emit('MODIFY' if old else 'INSERT', key, new_image=stored, old_image=old)
+        return response
+
+    def delete_item(self, Key, expired=False, **kwargs):
+        """Delete an item. expired=True marks the event as a TTL deletion."""
+        old = self.table.get_item(Key=Key).get('Item')
+        response = self.table.delete_item(Key=Key, **kwargs)
+        if old:
+            identity = {'type': 'Service', 'principalId': 'dynamodb.amazonaws.com'} if expired else None
+            self._emit('REMOVE', Key, old_image=old, user_identity=identity)
+        return response
+
+    def drain(self, max_records=None):
+        """Remove and return pending events as a Lambda stream event."""
+        count = len(self.records) if max_records is None else max_records
+        batch, self.records = self.records[:count], self.records[count:]
+        return {'Records': batch}
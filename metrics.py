@@ -0,0 +1,210 @@
+"""
+Per-invocation stage timings, emitted as CloudWatch embedded metrics.
+
+Handlers are wrapped with @instrumented('<function>'), which starts an
+Invocation for every call and emits one embedded metric format (EMF) document
+when the call returns:
+
+    @metrics.instrumented('track')
+    def lambda_handler(event, context):
+        with metrics.stage('auth'):
+            ...
+        metrics.set_dimension('organization_id', organization_id)
+
+Each stage becomes a `<stage>_ms` metric. Metrics are published per function,
+and per function and organization or model once those dimensions are set.
+CloudWatch extracts the metrics from the log line, so no API calls are made.
+
+Verbose logging goes through debug(). It is written when LOG_LEVEL is DEBUG,
+or at INFO for the fraction DEBUG_SAMPLE_RATE of invocations. Messages are
+formatted lazily, so unsampled invocations pay almost nothing for them.
+
+Tests replace `sink` with a MemorySink to assert on the emitted documents.
+"""
+import functools
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# Initialize logging
+logger = logging.getLogger()
+
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() == 'true'
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'ChatGPTUsageTracker')
+DEBUG_SAMPLE_RATE = float(os.environ.get('DEBUG_SAMPLE_RATE', '0'))
+
+# Dimension sets published for every document, where all their keys are set
+DIMENSION_SETS = [['function'], ['function', 'organization_id'], ['function', 'model_name']]
+
+
+class StdoutSink:
+    """Writes each document as one JSON line, which CloudWatch parses as EMF."""
+
+    def emit(self, document):
+        sys.stdout.write(json.dumps(document, default=str) + '\n')
+        sys.stdout.flush()
+
+
+class MemorySink:
+    """Keeps emitted documents in memory, for tests."""
+
+    def __init__(self):
+        self.documents = []
+
+    def emit(self, document):
+        self.documents.append(document)
+
+    def values(self, name, function=None):
+        """Values of one metric across the documents, optionally for one function."""
+        return [
+            document[name] for document in self.documents
+            if name in document and (function is None or document['function'] == function)
+        ]
+
+
+sink = StdoutSink()
+
+
+class Invocation:
+    """Timings, counts and dimensions collected during one handler call."""
+
+    def __init__(self, function, sample_rate=None, rng=random, clock=time.perf_counter):
+        self.function = function
+        self.clock = clock
+        self.started = clock()
+        self.dimensions = {}
+        self.timings = {}
+        self.counts = {}
+        self.properties = {}
+        rate = DEBUG_SAMPLE_RATE if sample_rate is None else sample_rate
+        self.sampled = rate > 0 and rng.random() < rate
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        started = self.clock()
+        try:
+            yield
+        finally:
+            self.add_time(name, (self.clock() - started) * 1000)
+
+    def add_time(self, name, ms):
+        """Add milliseconds to a stage. Safe to call from worker threads."""
+        with self._lock:
+            self.timings[name] = self.timings.get(name, 0.0) + ms
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + value
+
+    def document(self):
+        """The EMF document for this invocation."""
+        dimensions = dict(self.dimensions, function=self.function)
+        names = [{'Name': f'{stage}_ms', 'Unit': 'Milliseconds'} for stage in self.timings]
+        names.append({'Name': 'total_ms', 'Unit': 'Milliseconds'})
+        names.extend({'Name': name, 'Unit': 'Count'} for name in self.counts)
+        document = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': METRICS_NAMESPACE,
+                    'Dimensions': [keys for keys in DIMENSION_SETS if all(key in dimensions for key in keys)],
+                    'Metrics': names
+                }]
+            }
+        }
+        document.update(self.properties)
+        document.update(dimensions)
+        document.update({f'{stage}_ms': round(ms, 3) for stage, ms in self.timings.items()})
+        document['total_ms'] = round((self.clock() - self.started) * 1000, 3)
+        document.update(self.counts)
+        return document
+
+
+_local = threading.local()
+
+
+def current():
+    """The invocation of the calling thread's handler call, or None."""
+    return getattr(_local, 'invocation', None)
+
+
+def start(function, **kwargs):
+    invocation = Invocation(function, **kwargs)
+    _local.invocation = invocation
+    return invocation
+
+
+def finish(invocation):
+    """Emit an invocation's metrics. Failures are logged, never raised."""
+    if current() is invocation:
+        _local.invocation = None
+    if not METRICS_ENABLED:
+        return
+    try:
+        sink.emit(invocation.document())
+    except Exception as e:
+        logger.error(f"Metrics emit failed: {str(e)}")
+
+
+def instrumented(function):
+    """Decorate a Lambda handler so each call is timed and its metrics emitted."""
+    def decorate(handler):
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            invocation = start(function)
+            try:
+                response = handler(event, context)
+                if isinstance(response, dict) and 'statusCode' in response:
+                    invocation.properties['status_code'] = response['statusCode']
+                return response
+            finally:
+                finish(invocation)
+        return wrapper
+    return decorate
+
+
+@contextmanager
+def stage(name, invocation=None):
+    """Time a block as `name` in the given or current invocation."""
+    invocation = invocation or current()
+    if invocation is None:
+        yield
+        return
+    with invocation.stage(name):
+        yield
+
+
+def add_time(name, ms, invocation=None):
+    invocation = invocation or current()
+    if invocation is not None:
+        invocation.add_time(name, ms)
+
+
+def count(name, value=1, invocation=None):
+    invocation = invocation or current()
+    if invocation is not None:
+        invocation.count(name, value)
+
+
+def set_dimension(name, value):
+    invocation = current()
+    if invocation is not None and value is not None:
+        invocation.dimensions[name] = str(value)
+
+
+def debug(message, *args):
+    """
+    Log a verbose message with lazy %-formatting: at DEBUG normally, at INFO
+    when the current invocation is sampled.
+    """
+    invocation = current()
+    if invocation is not None and invocation.sampled:
+        logger.info(message, *args)
+    else:
+        logger.debug(message, *args)
@@ -0,0 +1,124 @@
+"""
+Rewrite existing usage records as compact items.
+
+Records written before COMPACT_ITEMS was enabled carry long attribute names,
+a Decimal total_cost and every field the client sent. This tool scans the
+usage table in parallel segments and writes each such record again under
+the same key in the compact form of item_schema, extra fields limited to
+EXTRA_FIELDS. Overwrites are MODIFY stream events, which the rollup consumer
+ignores, so nothing is counted twice. An interrupted run can simply be
+started again; compact records are left alone.
+
+Every run reports what a usage record costs before and after, per record
+on average: its size, the write units of one put into the table and its
+GSIs, and the storage it takes in both. "After" assumes the slimmed GSI
+projections, so run it with --dry-run first to see what the change saves.
+
+    python migrate_compact_items.py --table chatgpt_usage_tracking --segments 16
+"""
+import argparse
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+
+import item_schema
+from batch_write import batch_put_items
+from migrate_record_ids import KEY_FIELDS, scan_pages
+
+# Initialize logging
+logger = logging.getLogger()
+
+COUNTS = ('scanned', 'migrated', 'compact', 'failed')
+MEASURES = ('bytes_before', 'bytes_after', 'write_units_before', 'write_units_after',
+            'storage_bytes_before', 'storage_bytes_after')
+
+
+def measure(item, compact, counts):
+    """Add the sizes and units of `item` before and after compaction to `counts`."""
+    write_units, storage = item_schema.usage_units(item, item_schema.FULL_PROJECTIONS)
+    compact_write_units, compact_storage = item_schema.usage_units(compact, item_schema.SLIM_PROJECTIONS)
+    counts['bytes_before'] += item_schema.item_size(item)
+    counts['bytes_after'] += item_schema.item_size(compact)
+    counts['write_units_before'] += write_units
+    counts['write_units_after'] += compact_write_units
+    counts['storage_bytes_before'] += storage
+    counts['storage_bytes_after'] += compact_storage
+
+
+def migrate_segment(client, table_name, segment, total_segments, dry_run=False):
+    """Compact every old-format record in one scan segment and return counts."""
+    counts = dict.fromkeys(COUNTS + MEASURES, 0)
+    for items in scan_pages(client, table_name, segment, total_segments):
+        counts['scanned'] += len(items)
+        compact_items = []
+        for item in items:
+            if item_schema.is_compact(item):
+                counts['compact'] += 1
+                continue
+            compact = item_schema.compact_item(item)
+            measure(item, compact, counts)
+            compact_items.append(compact)
+        if dry_run or not compact_items:
+            counts['migrated'] += len(compact_items)
+            continue
+
+        errors = batch_put_items(client, table_name, compact_items, KEY_FIELDS, max_workers=1)
+        failed = sum(1 for error in errors if error)
+        counts['failed'] += failed
+        counts['migrated'] += len(compact_items) - failed
+    return counts
+
+
+def migrate_table(client, table_name, segments=8, dry_run=False):
+    """Migrate the whole table with one worker per scan segment and return the summed counts."""
+    with ThreadPoolExecutor(max_workers=segments) as executor:
+        results = list(executor.map(
+            lambda segment: migrate_segment(client, table_name, segment, segments, dry_run),
+            range(segments)
+        ))
+    totals = dict.fromkeys(COUNTS + MEASURES, 0)
+    for counts in results:
+        for name, value in counts.items():
+            totals[name] += value
+    return totals
+
+
+def report(totals):
+    """Counts, with the measures per rewritten record and the share saved."""
+    result = {name: totals[name] for name in COUNTS}
+    records = totals['migrated'] + totals['failed']
+    if records:
+        per_record = {}
+        for measure_name in ('bytes', 'write_units', 'storage_bytes'):
+            before = totals[f'{measure_name}_before'] / records
+            after = totals[f'{measure_name}_after'] / records
+            per_record[measure_name] = {
+                'before': round(before, 1),
+                'after': round(after, 1),
+                'saved': round(before - after, 1),
+                'saved_percent': round(100 * (before - after) / before, 1) if before else 0.0
+            }
+        result['per_record'] = per_record
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Rewrite usage records as compact items.')
+    parser.add_argument('--table', default=os.environ.get('DYNAMODB_TABLE', 'chatgpt_usage_tracking'))
+    parser.add_argument('--region', default=os.environ.get('AWS_DEFAULT_REGION', 'us-east-1'))
+    parser.add_argument('--segments', type=int, default=8, help='Parallel scan segments (one worker each)')
+    parser.add_argument('--dry-run', action='store_true', help='Count and measure the records that would be rewritten')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    client = boto3.client('dynamodb', region_name=args.region)
+    totals = migrate_table(client, args.table, args.segments, args.dry_run)
+    print(json.dumps(report(totals), indent=2))
+    return 1 if totals['failed'] else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,136 @@
+"""
+Rewrite existing usage records to time-ordered record ids.
+
+Records written before record_keys was introduced have uuid4 record ids and
+whatever timestamp string the client sent. This tool scans the usage table in
+parallel segments and rewrites every such record:
+
+    record_id      a ULID for the record's time, derived from the old id so a
+                   rerun produces the same key instead of a duplicate
+    timestamp      normalized to UTC ISO 8601 with microseconds
+    ts             epoch milliseconds
+    migrated_from  the old record id; the rollup consumer skips these inserts
+
+The new item is written first and the old one deleted afterwards, both with
+BatchWriteItem. An interrupted run can simply be started again. Once a run
+reports no failures, set RecordIdQueries=true so organization ranges are
+read from the base table and OrgTimestampIndex is dropped.
+
+    python migrate_record_ids.py --table chatgpt_usage_tracking --segments 16
+"""
+import argparse
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from boto3.dynamodb.types import TypeDeserializer
+
+import item_schema
+import record_keys
+from batch_write import batch_delete_keys, batch_put_items
+
+# Initialize logging
+logger = logging.getLogger()
+
+KEY_FIELDS = ('organization_id', 'record_id')
+
+_deserializer = TypeDeserializer()
+
+
+def migrated_item(item):
+    """
+    Return the rewritten item for an old-format record, or None when it is
+    already migrated. Raises ValueError if its timestamp can't be parsed.
+    """
+    # Compact items keep ts only when their record_id doesn't hold it
+    if record_keys.is_record_id(item['record_id']) and ('ts' in item or item_schema.is_compact(item)):
+        return None
+    if 'timestamp' not in item:
+        raise ValueError('Record has no timestamp')
+    timestamp, ts = record_keys.normalize_timestamp(item['timestamp'])
+    return dict(
+        item,
+        record_id=record_keys.new_record_id(ts, seed=f"{item['organization_id']}#{item['record_id']}"),
+        timestamp=timestamp,
+        ts=ts,
+        migrated_from=item['record_id']
+    )
+
+
+def scan_pages(client, table_name, segment, total_segments):
+    """Yield the items of one scan segment, page by page."""
+    params = {'TableName': table_name, 'Segment': segment, 'TotalSegments': total_segments}
+    while True:
+        response = client.scan(**params)
+        yield [{k: _deserializer.deserialize(v) for k, v in item.items()} for item in response['Items']]
+        if not response.get('LastEvaluatedKey'):
+            return
+        params['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def migrate_segment(client, table_name, segment, total_segments, dry_run=False):
+    """Migrate every old-format record in one scan segment and return counts."""
+    counts = {'scanned': 0, 'migrated': 0, 'skipped': 0, 'failed': 0}
+    for items in scan_pages(client, table_name, segment, total_segments):
+        counts['scanned'] += len(items)
+        old_items, new_items = [], []
+        for item in items:
+            try:
+                new_item = migrated_item(item)
+            except ValueError as e:
+                logger.error(f"Skipping {item.get('organization_id')}/{item.get('record_id')}: {str(e)}")
+                counts['skipped'] += 1
+                continue
+            if new_item is not None:
+                old_items.append(item)
+                new_items.append(new_item)
+        if dry_run or not new_items:
+            counts['migrated'] += len(new_items)
+            continue
+
+        # Only delete the originals whose replacement was stored
+        put_errors = batch_put_items(client, table_name, new_items, KEY_FIELDS, max_workers=1)
+        stored = [old for old, error in zip(old_items, put_errors) if error is None]
+        delete_errors = batch_delete_keys(
+            client, table_name, [{field: old[field] for field in KEY_FIELDS} for old in stored], KEY_FIELDS,
+            max_workers=1
+        )
+        failed = len(old_items) - len(stored) + sum(1 for error in delete_errors if error)
+        counts['failed'] += failed
+        counts['migrated'] += len(old_items) - failed
+    return counts
+
+
+def migrate_table(client, table_name, segments=8, dry_run=False):
+    """Migrate the whole table with one worker per scan segment and return the summed counts."""
+    with ThreadPoolExecutor(max_workers=segments) as executor:
+        results = list(executor.map(
+            lambda segment: migrate_segment(client, table_name, segment, segments, dry_run),
+            range(segments)
+        ))
+    totals = {'scanned': 0, 'migrated': 0, 'skipped': 0, 'failed': 0}
+    for counts in results:
+        for name, value in counts.items():
+            totals[name] += value
+    return totals
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Rewrite usage records to time-ordered record ids.')
+    parser.add_argument('--table', default=os.environ.get('DYNAMODB_TABLE', 'chatgpt_usage_tracking'))
+    parser.add_argument('--region', default=os.environ.get('AWS_DEFAULT_REGION', 'us-east-1'))
+    parser.add_argument('--segments', type=int, default=8, help='Parallel scan segments (one worker each)')
+    parser.add_argument('--dry-run', action='store_true', help='Count the records that would be rewritten')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    client = boto3.client('dynamodb', region_name=args.region)
+    totals = migrate_table(client, args.table, args.segments, args.dry_run)
+    print(json.dumps(totals))
+    return 1 if totals['failed'] else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,121 @@
+"""
+Object stores for exported usage files.
+
+Every store offers the same small interface:
+
+    put(key, data)     store bytes under a '/'-separated key, replacing it
+    get(key)           the bytes under a key, or None
+    list(prefix='', start_after=None, limit=None)
+                       the keys starting with prefix, sorted; only those
+                       after start_after, and at most limit of them
+
+S3Store is used in AWS. DirectoryStore keeps objects as files under a local
+directory, with keys as relative paths. MemoryStore keeps them in a dict,
+for tests.
+"""
+import os
+import tempfile
+import threading
+
+import bootstrap
+
+
+class S3Store:
+    """Objects in an S3 bucket under `prefix`, using the shared client unless one is given."""
+
+    def __init__(self, bucket, prefix='', client=None):
+        self.bucket = bucket
+        self.prefix = prefix.strip('/') + '/' if prefix.strip('/') else ''
+        self._client = client
+
+    @property
+    def client(self):
+        return self._client or bootstrap.client('s3')
+
+    def put(self, key, data):
+        self.client.put_object(Bucket=self.bucket, Key=self.prefix + key, Body=data)
+
+    def get(self, key):
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=self.prefix + key)['Body'].read()
+        except Exception as e:
+            if getattr(e, 'response', {}).get('Error', {}).get('Code') in ('NoSuchKey', '404'):
+                return None
+            raise
+
+    def list(self, prefix='', start_after=None, limit=None):
+        keys = []
+        params = {'Bucket': self.bucket, 'Prefix': self.prefix + prefix}
+        if start_after is not None:
+            params['StartAfter'] = self.prefix + start_after
+        if limit:
+            params['PaginationConfig'] = {'MaxItems': limit, 'PageSize': min(limit, 1000)}
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(**params):
+            keys.extend(item['Key'][len(self.prefix):] for item in page.get('Contents', []))
+        return sorted(keys)[:limit]
+
+
+class DirectoryStore:
+    """Objects as files under a local directory. Writes are atomic renames."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, key):
+        path = os.path.normpath(os.path.join(self.root, *key.split('/')))
+        if not path.startswith(os.path.normpath(self.root) + os.sep):
+            raise ValueError(f'Key outside the store: {key}')
+        return path
+
+    def put(self, key, data):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        handle, temporary = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+        try:
+            with os.fdopen(handle, 'wb') as output:
+                output.write(data)
+            os.replace(temporary, path)
+        except BaseException:
+            os.unlink(temporary)
+            raise
+
+    def get(self, key):
+        try:
+            with open(self._path(key), 'rb') as stored:
+                return stored.read()
+        except FileNotFoundError:
+            return None
+
+    def list(self, prefix='', start_after=None, limit=None):
+        keys = []
+        for directory, _, files in os.walk(self.root):
+            for name in files:
+                if name.startswith('.tmp-'):
+                    continue
+                key = os.path.relpath(os.path.join(directory, name), self.root).replace(os.sep, '/')
+                if key.startswith(prefix) and (start_after is None or key > start_after):
+                    keys.append(key)
+        return sorted(keys)[:limit]
+
+
+class MemoryStore:
+    """Objects in a dict."""
+
+    def __init__(self):
+        self.objects = {}
+        self._lock = threading.Lock()
+
+    def put(self, key, data):
+        with self._lock:
+            self.objects[key] = bytes(data)
+
+    def get(self, key):
+        with self._lock:
+            return self.objects.get(key)
+
+    def list(self, prefix='', start_after=None, limit=None):
+        with self._lock:
+            return sorted(
+                key for key in self.objects if key.startswith(prefix) and (start_after is None or key > start_after)
+            )[:limit]
@@ -0,0 +1,132 @@
+"""
+Compile-once pricing engine.
+
+MODEL_PRICING is the human-edited price list in USD per 1,000,000 tokens.
+At import it is compiled into integer nano-dollars (1e-9 USD) per token, so
+pricing a record is an exact integer multiply-add with no Decimal division.
+"""
+from decimal import Decimal
+
+# Pricing rates per 1,000,000 tokens (in USD) - update these as needed
+MODEL_PRICING = {
+    # GPT-4 models
+    'gpt-4': {'input': Decimal('30.0'), 'output': Decimal('60.0')},
+    'gpt-4-32k': {'input': Decimal('60.0'), 'output': Decimal('120.0')},
+    'gpt-4-turbo': {'input': Decimal('10.0'), 'output': Decimal('30.0'), 'cached_input': Decimal('1.5')},
+    'gpt-4-turbo-preview': {'input': Decimal('10.0'), 'output': Decimal('30.0'), 'cached_input': Decimal('1.5')},
+    'gpt-4-vision-preview': {'input': Decimal('10.0'), 'output': Decimal('30.0')},
+    'gpt-4-1106-preview': {'input': Decimal('10.0'), 'output': Decimal('30.0'), 'cached_input': Decimal('1.5')},
+    'gpt-4-0125-preview': {'input': Decimal('10.0'), 'output': Decimal('30.0'), 'cached_input': Decimal('1.5')},
+    'gpt-4o': {'input': Decimal('5.0'), 'output': Decimal('15.0'), 'cached_input': Decimal('0.75')},
+    'gpt-4o-2024-05-13': {'input': Decimal('5.0'), 'output': Decimal('15.0'), 'cached_input': Decimal('0.75')},
+
+    # GPT-3.5 models
+    'gpt-3.5-turbo': {'input': Decimal('1.5'), 'output': Decimal('2.0'), 'cached_input': Decimal('0.3')},
+    'gpt-3.5-turbo-16k': {'input': Decimal('3.0'), 'output': Decimal('4.0'), 'cached_input': Decimal('0.6')},
+    'gpt-3.5-turbo-instruct': {'input': Decimal('1.5'), 'output': Decimal('2.0')},
+    'gpt-3.5-turbo-0125': {'input': Decimal('0.5'), 'output': Decimal('1.5'), 'cached_input': Decimal('0.1')},
+    'gpt-3.5-turbo-0613': {'input': Decimal('1.5'), 'output': Decimal('2.0'), 'cached_input': Decimal('0.3')},
+    'gpt-3.5-turbo-1106': {'input': Decimal('1.0'), 'output': Decimal('2.0'), 'cached_input': Decimal('0.2')},
+
+    # Claude models
+    'claude-3-opus-20240229': {'input': Decimal('15.0'), 'output': Decimal('75.0')},
+    'claude-3-sonnet-20240229': {'input': Decimal('3.0'), 'output': Decimal('15.0')},
+    'claude-3-haiku-20240307': {'input': Decimal('0.25'), 'output': Decimal('1.25')},
+    'claude-2.1': {'input': Decimal('8.0'), 'output': Decimal('24.0')},
+    'claude-2.0': {'input': Decimal('8.0'), 'output': Decimal('24.0')},
+    'claude-instant-1.2': {'input': Decimal('0.8'), 'output': Decimal('2.4')},
+
+    # Mistral models
+    'mistral-tiny': {'input': Decimal('0.14'), 'output': Decimal('0.42')},
+    'mistral-small': {'input': Decimal('0.6'), 'output': Decimal('1.8')},
+    'mistral-medium': {'input': Decimal('2.7'), 'output': Decimal('8.1'), 'reasoning': Decimal('0.9')},
+    'mistral-large': {'input': Decimal('8.0'), 'output': Decimal('24.0'), 'reasoning': Decimal('2.7')},
+
+    # Llama models
+    'llama-2-7b': {'input': Decimal('0.2'), 'output': Decimal('0.2')},
+    'llama-2-13b': {'input': Decimal('0.3'), 'output': Decimal('0.4')},
+    'llama-2-70b': {'input': Decimal('0.8'), 'output': Decimal('0.9')},
+    'llama-3-8b': {'input': Decimal('0.3'), 'output': Decimal('0.3')},
+    'llama-3-70b': {'input': Decimal('0.9'), 'output': Decimal('0.9')}
+}
+
+# Positions of each rate inside a compiled rate tuple
+RATE_FIELDS = ('input', 'output', 'cached_input', 'reasoning')
+
+
+def _compile_rates(pricing):
+    """
+    Convert USD-per-million rates into (input, output, cached_input, reasoning)
+    tuples of integer nano-dollars per token. Missing rates become 0, which
+    matches the handler's rule of not charging token kinds a model has no
+    price for.
+    """
+    compiled = {}
+    for model_name, rates in pricing.items():
+        nanos = []
+        for field in RATE_FIELDS:
+            # USD per 1M tokens * 1e9 nano-dollars / 1e6 tokens = rate * 1000
+            value = rates.get(field, Decimal('0')) * 1000
+            if value != value.to_integral_value():
+                raise ValueError(f'Rate {field} for {model_name} is finer than one nano-dollar per token')
+            nanos.append(int(value))
+        compiled[model_name] = tuple(nanos)
+    return compiled
+
+
+# Built once per container
+COMPILED_RATES = _compile_rates(MODEL_PRICING)
+SUPPORTED_MODELS = tuple(MODEL_PRICING.keys())
+
+
+def is_supported(model_name):
+    """Return True if the model has a price."""
+    return model_name in COMPILED_RATES
+
+
+def price(model_name, input_tokens, output_tokens, cached_input_tokens=0, reasoning_tokens=0):
+    """
+    Price one call in integer nano-dollars.
+    Raises KeyError for unsupported models.
+    """
+    input_rate, output_rate, cached_rate, reasoning_rate = COMPILED_RATES[model_name]
+    return (input_tokens * input_rate + output_tokens * output_rate
+            + cached_input_tokens * cached_rate + reasoning_tokens * reasoning_rate)
+
+
+def price_many(records):
+    """
+    Price a list of validated usage records in one call.
+
+    Each record is a dict with model_name and non-negative integer token counts
+    (cached_input_tokens and reasoning_tokens are optional).
+    Returns a list of nano-dollar costs aligned with `records`,
+    holding None for records whose model is not supported.
+    """
+    rates = COMPILED_RATES
+    costs = []
+    append = costs.append
+    for record in records:
+        compiled = rates.get(record['model_name'])
+        if compiled is None:
+            append(None)
+            continue
+        append(record['input_tokens'] * compiled[0] + record['output_tokens'] * compiled[1]
+               + record.get('cached_input_tokens', 0) * compiled[2]
+               + record.get('reasoning_tokens', 0) * compiled[3])
+    return costs
+
+
+_NANOS_PER_USD = Decimal(10) ** 9
+
+
+def to_decimal(nanos):
+    """Convert nano-dollars to an exact USD Decimal for storage."""
+    return Decimal(nanos).scaleb(-9)
+
+
+def to_nanos(cost):
+    """Convert a stored USD cost back to integer nano-dollars (exact for costs from to_decimal)."""
+    if not isinstance(cost, Decimal):
+        cost = Decimal(str(cost))
+    return int(cost * _NANOS_PER_USD)
@@ -0,0 +1,328 @@
+"""
+Request, token and spend limits for the track endpoints.
+
+Every organization, and every user within it, has two token buckets: one of
+requests and one of LLM tokens (input plus output). Each refills at a steady
+rate up to its burst size. Each also has a monthly spend cap in USD.
+Checks run against counters held in this container, so a tracked request
+pays no DynamoDB round trip for them and an over-limit call is answered with
+429 and Retry-After straight away.
+
+Counters are shared between containers through RATE_LIMIT_TABLE. At most
+once every RATE_LIMIT_SYNC_SECONDS a container adds what it consumed since
+its last sync to the shared totals, with one atomic UpdateItem ADD per
+counter. The adds run in parallel on RATE_LIMIT_SYNC_WORKERS threads, and
+at most RATE_LIMIT_SYNC_MAX_COUNTERS counters are synced at a time; the rest
+go first at the next sync. The new totals show what every other container
+consumed meanwhile, and that is taken out of the local buckets as well. The
+limits therefore hold across containers, give or take one sync interval of
+traffic. Before a container first checks a monthly spend cap it reads the
+shared totals it doesn't know yet, for every subject of the call in one
+BatchGetItem, and only once.
+
+Limiting is off unless RATE_LIMITING is true. A rate or cap of 0 turns that
+limit off. If the shared table can't be reached, containers keep limiting
+with what they know.
+"""
+import logging
+import math
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from decimal import Decimal
+
+import bootstrap
+from batch_write import batch_get_items
+
+# Initialize logging
+logger = logging.getLogger()
+
+RATE_LIMITING = os.environ.get('RATE_LIMITING', 'false').lower() == 'true'
+
+# Requests per second and LLM tokens per minute, with burst sizes. A burst of
+# 0 allows five seconds' worth of requests or one minute's worth of tokens.
+ORG_REQUESTS_PER_SECOND = float(os.environ.get('ORG_REQUESTS_PER_SECOND', '100'))
+ORG_REQUEST_BURST = float(os.environ.get('ORG_REQUEST_BURST', '0'))
+ORG_TOKENS_PER_MINUTE = float(os.environ.get('ORG_TOKENS_PER_MINUTE', '0'))
+ORG_TOKEN_BURST = float(os.environ.get('ORG_TOKEN_BURST', '0'))
+USER_REQUESTS_PER_SECOND = float(os.environ.get('USER_REQUESTS_PER_SECOND', '10'))
+USER_REQUEST_BURST = float(os.environ.get('USER_REQUEST_BURST', '0'))
+USER_TOKENS_PER_MINUTE = float(os.environ.get('USER_TOKENS_PER_MINUTE', '0'))
+USER_TOKEN_BURST = float(os.environ.get('USER_TOKEN_BURST', '0'))
+
+# Monthly spend caps in USD
+ORG_MONTHLY_SPEND_CAP = Decimal(os.environ.get('ORG_MONTHLY_SPEND_CAP', '0'))
+USER_MONTHLY_SPEND_CAP = Decimal(os.environ.get('USER_MONTHLY_SPEND_CAP', '0'))
+
+RATE_LIMIT_TABLE = os.environ.get('RATE_LIMIT_TABLE') or None
+RATE_LIMIT_SYNC_SECONDS = float(os.environ.get('RATE_LIMIT_SYNC_SECONDS', '1'))
+RATE_LIMIT_SYNC_MAX_COUNTERS = int(os.environ.get('RATE_LIMIT_SYNC_MAX_COUNTERS', '50'))
+RATE_LIMIT_SYNC_WORKERS = int(os.environ.get('RATE_LIMIT_SYNC_WORKERS', '8'))
+
+# Shared counters outlive their period by this long
+_COUNTER_TTL_SECONDS = 40 * 86400
+
+_NANOS_PER_USD = Decimal(10) ** 9
+
+
+class Limits:
+    """
+    One set of limits: (rate per second, burst) for each bucket and a spend
+    cap in nano-dollars, per organization and per user.
+    """
+
+    def __init__(self, org_requests=(0, 0), org_tokens=(0, 0), user_requests=(0, 0), user_tokens=(0, 0),
+                 org_spend_cap=0, user_spend_cap=0):
+        self.buckets = {
+            ('org', 'requests'): org_requests,
+            ('org', 'tokens'): org_tokens,
+            ('user', 'requests'): user_requests,
+            ('user', 'tokens'): user_tokens
+        }
+        self.spend_caps = {'org': org_spend_cap, 'user': user_spend_cap}
+
+    @classmethod
+    def from_environment(cls):
+        return cls(
+            org_requests=(ORG_REQUESTS_PER_SECOND, ORG_REQUEST_BURST or 5 * ORG_REQUESTS_PER_SECOND),
+            org_tokens=(ORG_TOKENS_PER_MINUTE / 60, ORG_TOKEN_BURST or ORG_TOKENS_PER_MINUTE),
+            user_requests=(USER_REQUESTS_PER_SECOND, USER_REQUEST_BURST or 5 * USER_REQUESTS_PER_SECOND),
+            user_tokens=(USER_TOKENS_PER_MINUTE / 60, USER_TOKEN_BURST or USER_TOKENS_PER_MINUTE),
+            org_spend_cap=int(ORG_MONTHLY_SPEND_CAP * _NANOS_PER_USD),
+            user_spend_cap=int(USER_MONTHLY_SPEND_CAP * _NANOS_PER_USD)
+        )
+
+
+def _month(now):
+    return datetime.fromtimestamp(now, timezone.utc).strftime('%Y-%m')
+
+
+def _day(now):
+    return datetime.fromtimestamp(now, timezone.utc).strftime('%Y-%m-%d')
+
+
+def seconds_to_next_month(now):
+    current = datetime.fromtimestamp(now, timezone.utc)
+    if current.month == 12:
+        following = datetime(current.year + 1, 1, 1, tzinfo=timezone.utc)
+    else:
+        following = datetime(current.year, current.month + 1, 1, tzinfo=timezone.utc)
+    return following.timestamp() - now
+
+
+class RateLimiter:
+    """
+    Token buckets and spend totals of one container, synced with an optional
+    shared counter table. The limiter lives at module level and therefore
+    survives warm invocations.
+
+    A shared counter is a running total per key and period, for example
+    "org#org_1#requests#2025-03-08" or "user#org_1/user_1#spend#2025-03".
+    """
+
+    def __init__(self, limits, shared_table=None, sync_seconds=RATE_LIMIT_SYNC_SECONDS, clock=time.time,
+                 max_sync_counters=RATE_LIMIT_SYNC_MAX_COUNTERS, sync_workers=RATE_LIMIT_SYNC_WORKERS):
+        self.limits = limits
+        self.shared_table = shared_table
+        self.sync_seconds = sync_seconds
+        self.clock = clock
+        self.max_sync_counters = max_sync_counters
+        self.sync_workers = sync_workers
+        # (scope, subject, kind) -> [tokens, refilled at]
+        self._buckets = {}
+        # counter key -> [pending, last seen total or None]
+        self._counters = {}
+        self._last_sync = clock()
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+
+    def _subjects(self, organization_id, usage):
+        """(scope, subject, requests, tokens) for the organization and each user."""
+        subjects = [('org', organization_id, sum(r for r, _ in usage.values()), sum(t for _, t in usage.values()))]
+        for user_id, (requests, tokens) in usage.items():
+            subjects.append(('user', f'{organization_id}/{user_id}', requests, tokens))
+        return subjects
+
+    def _bucket(self, scope, subject, kind, now):
+        """The refilled bucket, or None when that limit is off."""
+        rate, burst = self.limits.buckets[(scope, kind)]
+        if rate <= 0:
+            return None
+        bucket = self._buckets.get((scope, subject, kind))
+        if bucket is None:
+            bucket = self._buckets[(scope, subject, kind)] = [burst, now]
+        bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+        return bucket, rate, burst
+
+    def _spend_key(self, scope, subject, now):
+        return f'{scope}#{subject}#spend#{_month(now)}'
+
+    def _spent(self, key):
+        pending, seen = self._counters.get(key, (0, None))
+        return (seen or 0) + pending
+
+    def acquire(self, organization_id, usage):
+        """
+        Take requests and tokens for one call. `usage` maps each user_id to its
+        (requests, tokens). Returns 0 when the call is within every limit and
+        was counted, or the whole seconds to wait before retrying.
+        """
+        now = self.clock()
+        subjects = self._subjects(organization_id, usage)
+        # A container learns the month's spend before it first checks a cap
+        unknown = [
+            self._spend_key(scope, subject, now) for scope, subject, _, _ in subjects
+            if self.limits.spend_caps[scope] and self._counters.get(self._spend_key(scope, subject, now), (0, None))[1] is None
+        ]
+        if unknown:
+            totals = self._shared_totals(unknown)
+            with self._lock:
+                # When the shared table can't be read, go on from what this container counted
+                for key in unknown:
+                    counter = self._counters.setdefault(key, [0, None])
+                    if counter[1] is None:
+                        counter[1] = totals.get(key, 0)
+
+        with self._lock:
+            wait = 0
+            taken = []
+            for scope, subject, requests, tokens in subjects:
+                for kind, amount in (('requests', requests), ('tokens', tokens)):
+                    found = self._bucket(scope, subject, kind, now)
+                    if found is None or not amount:
+                        continue
+                    bucket, rate, burst = found
+                    # A call larger than the burst waits for a full bucket
+                    need = min(amount, burst)
+                    if bucket[0] < need:
+                        wait = max(wait, (need - bucket[0]) / rate)
+                    taken.append((bucket, need, f'{scope}#{subject}#{kind}#{_day(now)}', amount))
+                cap = self.limits.spend_caps[scope]
+                if cap and self._spent(self._spend_key(scope, subject, now)) >= cap:
+                    wait = max(wait, seconds_to_next_month(now))
+            if wait:
+                return max(1, math.ceil(wait))
+            for bucket, need, key, amount in taken:
+                bucket[0] -= need
+                self._counters.setdefault(key, [0, None])[0] += amount
+
+        if now - self._last_sync >= self.sync_seconds:
+            self.sync()
+        return 0
+
+    def release(self, organization_id, usage):
+        """
+        Give back what acquire() took for a call whose records were not
+        stored. `usage` maps each user_id to its (requests, tokens).
+        """
+        now = self.clock()
+        with self._lock:
+            for scope, subject, requests, tokens in self._subjects(organization_id, usage):
+                for kind, amount in (('requests', requests), ('tokens', tokens)):
+                    found = self._bucket(scope, subject, kind, now)
+                    if found is None or not amount:
+                        continue
+                    bucket, _, burst = found
+                    bucket[0] = min(burst, bucket[0] + min(amount, burst))
+                    # Taken off the shared total too if it was synced already
+                    self._counters.setdefault(f'{scope}#{subject}#{kind}#{_day(now)}', [0, None])[0] -= amount
+
+    def record_spend(self, organization_id, costs):
+        """Count spend, in nano-dollars per user_id, towards the monthly caps."""
+        if not any(self.limits.spend_caps.values()):
+            return
+        now = self.clock()
+        with self._lock:
+            for user_id, nanos in costs.items():
+                for scope, subject in (('org', organization_id), ('user', f'{organization_id}/{user_id}')):
+                    if self.limits.spend_caps[scope]:
+                        self._counters.setdefault(self._spend_key(scope, subject, now), [0, None])[0] += nanos
+
+    def sync(self):
+        """
+        Add pending counts to the shared totals and take what other containers
+        consumed since the last sync out of the local buckets. Syncs up to
+        max_sync_counters counters with something pending, in parallel.
+        Counters left over are synced first next time.
+        """
+        with self._sync_lock:
+            now = self.clock()
+            with self._lock:
+                self._last_sync = now
+                # Counters of earlier periods are no longer checked
+                current = (_day(now), _month(now))
+                for key in [key for key in self._counters if key.rsplit('#', 1)[1] not in current]:
+                    if not self._counters[key][0]:
+                        del self._counters[key]
+                # A full bucket is the same as a new one
+                for bucket_key, (tokens, refilled_at) in list(self._buckets.items()):
+                    rate, burst = self.limits.buckets[(bucket_key[0], bucket_key[2])]
+                    if tokens + (now - refilled_at) * rate >= burst:
+                        del self._buckets[bucket_key]
+                keys = [key for key, (pending, _) in self._counters.items() if pending][:self.max_sync_counters]
+                flushes = [(key, self._counters[key][0]) for key in keys]
+                # Synced counters go to the back of the line
+                for key in keys:
+                    self._counters[key] = self._counters.pop(key)
+
+            if self.shared_table is None or len(flushes) < 2:
+                totals = [self._add_shared(key, pending, now) for key, pending in flushes]
+            else:
+                with ThreadPoolExecutor(max_workers=min(self.sync_workers, len(flushes))) as executor:
+                    totals = list(executor.map(lambda flush: self._add_shared(flush[0], flush[1], now), flushes))
+
+            for (key, pending), total in zip(flushes, totals):
+                if total is None:
+                    continue
+                with self._lock:
+                    counter = self._counters.setdefault(key, [0, None])
+                    counter[0] -= pending
+                    others = total - pending - counter[1] if counter[1] is not None else 0
+                    counter[1] = total
+                    scope, rest = key.split('#', 1)
+                    subject, kind, _ = rest.rsplit('#', 2)
+                    bucket = self._buckets.get((scope, subject, kind))
+                    if bucket is not None and others > 0:
+                        bucket[0] -= others
+
+    def _shared_totals(self, keys):
+        """Shared totals of `keys` that exist, read in one batch; empty when they can't be read."""
+        if self.shared_table is None:
+            return {}
+        try:
+            items = batch_get_items(
+                self.shared_table.meta.client, self.shared_table.name, [{'counter_key': key} for key in keys], ['counter_key']
+            )
+        except Exception as e:
+            logger.warning(f"Rate limit counter read failed for {len(keys)} counters: {str(e)}")
+            return {}
+        return {key: int(item['total']) for key, item in zip(keys, items) if item is not None}
+
+    def _add_shared(self, key, amount, now):
+        """The shared total after adding `amount`, or None when it is unknown."""
+        if self.shared_table is None:
+            counter = self._counters[key]
+            return (counter[1] or 0) + amount
+        try:
+            response = self.shared_table.update_item(
+                Key={'counter_key': key},
+                UpdateExpression='SET expires_at = :expires ADD #total :amount',
+                ExpressionAttributeNames={'#total': 'total'},
+                ExpressionAttributeValues={':amount': amount, ':expires': int(now + _COUNTER_TTL_SECONDS)},
+                ReturnValues='ALL_NEW'
+            )
+        except Exception as e:
+            logger.warning(f"Rate limit counter sync failed for {key}: {str(e)}")
+            return None
+        return int(response['Attributes']['total'])
+
+    def reset(self):
+        with self._lock:
+            self._buckets.clear()
+            self._counters.clear()
+
+
+limiter = RateLimiter(Limits.from_environment(), bootstrap.table(RATE_LIMIT_TABLE) if RATE_LIMIT_TABLE else None)
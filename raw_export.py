@@ -0,0 +1,152 @@
+"""
+NDJSON export of raw usage records.
+
+GET /usage-export returns the records of an organization, or of one of its
+users, in a time range as newline-delimited JSON, one record per line. The
+response is produced by a pipeline of generators:
+
+    query pages -> records -> NDJSON lines -> gzip chunks -> response body
+
+so only the current page and the encoded output are held in memory. A
+response stops between pages once it holds EXPORT_RESPONSE_BYTES of NDJSON
+(Lambda responses are limited to 6 MB) or the Lambda is close to its timeout.
+Its position is returned as an opaque cursor, built on the LastEvaluatedKey
+of the last page read, and the next request resumes there. Memory therefore
+stays bounded however large the range is.
+
+Records are read in time order from each write shard in turn. Shard suffixes
+and internal attributes are removed, so records look as they were tracked.
+"""
+import base64
+import io
+import json
+import logging
+import os
+import zlib
+from decimal import Decimal
+
+import sharding
+import usage_queries
+
+# Initialize logging
+logger = logging.getLogger()
+
+# NDJSON bytes per response, leaving room for one more page under the 6 MB limit
+EXPORT_RESPONSE_BYTES = int(os.environ.get('EXPORT_RESPONSE_BYTES', str(3 * 1024 * 1024)))
+
+CONTENT_TYPE = 'application/x-ndjson'
+
+# Stored attributes that are not part of the tracked record; expires_at is the
+# TTL of retention
+_INTERNAL_FIELDS = ('write_shard', 'ingest_key', 'expires_at')
+
+
+def is_export_request(event):
+    """Return True when the event was routed to GET /usage-export."""
+    path = event.get('resource') or event.get('path') or ''
+    return path.rstrip('/').endswith('/usage-export')
+
+
+def accepts_gzip(event):
+    headers = {name.lower(): value for name, value in (event.get('headers') or {}).items()}
+    return 'gzip' in (headers.get('accept-encoding') or '').lower()
+
+
+def export_sources(organization_id, start, end, shards=1, user_id=None):
+    """
+    Whole-item sources for an organization or one of its users, shard by
+    shard, and its archive when the range starts before the hot window.
+    """
+    scope, key = ('user', user_id) if user_id else ('organization', organization_id)
+    sources = [
+        usage_queries.export_source(shard_key, start, end, scope)
+        for shard_key in sharding.shard_keys(key, shards)
+    ]
+    return sources + usage_queries.archived_sources(scope, key, organization_id, [(start, end, False)])
+
+
+def _json_value(value):
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+def records(pages, organization_id):
+    """The tracked records of a sequence of (source, items) pages."""
+    for _, items in pages:
+        for item in items:
+            item = sharding.unshard_item(item)
+            # User indexes span organizations
+            if item['organization_id'] != organization_id:
+                continue
+            yield {k: v for k, v in item.items() if k not in _INTERNAL_FIELDS}
+
+
+def ndjson_lines(items, counts):
+    """One encoded line per item, counting items and bytes into `counts`."""
+    for item in items:
+        line = json.dumps(item, default=_json_value, separators=(',', ':'), sort_keys=True).encode('utf-8') + b'\n'
+        counts['records'] += 1
+        counts['bytes'] += len(line)
+        yield line
+
+
+def gzip_chunks(chunks, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def export(sources, store, organization_id, cursor=None, should_stop=None, compress=False, max_bytes=None):
+    """
+    Encode the records of `sources` from `cursor` on, until they run out, the
+    output holds `max_bytes` (EXPORT_RESPONSE_BYTES) of NDJSON or
+    `should_stop` fires. Returns (body bytes, record count, scan).
+    """
+    max_bytes = EXPORT_RESPONSE_BYTES if max_bytes is None else max_bytes
+    should_stop = should_stop or (lambda: False)
+    counts = {'records': 0, 'bytes': 0}
+    scan = usage_queries.UsageScan(sources, store, cursor, lambda: counts['bytes'] >= max_bytes or should_stop())
+    chunks = ndjson_lines(records(scan.item_pages(), organization_id), counts)
+    if compress:
+        chunks = gzip_chunks(chunks)
+    body = io.BytesIO()
+    for chunk in chunks:
+        body.write(chunk)
+    return body.getvalue(), counts['records'], scan
+
+
+def encode_cursor(sources, scan, exported):
+    return usage_queries.encode_continuation(sources, scan.cursor(), {'exported': exported})
+
+
+def decode_cursor(token, sources):
+    """Return (scan cursor, records exported so far). Raises ValueError."""
+    cursor, partial = usage_queries.decode_continuation(token, sources)
+    try:
+        return cursor, int(partial['exported'])
+    except (KeyError, TypeError, ValueError):
+        raise ValueError('Invalid cursor')
+
+
+def response(body, records, exported, cursor_token, compressed):
+    """The API Gateway response for one part of an export."""
+    headers = {
+        'Content-Type': CONTENT_TYPE,
+        'X-Export-Records': str(records),
+        'X-Export-Total-Records': str(exported)
+    }
+    if cursor_token:
+        headers['X-Export-Cursor'] = cursor_token
+    if compressed:
+        headers['Content-Encoding'] = 'gzip'
+        return {
+            'statusCode': 200,
+            'headers': headers,
+            'body': base64.b64encode(body).decode('ascii'),
+            'isBase64Encoded': True
+        }
+    return {'statusCode': 200, 'headers': headers, 'body': body.decode('utf-8')}
@@ -0,0 +1,182 @@
+"""
+Time-ordered record ids and normalized timestamps.
+
+Usage records are stored with:
+
+    record_id  a ULID: 48 bits of epoch milliseconds followed by 80 random
+               bits, in Crockford base32. Ids sort by the record's time, so
+               the base table's sort key answers time-range queries.
+    timestamp  the record's time as UTC ISO 8601 with microseconds
+               ("2025-03-08T10:00:00.000000+00:00"), whatever format the
+               client sent. Fixed width, so string order is time order.
+    ts         the same instant in epoch milliseconds (Number).
+
+Query bounds keep the string semantics the API has always had: a record is
+in [start, end] when start <= timestamp <= end as strings. lower_bound() and
+upper_bound() turn such bounds into record_id bounds covering every matching
+record. Callers still compare the timestamps of what they read, because an
+id range is only exact to the millisecond.
+"""
+import hashlib
+import os
+import re
+from datetime import datetime, timedelta, timezone
+
+# Crockford base32, which sorts in the same order as the values it encodes
+_ALPHABET = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+_DECODE = {c: i for i, c in enumerate(_ALPHABET)}
+
+RECORD_ID_LENGTH = 26
+_RANDOM_BITS = 80
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+# Latest instant a canonical timestamp can hold (year 9999)
+_MAX_MS = int((datetime(9999, 12, 31, 23, 59, 59, 999000, tzinfo=timezone.utc) - _EPOCH).total_seconds() * 1000)
+
+# Numbers above this are taken as epoch milliseconds rather than seconds
+_MS_THRESHOLD = 100000000000
+
+# ISO 8601 date, optionally with a time, fraction and offset. Parsed here
+# rather than with datetime.fromisoformat, which before Python 3.11 rejects
+# fractions that aren't 3 or 6 digits and offsets without a colon.
+_ISO_PATTERN = re.compile(
+    r'(\d{4})-(\d{2})-(\d{2})'
+    r'(?:[T ](\d{2})(?::(\d{2})(?::(\d{2})(?:[.,](\d+))?)?)?'
+    r'(Z|[+-]\d{2}(?::?\d{2})?)?)?',
+    re.IGNORECASE | re.ASCII
+)
+
+
+def _encode(ms, randomness):
+    value = (ms << _RANDOM_BITS) | randomness
+    chars = []
+    for _ in range(RECORD_ID_LENGTH):
+        chars.append(_ALPHABET[value & 31])
+        value >>= 5
+    return ''.join(reversed(chars))
+
+
+def new_record_id(ms, seed=None):
+    """
+    ULID for a record at `ms` epoch milliseconds. With `seed` the random part
+    is derived from it, so the same seed always gives the same id.
+    """
+    if seed is None:
+        randomness = int.from_bytes(os.urandom(10), 'big')
+    else:
+        randomness = int.from_bytes(hashlib.sha256(seed.encode('utf-8')).digest()[:10], 'big')
+    return _encode(ms, randomness)
+
+
+def is_record_id(value):
+    return isinstance(value, str) and len(value) == RECORD_ID_LENGTH and all(c in _DECODE for c in value)
+
+
+def record_id_ms(record_id):
+    """Epoch milliseconds encoded in a record id."""
+    value = 0
+    for c in record_id:
+        value = (value << 5) | _DECODE[c]
+    return value >> _RANDOM_BITS
+
+
+def canonical(dt):
+    """Fixed-width UTC string for an aware datetime."""
+    return dt.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f+00:00')
+
+
+def _from_ms(ms, microseconds=0):
+    return _EPOCH + timedelta(milliseconds=ms, microseconds=microseconds)
+
+
+def _parse_iso(text):
+    """Aware datetime for an ISO 8601 string; naive values are taken as UTC."""
+    match = _ISO_PATTERN.fullmatch(text)
+    if match is None:
+        raise ValueError(f'Invalid timestamp: {text}')
+    year, month, day, hour, minute, second, fraction, offset = match.groups()
+    # Fractions are cut or padded to microseconds
+    microsecond = int((fraction or '')[:6].ljust(6, '0'))
+    tz = timezone.utc
+    if offset and offset.upper() != 'Z':
+        digits = offset[1:].replace(':', '')
+        delta = timedelta(hours=int(digits[:2]), minutes=int(digits[2:] or 0))
+        tz = timezone(-delta if offset[0] == '-' else delta)
+    return datetime(int(year), int(month), int(day), int(hour or 0), int(minute or 0), int(second or 0),
+                    microsecond, tzinfo=tz)
+
+
+def normalize_timestamp(value):
+    """
+    Return (timestamp, ts) for a client timestamp: an ISO 8601 string (naive
+    values are taken as UTC) or epoch seconds or milliseconds.
+    Raises ValueError for anything else.
+    """
+    if isinstance(value, bool):
+        raise ValueError(f'Invalid timestamp: {value}')
+    if isinstance(value, str):
+        text = value.strip()
+        try:
+            number = float(text)
+        except ValueError:
+            number = None
+        if number is None:
+            dt = _parse_iso(text)
+        else:
+            value = number
+    if not isinstance(value, str):
+        try:
+            number = float(value)
+        except (TypeError, ValueError):
+            raise ValueError(f'Invalid timestamp: {value}')
+        seconds = number / 1000 if abs(number) >= _MS_THRESHOLD else number
+        try:
+            dt = _EPOCH + timedelta(seconds=seconds)
+        except (OverflowError, ValueError):
+            raise ValueError(f'Timestamp out of range: {value}')
+    ms = (dt - _EPOCH) // timedelta(milliseconds=1)
+    if not 0 <= ms <= _MAX_MS:
+        raise ValueError(f'Timestamp out of range: {value}')
+    return canonical(dt), ms
+
+
+def now():
+    """(timestamp, ts) for the current time."""
+    dt = datetime.now(timezone.utc)
+    return canonical(dt), (dt - _EPOCH) // timedelta(milliseconds=1)
+
+
+def _lower_ms(bound):
+    """First millisecond holding a canonical timestamp >= bound."""
+    low, high = 0, _MAX_MS + 1
+    while low < high:
+        middle = (low + high) // 2
+        if canonical(_from_ms(middle, 999)) >= bound:
+            high = middle
+        else:
+            low = middle + 1
+    return low
+
+
+def _upper_ms(bound):
+    """Last millisecond holding a canonical timestamp <= bound, or -1."""
+    low, high = -1, _MAX_MS
+    while low < high:
+        middle = (low + high + 1) // 2
+        if canonical(_from_ms(middle)) <= bound:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def lower_bound(start):
+    """Smallest record id of a record whose timestamp can be >= start, or None."""
+    ms = _lower_ms(start)
+    return _encode(ms, 0) if ms <= _MAX_MS else None
+
+
+def upper_bound(end):
+    """Largest record id of a record whose timestamp can be <= end, or None."""
+    ms = _upper_ms(end)
+    return _encode(ms, (1 << _RANDOM_BITS) - 1) if ms >= 0 else None
@@ -1,19 +1,20 @@
 import json
-import boto3
 import os
 import uuid
 import logging
 from datetime import datetime, timezone
 
+import storage
+
 # Initialize logging
 logger = logging.getLogger()
-logger.setLevel(logging.INFO)
+logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO'))
 
-# Initialize DynamoDB client
-region = os.environ.get('AWS_DEFAULT_REGION', 'us-east-1')
-dynamodb = boto3.resource('dynamodb', region_name=region)
-table_name = os.environ.get('DYNAMODB_TABLE', 'chatgpt_organizations')
-table = dynamodb.Table(table_name)
+# Organization storage, connected on first use. ORG_TABLE_NAME takes
+# precedence, as DYNAMODB_TABLE names the usage table when one function
+# serves every route (see router).
+table_name = os.environ.get('ORG_TABLE_NAME') or os.environ.get('DYNAMODB_TABLE', 'chatgpt_organizations')
+store = storage.open_storage(org_table_name=table_name)
 
 def generate_auth_token():
     """Generate a unique auth token for the organization."""
@@ -41,7 +42,7 @@ def lambda_handler(event, context):
         auth_token = generate_auth_token()
         timestamp = datetime.now(timezone.utc).isoformat()
 
-        # Create item to store in DynamoDB
+        # Create the organization record
         item = {
             'organization_id': organization_id,
             'organization_name': body['organization_name'],
@@ -56,8 +57,8 @@ def lambda_handler(event, context):
             if field in body:
                 item[field] = body[field]
 
-        # Store the organization data in DynamoDB
-        table.put_item(Item=item)
+        # Store the organization record
+        store.put_organization(item)
 
         # Log the registration
         logger.info({
@@ -0,0 +1,242 @@
+"""
+Cached cost query results for settled time.
+
+Dashboards poll the cost endpoints for ranges that are mostly in the past.
+Records can arrive up to RESULT_CACHE_SETTLE_MINUTES after their timestamp
+(client-supplied timestamps, the async ingest queue, the rollup stream), so
+hours ending before now minus that are settled and their totals no longer
+change. plan() splits a query at that boundary. The aggregate of the settled
+part is cached under the fingerprint of its sources, and each request only
+reads the live tail after it.
+
+Nothing stops a record from arriving later than that, so an entry also keeps
+the ingest watermark it counts every record up to (see usage_queries). Before
+an entry is used, LateRecords reads what the organization stored since then
+through OrgIngestIndex. A record with a timestamp in the settled range makes
+the entry stale, and the range is read again. Otherwise the entry is kept
+with the newer watermark, so each check only reads what arrived since the
+last one.
+
+Entries are kept in warm memory, in an LRU bounded by RESULT_CACHE_BYTES of
+serialized JSON. With RESULT_CACHE_TABLE set they are also shared between
+function instances through a DynamoDB table, where they expire after
+RESULT_CACHE_SHARED_TTL_DAYS.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+
+import bootstrap
+import sharding
+import usage_queries
+
+# Initialize logging
+logger = logging.getLogger()
+
+RESULT_CACHE_BYTES = int(os.environ.get('RESULT_CACHE_BYTES', str(16 * 1024 * 1024)))
+RESULT_CACHE_SETTLE_MINUTES = float(os.environ.get('RESULT_CACHE_SETTLE_MINUTES', '60'))
+RESULT_CACHE_TABLE = os.environ.get('RESULT_CACHE_TABLE') or None
+RESULT_CACHE_SHARED_TTL_DAYS = float(os.environ.get('RESULT_CACHE_SHARED_TTL_DAYS', '30'))
+# Cache-Control max-age of responses that only cover settled time
+RESULT_CACHE_MAX_AGE_SECONDS = int(os.environ.get('RESULT_CACHE_MAX_AGE_SECONDS', '3600'))
+
+# DynamoDB items are limited to 400 KB; larger entries are only kept in memory
+_MAX_SHARED_BYTES = 350 * 1024
+
+
+def settled_before(now=None, settle_minutes=None):
+    """The first hour bucket ("YYYY-MM-DDTHH") that is not settled yet."""
+    settle_minutes = RESULT_CACHE_SETTLE_MINUTES if settle_minutes is None else settle_minutes
+    now = now or datetime.now(timezone.utc)
+    return (now - timedelta(minutes=settle_minutes)).strftime('%Y-%m-%dT%H')
+
+
+def plan(scope, key, start, end, boundary, use_rollups=False, rollup_start=None, shards=1, hourly=False,
+         organization_id=None):
+    """
+    Return (settled, live) sources answering [start, end]: settled sources
+    cover [start, boundary) and live ones [boundary, end]. Settled sources are
+    tagged, so their pages can be told apart during a scan.
+    """
+    options = dict(
+        use_rollups=use_rollups, rollup_start=rollup_start, shards=shards, hourly=hourly, organization_id=organization_id
+    )
+    if start >= boundary:
+        return [], usage_queries.build_sources(scope, key, start, end, **options)
+    if end < boundary:
+        settled, live = usage_queries.build_sources(scope, key, start, end, **options), []
+    else:
+        settled = usage_queries.build_sources(scope, key, start, boundary, end_exclusive=True, **options)
+        live = usage_queries.build_sources(scope, key, boundary, end, **options)
+    return [dict(source, settled=True) for source in settled], live
+
+
+def lookup(key):
+    """(value, watermark) cached under `key`, or None."""
+    entry = cache.get(key)
+    # Entries cached without a watermark can't be checked for late records
+    if not isinstance(entry, dict) or 'watermark' not in entry:
+        return None
+    return entry['value'], entry['watermark']
+
+
+def remember(key, value, watermark):
+    """Cache `value`, which counts every record stored up to `watermark`."""
+    cache.put(key, {'value': value, 'watermark': watermark})
+
+
+class LateRecords:
+    """
+    Records of an organization stored after a cached entry's watermark, up
+    to `through`, with timestamps in the settled range [start, boundary).
+    The entry doesn't count them. One scan of OrgIngestIndex, from the
+    oldest watermark asked about, serves every entry of a request. With
+    `shared` it is read on the store's thread-safe client.
+    """
+
+    def __init__(self, store, organization_id, shards, start, boundary, through, shared=False):
+        self.store = store
+        self.shared = shared
+        self.organization_id = organization_id
+        self.shards = shards
+        self.start = start
+        self.boundary = boundary
+        self.through = through
+        self.after = None
+        self.records = []
+        self._lock = threading.Lock()
+
+    def _read(self, after):
+        sources = [
+            usage_queries.ingest_source(shard_key, after, self.through, self.start, self.boundary)
+            for shard_key in sharding.shard_keys(self.organization_id, self.shards)
+        ]
+        scan = usage_queries.UsageScan(sources, self.store, shared=self.shared)
+        return [
+            (sharding.base_key(item['user_id'], int(item.get('write_shard') or 0)), item['ingest_key'])
+            for _, items in scan.item_pages() for item in items
+        ]
+
+    def stale(self, watermark, user_id=None):
+        """Whether an entry counted up to `watermark` misses records, of `user_id` when given."""
+        with self._lock:
+            if self.after is None or watermark < self.after:
+                self.records = self._read(watermark)
+                self.after = watermark
+            return any(
+                ingest_key > watermark and (user_id is None or record_user == user_id)
+                for record_user, ingest_key in self.records
+            )
+
+
+def cache_key(kind, settled, params=None):
+    """Key of the cached aggregate of `settled` sources for one kind of report."""
+    payload = json.dumps([kind, params, settled], sort_keys=True, default=str)
+    return f'{kind}:{hashlib.sha256(payload.encode("utf-8")).hexdigest()}'
+
+
+class ResultCache:
+    """
+    LRU of JSON-serializable results, bounded by their serialized size, in
+    front of an optional shared DynamoDB table. The cache lives at module
+    level and therefore survives warm invocations.
+    """
+
+    def __init__(self, max_bytes, shared_table=None, shared_ttl_days=RESULT_CACHE_SHARED_TTL_DAYS, clock=time.time):
+        self.max_bytes = max_bytes
+        self.shared_table = shared_table
+        self.shared_ttl = shared_ttl_days * 86400
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _remember(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous)
+            self._entries[key] = data
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def get(self, key):
+        """The cached value, or None."""
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return json.loads(data)
+        if self.shared_table is not None:
+            try:
+                item = self.shared_table.get_item(Key={'cache_key': key}).get('Item')
+            except Exception as e:
+                logger.warning(f"Shared result cache read failed: {str(e)}")
+                item = None
+            if item is not None:
+                data = zlib.decompress(bytes(getattr(item['value'], 'value', item['value'])))
+                self._remember(key, data)
+                with self._lock:
+                    self.hits += 1
+                return json.loads(data)
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, value):
+        data = json.dumps(value, separators=(',', ':')).encode('utf-8')
+        self._remember(key, data)
+        if self.shared_table is None:
+            return
+        compressed = zlib.compress(data)
+        if len(compressed) > _MAX_SHARED_BYTES:
+            return
+        try:
+            self.shared_table.put_item(Item={
+                'cache_key': key,
+                'value': compressed,
+                'expires_at': int(self.clock() + self.shared_ttl)
+            })
+        except Exception as e:
+            logger.warning(f"Shared result cache write failed: {str(e)}")
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+cache = ResultCache(RESULT_CACHE_BYTES, bootstrap.table(RESULT_CACHE_TABLE) if RESULT_CACHE_TABLE else None)
+
+
+def respond(event, report, settled):
+    """
+    The 200 response for a complete report, with an ETag and Cache-Control,
+    or a 304 without a body when If-None-Match already names it. Reports
+    covering only `settled` time may be reused by clients without asking.
+    """
+    body = json.dumps(report)
+    etag = '"' + hashlib.sha256(body.encode('utf-8')).hexdigest()[:32] + '"'
+    headers = {
+        'ETag': etag,
+        'Cache-Control': f'private, max-age={RESULT_CACHE_MAX_AGE_SECONDS}' if settled else 'private, no-cache'
+    }
+    request_headers = {name.lower(): value for name, value in (event.get('headers') or {}).items()}
+    if_none_match = request_headers.get('if-none-match') or ''
+    tags = [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+    if etag in tags or '*' in tags:
+        return {'statusCode': 304, 'headers': headers, 'body': ''}
+    return {'statusCode': 200, 'headers': headers, 'body': body}
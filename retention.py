@@ -0,0 +1,296 @@
+"""
+Tiered retention: raw usage records expire from DynamoDB into an archive.
+
+With RETENTION_DAYS set, every stored record carries a TTL attribute,
+expires_at, RETENTION_DAYS after its timestamp. DynamoDB deletes expired
+items on its own, usually within a few days, and each deletion is a REMOVE
+event on the usage table's stream made by dynamodb.amazonaws.com.
+archive_function hands those events to archive_records(), which writes the
+expiring records to an object store (see object_store) as compressed,
+append-only segments, one per stream batch, organization and UTC day:
+
+    organization_id=<org>/date=<YYYY-MM-DD>/segment-<sequence number>.ucol
+
+Segments are in the 'columns' format of usage_export and hold its export
+rows, so an archive can also be read with usage_export.scan() and
+cost_report(). A segment is named after the first stream record in it, so a
+retried batch writes the same segment again. Records that end up in two
+segments anyway are read once.
+
+Only deletions made by TTL are archived, so a record is either still in the
+table or in the archive, never both. Cost queries therefore read both for
+the parts of their range older than the hot window (RETENTION_DAYS back
+from now), and only the table for the rest; see usage_queries.build_sources.
+Rollups are not affected by TTL deletions and keep answering whole buckets.
+
+ARCHIVE_BUCKET (with ARCHIVE_PREFIX) keeps the archive in S3, ARCHIVE_DIR in
+a local directory. Without either nothing is archived or read from it.
+Records stored before retention was enabled have no TTL; backfill() sets it:
+
+    python retention.py backfill --table chatgpt_usage_tracking --segments 16
+"""
+import argparse
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+from urllib.parse import quote
+
+import bootstrap
+import item_schema
+import object_store
+import pricing
+import record_keys
+
+# Initialize logging
+logger = logging.getLogger()
+
+# Days a raw record stays in the usage table; 0 sets no TTL
+RETENTION_DAYS = int(os.environ.get('RETENTION_DAYS', '0'))
+TTL_ATTRIBUTE = 'expires_at'
+
+ARCHIVE_BUCKET = os.environ.get('ARCHIVE_BUCKET') or None
+ARCHIVE_PREFIX = os.environ.get('ARCHIVE_PREFIX', '')
+ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR') or None
+
+SEGMENT_FORMAT = 'columns'
+
+# Stream records of deletions made by TTL carry this identity
+_TTL_IDENTITY = {'type': 'Service', 'principalId': 'dynamodb.amazonaws.com'}
+
+
+
+def open_archive():
+    """The configured archive store, or None."""
+    if ARCHIVE_BUCKET:
+        return object_store.S3Store(ARCHIVE_BUCKET, ARCHIVE_PREFIX)
+    if ARCHIVE_DIR:
+        return object_store.DirectoryStore(ARCHIVE_DIR)
+    return None
+
+
+archive = open_archive()
+
+
+def expires_at(ts):
+    """The TTL, in epoch seconds, of a record with epoch milliseconds `ts`, or None."""
+    if not RETENTION_DAYS:
+        return None
+    return int(ts) // 1000 + RETENTION_DAYS * 86400
+
+
+def hot_window_start(now=None):
+    """Timestamps before this may have left the table for the archive."""
+    now = now or datetime.now(timezone.utc)
+    return record_keys.canonical(now - timedelta(days=RETENTION_DAYS))
+
+
+def _codec():
+    # usage_export plans its own reads with usage_queries, which plans archive
+    # reads with this module, so it is imported on first use
+    import usage_export
+    return usage_export
+
+
+def archive_prefix(organization_id, day=None):
+    """Key prefix of an organization's archive, or of one of its days."""
+    prefix = f"organization_id={quote(organization_id, safe='')}/"
+    return prefix if day is None else f'{prefix}date={day}/'
+
+
+def segment_key(organization_id, day, sequence_number):
+    extension = _codec().FORMATS[SEGMENT_FORMAT][0]
+    return f'{archive_prefix(organization_id, day)}segment-{sequence_number}.{extension}'
+
+
+def is_expiry(stream_record):
+    return stream_record.get('eventName') == 'REMOVE' and stream_record.get('userIdentity') == _TTL_IDENTITY
+
+
+def _expired_item(stream_record):
+    """The usage record an expiry event removed, or None for other events."""
+    if not is_expiry(stream_record):
+        return None
+    image = stream_record.get('dynamodb', {}).get('OldImage')
+    if not image:
+        return None
+    item = item_schema.expand_item({k: bootstrap.deserialize(v) for k, v in image.items()})
+    if not all(field in item for field in ('organization_id', 'record_id', 'user_id', 'timestamp', 'total_cost')):
+        logger.error(f"Not archiving usage record without its fields: {item.get('record_id')}")
+        return None
+    return item
+
+
+def archive_records(stream_records, store):
+    """
+    Write the records removed by TTL in a batch of stream records to
+    segments in `store`. Segments are written in stream order, and if one
+    fails the first record in it is reported as the failed item, so Lambda
+    retries from there.
+
+    Returns a Lambda partial batch response.
+    """
+    codec = _codec()
+    segments = {}
+    for stream_record in stream_records:
+        item = _expired_item(stream_record)
+        if item is None:
+            continue
+        row = codec.export_row(item)
+        segment = segments.setdefault(
+            (row['organization_id'], row['timestamp'][:10]),
+            [stream_record['dynamodb']['SequenceNumber'], []]
+        )
+        segment[1].append(row)
+
+    encode = codec.FORMATS[SEGMENT_FORMAT][1]
+    archived = 0
+    for (organization_id, day), (sequence_number, rows) in sorted(segments.items(), key=lambda entry: int(entry[1][0])):
+        rows.sort(key=lambda row: (row['timestamp'], row['record_id']))
+        try:
+            store.put(
+                segment_key(organization_id, day, sequence_number),
+                encode({name: [row[name] for row in rows] for name in codec.EXPORT_COLUMNS})
+            )
+        except Exception as e:
+            logger.error(f"Archive segment write failed: {str(e)}")
+            return {'batchItemFailures': [{'itemIdentifier': sequence_number}]}
+        archived += len(rows)
+    logger.info({'action': 'usage_archive', 'segments': len(segments), 'records': archived})
+    return {'batchItemFailures': []}
+
+
+def _item(row):
+    """The usage record of an archived row."""
+    item = {
+        'organization_id': row['organization_id'],
+        'record_id': row['record_id'],
+        'user_id': row['user_id'],
+        'timestamp': row['timestamp'],
+        'total_cost': pricing.to_decimal(row['cost_nanos'])
+    }
+    if row['ts'] is not None:
+        item['ts'] = row['ts']
+    if row['model_name'] is not None:
+        item['model_name'] = row['model_name']
+    if row['attributes']:
+        item.update(json.loads(row['attributes'], parse_float=Decimal))
+    return item
+
+
+def read_day(store, organization_id, day):
+    """The archived records of one organization and day, once each, in time order."""
+    codec = _codec()
+    extension, _, decode = codec.FORMATS[SEGMENT_FORMAT]
+    records = {}
+    for key in store.list(archive_prefix(organization_id, day)):
+        if not key.endswith(f'.{extension}'):
+            continue
+        columns = decode(store.get(key), codec.EXPORT_COLUMNS)
+        for values in zip(*(columns[name] for name in codec.EXPORT_COLUMNS)):
+            row = dict(zip(codec.EXPORT_COLUMNS, values))
+            records[row['record_id']] = row
+    return [_item(row) for row in sorted(records.values(), key=lambda row: (row['timestamp'], row['record_id']))]
+
+
+def _next_day(store, organization_id, start_after, high):
+    """The first archived day after the key `start_after` and up to `high`, or None. Lists one key."""
+    keys = store.list(archive_prefix(organization_id), start_after=start_after, limit=1)
+    if not keys:
+        return None
+    day = keys[0].split('/')[1][len('date='):]
+    return day if day <= high[:10] else None
+
+
+def query_archive(source, start_key=None, store=None):
+    """
+    One page of an archive source planned by usage_queries: the records of
+    one archived day, with {'day': <next archived day>} as LastEvaluatedKey
+    while more remain. Items are whole records. A page lists the keys of its
+    own day and the first key after it, so a query lists each day once.
+    """
+    store = store or archive
+    if store is None:
+        return {'Items': []}
+    organization_id = source['organization_id']
+    prefix = archive_prefix(organization_id)
+    if start_key:
+        day = start_key['day']
+    else:
+        # Keys of the first day sort after its prefix without the slash
+        day = _next_day(store, organization_id, f"{prefix}date={source['low'][:10]}", source['high'])
+    if day is None:
+        return {'Items': []}
+    items = read_day(store, organization_id, day)
+    if source['scope'] == 'user':
+        items = [item for item in items if item['user_id'] == source['key']]
+    response = {'Items': items}
+    # '~' sorts after every key of the day and before the next day's
+    following = _next_day(store, organization_id, f'{archive_prefix(organization_id, day)}~', source['high'])
+    if following is not None:
+        response['LastEvaluatedKey'] = {'day': following}
+    return response
+
+
+def backfill_segment(client, table_name, segment, total_segments):
+    """Set the TTL of every record in one scan segment that has none, and return counts."""
+    from batch_write import batch_put_items
+    from migrate_record_ids import KEY_FIELDS, scan_pages
+    counts = {'scanned': 0, 'updated': 0, 'skipped': 0, 'failed': 0}
+    for items in scan_pages(client, table_name, segment, total_segments):
+        counts['scanned'] += len(items)
+        updated = []
+        for item in items:
+            if TTL_ATTRIBUTE in item:
+                continue
+            ts = item_schema.expand_item(item).get('ts')
+            try:
+                ts = record_keys.normalize_timestamp(item['timestamp'])[1] if ts is None else ts
+            except (KeyError, ValueError):
+                counts['skipped'] += 1
+                continue
+            updated.append(dict(item, **{TTL_ATTRIBUTE: expires_at(ts)}))
+        # Rewrites are MODIFY events, which the stream consumers ignore
+        errors = batch_put_items(client, table_name, updated, KEY_FIELDS, max_workers=1)
+        failed = sum(1 for error in errors if error)
+        counts['failed'] += failed
+        counts['updated'] += len(updated) - failed
+    return counts
+
+
+def backfill(client, table_name, segments=8):
+    """Backfill the whole table with one worker per scan segment and return the summed counts."""
+    if not RETENTION_DAYS:
+        raise ValueError('Set RETENTION_DAYS to backfill record TTLs')
+    with ThreadPoolExecutor(max_workers=segments) as executor:
+        results = list(executor.map(
+            lambda segment: backfill_segment(client, table_name, segment, segments),
+            range(segments)
+        ))
+    totals = {'scanned': 0, 'updated': 0, 'skipped': 0, 'failed': 0}
+    for counts in results:
+        for name, value in counts.items():
+            totals[name] += value
+    return totals
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Set a TTL on usage records stored before retention was enabled.')
+    parser.add_argument('command', choices=('backfill',))
+    parser.add_argument('--table', default=os.environ.get('DYNAMODB_TABLE', 'chatgpt_usage_tracking'))
+    parser.add_argument('--region', default=os.environ.get('AWS_DEFAULT_REGION', 'us-east-1'))
+    parser.add_argument('--segments', type=int, default=8, help='Parallel scan segments (one worker each)')
+    args = parser.parse_args(argv)
+
+    import boto3
+    logging.basicConfig(level=logging.INFO)
+    client = boto3.client('dynamodb', region_name=args.region)
+    totals = backfill(client, args.table, args.segments)
+    print(json.dumps(totals))
+    return 1 if totals['failed'] else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
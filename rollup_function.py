@@ -0,0 +1,33 @@
+import os
+import logging
+
+import bootstrap
+import metrics
+import rollups
+
+# Initialize logging
+logger = logging.getLogger()
+logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO'))
+
+# DynamoDB tables, connected on first use
+rollup_table_name = os.environ.get('ROLLUP_TABLE_NAME', 'chatgpt_usage_rollups')
+rollup_table = bootstrap.table(rollup_table_name)
+
+@metrics.instrumented('rollup')
+def lambda_handler(event, context):
+    """
+    Consume usage table stream records and add them to the hourly and daily rollups.
+    Returns a partial batch response so Lambda retries only from a failed chunk.
+    """
+    records = event.get('Records', [])
+    with metrics.stage('write'):
+        response = rollups.apply_stream_records(records, rollup_table)
+    metrics.count('records', len(records))
+
+    logger.info({
+        'action': 'rollup_update',
+        'records': len(records),
+        'failed_from': [failure['itemIdentifier'] for failure in response['batchItemFailures']]
+    })
+
+    return response
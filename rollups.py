@@ -0,0 +1,322 @@
+"""
+Pre-aggregated cost rollups maintained from the usage table's stream.
+
+Every usage record adds its cost and a count of one to an hourly row and a
+daily row keyed by (organization, user, model, bucket). Rollup rows live in
+their own table:
+
+    rollup_key       "<organization_id>#H" or "<organization_id>#D"   (hash key)
+    bucket_key       "<bucket>#<user_id>#<model_name>"                 (range key)
+    user_rollup_key  "<user_id>#H" or "<user_id>#D"                    (UserRollupIndex hash key)
+
+Each organization also gets one usage sketch per day (see sketches), stored as
+rollup_key "<organization_id>#S" and bucket_key "<day>". It is merged with
+the day's new records in the same transaction as their cost rows.
+
+Buckets are timestamp prefixes ("2025-03-08T15" for hours, "2025-03-08" for
+days), so a bucket is covered by a string range exactly when every timestamp
+starting with it is. plan_range() splits a query range into whole buckets,
+answered from this table, and the partial buckets at its edges, which are
+read from raw records (see usage_queries).
+"""
+import logging
+import re
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+import bootstrap
+import item_schema
+import pricing
+import sharding
+from sketches import UsageSketch
+
+# Initialize logging
+logger = logging.getLogger()
+
+HOURLY = 'H'
+DAILY = 'D'
+SKETCH = 'S'
+
+# TransactWriteItems accepts at most 100 actions
+MAX_TRANSACTION_ROWS = 100
+
+_HOUR_FORMAT = '%Y-%m-%dT%H'
+_DAY_FORMAT = '%Y-%m-%d'
+_HOUR_PREFIX = re.compile(r'^\d{4}-\d{2}-\d{2}T\d{2}')
+_DAY_PREFIX = re.compile(r'^\d{4}-\d{2}-\d{2}')
+
+
+
+# -- write side --------------------------------------------------------------
+
+def bucket_keys(timestamp):
+    """
+    Return {granularity: bucket} for an ISO 8601 timestamp.
+
+    Only timestamps starting "YYYY-MM-DDTHH" are rolled up. Anything else
+    (date-only values, space separators) would sort outside the hour range of
+    its day and could be counted twice at range edges, so it is left to raw
+    queries.
+    """
+    if not _HOUR_PREFIX.match(timestamp):
+        return {}
+    return {HOURLY: timestamp[:13], DAILY: timestamp[:10]}
+
+
+def _usage_item(stream_record):
+    """Return the inserted usage item for an INSERT event, else None."""
+    if stream_record.get('eventName') != 'INSERT':
+        # Aggregates are append-only; updates and TTL deletes leave them alone
+        return None
+    image = stream_record.get('dynamodb', {}).get('NewImage')
+    if not image:
+        return None
+    item = item_schema.expand_item({k: bootstrap.deserialize(v) for k, v in image.items()})
+    if 'migrated_from' in item:
+        # Rewritten by the record id migration; the original was already counted
+        return None
+    if not all(field in item for field in ('organization_id', 'user_id', 'timestamp', 'total_cost')):
+        logger.error(f"Skipping usage record without rollup fields: {item.get('record_id')}")
+        return None
+    # Sharded records are rolled up under their real organization and user
+    return sharding.unshard_item(item)
+
+
+def _delta_keys(item):
+    model_name = item.get('model_name', 'unknown')
+    return [
+        (item['organization_id'], granularity, bucket, item['user_id'], model_name)
+        for granularity, bucket in bucket_keys(item['timestamp']).items()
+    ]
+
+
+def _sketch_key(item):
+    day = bucket_keys(item['timestamp']).get(DAILY)
+    return (item['organization_id'], day) if day else None
+
+
+def _add_record(deltas, sketches, keys, sketch_key, item):
+    cost = Decimal(str(item['total_cost']))
+    for key in keys:
+        delta = deltas.setdefault(key, [Decimal('0'), 0])
+        delta[0] += cost
+        delta[1] += 1
+    if sketch_key is not None:
+        sketch = sketches.get(sketch_key)
+        if sketch is None:
+            sketch = sketches[sketch_key] = UsageSketch()
+        sketch.add(item['user_id'], item.get('model_name', 'unknown'), pricing.to_nanos(cost))
+
+
+def _update_action(table_name, key, delta):
+    org_id, granularity, bucket, user_id, model_name = key
+    cost, count = delta
+    values = {
+        ':cost': cost,
+        ':count': count,
+        ':org': org_id,
+        ':uid': user_id,
+        ':model': model_name,
+        ':bucket': bucket,
+        ':urk': f'{user_id}#{granularity}'
+    }
+    return {
+        'Update': {
+            'TableName': table_name,
+            'Key': {
+                'rollup_key': bootstrap.serialize(f'{org_id}#{granularity}'),
+                'bucket_key': bootstrap.serialize(f'{bucket}#{user_id}#{model_name}')
+            },
+            'UpdateExpression': (
+                'ADD total_cost :cost, usage_count :count '
+                'SET organization_id = :org, user_id = :uid, model_name = :model, '
+                'bucket = :bucket, user_rollup_key = :urk'
+            ),
+            'ExpressionAttributeValues': {k: bootstrap.serialize(v) for k, v in values.items()}
+        }
+    }
+
+
+def sketch_bytes(value):
+    """Raw bytes of a stored sketch attribute, which boto3 returns as Binary."""
+    return bytes(getattr(value, 'value', value))
+
+
+def _sketch_action(rollup_table, key, sketch):
+    """
+    Merge `sketch` into the stored sketch for (organization, day).
+
+    The stored sketch is read first and written back only if its version has
+    not moved, so concurrent shards of the stream cannot lose each other's
+    records; a conflict fails the transaction and Lambda retries the chunk.
+    """
+    org_id, day = key
+    row_key = {'rollup_key': f'{org_id}#{SKETCH}', 'bucket_key': day}
+    current = rollup_table.get_item(Key=row_key, ConsistentRead=True).get('Item')
+    values = {':org': org_id, ':bucket': day}
+    if current is None:
+        condition = 'attribute_not_exists(sketch_version)'
+        values[':next'] = 1
+    else:
+        merged = UsageSketch.from_bytes(sketch_bytes(current['sketch']))
+        merged.merge(sketch)
+        sketch = merged
+        condition = 'sketch_version = :version'
+        values[':version'] = int(current['sketch_version'])
+        values[':next'] = int(current['sketch_version']) + 1
+    values[':sketch'] = sketch.to_bytes()
+    return {
+        'Update': {
+            'TableName': rollup_table.name,
+            'Key': {k: bootstrap.serialize(v) for k, v in row_key.items()},
+            'UpdateExpression': (
+                'SET sketch = :sketch, sketch_version = :next, organization_id = :org, bucket = :bucket'
+            ),
+            'ConditionExpression': condition,
+            'ExpressionAttributeValues': {k: bootstrap.serialize(v) for k, v in values.items()}
+        }
+    }
+
+
+def _commit(rollup_table, deltas, sketches):
+    actions = [_update_action(rollup_table.name, key, delta) for key, delta in deltas.items()]
+    actions.extend(_sketch_action(rollup_table, key, sketch) for key, sketch in sketches.items())
+    rollup_table.meta.client.transact_write_items(TransactItems=actions)
+
+
+def apply_stream_records(stream_records, rollup_table):
+    """
+    Add a batch of stream records to the rollup table.
+
+    Records are folded, in stream order, into chunks touching at most
+    MAX_TRANSACTION_ROWS rows (cost rows and sketches), and each chunk is
+    committed atomically with TransactWriteItems. If a chunk fails, processing
+    stops and the first record of that chunk is reported as the failed item.
+    Lambda then retries from that record only, so nothing already committed is
+    counted twice.
+
+    Returns a Lambda partial batch response.
+    """
+    deltas = {}
+    sketches = {}
+    chunk_start = None
+    for stream_record in stream_records:
+        item = _usage_item(stream_record)
+        if item is None:
+            continue
+        keys = _delta_keys(item)
+        sketch_key = _sketch_key(item)
+        new_rows = sum(1 for key in keys if key not in deltas)
+        if sketch_key is not None and sketch_key not in sketches:
+            new_rows += 1
+        if len(deltas) + len(sketches) + new_rows > MAX_TRANSACTION_ROWS:
+            # Commit the chunk so far and start a new one with this record
+            try:
+                _commit(rollup_table, deltas, sketches)
+            except Exception as e:
+                logger.error(f"Rollup commit failed: {str(e)}")
+                return {'batchItemFailures': [{'itemIdentifier': chunk_start}]}
+            deltas, sketches = {}, {}
+            chunk_start = None
+        _add_record(deltas, sketches, keys, sketch_key, item)
+        if chunk_start is None:
+            chunk_start = stream_record['dynamodb']['SequenceNumber']
+
+    if deltas or sketches:
+        try:
+            _commit(rollup_table, deltas, sketches)
+        except Exception as e:
+            logger.error(f"Rollup commit failed: {str(e)}")
+            return {'batchItemFailures': [{'itemIdentifier': chunk_start}]}
+    return {'batchItemFailures': []}
+
+
+# -- read side ---------------------------------------------------------------
+
+def _next_hour(hour):
+    return (datetime.strptime(hour, _HOUR_FORMAT) + timedelta(hours=1)).strftime(_HOUR_FORMAT)
+
+
+def _previous_hour(hour):
+    return (datetime.strptime(hour, _HOUR_FORMAT) - timedelta(hours=1)).strftime(_HOUR_FORMAT)
+
+
+def _shift_day(day, days):
+    return (datetime.strptime(day, _DAY_FORMAT) + timedelta(days=days)).strftime(_DAY_FORMAT)
+
+
+def _first_full_hour(start):
+    """Earliest hour bucket whose timestamps are all >= start, or None."""
+    try:
+        if _HOUR_PREFIX.match(start):
+            hour = start[:13]
+            return hour if hour >= start else _next_hour(hour)
+        if len(start) == 10 and _DAY_PREFIX.match(start):
+            return f'{start}T00'
+    except ValueError:
+        pass
+    return None
+
+
+def _last_full_hour(end):
+    """Latest hour bucket whose timestamps are all <= end, or None."""
+    try:
+        if _HOUR_PREFIX.match(end):
+            # end itself starts with this hour, so the hour is only partly covered
+            return _previous_hour(end[:13])
+        if len(end) == 10 and _DAY_PREFIX.match(end):
+            return f'{_shift_day(end, -1)}T23'
+    except ValueError:
+        pass
+    return None
+
+
+def _successor(prefix):
+    """Smallest string greater than every string starting with `prefix`."""
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def plan_range(start, end, rollup_start=None, end_exclusive=False):
+    """
+    Split the inclusive string range [start, end] into rollup and raw parts.
+    With `end_exclusive`, `end` is an hour bucket and the range is [start, end).
+
+    Returns a dict with:
+      days   (first_day, last_day) answered from daily rollups, or None
+      hours  list of (first_hour, last_hour) answered from hourly rollups
+      raw    list of (low, high, high_exclusive) ranges to read from raw
+             records; with high_exclusive set, a timestamp equal to high
+             belongs to a rollup and must be skipped
+
+    Buckets before `rollup_start` (when rollups began) are read raw.
+    """
+    whole_range = {'days': None, 'hours': [], 'raw': [(start, end, end_exclusive)]}
+    first = _first_full_hour(start)
+    last = _previous_hour(end) if end_exclusive else _last_full_hour(end)
+    if rollup_start:
+        cutover = _first_full_hour(rollup_start)
+        if cutover is None:
+            return whole_range
+        if first is not None:
+            first = max(first, cutover)
+    if first is None or last is None or first > last:
+        return whole_range
+
+    plan = {'days': None, 'hours': [], 'raw': []}
+    first_day = first[:10] if first[11:13] == '00' else _shift_day(first[:10], 1)
+    last_day = last[:10] if last[11:13] == '23' else _shift_day(last[:10], -1)
+    if first_day <= last_day:
+        plan['days'] = (first_day, last_day)
+        if first < f'{first_day}T00':
+            plan['hours'].append((first, _previous_hour(f'{first_day}T00')))
+        if last > f'{last_day}T23':
+            plan['hours'].append((f'{_shift_day(last_day, 1)}T00', last))
+    else:
+        plan['hours'].append((first, last))
+
+    if start < first:
+        plan['raw'].append((start, first, True))
+    tail_start = _successor(last)
+    if tail_start <= end:
+        plan['raw'].append((tail_start, end, end_exclusive))
+    return plan
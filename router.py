@@ -0,0 +1,78 @@
+"""
+Single-function deployment: one Lambda serving every API route.
+
+With FunctionLayout=router in template.yaml, each API Gateway method
+integrates with this function instead of its own one. lambda_handler()
+picks the existing handler by method and path and passes the event to it
+unchanged, so handlers behave exactly as they do deployed on their own.
+
+All handler modules are imported when the function starts. They share
+auth, pricing, bootstrap and the other common modules, so one warm
+execution environment holds one DynamoDB resource and connection pool, one
+token cache and one result cache for every route. The separate four-function
+layout (FunctionLayout=separate) remains the default.
+"""
+import json
+import logging
+
+import get_costs_function
+import get_org_costs_function
+import lambda_function
+import register_org_function
+
+# Initialize logging
+logger = logging.getLogger()
+
+# path -> {method: handler}
+ROUTES = {
+    '/track': {'POST': lambda_function.lambda_handler},
+    '/track/batch': {'POST': lambda_function.lambda_handler},
+    '/costs': {'GET': get_costs_function.lambda_handler},
+    '/costs/batch': {'POST': get_costs_function.lambda_handler},
+    '/organization-costs': {'GET': get_org_costs_function.lambda_handler},
+    '/organization-stats': {'GET': get_org_costs_function.lambda_handler},
+    '/usage-export': {'GET': get_org_costs_function.lambda_handler},
+    '/register-organization': {'POST': register_org_function.lambda_handler},
+}
+
+
+def request_route(event):
+    """The (method, path) of an API Gateway proxy event."""
+    http = event.get('requestContext', {}).get('http', {})
+    method = (event.get('httpMethod') or http.get('method') or '').upper()
+    path = event.get('resource') or event.get('path') or event.get('rawPath') or ''
+    return method, path.rstrip('/') or '/'
+
+
+def find_handler(method, path):
+    """Return (handler, allowed methods); handler is None when nothing matches."""
+    methods = ROUTES.get(path)
+    if methods is None:
+        # Stage-prefixed paths such as /prod/costs end with a route
+        methods = next((found for route, found in ROUTES.items() if path.endswith(route)), None)
+    if methods is None:
+        return None, ()
+    return methods.get(method), tuple(sorted(methods))
+
+
+def lambda_handler(event, context):
+    method, path = request_route(event)
+    handler, allowed = find_handler(method, path)
+    if handler is not None:
+        return handler(event, context)
+
+    if not allowed:
+        logger.warning(f"No route for {method} {path}")
+        return {
+            'statusCode': 404,
+            'body': json.dumps({
+                'error': 'Not found'
+            })
+        }
+    return {
+        'statusCode': 405,
+        'headers': {'Allow': ', '.join(allowed)},
+        'body': json.dumps({
+            'error': f'Method {method} not allowed'
+        })
+    }
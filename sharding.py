@@ -0,0 +1,225 @@
+"""
+Write sharding for busy organizations.
+
+All usage for an organization shares one partition key, and the GSIs are
+keyed by a single organization or user value, so one very busy organization
+can throttle while the rest of the table sits idle. With WRITE_SHARDING
+enabled, an organization writing faster than WRITE_SHARD_RATE records per
+second (as seen by one container) has its records spread over up to
+MAX_WRITE_SHARDS key values: "org_1", "org_1#1", "org_1#2", ... and likewise
+for user_id. Shard 0 keeps the plain key, so unsharded data needs no
+migration. Sharded items carry a `write_shard` attribute so the suffix can
+be stripped again.
+
+The shard count lives on the organization record (`write_shards`) and only
+ever grows, so readers that query every shard up to it never miss a record.
+"""
+import json
+import logging
+import math
+import os
+import random
+import threading
+import time
+from collections import deque
+
+# Initialize logging
+logger = logging.getLogger()
+
+WRITE_SHARDING = os.environ.get('WRITE_SHARDING', 'false').lower() == 'true'
+WRITE_SHARD_RATE = float(os.environ.get('WRITE_SHARD_RATE', '200'))
+MAX_WRITE_SHARDS = int(os.environ.get('MAX_WRITE_SHARDS', '8'))
+
+# Write rates are measured over this window and reported at most once per window per org
+WRITE_RATE_WINDOW_SECONDS = float(os.environ.get('WRITE_RATE_WINDOW_SECONDS', '60'))
+
+# How long a writer trusts its copy of an organization's shard count
+SHARD_COUNT_TTL_SECONDS = float(os.environ.get('SHARD_COUNT_TTL_SECONDS', '60'))
+# How long a reader does. Records written to a shard added meanwhile are
+# missed for that long, so it is kept short.
+READ_SHARD_COUNT_TTL_SECONDS = float(os.environ.get('READ_SHARD_COUNT_TTL_SECONDS', '5'))
+
+SHARD_SEPARATOR = '#'
+
+
+def shard_key(value, shard):
+    """Key value for one shard. Shard 0 is the plain value."""
+    return value if not shard else f'{value}{SHARD_SEPARATOR}{shard}'
+
+
+def shard_keys(value, shards):
+    """Every key value a reader has to query for `shards` shards."""
+    return [shard_key(value, shard) for shard in range(max(1, shards))]
+
+
+def base_key(value, shard):
+    """Strip the shard suffix added by shard_key."""
+    suffix = f'{SHARD_SEPARATOR}{shard}'
+    if shard and isinstance(value, str) and value.endswith(suffix):
+        return value[:-len(suffix)]
+    return value
+
+
+def unshard_item(item):
+    """Return the item with its organization and user ids restored."""
+    shard = int(item.get('write_shard') or 0)
+    if not shard:
+        return item
+    item = dict(item)
+    for field in ('organization_id', 'user_id'):
+        if field in item:
+            item[field] = base_key(item[field], shard)
+    return item
+
+
+def pick_shard(shards, rng=random):
+    """A random shard out of `shards`."""
+    return rng.randrange(shards) if shards > 1 else 0
+
+
+def shard_item(item, shards, rng=random):
+    """Place an item on a random shard out of `shards`."""
+    return item_on_shard(item, pick_shard(shards, rng))
+
+
+def item_on_shard(item, shard):
+    """Place an item on the given shard."""
+    if not shard:
+        return item
+    item = dict(item)
+    item['organization_id'] = shard_key(item['organization_id'], shard)
+    item['user_id'] = shard_key(item['user_id'], shard)
+    item['write_shard'] = shard
+    return item
+
+
+def required_shards(rate):
+    """Shards needed to keep every shard under WRITE_SHARD_RATE."""
+    if WRITE_SHARD_RATE <= 0:
+        return 1
+    return max(1, min(MAX_WRITE_SHARDS, math.ceil(rate / WRITE_SHARD_RATE)))
+
+
+def org_write_shards(org_table, organization_id):
+    """Current shard count of an organization, read consistently."""
+    response = org_table.get_item(
+        Key={'organization_id': organization_id},
+        ProjectionExpression='write_shards',
+        ConsistentRead=True
+    )
+    return max(1, int(response.get('Item', {}).get('write_shards', 1)))
+
+
+def raise_write_shards(org_table, organization_id, shards):
+    """
+    Raise an organization's shard count to at least `shards` and return the
+    resulting count. The count never goes down.
+    """
+    try:
+        org_table.update_item(
+            Key={'organization_id': organization_id},
+            UpdateExpression='SET write_shards = :shards',
+            # AND binds tighter than OR; a record with write_shards always exists
+            ConditionExpression='attribute_exists(organization_id) AND attribute_not_exists(write_shards) '
+                                'OR write_shards < :shards',
+            ExpressionAttributeValues={':shards': shards}
+        )
+        logger.info(f"Raised write shards for {organization_id} to {shards}")
+        return shards
+    except Exception as e:
+        if getattr(e, 'response', {}).get('Error', {}).get('Code') != 'ConditionalCheckFailedException':
+            raise
+        # Someone else raised it further, or the organization doesn't exist
+        return org_write_shards(org_table, organization_id)
+
+
+class WriteRateTracker:
+    """
+    Records written per organization over a sliding window, as seen by this
+    container. Lives at module level so it survives warm invocations.
+    """
+
+    def __init__(self, window=WRITE_RATE_WINDOW_SECONDS, clock=time.monotonic):
+        self.window = window
+        self.clock = clock
+        self._events = {}
+        self._reported = {}
+        self._lock = threading.Lock()
+
+    def record(self, organization_id, count):
+        """Add `count` writes and return the organization's current rate per second."""
+        now = self.clock()
+        with self._lock:
+            events = self._events.setdefault(organization_id, deque())
+            events.append((now, count))
+            while events and events[0][0] <= now - self.window:
+                events.popleft()
+            return sum(n for _, n in events) / self.window
+
+    def due_for_report(self, organization_id):
+        """True at most once per window for each organization."""
+        now = self.clock()
+        with self._lock:
+            last = self._reported.get(organization_id)
+            if last is not None and now - last < self.window:
+                return False
+            self._reported[organization_id] = now
+            return True
+
+
+write_rates = WriteRateTracker()
+
+# organization_id -> (expires_at, shard count) for the write and read paths
+_shard_counts = {}
+_read_shard_counts = {}
+_shard_counts_lock = threading.Lock()
+
+
+def _known_shards(store, organization_id, counts=None, ttl=None):
+    counts = _shard_counts if counts is None else counts
+    ttl = SHARD_COUNT_TTL_SECONDS if ttl is None else ttl
+    now = time.monotonic()
+    with _shard_counts_lock:
+        entry = counts.get(organization_id)
+    if entry and entry[0] > now:
+        return entry[1]
+    shards = store.write_shards(organization_id)
+    with _shard_counts_lock:
+        counts[organization_id] = (now + ttl, shards)
+    return shards
+
+
+def read_shards(store, organization_id):
+    """
+    Shards a reader queries for an organization: 1 when WRITE_SHARDING is
+    off, otherwise the stored count, cached for READ_SHARD_COUNT_TTL_SECONDS.
+    """
+    if not WRITE_SHARDING:
+        return 1
+    return _known_shards(store, organization_id, _read_shard_counts, READ_SHARD_COUNT_TTL_SECONDS)
+
+
+def write_shards_for(store, organization_id, count):
+    """
+    Record `count` writes for an organization and return how many shards to
+    spread them over. `store` holds the shard counts (see storage). Emits the
+    organization's write rate once per window.
+    """
+    rate = write_rates.record(organization_id, count)
+    shards = 1
+    if WRITE_SHARDING:
+        shards = _known_shards(store, organization_id)
+        needed = required_shards(rate)
+        if needed > shards:
+            shards = store.raise_write_shards(organization_id, needed)
+            with _shard_counts_lock:
+                _shard_counts[organization_id] = (time.monotonic() + SHARD_COUNT_TTL_SECONDS, shards)
+    if write_rates.due_for_report(organization_id):
+        logger.info(json.dumps({
+            'metric': 'org_write_rate',
+            'organization_id': organization_id,
+            'records_per_second': round(rate, 3),
+            'write_shards': shards,
+            'shards_needed': required_shards(rate)
+        }))
+    return shards
@@ -0,0 +1,276 @@
+"""
+Mergeable usage sketches.
+
+A UsageSketch summarizes any number of usage records in a few kilobytes:
+
+    distinct users    HyperLogLog with 2**HLL_PRECISION registers. The
+                      standard error is 1.04 / sqrt(registers), 1.6%
+    cost per request  t-digest with compression TDIGEST_COMPRESSION. The rank
+                      error at quantile q stays under 2q(1-q) / compression
+    spend by user     count-min sketch of nano-dollars, CMS_DEPTH rows of
+    and by model      CMS_WIDTH counters, with the TOP_K largest users and
+                      models as candidates. An estimate exceeds the true
+                      spend by at most e / CMS_WIDTH of the total, with
+                      probability 1 - e**-CMS_DEPTH
+    count, total      exact
+
+The sketch of a union is the merge of the sketches of its parts, so a range
+of days is answered by merging one sketch per day. The rollup consumer keeps
+one per organization and day (see rollups).
+"""
+import hashlib
+import json
+import math
+import struct
+import sys
+import zlib
+from array import array
+
+HLL_PRECISION = 12
+TDIGEST_COMPRESSION = 100
+CMS_WIDTH = 512
+CMS_DEPTH = 4
+TOP_K = 20
+
+# Points buffered by a t-digest before they are merged into its centroids
+_TDIGEST_BUFFER = 500
+_MASK64 = (1 << 64) - 1
+
+
+def _little_endian(values):
+    """Copy of an array in little-endian byte order, the stored layout."""
+    values = array(values.typecode, values)
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return values
+
+
+def _from_little_endian(typecode, data):
+    values = array(typecode)
+    values.frombytes(data)
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return values
+
+
+class HyperLogLog:
+    """Distinct count estimate over string values."""
+
+    def __init__(self, precision=HLL_PRECISION, registers=None):
+        self.precision = precision
+        self.registers = bytearray(registers) if registers is not None else bytearray(1 << precision)
+
+    def add(self, value):
+        digest = int.from_bytes(hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest(), 'little')
+        bits = 64 - self.precision
+        index = digest >> bits
+        rank = bits - (digest & ((1 << bits) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def estimate(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -register for register in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            # Linear counting is more accurate while many registers are empty
+            estimate = m * math.log(m / zeros)
+        return estimate
+
+    def relative_error(self):
+        return 1.04 / math.sqrt(len(self.registers))
+
+
+class TDigest:
+    """Quantile estimates over weighted values, most accurate at the tails."""
+
+    def __init__(self, compression=TDIGEST_COMPRESSION, centroids=None, minimum=None, maximum=None):
+        self.compression = compression
+        self.centroids = centroids or []
+        self.min = minimum
+        self.max = maximum
+        self._buffer = []
+
+    def add(self, value, weight=1):
+        self._buffer.append((value, weight))
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        if len(self._buffer) >= _TDIGEST_BUFFER:
+            self._compress()
+
+    def merge(self, other):
+        other._compress()
+        self._buffer.extend(other.centroids)
+        for value in (other.min, other.max):
+            if value is not None:
+                self.min = value if self.min is None else min(self.min, value)
+                self.max = value if self.max is None else max(self.max, value)
+        self._compress()
+
+    def _compress(self):
+        """Merge the buffer into the centroids, keeping each under its size limit."""
+        if not self._buffer:
+            return
+        points = sorted(self.centroids + self._buffer)
+        self._buffer = []
+        total = sum(weight for _, weight in points)
+        centroids = []
+        before = 0
+        mean, weight = points[0]
+        for value, value_weight in points[1:]:
+            q = (before + (weight + value_weight) / 2) / total
+            if weight + value_weight <= 4 * total * q * (1 - q) / self.compression:
+                weight += value_weight
+                mean += (value - mean) * value_weight / weight
+            else:
+                centroids.append((mean, weight))
+                before += weight
+                mean, weight = value, value_weight
+        centroids.append((mean, weight))
+        self.centroids = centroids
+
+    def quantile(self, q):
+        """The value at quantile q (0 to 1), or None when empty."""
+        self._compress()
+        if not self.centroids:
+            return None
+        total = sum(weight for _, weight in self.centroids)
+        # Interpolate between centroid centers, anchored at the exact min and max
+        ranks, values = [0.0], [self.min]
+        cumulative = 0
+        for mean, weight in self.centroids:
+            ranks.append(cumulative + weight / 2)
+            values.append(mean)
+            cumulative += weight
+        ranks.append(total)
+        values.append(self.max)
+        target = q * total
+        for i in range(1, len(ranks)):
+            if target <= ranks[i]:
+                span = ranks[i] - ranks[i - 1]
+                if span <= 0:
+                    return values[i]
+                return values[i - 1] + (values[i] - values[i - 1]) * (target - ranks[i - 1]) / span
+        return self.max
+
+    def rank_error(self, q):
+        return 2 * q * (1 - q) / self.compression
+
+
+class CountMinSketch:
+    """Upper-bound estimates of per-key totals."""
+
+    def __init__(self, width=CMS_WIDTH, depth=CMS_DEPTH, counts=None):
+        self.width = width
+        self.depth = depth
+        self.counts = counts if counts is not None else array('q', bytes(8 * width * depth))
+
+    def _cells(self, key):
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        return [row * self.width + ((first + row * second) & _MASK64) % self.width for row in range(self.depth)]
+
+    def add(self, key, amount):
+        for cell in self._cells(key):
+            self.counts[cell] += amount
+
+    def estimate(self, key):
+        return min(self.counts[cell] for cell in self._cells(key))
+
+    def merge(self, other):
+        self.counts = array('q', map(int.__add__, self.counts, other.counts))
+
+    def error(self, total):
+        """Largest overestimate, with probability 1 - e**-depth, given the sum of all amounts."""
+        return math.e / self.width * total
+
+
+class UsageSketch:
+    """Distinct users, cost percentiles and top spenders of a set of usage records."""
+
+    def __init__(self):
+        self.users = HyperLogLog()
+        self.costs = TDigest()
+        self.spend = CountMinSketch()
+        self.top_users = {}
+        self.top_models = {}
+        self.count = 0
+        self.cost_nanos = 0
+
+    def add(self, user_id, model_name, cost_nanos):
+        self.users.add(user_id)
+        self.costs.add(cost_nanos / 1e9)
+        self.count += 1
+        self.cost_nanos += cost_nanos
+        self._add_spend(self.top_users, 'user', user_id, cost_nanos)
+        self._add_spend(self.top_models, 'model', model_name, cost_nanos)
+
+    def _add_spend(self, top, kind, key, cost_nanos):
+        spend_key = f'{kind}#{key}'
+        self.spend.add(spend_key, cost_nanos)
+        top[key] = self.spend.estimate(spend_key)
+        if len(top) > TOP_K:
+            del top[min(top, key=top.get)]
+
+    def _top(self, top, kind, limit):
+        """Re-estimated candidates, largest first."""
+        ranked = sorted(((self.spend.estimate(f'{kind}#{key}'), key) for key in top), reverse=True)
+        return [(key, estimate) for estimate, key in ranked[:limit]]
+
+    def merge(self, other):
+        self.users.merge(other.users)
+        self.costs.merge(other.costs)
+        self.spend.merge(other.spend)
+        self.count += other.count
+        self.cost_nanos += other.cost_nanos
+        self.top_users = dict(self._top(dict(self.top_users, **other.top_users), 'user', TOP_K))
+        self.top_models = dict(self._top(dict(self.top_models, **other.top_models), 'model', TOP_K))
+
+    def top_spenders(self, limit=TOP_K):
+        """([(user_id, nanos)], [(model_name, nanos)]), largest first. Estimates never undercount."""
+        return self._top(self.top_users, 'user', limit), self._top(self.top_models, 'model', limit)
+
+    def to_bytes(self):
+        self.costs._compress()
+        centroids = array('d', [value for centroid in self.costs.centroids for value in centroid])
+        header = json.dumps({
+            'count': self.count,
+            'cost_nanos': self.cost_nanos,
+            'min': self.costs.min,
+            'max': self.costs.max,
+            'centroids': len(self.costs.centroids),
+            'top_users': self.top_users,
+            'top_models': self.top_models
+        }, separators=(',', ':')).encode('utf-8')
+        body = b''.join([
+            struct.pack('<I', len(header)), header, bytes(self.users.registers),
+            _little_endian(self.spend.counts).tobytes(), _little_endian(centroids).tobytes()
+        ])
+        return zlib.compress(body)
+
+    @classmethod
+    def from_bytes(cls, data):
+        body = zlib.decompress(data)
+        (header_length,) = struct.unpack('<I', body[:4])
+        header = json.loads(body[4:4 + header_length])
+        sketch = cls()
+        offset = 4 + header_length
+        registers = len(sketch.users.registers)
+        sketch.users.registers = bytearray(body[offset:offset + registers])
+        offset += registers
+        cells = 8 * CMS_WIDTH * CMS_DEPTH
+        sketch.spend.counts = _from_little_endian('q', body[offset:offset + cells])
+        offset += cells
+        values = _from_little_endian('d', body[offset:offset + 16 * header['centroids']])
+        sketch.costs = TDigest(
+            centroids=list(zip(values[0::2], values[1::2])), minimum=header['min'], maximum=header['max']
+        )
+        sketch.count = header['count']
+        sketch.cost_nanos = header['cost_nanos']
+        sketch.top_users = header['top_users']
+        sketch.top_models = header['top_models']
+        return sketch
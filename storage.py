@@ -0,0 +1,488 @@
+"""
+Storage backends for usage records and organizations.
+
+Handlers never talk to a database directly. Each module opens a store with
+open_storage() and uses this interface:
+
+    put_usage(item)                      store one usage record
+    put_usage_batch(items, max_workers)  store many; returns a list aligned with
+                                         items of None or an error message
+    query_usage(source, start_key)       one page of a query source planned by
+                                         usage_queries: {'Items': [...]} plus
+                                         'LastEvaluatedKey' while more remain.
+                                         Items hold the projected attributes,
+                                         or every attribute for 'full' sources
+    get_usage(organization_id, record_id)
+                                         one stored usage record, or None
+    find_organization(auth_token)        the organization owning a token, or None
+    organizations()                      every organization, for cache prefetch
+    put_organization(item)               store an organization record
+    write_shards(organization_id)        the organization's write shard count
+    raise_write_shards(organization_id, shards)
+                                         raise it (never lower) and return it
+    has_rollups                          whether rollup sources can be queried
+    usage_sketches(organization_id, first_day, last_day)
+                                         (day, bytes) for each stored daily
+                                         usage sketch (see sketches)
+
+STORAGE_BACKEND selects the implementation. 'dynamodb' (the default) uses the
+tables deployed by template.yaml. 'sqlite' keeps everything in one embedded
+SQLite database at SQLITE_PATH, for running the tracker without AWS. Rollups
+are maintained from the DynamoDB stream, so only the DynamoDB backend has
+them; SQLite answers every range from raw records through covering indexes.
+"""
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+from decimal import Decimal
+
+import bootstrap
+import item_schema
+import sharding
+
+# Initialize logging
+logger = logging.getLogger()
+
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'dynamodb').lower()
+if STORAGE_BACKEND not in ('dynamodb', 'sqlite'):
+    raise ValueError(f'Unknown STORAGE_BACKEND: {STORAGE_BACKEND}')
+
+SQLITE_PATH = os.environ.get('SQLITE_PATH', 'usage.db')
+# Rows per query page, and rows per write transaction
+SQLITE_PAGE_ITEMS = int(os.environ.get('SQLITE_PAGE_ITEMS', '5000'))
+SQLITE_BATCH_ROWS = int(os.environ.get('SQLITE_BATCH_ROWS', '500'))
+SQLITE_BUSY_TIMEOUT_SECONDS = float(os.environ.get('SQLITE_BUSY_TIMEOUT_SECONDS', '5'))
+
+
+def client_query(table, query):
+    """
+    Run a Table.query through the table's low-level client, which unlike the
+    resource objects is safe to share between threads. Takes and returns
+    plain Python values, like Table.query.
+    """
+    params = dict(query, TableName=table.name)
+    params['ExpressionAttributeValues'] = {
+        k: bootstrap.serialize(v) for k, v in query['ExpressionAttributeValues'].items()
+    }
+    if query.get('ExclusiveStartKey'):
+        params['ExclusiveStartKey'] = {k: bootstrap.serialize(v) for k, v in query['ExclusiveStartKey'].items()}
+    response = table.meta.client.query(**params)
+    result = {'Items': [{k: bootstrap.deserialize(v) for k, v in item.items()} for item in response['Items']]}
+    if response.get('LastEvaluatedKey'):
+        result['LastEvaluatedKey'] = {k: bootstrap.deserialize(v) for k, v in response['LastEvaluatedKey'].items()}
+    return result
+
+
+USAGE_KEY_FIELDS = ('organization_id', 'record_id')
+
+
+class DynamoDBStorage:
+    """
+    The usage, organization and (optional) rollup tables in DynamoDB.
+    Any of them may be a boto3 Table, a LazyTable or a test fake. boto3 is
+    imported on first use, like the clients themselves (see bootstrap).
+    """
+
+    def __init__(self, table=None, org_table=None, rollup_table=None):
+        self.table = table
+        self.org_table = org_table
+        self.rollup_table = rollup_table
+
+    @property
+    def has_rollups(self):
+        return self.rollup_table is not None
+
+    def put_usage(self, item):
+        self.table.put_item(Item=item_schema.compact_item(item) if item_schema.COMPACT_ITEMS else item)
+
+    def put_usage_batch(self, items, max_workers=8):
+        """Parallel BatchWriteItem calls, 25 items each, with retries."""
+        from batch_write import batch_put_items
+        if item_schema.COMPACT_ITEMS:
+            items = [item_schema.compact_item(item) for item in items]
+        return batch_put_items(
+            self.table.meta.client, self.table.name, items,
+            key_fields=USAGE_KEY_FIELDS,
+            max_workers=max_workers
+        )
+
+    def query_usage(self, source, start_key=None, shared=False):
+        """
+        One page of a raw or rollup source. With `shared` the query runs on
+        the thread-safe low-level client, for callers on worker threads.
+        Compact usage items are expanded (see item_schema).
+        """
+        query = dict(source['query'])
+        if start_key:
+            query['ExclusiveStartKey'] = start_key
+        if source['kind'] == 'rollup':
+            return client_query(self.rollup_table, query) if shared else self.rollup_table.query(**query)
+        response = client_query(self.table, query) if shared else self.table.query(**query)
+        items = response['Items']
+        if source.get('full') and query.get('IndexName') and not item_schema.projects_whole_items(query['IndexName']) and items:
+            # The index holds only the aggregated attributes
+            from batch_write import batch_get_items
+            items = [
+                item for item in batch_get_items(self.table.meta.client, self.table.name, items, USAGE_KEY_FIELDS)
+                if item is not None
+            ]
+        response['Items'] = [item_schema.expand_item(item) for item in items]
+        return response
+
+    def get_usage(self, organization_id, record_id):
+        response = self.table.get_item(Key={'organization_id': organization_id, 'record_id': record_id})
+        item = response.get('Item')
+        return item_schema.expand_item(item) if item is not None else None
+
+    def usage_sketches(self, organization_id, first_day, last_day):
+        """Daily sketches kept in the rollup table by the stream consumer."""
+        import rollups
+        query = {
+            'KeyConditionExpression': 'rollup_key = :key AND bucket_key BETWEEN :low AND :high',
+            'ExpressionAttributeValues': {
+                ':key': f'{organization_id}#{rollups.SKETCH}', ':low': first_day, ':high': last_day
+            },
+            'ProjectionExpression': 'bucket_key, sketch'
+        }
+        while True:
+            response = self.rollup_table.query(**query)
+            for item in response.get('Items', []):
+                yield item['bucket_key'], rollups.sketch_bytes(item['sketch'])
+            if 'LastEvaluatedKey' not in response:
+                return
+            query['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    def find_organization(self, auth_token):
+        response = self.org_table.query(
+            IndexName='AuthTokenIndex',
+            KeyConditionExpression='auth_token = :token',
+            ExpressionAttributeValues={':token': auth_token}
+        )
+        return response['Items'][0] if response.get('Items') else None
+
+    def organizations(self):
+        """Paginated scan of the token, id and status of every organization."""
+        scan_kwargs = {
+            'ProjectionExpression': 'auth_token, organization_id, #st',
+            'ExpressionAttributeNames': {'#st': 'status'}
+        }
+        while True:
+            response = self.org_table.scan(**scan_kwargs)
+            yield from response.get('Items', [])
+            if 'LastEvaluatedKey' not in response:
+                return
+            scan_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    def put_organization(self, item):
+        self.org_table.put_item(Item=item)
+
+    def write_shards(self, organization_id):
+        return sharding.org_write_shards(self.org_table, organization_id)
+
+    def raise_write_shards(self, organization_id, shards):
+        return sharding.raise_write_shards(self.org_table, organization_id, shards)
+
+
+# Usage columns; any other item attributes are kept as JSON in `attributes`
+USAGE_COLUMNS = (
+    'organization_id', 'record_id', 'user_id', 'timestamp', 'ts', 'model_name', 'total_cost', 'write_shard', 'ingest_key'
+)
+ORG_COLUMNS = ('organization_id', 'auth_token', 'status', 'write_shards')
+
+# The range indexes hold every attribute the cost queries read, so a page is
+# answered from the index alone, in the order it is paged in
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS usage (
+    organization_id TEXT NOT NULL,
+    record_id TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    ts INTEGER,
+    model_name TEXT,
+    total_cost TEXT NOT NULL,
+    write_shard INTEGER,
+    ingest_key TEXT,
+    attributes TEXT,
+    PRIMARY KEY (organization_id, record_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS usage_org_timestamp
+    ON usage (organization_id, timestamp, record_id, user_id, total_cost, write_shard, model_name);
+CREATE INDEX IF NOT EXISTS usage_user_timestamp
+    ON usage (user_id, timestamp, record_id, organization_id, total_cost, write_shard, model_name);
+CREATE TABLE IF NOT EXISTS organizations (
+    organization_id TEXT PRIMARY KEY,
+    auth_token TEXT,
+    status TEXT,
+    write_shards INTEGER,
+    attributes TEXT
+);
+CREATE INDEX IF NOT EXISTS organizations_auth_token ON organizations (auth_token);
+"""
+
+# Columns added after the first release, for databases created before them,
+# and the indexes over them
+SQLITE_ADDED_COLUMNS = (('usage', 'ingest_key', 'TEXT'),)
+SQLITE_ADDED_INDEXES = """
+CREATE INDEX IF NOT EXISTS usage_org_ingest
+    ON usage (organization_id, ingest_key, timestamp, user_id, total_cost, write_shard, model_name);
+"""
+
+# Attributes returned for raw usage queries, matching usage_queries.RAW_PROJECTION,
+# and for sources that also read when records were stored (INGEST_PROJECTION)
+_PROJECTED = ('user_id', 'total_cost', 'timestamp', 'write_shard', 'model_name')
+_INGEST_PROJECTED = _PROJECTED + ('ingest_key',)
+
+
+def _row(item, columns):
+    """Column values for an item, with the remaining attributes as JSON."""
+    values = []
+    for column in columns:
+        value = item.get(column)
+        if column == 'total_cost' and value is not None:
+            # Stored as text so costs stay exact Decimals
+            value = str(value)
+        elif column in ('ts', 'write_shard', 'write_shards') and value is not None:
+            value = int(value)
+        values.append(value)
+    rest = {k: v for k, v in item.items() if k not in columns}
+    values.append(json.dumps(rest, default=str, sort_keys=True) if rest else None)
+    return values
+
+
+def _item(row, columns):
+    item = json.loads(row[-1]) if row[-1] else {}
+    for column, value in zip(columns, row):
+        if value is not None:
+            item[column] = value
+    return item
+
+
+class SQLiteStorage:
+    """
+    Usage records and organizations in one embedded SQLite database.
+
+    The database runs in WAL mode, so queries never wait for writers. Usage
+    rows are keyed by (organization_id, record_id) like the DynamoDB table,
+    and covering indexes on (organization_id, timestamp) and
+    (user_id, timestamp) answer the range queries. Batch writes commit
+    SQLITE_BATCH_ROWS rows per transaction. Connections are pooled and may be
+    used from any thread, so parallel scans work as they do on DynamoDB.
+    `path` must be a file; every ':memory:' connection is a separate database.
+    """
+
+    has_rollups = False
+
+    def __init__(self, path, page_items=SQLITE_PAGE_ITEMS, batch_rows=SQLITE_BATCH_ROWS):
+        self.path = path
+        self.page_items = page_items
+        self.batch_rows = batch_rows
+        self._pool = queue.SimpleQueue()
+
+    def _open(self):
+        db = sqlite3.connect(
+            self.path, timeout=SQLITE_BUSY_TIMEOUT_SECONDS, isolation_level=None, check_same_thread=False
+        )
+        db.execute('PRAGMA journal_mode=WAL')
+        # With WAL, NORMAL only risks the last transactions on power loss, never corruption
+        db.execute('PRAGMA synchronous=NORMAL')
+        db.executescript(SQLITE_SCHEMA)
+        for table, column, column_type in SQLITE_ADDED_COLUMNS:
+            if column not in [row[1] for row in db.execute(f'PRAGMA table_info({table})')]:
+                try:
+                    db.execute(f'ALTER TABLE {table} ADD COLUMN {column} {column_type}')
+                except sqlite3.OperationalError:
+                    # Another connection added it first
+                    pass
+        db.executescript(SQLITE_ADDED_INDEXES)
+        return db
+
+    @contextmanager
+    def _connection(self):
+        try:
+            db = self._pool.get_nowait()
+        except queue.Empty:
+            db = self._open()
+        try:
+            yield db
+        finally:
+            self._pool.put(db)
+
+    @contextmanager
+    def _transaction(self):
+        with self._connection() as db:
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                yield db
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+            db.execute('COMMIT')
+
+    def close(self):
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                return
+
+    def put_usage(self, item):
+        self.put_usage_batch([item])
+
+    def put_usage_batch(self, items, max_workers=None):
+        """
+        Insert or replace usage rows, one transaction per SQLITE_BATCH_ROWS.
+        A failed transaction fails its rows only. SQLite has one writer at a
+        time, so `max_workers` is ignored.
+        """
+        statement = (
+            f"INSERT OR REPLACE INTO usage ({', '.join(USAGE_COLUMNS)}, attributes) "
+            f"VALUES ({', '.join('?' * (len(USAGE_COLUMNS) + 1))})"
+        )
+        results = [None] * len(items)
+        for start in range(0, len(items), self.batch_rows):
+            chunk = items[start:start + self.batch_rows]
+            try:
+                with self._transaction() as db:
+                    db.executemany(statement, [_row(item, USAGE_COLUMNS) for item in chunk])
+            except (sqlite3.Error, KeyError, TypeError, ValueError) as e:
+                logger.error(f"SQLite batch write failed: {str(e)}")
+                results[start:start + len(chunk)] = [str(e)] * len(chunk)
+        return results
+
+    def query_usage(self, source, start_key=None, shared=False):
+        """
+        One page of a raw or ingest source, in index order. LastEvaluatedKey
+        holds the ordering columns of the last row, so the next page seeks
+        past it. Full sources read the table rows instead of the covering index.
+        """
+        if source['kind'] == 'rollup':
+            raise ValueError('SQLite storage has no rollups')
+        values = source['query']['ExpressionAttributeValues']
+        if source['kind'] == 'ingest':
+            key_column, order = 'organization_id', ('ingest_key', 'record_id')
+        elif source.get('scope') == 'user':
+            key_column, order = 'user_id', ('timestamp', 'record_id', 'organization_id')
+        elif source['by'] == 'record_id':
+            key_column, order = 'organization_id', ('record_id',)
+        else:
+            key_column, order = 'organization_id', ('timestamp', 'record_id')
+
+        if source.get('full'):
+            projected = USAGE_COLUMNS
+        elif source['kind'] == 'ingest' or source.get('through'):
+            projected = _INGEST_PROJECTED
+        else:
+            projected = _PROJECTED
+        columns = list(projected) + [column for column in order if column not in projected]
+        if source.get('full'):
+            columns.append('attributes')
+        sql = (
+            f"SELECT {', '.join(columns)} FROM usage "
+            f"WHERE {key_column} = ? AND {order[0]} BETWEEN ? AND ?"
+        )
+        params = [values[':key'], values[':start'], values[':end']]
+        if start_key:
+            sql += f" AND ({', '.join(order)}) > ({', '.join('?' * len(order))})"
+            params.extend(start_key[column] for column in order)
+        sql += f" ORDER BY {', '.join(order)} LIMIT ?"
+        params.append(self.page_items + 1)
+
+        with self._connection() as db:
+            rows = db.execute(sql, params).fetchall()
+        items = []
+        for row in rows[:self.page_items]:
+            if source.get('full'):
+                item = _item(row, USAGE_COLUMNS)
+            else:
+                item = {column: value for column, value in zip(columns, row) if value is not None}
+            item['total_cost'] = Decimal(item['total_cost'])
+            items.append(item)
+        if source.get('full'):
+            response = {'Items': items}
+        else:
+            response = {'Items': [{k: item[k] for k in projected if k in item} for item in items]}
+        if len(rows) > self.page_items:
+            last_key = {column: items[-1][column] for column in order}
+            last_key[key_column] = values[':key']
+            response['LastEvaluatedKey'] = last_key
+        return response
+
+    def get_usage(self, organization_id, record_id):
+        with self._connection() as db:
+            row = db.execute(
+                f"SELECT {', '.join(USAGE_COLUMNS)}, attributes FROM usage WHERE organization_id = ? AND record_id = ?",
+                (organization_id, record_id)
+            ).fetchone()
+        if row is None:
+            return None
+        item = _item(row, USAGE_COLUMNS)
+        item['total_cost'] = Decimal(item['total_cost'])
+        return item
+
+    def usage_sketches(self, organization_id, first_day, last_day):
+        # Sketches are kept by the stream consumer, like rollups
+        return iter(())
+
+    def find_organization(self, auth_token):
+        with self._connection() as db:
+            row = db.execute(
+                f"SELECT {', '.join(ORG_COLUMNS)}, attributes FROM organizations WHERE auth_token = ? LIMIT 1",
+                (auth_token,)
+            ).fetchone()
+        return _item(row, ORG_COLUMNS) if row else None
+
+    def organizations(self):
+        with self._connection() as db:
+            rows = db.execute(f"SELECT {', '.join(ORG_COLUMNS)}, attributes FROM organizations").fetchall()
+        for row in rows:
+            yield _item(row, ORG_COLUMNS)
+
+    def put_organization(self, item):
+        with self._transaction() as db:
+            db.execute(
+                f"INSERT OR REPLACE INTO organizations ({', '.join(ORG_COLUMNS)}, attributes) "
+                f"VALUES ({', '.join('?' * (len(ORG_COLUMNS) + 1))})",
+                _row(item, ORG_COLUMNS)
+            )
+
+    def write_shards(self, organization_id):
+        with self._connection() as db:
+            row = db.execute(
+                "SELECT write_shards FROM organizations WHERE organization_id = ?", (organization_id,)
+            ).fetchone()
+        return max(1, int(row[0] or 1)) if row else 1
+
+    def raise_write_shards(self, organization_id, shards):
+        with self._transaction() as db:
+            db.execute(
+                "UPDATE organizations SET write_shards = ? "
+                "WHERE organization_id = ? AND (write_shards IS NULL OR write_shards < ?)",
+                (shards, organization_id, shards)
+            )
+        return self.write_shards(organization_id)
+
+
+_sqlite_stores = {}
+_lock = threading.Lock()
+
+
+def open_storage(table_name=None, org_table_name=None, rollup_table_name=None):
+    """
+    Storage for a handler module. With the DynamoDB backend the named tables
+    are connected on first use. With SQLite every caller shares the database
+    at SQLITE_PATH and the table names are ignored.
+    """
+    if STORAGE_BACKEND == 'sqlite':
+        with _lock:
+            if SQLITE_PATH not in _sqlite_stores:
+                _sqlite_stores[SQLITE_PATH] = SQLiteStorage(SQLITE_PATH)
+            return _sqlite_stores[SQLITE_PATH]
+    return DynamoDBStorage(
+        bootstrap.table(table_name) if table_name else None,
+        bootstrap.table(org_table_name) if org_table_name else None,
+        bootstrap.table(rollup_table_name) if rollup_table_name else None
+    )
@@ -0,0 +1,547 @@
+"""
+In-memory stand-in for the parts of the DynamoDB resource API this project uses.
+
+Tables behave like boto3 `Table` resources (plain Python values in and out)
+and share a low-level client (`table.meta.client`) that speaks the typed
+AttributeValue format, which is what the batch write path and the parallel
+query workers use.
+
+It also holds the small builders of Lambda contexts, request events and
+usage items that several test modules share.
+"""
+import bisect
+import copy
+import json
+import re
+from decimal import Decimal
+from types import SimpleNamespace
+
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+
+import record_keys
+
+_deserializer = TypeDeserializer()
+_serializer = TypeSerializer()
+
+USAGE_TABLE_INDEXES = {
+    'OrgTimestampIndex': ('organization_id', 'timestamp'),
+    'UserTimestampIndex': ('user_id', 'timestamp'),
+    'OrgIngestIndex': ('organization_id', 'ingest_key'),
+    'OrgTimestampSlimIndex': ('organization_id', 'timestamp'),
+    'UserTimestampSlimIndex': ('user_id', 'timestamp'),
+    'OrgIngestSlimIndex': ('organization_id', 'ingest_key'),
+}
+ORG_TABLE_INDEXES = {
+    'AuthTokenIndex': ('auth_token', None),
+}
+
+_KEY_CONDITION = re.compile(
+    r'^\s*(?P<pk>[#\w]+)\s*=\s*(?P<pkv>:\w+)'
+    r'(?:\s+AND\s+(?:'
+    r'(?P<bsk>[#\w]+)\s+BETWEEN\s+(?P<lo>:\w+)\s+AND\s+(?P<hi>:\w+)'
+    r'|begins_with\s*\(\s*(?P<psk>[#\w]+)\s*,\s*(?P<prefix>:\w+)\s*\)'
+    r'|(?P<csk>[#\w]+)\s*(?P<op><=|>=|<|>|=)\s*(?P<cv>:\w+)'
+    r'))?\s*$',
+    re.IGNORECASE
+)
+
+
+def _plain(value):
+    """Normalise numbers the way boto3 returns them (ints and floats become Decimal)."""
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, (int, float)):
+        return Decimal(str(value))
+    if isinstance(value, dict):
+        return {k: _plain(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_plain(v) for v in value]
+    return value
+
+
+class FakeClientError(Exception):
+    """Mimics botocore's ClientError closely enough for error-code checks."""
+
+    def __init__(self, code, message=''):
+        super().__init__(f"An error occurred ({code}): {message}")
+        self.response = {'Error': {'Code': code, 'Message': message}}
+
+
+_UPDATE_CLAUSE = re.compile(r'\b(SET|ADD|REMOVE)\b', re.IGNORECASE)
+_CONDITION_TERM = re.compile(
+    r'^\s*(?:(?P<func>attribute_not_exists|attribute_exists)\s*\(\s*(?P<fattr>[#\w]+)\s*\)'
+    r'|(?P<attr>[#\w]+)\s*(?P<op><=|>=|<>|<|>|=)\s*(?P<value>:\w+))\s*$',
+    re.IGNORECASE
+)
+
+
+def _apply_update(item, expression, values, names):
+    """Apply a SET/ADD/REMOVE update expression to `item` in place."""
+    parts = _UPDATE_CLAUSE.split(expression)
+    for position in range(1, len(parts), 2):
+        action = parts[position].upper()
+        for clause in filter(None, (c.strip() for c in parts[position + 1].split(','))):
+            if action == 'SET':
+                name, value = (p.strip() for p in clause.split('=', 1))
+                name = FakeTable._resolve(name, names)
+                if '+' in value:
+                    left, right = (p.strip() for p in value.split('+', 1))
+                    item[name] = item.get(FakeTable._resolve(left, names), 0) + values[right]
+                elif value.startswith('if_not_exists'):
+                    inner = value[value.index('(') + 1:value.rindex(')')]
+                    attr, default = (p.strip() for p in inner.split(','))
+                    item[name] = item.get(FakeTable._resolve(attr, names), values[default])
+                else:
+                    item[name] = values[value]
+            elif action == 'ADD':
+                name, value = clause.split()
+                name = FakeTable._resolve(name, names)
+                item[name] = item.get(name, 0) + values[value]
+            else:
+                item.pop(FakeTable._resolve(clause, names), None)
+
+
+def _condition_holds(item, expression, values, names):
+    """Evaluate simple AND/OR chains of comparisons and attribute_(not_)exists."""
+    def term_holds(term):
+        match = _CONDITION_TERM.match(term)
+        if not match:
+            raise FakeClientError('ValidationException', f'Unsupported condition: {term}')
+        if match.group('func'):
+            exists = FakeTable._resolve(match.group('fattr'), names) in item
+            return exists if match.group('func').lower() == 'attribute_exists' else not exists
+        name = FakeTable._resolve(match.group('attr'), names)
+        if name not in item:
+            return False
+        current, other = item[name], values[match.group('value')]
+        return {
+            '<': current < other, '<=': current <= other, '>': current > other,
+            '>=': current >= other, '=': current == other, '<>': current != other,
+        }[match.group('op')]
+
+    return any(
+        all(term_holds(term) for term in re.split(r'\s+AND\s+', alternative, flags=re.IGNORECASE))
+        for alternative in re.split(r'\s+OR\s+', expression, flags=re.IGNORECASE)
+    )
+
+
+class FakeClient:
+    """Low-level client sharing storage with the FakeTable objects."""
+
+    def __init__(self, resource):
+        self._resource = resource
+        self.calls = []
+        # Number of upcoming transactions to reject
+        self.fail_next_transactions = 0
+
+    def transact_write_items(self, TransactItems, **kwargs):
+        self.calls.append(('transact_write_items', TransactItems))
+        if len(TransactItems) > 100:
+            raise FakeClientError('ValidationException', 'Too many actions in TransactWriteItems')
+        if self.fail_next_transactions > 0:
+            self.fail_next_transactions -= 1
+            raise FakeClientError('TransactionCanceledException', 'Transaction cancelled')
+        snapshots = {name: copy.deepcopy(table.items) for name, table in self._resource.tables.items()}
+        try:
+            for action in TransactItems:
+                update = action['Update']
+                self._resource.Table(update['TableName']).update_item(
+                    Key={k: _deserializer.deserialize(v) for k, v in update['Key'].items()},
+                    UpdateExpression=update['UpdateExpression'],
+                    ExpressionAttributeValues={
+                        k: _deserializer.deserialize(v)
+                        for k, v in update.get('ExpressionAttributeValues', {}).items()
+                    },
+                    ExpressionAttributeNames=update.get('ExpressionAttributeNames'),
+                    ConditionExpression=update.get('ConditionExpression')
+                )
+        except Exception:
+            for name, items in snapshots.items():
+                self._resource.tables[name].items = items
+                self._resource.tables[name].version += 1
+            raise FakeClientError('TransactionCanceledException', 'Transaction cancelled')
+        return {}
+
+    def batch_write_item(self, RequestItems, **kwargs):
+        self.calls.append(('batch_write_item', RequestItems))
+        if sum(len(requests) for requests in RequestItems.values()) > 25:
+            raise FakeClientError('ValidationException', 'Too many items requested for the BatchWriteItem call')
+        for table_name, requests in RequestItems.items():
+            table = self._resource.Table(table_name)
+            keys = []
+            for request in requests:
+                item = request['PutRequest']['Item'] if 'PutRequest' in request else request['DeleteRequest']['Key']
+                keys.append(table._key({k: _deserializer.deserialize(v) for k, v in item.items()}))
+            if len(set(keys)) < len(keys):
+                raise FakeClientError('ValidationException', 'Provided list of item keys contains duplicates')
+        unprocessed = {}
+        for table_name in RequestItems:
+            if self._resource.Table(table_name).throttled():
+                raise FakeClientError('ProvisionedThroughputExceededException', 'The level of configured provisioned throughput for the table was exceeded')
+        for table_name, requests in RequestItems.items():
+            table = self._resource.Table(table_name)
+            for request in requests:
+                if table.unprocess_next > 0:
+                    table.unprocess_next -= 1
+                    unprocessed.setdefault(table_name, []).append(request)
+                    continue
+                if 'PutRequest' in request:
+                    item = {k: _deserializer.deserialize(v) for k, v in request['PutRequest']['Item'].items()}
+                    table._put(item)
+                elif 'DeleteRequest' in request:
+                    key = {k: _deserializer.deserialize(v) for k, v in request['DeleteRequest']['Key'].items()}
+                    table.delete_item(Key=key)
+        return {'UnprocessedItems': unprocessed}
+
+    def batch_get_item(self, RequestItems, **kwargs):
+        self.calls.append(('batch_get_item', RequestItems))
+        if sum(len(request['Keys']) for request in RequestItems.values()) > 100:
+            raise FakeClientError('ValidationException', 'Too many items requested for the BatchGetItem call')
+        responses = {}
+        for table_name, request in RequestItems.items():
+            table = self._resource.Table(table_name)
+            for key in request['Keys']:
+                item = table.get_item(Key={k: _deserializer.deserialize(v) for k, v in key.items()}).get('Item')
+                if item is not None:
+                    responses.setdefault(table_name, []).append({k: _serializer.serialize(v) for k, v in item.items()})
+        return {'Responses': responses, 'UnprocessedKeys': {}}
+
+    def query(self, TableName, ExpressionAttributeValues=None, ExclusiveStartKey=None, **kwargs):
+        self.calls.append(('query', TableName))
+        response = self._resource.Table(TableName).query(
+            ExpressionAttributeValues={k: _deserializer.deserialize(v) for k, v in (ExpressionAttributeValues or {}).items()},
+            ExclusiveStartKey={k: _deserializer.deserialize(v) for k, v in ExclusiveStartKey.items()} if ExclusiveStartKey else None,
+            **kwargs
+        )
+        return self._typed(response)
+
+    def scan(self, TableName, ExclusiveStartKey=None, **kwargs):
+        self.calls.append(('scan', TableName))
+        response = self._resource.Table(TableName).scan(
+            ExclusiveStartKey={k: _deserializer.deserialize(v) for k, v in ExclusiveStartKey.items()} if ExclusiveStartKey else None,
+            **kwargs
+        )
+        return self._typed(response)
+
+    @staticmethod
+    def _typed(response):
+        typed = dict(response, Items=[{k: _serializer.serialize(v) for k, v in item.items()} for item in response['Items']])
+        if 'LastEvaluatedKey' in response:
+            typed['LastEvaluatedKey'] = {k: _serializer.serialize(v) for k, v in response['LastEvaluatedKey'].items()}
+        return typed
+
+
+class FakeTable:
+    """A single table with optional global secondary indexes."""
+
+    def __init__(self, resource, name, hash_key, range_key=None, indexes=None, page_size=None):
+        self.name = name
+        self.table_name = name
+        self.hash_key = hash_key
+        self.range_key = range_key
+        self.indexes = dict(indexes or {})
+        self.page_size = page_size
+        self.items = {}
+        # Bumped by every write; query() keeps sorted partitions per version
+        self.version = 0
+        self._partitions = {}
+        self.query_calls = []
+        # Number of upcoming batch write requests to hand back as unprocessed
+        self.unprocess_next = 0
+        # Number of upcoming writes (PutItem or BatchWriteItem calls) to reject
+        # as throttled
+        self.throttle_next = 0
+        self.meta = SimpleNamespace(client=resource.client)
+
+    # -- helpers -----------------------------------------------------------
+
+    def _key(self, item):
+        return (item[self.hash_key], item.get(self.range_key) if self.range_key else None)
+
+    def _key_dict(self, item, index_name=None):
+        key = {self.hash_key: item[self.hash_key]}
+        if self.range_key:
+            key[self.range_key] = item[self.range_key]
+        if index_name:
+            pk, sk = self.indexes[index_name]
+            key[pk] = item[pk]
+            if sk:
+                key[sk] = item[sk]
+        return key
+
+    @staticmethod
+    def _resolve(name, names):
+        return names.get(name, name) if name.startswith('#') else name
+
+    @staticmethod
+    def _project(item, projection, names):
+        if not projection:
+            return copy.deepcopy(item)
+        wanted = [FakeTable._resolve(p.strip(), names) for p in projection.split(',')]
+        return {k: copy.deepcopy(item[k]) for k in wanted if k in item}
+
+    # -- item operations ---------------------------------------------------
+
+    def _sorted_partitions(self, index_name):
+        """
+        Items grouped by partition key and sorted by (sort key, table range
+        key), with the parallel sort-key and order lists used for bisecting.
+        """
+        version, partitions = self._partitions.get(index_name, (None, None))
+        if version == self.version:
+            return partitions
+        version = self.version
+        pk_name, sk_name = self.indexes[index_name] if index_name else (self.hash_key, self.range_key)
+        groups = {}
+        for item in list(self.items.values()):
+            if pk_name in item and (not sk_name or sk_name in item):
+                groups.setdefault(item[pk_name], []).append(item)
+        partitions = {}
+        for pk_value, members in groups.items():
+            members.sort(key=lambda item: self._order(item, sk_name))
+            partitions[pk_value] = (
+                members,
+                [item[sk_name] if sk_name else '' for item in members],
+                [self._order(item, sk_name) for item in members]
+            )
+        self._partitions[index_name] = (version, partitions)
+        return partitions
+
+    def _order(self, item, sk_name):
+        return (item[sk_name] if sk_name else '', self._key(item)[1] or '')
+
+    def throttled(self):
+        """Count down throttle_next, and tell whether this write is rejected."""
+        if self.throttle_next > 0:
+            self.throttle_next -= 1
+            return True
+        return False
+
+    def put_item(self, Item, **kwargs):
+        if self.throttled():
+            raise FakeClientError('ProvisionedThroughputExceededException', 'The level of configured provisioned throughput for the table was exceeded')
+        return self._put(Item)
+
+    def _put(self, Item):
+        item = _plain(copy.deepcopy(Item))
+        self.items[self._key(item)] = item
+        self.version += 1
+        return {}
+
+    def get_item(self, Key, **kwargs):
+        item = self.items.get(self._key(Key))
+        return {'Item': copy.deepcopy(item)} if item is not None else {}
+
+    def delete_item(self, Key, **kwargs):
+        self.items.pop(self._key(Key), None)
+        self.version += 1
+        return {}
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeValues=None,
+                    ExpressionAttributeNames=None, ConditionExpression=None, ReturnValues=None, **kwargs):
+        key = _plain(Key)
+        values = _plain(ExpressionAttributeValues or {})
+        names = ExpressionAttributeNames or {}
+        current = self.items.get(self._key(key))
+        item = copy.deepcopy(current) if current is not None else dict(key)
+        if ConditionExpression and not _condition_holds(current or {}, ConditionExpression, values, names):
+            raise FakeClientError('ConditionalCheckFailedException', 'The conditional request failed')
+        _apply_update(item, UpdateExpression, values, names)
+        self.items[self._key(item)] = item
+        self.version += 1
+        if ReturnValues == 'ALL_NEW':
+            return {'Attributes': copy.deepcopy(item)}
+        return {}
+
+    def query(self, KeyConditionExpression, ExpressionAttributeValues=None,
+              ExpressionAttributeNames=None, IndexName=None, ProjectionExpression=None,
+              ExclusiveStartKey=None, Limit=None, ScanIndexForward=True, **kwargs):
+        self.query_calls.append(dict(
+            KeyConditionExpression=KeyConditionExpression, IndexName=IndexName,
+            ExpressionAttributeValues=ExpressionAttributeValues,
+            ProjectionExpression=ProjectionExpression, ExclusiveStartKey=ExclusiveStartKey
+        ))
+        values = _plain(ExpressionAttributeValues or {})
+        names = ExpressionAttributeNames or {}
+        match = _KEY_CONDITION.match(KeyConditionExpression)
+        if not match:
+            raise FakeClientError('ValidationException', f'Unsupported key condition: {KeyConditionExpression}')
+
+        if IndexName:
+            pk_name, sk_name = self.indexes[IndexName]
+        else:
+            pk_name, sk_name = self.hash_key, self.range_key
+
+        if self._resolve(match.group('pk'), names) != pk_name:
+            raise FakeClientError('ValidationException', 'Query condition missed key schema element')
+        pk_value = values[match.group('pkv')]
+
+        members, sks, orders = self._sorted_partitions(IndexName).get(pk_value, ([], [], []))
+        low, high = 0, len(members)
+        if match.group('bsk'):
+            low = bisect.bisect_left(sks, values[match.group('lo')])
+            high = bisect.bisect_right(sks, values[match.group('hi')])
+        elif match.group('psk'):
+            prefix = values[match.group('prefix')]
+            low = high = bisect.bisect_left(sks, prefix)
+            while high < len(sks) and isinstance(sks[high], str) and sks[high].startswith(prefix):
+                high += 1
+        elif match.group('csk'):
+            other, op = values[match.group('cv')], match.group('op')
+            if op in ('>=', '='):
+                low = bisect.bisect_left(sks, other)
+            if op == '>':
+                low = bisect.bisect_right(sks, other)
+            if op in ('<=', '='):
+                high = bisect.bisect_right(sks, other)
+            if op == '<':
+                high = bisect.bisect_left(sks, other)
+
+        # Resume after the start key's position, even if that item is gone
+        if ExclusiveStartKey:
+            start = self._order(_plain(ExclusiveStartKey), sk_name)
+            if ScanIndexForward:
+                low = max(low, bisect.bisect_right(orders, start))
+            else:
+                high = min(high, bisect.bisect_left(orders, start))
+        remaining = max(0, high - low)
+        page_limit = min(x for x in (Limit, self.page_size, remaining or 1) if x)
+        if ScanIndexForward:
+            page = members[low:low + page_limit]
+        else:
+            page = members[max(low, high - page_limit):high][::-1]
+        response = {
+            'Items': [self._project(item, ProjectionExpression, names) for item in page],
+            'Count': len(page),
+            'ScannedCount': len(page),
+        }
+        if remaining > len(page):
+            response['LastEvaluatedKey'] = self._key_dict(page[-1], IndexName)
+        return response
+
+    def scan(self, ProjectionExpression=None, ExpressionAttributeNames=None,
+             ExclusiveStartKey=None, Limit=None, Segment=None, TotalSegments=None, **kwargs):
+        order = lambda item: (self._key(item)[0], self._key(item)[1] or '')
+        candidates = sorted(list(self.items.values()), key=order)
+        if TotalSegments:
+            candidates = [
+                item for item in candidates
+                if hash(self._key(item)[0]) % TotalSegments == Segment
+            ]
+        return self._page(candidates, None, ProjectionExpression, ExpressionAttributeNames or {},
+                          ExclusiveStartKey, Limit, order)
+
+    def _page(self, candidates, index_name, projection, names, start_key, limit, order, reverse=False):
+        if start_key:
+            # Resume after the start key's position, even if that item is gone
+            start = order(_plain(start_key))
+            candidates = [item for item in candidates if (order(item) < start if reverse else order(item) > start)]
+        page_limit = min(x for x in (limit, self.page_size, len(candidates) or 1) if x)
+        page = candidates[:page_limit]
+        response = {
+            'Items': [self._project(item, projection, names) for item in page],
+            'Count': len(page),
+            'ScannedCount': len(page),
+        }
+        if len(candidates) > len(page):
+            response['LastEvaluatedKey'] = self._key_dict(page[-1], index_name)
+        return response
+
+
+class FakeDynamoDB:
+    """Drop-in for `boto3.resource('dynamodb')` holding FakeTable objects."""
+
+    def __init__(self):
+        self.client = FakeClient(self)
+        self.meta = SimpleNamespace(client=self.client)
+        self.tables = {}
+
+    def create_table(self, name, hash_key, range_key=None, indexes=None, page_size=None):
+        table = FakeTable(self, name, hash_key, range_key, indexes, page_size)
+        self.tables[name] = table
+        return table
+
+    def Table(self, name):
+        return self.tables[name]
+
+
+def make_tables(page_size=None):
+    """Create the usage and organization tables used by the handlers."""
+    resource = FakeDynamoDB()
+    usage = resource.create_table(
+        'chatgpt_usage_tracking', 'organization_id', 'record_id',
+        indexes=USAGE_TABLE_INDEXES, page_size=page_size
+    )
+    orgs = resource.create_table(
+        'chatgpt_organizations', 'organization_id',
+        indexes=ORG_TABLE_INDEXES
+    )
+    return resource, usage, orgs
+
+
+def make_rollup_table(resource):
+    """Create the rollup table maintained from the usage stream."""
+    return resource.create_table(
+        'chatgpt_usage_rollups', 'rollup_key', 'bucket_key',
+        indexes={'UserRollupIndex': ('user_rollup_key', 'bucket_key')}
+    )
+
+
+class FakeContext:
+    """Lambda context whose remaining time drops by a fixed step per check."""
+
+    def __init__(self, remaining_ms=10000, step_ms=0):
+        self.remaining_ms = remaining_ms
+        self.step_ms = step_ms
+
+    def get_remaining_time_in_millis(self):
+        self.remaining_ms -= self.step_ms
+        return self.remaining_ms
+
+
+class FixedShard:
+    """Stands in for `random` so sharding.shard_item picks a known shard."""
+
+    def __init__(self, shard):
+        self.shard = shard
+
+    def randrange(self, shards):
+        return self.shard
+
+
+def cost_event(params):
+    """A GET /costs event with the given query parameters."""
+    return {'headers': {'Authorization': 'token'}, 'queryStringParameters': params}
+
+
+def batch_event(records, organization_id='org_123'):
+    """A POST /track/batch event carrying `records`."""
+    return {
+        'resource': '/track/batch',
+        'headers': {'Authorization': 'Bearer token'},
+        'body': json.dumps({'organization_id': organization_id, 'records': records})
+    }
+
+
+def usage_record(**overrides):
+    """A valid tracked record for user_1, with any field overridden."""
+    record = {'model_name': 'gpt-4', 'input_tokens': 1000, 'output_tokens': 500, 'user_id': 'user_1'}
+    record.update(overrides)
+    return record
+
+
+def hourly_item(i, organization_id='org_1'):
+    """The i-th stored usage item of three users, one per hour from 2025-03-08 10:00 UTC."""
+    timestamp, ts = record_keys.normalize_timestamp(1741428000000 + i * 3600000)
+    return {
+        'organization_id': organization_id,
+        'record_id': record_keys.new_record_id(ts),
+        'user_id': f'user_{i % 3}',
+        'timestamp': timestamp,
+        'ts': ts,
+        'model_name': 'gpt-4',
+        'total_cost': Decimal(i + 1).scaleb(-4),
+        'ingest_key': record_keys.new_record_id(ts + 5),
+        'session': f's{i}',
+        'expires_at': ts // 1000 + 90 * 86400
+    }
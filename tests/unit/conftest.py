@@ -0,0 +1,32 @@
+import pytest
+from unittest.mock import patch
+import os
+import sys
+
+# Add the project root to the Python path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+import result_cache
+
+@pytest.fixture(autouse=True)
+def no_result_cache():
+    """
+    Cost tests repeat queries to compare how they are scanned, so results are
+    not cached unless a test installs a cache of its own.
+    """
+    with patch.object(result_cache, 'cache', result_cache.ResultCache(0)):
+        yield
+
+@pytest.fixture(autouse=True)
+def fresh_write_guard():
+    """Every test starts with a closed write breaker."""
+    import write_guard
+    with patch.object(write_guard, 'guard', write_guard.WriteGuard(sleep=lambda seconds: None)):
+        yield
+
+@pytest.fixture(autouse=True)
+def fresh_shard_counts():
+    """Shard counts are read again in every test rather than kept from an earlier one."""
+    import sharding
+    with patch.object(sharding, '_shard_counts', {}), patch.object(sharding, '_read_shard_counts', {}):
+        yield
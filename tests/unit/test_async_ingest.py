@@ -0,0 +1,204 @@
+import pytest
+import json
+from decimal import Decimal
+from unittest.mock import patch
+import os
+import sys
+
+# Add the project root to the Python path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+import ingest_queue
+import item_schema
+import ingest_worker
+import lambda_function
+import record_keys
+import sharding
+import storage
+from tests.fake_dynamodb import make_tables
+
+def track_event(**overrides):
+    body = {'model_name': 'gpt-4', 'input_tokens': 1000, 'output_tokens': 500,
+            'user_id': 'user_1', 'organization_id': 'org_1'}
+    body.update(overrides)
+    return {'headers': {'Authorization': 'Bearer token'}, 'body': json.dumps(body)}
+
+@pytest.fixture
+def async_ingest():
+    """Track handler in async mode, queueing to memory, with fake tables."""
+    _, usage, orgs = make_tables()
+    dead_letters = ingest_queue.MemoryQueue()
+    queue = ingest_queue.MemoryQueue(max_receives=3, dead_letters=dead_letters)
+    with patch.object(lambda_function, 'queue', queue), \
+            patch.object(lambda_function, 'store', storage.DynamoDBStorage(usage, orgs)), \
+            patch.object(lambda_function, 'authorize_request', return_value=True):
+        yield queue, dead_letters, usage
+
+def test_track_queues_and_worker_stores(async_ingest):
+    queue, dead_letters, usage = async_ingest
+    response = lambda_function.lambda_handler(track_event(timestamp='2025-03-08T10:00:00Z'), None)
+
+    assert response['statusCode'] == 202
+    record_id = json.loads(response['body'])['record_id']
+    assert len(queue) == 1 and not usage.items
+
+    totals = ingest_worker.drain(queue, dead_letters)
+
+    assert totals == {'stored': 1, 'dead_lettered': 0, 'failed': 0}
+    item, = usage.items.values()
+    assert item['record_id'] == record_id
+    assert item['timestamp'] == '2025-03-08T10:00:00.000000+00:00'
+    assert item['total_cost'] == Decimal('0.06')
+    assert len(queue) == 0
+
+def test_track_rejects_invalid_records_without_queueing(async_ingest):
+    queue, _, _ = async_ingest
+    response = lambda_function.lambda_handler(track_event(model_name='gpt-5'), None)
+
+    assert response['statusCode'] == 400
+    assert len(queue) == 0
+
+def test_redelivered_messages_are_stored_once(async_ingest):
+    queue, dead_letters, usage = async_ingest
+    for i in range(30):
+        lambda_function.lambda_handler(track_event(user_id=f'user_{i % 3}'), None)
+    messages = queue.receive(100)
+
+    # The first delivery is processed but never acknowledged
+    ingest_worker.process_messages(messages, dead_letters)
+    queue.release([message['receipt'] for message in messages])
+    ingest_worker.drain(queue, dead_letters)
+
+    assert len(usage.items) == 30
+    assert all(record_keys.is_record_id(item['record_id']) for item in usage.items.values())
+
+def test_redelivered_messages_keep_their_shard_when_shards_grow(async_ingest):
+    queue, dead_letters, usage = async_ingest
+    store = lambda_function.store
+    with patch.object(sharding, 'WRITE_SHARDING', True), \
+            patch.object(store, 'write_shards', return_value=8):
+        for i in range(20):
+            lambda_function.lambda_handler(track_event(user_id=f'user_{i}'), None)
+        messages = queue.receive(100)
+        ingest_worker.process_messages(messages, dead_letters)
+        stored = dict(usage.items)
+        assert any(item.get('write_shard') for item in stored.values())
+
+        # Redelivered after the shard count grew, every record finds its first copy
+        queue.release([message['receipt'] for message in messages])
+        with patch.object(store, 'write_shards', return_value=64):
+            ingest_worker.drain(queue, dead_letters)
+    assert usage.items == stored
+
+def test_duplicate_messages_in_one_batch_are_written_once(async_ingest):
+    queue, dead_letters, usage = async_ingest
+    lambda_function.lambda_handler(track_event(), None)
+    message, = queue.receive(10)
+    copies = [dict(message, id=f'copy_{n}') for n in range(3)]
+
+    assert ingest_worker.process_messages(copies, dead_letters) == (3, 0, [])
+    assert len(usage.items) == 1
+
+    usage.unprocess_next = 10 ** 6
+    assert ingest_worker.process_messages(copies, dead_letters) == (0, 0, ['copy_0', 'copy_1', 'copy_2'])
+
+def test_invalid_messages_go_to_the_dead_letter_queue(async_ingest):
+    queue, dead_letters, usage = async_ingest
+    lambda_function.lambda_handler(track_event(), None)
+    queue.send({'record_id': record_keys.new_record_id(0), 'record': {'model_name': 'gpt-4'}})
+    queue.send('not a usage record')
+
+    totals = ingest_worker.drain(queue, dead_letters)
+
+    assert totals == {'stored': 1, 'dead_lettered': 2, 'failed': 0}
+    reasons = sorted(json.loads(message['body'])['error'] for message in dead_letters.receive(10))
+    assert reasons[0].startswith('Malformed message')
+    assert reasons[1] == 'Missing required field: input_tokens'
+    assert len(usage.items) == 1 and len(queue) == 0
+
+def test_unstorable_records_are_dead_lettered_alone(async_ingest):
+    queue, dead_letters, usage = async_ingest
+    for n in range(4):
+        lambda_function.lambda_handler(track_event(user_id=f'user_{n}', temperature=0.5 + n), None)
+    queue.send({'record_id': record_keys.new_record_id(1000),
+                'record': json.loads(track_event(user_id='user_nan')['body'].replace('}', ', "score": NaN}'))})
+
+    totals = ingest_worker.drain(queue, dead_letters)
+    assert totals == {'stored': 4, 'dead_lettered': 1, 'failed': 0}
+    assert sorted(item['temperature'] for item in usage.items.values()) == [Decimal('0.5'), Decimal('1.5'), Decimal('2.5'), Decimal('3.5')]
+
+    # A record that only fails when it is serialized for the table is dead-lettered on its own too
+    lambda_function.lambda_handler(track_event(user_id='user_4'), None)
+    lambda_function.lambda_handler(track_event(user_id='user_float', temperature=0.7), None)
+    with patch.object(item_schema, 'storable', side_effect=lambda value: value):
+        totals = ingest_worker.drain(queue, dead_letters)
+    assert totals == {'stored': 1, 'dead_lettered': 1, 'failed': 0}
+    assert len(usage.items) == 5 and len(queue) == 0
+    reasons = [json.loads(message['body'])['error'] for message in dead_letters.receive(10)]
+    assert reasons[0] == 'Invalid value for score: nan is not a finite number'
+    assert reasons[1].startswith('Invalid item: Float types are not supported')
+
+def test_failed_writes_are_retried_then_dead_lettered(async_ingest):
+    queue, dead_letters, usage = async_ingest
+    lambda_function.lambda_handler(track_event(), None)
+
+    # Every attempt of the first delivery is left unprocessed
+    usage.unprocess_next = 5
+    assert ingest_worker.drain(queue, dead_letters, max_batches=1)['failed'] == 1
+    assert ingest_worker.drain(queue, dead_letters)['stored'] == 1
+    assert len(usage.items) == 1
+
+    lambda_function.lambda_handler(track_event(), None)
+    usage.unprocess_next = 10 ** 6
+    ingest_worker.drain(queue, dead_letters)
+    assert len(queue) == 0 and len(usage.items) == 1
+    assert json.loads(dead_letters.receive(10)[0]['body'])['record']['user_id'] == 'user_1'
+
+def test_sqs_handler_reports_failed_messages(async_ingest):
+    _, _, usage = async_ingest
+    records = [
+        {'messageId': 'ok', 'body': json.dumps({'record_id': record_keys.new_record_id(1000),
+                                                'record': json.loads(track_event()['body'])})},
+        {'messageId': 'bad', 'body': '{'}
+    ]
+    dead_letters = ingest_queue.MemoryQueue()
+    with patch.object(ingest_worker, 'dead_letters', dead_letters):
+        assert ingest_worker.lambda_handler({'Records': records}, None) == {'batchItemFailures': []}
+        usage.unprocess_next = 10 ** 6
+        response = ingest_worker.lambda_handler({'Records': records[:1]}, None)
+
+    assert response == {'batchItemFailures': [{'itemIdentifier': 'ok'}]}
+    assert len(dead_letters) == 1 and len(usage.items) == 1
+
+def test_file_queue_keeps_unacknowledged_messages(tmp_path):
+    path = str(tmp_path / 'ingest.jsonl')
+    queue = ingest_queue.FileQueue(path)
+    for n in range(3):
+        queue.send({'n': n})
+    received = queue.receive(2)
+    queue.delete([received[0]['receipt']])
+
+    reopened = ingest_queue.FileQueue(path)
+
+    assert len(reopened) == 2
+    assert sorted(json.loads(message['body'])['n'] for message in reopened.receive(10)) == [1, 2]
+
+def test_sqs_batches_report_unsent_messages():
+    class FakeSQS:
+        def __init__(self):
+            self.calls = []
+        def send_message_batch(self, QueueUrl, Entries):
+            self.calls.append(Entries)
+            if len(self.calls) == 2:
+                raise RuntimeError('unreachable')
+            return {'Successful': [{'Id': entry['Id'], 'MessageId': f"m{len(self.calls)}-{entry['Id']}"} for entry in Entries[1:]],
+                    'Failed': [{'Id': Entries[0]['Id'], 'Code': 'InternalError'}]}
+
+    client = FakeSQS()
+    message_ids = ingest_queue.SQSQueue('queue', client=client).send_batch([{'n': n} for n in range(25)])
+
+    # Ten messages per call; the first of each call fails and so does the whole second call
+    assert [len(entries) for entries in client.calls] == [10, 10, 5]
+    assert message_ids[:3] == [None, 'm1-1', 'm1-2']
+    assert message_ids[10:20] == [None] * 10
+    assert message_ids[20:] == [None, 'm3-1', 'm3-2', 'm3-3', 'm3-4']
@@ -0,0 +1,94 @@
+import pytest
+from unittest.mock import patch
+import os
+import sys
+
+# Add the project root to the Python path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+import auth
+from auth import TokenCache
+import storage
+from tests.fake_dynamodb import make_tables
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+def auth_event(token):
+    return {'headers': {'Authorization': f'Bearer {token}'}}
+
+@pytest.fixture
+def org_table():
+    """Organization table fake plus a fresh cache driven by a fake clock."""
+    _, _, orgs = make_tables()
+    orgs.put_item(Item={'organization_id': 'org_1', 'auth_token': 'good', 'status': 'active'})
+    clock = FakeClock()
+    cache = TokenCache(max_entries=100, ttl=60, negative_ttl=10, clock=clock)
+    with patch.object(auth, 'store', storage.DynamoDBStorage(org_table=orgs)), patch.object(auth, 'token_cache', cache):
+        orgs.clock = clock
+        orgs.cache = cache
+        yield orgs
+
+def test_cache_hit_skips_gsi_query(org_table):
+    assert auth.authorize_request(auth_event('good'), 'org_1')
+    assert auth.authorize_request(auth_event('good'), 'org_1')
+
+    assert len(org_table.query_calls) == 1
+    assert org_table.cache.hits == 1
+
+def test_unknown_token_is_negatively_cached(org_table):
+    for _ in range(5):
+        assert not auth.authorize_request(auth_event('bad'), 'org_1')
+    assert len(org_table.query_calls) == 1
+
+    # The negative entry expires after its short TTL
+    org_table.clock.now += 11
+    assert not auth.authorize_request(auth_event('bad'), 'org_1')
+    assert len(org_table.query_calls) == 2
+
+def test_suspension_is_seen_within_ttl(org_table):
+    assert auth.authorize_request(auth_event('good'), 'org_1')
+    org_table.put_item(Item={'organization_id': 'org_1', 'auth_token': 'good', 'status': 'suspended'})
+
+    # Still served from cache inside the staleness window
+    org_table.clock.now += 30
+    assert auth.authorize_request(auth_event('good'), 'org_1')
+
+    org_table.clock.now += 31
+    assert not auth.authorize_request(auth_event('good'), 'org_1')
+
+def test_mismatched_org_is_rejected_from_cache(org_table):
+    assert auth.authorize_request(auth_event('good'), 'org_1')
+    assert not auth.authorize_request(auth_event('good'), 'org_2')
+    assert len(org_table.query_calls) == 1
+
+def test_query_errors_are_not_cached(org_table):
+    with patch.object(org_table, 'query', side_effect=Exception('throttled')):
+        assert not auth.authorize_request(auth_event('good'), 'org_1')
+    assert len(org_table.cache) == 0
+    assert auth.authorize_request(auth_event('good'), 'org_1')
+
+def test_lru_eviction_is_bounded():
+    cache = TokenCache(max_entries=2, ttl=60, negative_ttl=10)
+    cache.put('a', {'organization_id': 'org_a', 'status': 'active'})
+    cache.put('b', {'organization_id': 'org_b', 'status': 'active'})
+    cache.get('a')
+    cache.put('c', {'organization_id': 'org_c', 'status': 'active'})
+
+    assert len(cache) == 2
+    assert cache.get('a')[0]
+    assert not cache.get('b')[0]
+
+def test_prefetch_loads_only_active_organizations(org_table):
+    org_table.put_item(Item={'organization_id': 'org_2', 'auth_token': 'other', 'status': 'suspended'})
+    org_table.put_item(Item={'organization_id': 'org_3', 'auth_token': 'third', 'status': 'active'})
+
+    loaded = auth.prefetch_active_organizations(org_table.cache, storage.DynamoDBStorage(org_table=org_table))
+
+    assert loaded == 2
+    assert org_table.cache.get('third') == (True, {'organization_id': 'org_3', 'status': 'active'})
+    assert org_table.cache.get('other') == (False, None)
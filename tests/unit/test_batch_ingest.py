@@ -0,0 +1,138 @@
+import pytest
+import json
+from decimal import Decimal
+from unittest.mock import patch
+import os
+import sys
+
+# Add the project root to the Python path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+import lambda_function
+import storage
+from batch_write import batch_put_items
+from tests.fake_dynamodb import FakeClientError, batch_event, make_tables, usage_record
+
+@pytest.fixture
+def usage_table():
+    _, usage, _ = make_tables()
+    with patch.object(lambda_function, 'store', storage.DynamoDBStorage(usage)), \
+            patch.object(lambda_function, 'authorize_request', return_value=True) as authorize:
+        usage.authorize = authorize
+        yield usage
+
+def test_batch_stores_all_records_with_one_authorization(usage_table):
+    """Every record is priced and stored; auth runs once per batch."""
+    records = [usage_record(user_id=f'user_{i % 7}') for i in range(60)]
+
+    response = lambda_function.lambda_handler(batch_event(records), None)
+    body = json.loads(response['body'])
+
+    assert response['statusCode'] == 200
+    assert body['succeeded'] == 60 and body['failed'] == 0
+    assert len(usage_table.items) == 60
+    assert usage_table.authorize.call_count == 1
+    # 60 records need three BatchWriteItem calls of at most 25
+    assert len(usage_table.meta.client.calls) == 3
+    assert all(result['total_cost'] == pytest.approx(0.06) for result in body['results'])
+
+def test_batch_reports_per_record_errors(usage_table):
+    """Invalid records are reported by position while the rest are stored."""
+    records = [
+        usage_record(),
+        usage_record(model_name='not-a-model'),
+        {'model_name': 'gpt-4'},
+        usage_record(organization_id='org_other'),
+        usage_record(input_tokens='many'),
+        usage_record(cached_input_tokens=-500),
+    ]
+
+    response = lambda_function.lambda_handler(batch_event(records), None)
+    body = json.loads(response['body'])
+
+    assert response['statusCode'] == 207
+    assert [result['status'] for result in body['results']] == ['ok', 'error', 'error', 'error', 'error', 'error']
+    assert 'Unsupported model' in body['results'][1]['error']
+    assert 'Missing required field' in body['results'][2]['error']
+    assert body['results'][5]['error'] == 'Token counts must not be negative'
+    assert len(usage_table.items) == 1
+
+def test_batch_stores_numeric_extra_fields_and_rejects_unstorable_ones(usage_table):
+    """Floats are stored as Decimal; a value DynamoDB can't hold fails only its record."""
+    records = [usage_record(user_id=f'user_{i}') for i in range(30)]
+    records[3]['temperature'] = 0.7
+    records[4]['settings'] = {'top_p': 0.95, 'stop': [1.5, 'end']}
+    records[26]['temperature'] = float('nan')
+    records[27]['score'] = 1e200
+    records[28]['user_id'] = 28
+
+    response = lambda_function.lambda_handler(batch_event(records), None)
+    body = json.loads(response['body'])
+
+    assert response['statusCode'] == 207
+    assert [result['index'] for result in body['results'] if result['status'] == 'error'] == [26, 27, 28]
+    assert body['results'][26]['error'] == 'Invalid value for temperature: nan is not a finite number'
+    assert body['results'][28]['error'] == 'user_id must be a non-empty string'
+    assert len(usage_table.items) == 27
+    stored = {item['user_id']: item for item in usage_table.items.values()}
+    assert stored['user_3']['temperature'] == Decimal('0.7')
+    assert stored['user_4']['settings'] == {'top_p': Decimal('0.95'), 'stop': [Decimal('1.5'), 'end']}
+
+def test_batch_rejects_unauthorized_and_oversized_requests(usage_table):
+    usage_table.authorize.return_value = False
+    assert lambda_function.lambda_handler(batch_event([usage_record()]), None)['statusCode'] == 403
+
+    with patch.object(lambda_function, 'MAX_BATCH_RECORDS', 2):
+        response = lambda_function.lambda_handler(batch_event([usage_record()] * 3), None)
+    assert response['statusCode'] == 400
+    assert usage_table.items == {}
+
+def test_single_track_still_uses_put_item(usage_table):
+    response = lambda_function.lambda_handler({'body': json.dumps(usage_record(organization_id='org_123'))}, None)
+
+    assert response['statusCode'] == 200
+    assert json.loads(response['body'])['total_cost'] == pytest.approx(0.06)
+    assert len(usage_table.items) == 1
+    assert usage_table.meta.client.calls == []
+
+def test_unprocessed_items_are_retried():
+    _, usage, _ = make_tables()
+    usage.unprocess_next = 10
+    items = [{'organization_id': 'org_1', 'record_id': str(i)} for i in range(30)]
+
+    errors = batch_put_items(usage.meta.client, usage.name, items, ('organization_id', 'record_id'), base_delay=0)
+
+    assert errors == [None] * 30
+    assert len(usage.items) == 30
+
+def test_items_left_unprocessed_are_reported():
+    _, usage, _ = make_tables()
+    usage.unprocess_next = 1000
+    items = [{'organization_id': 'org_1', 'record_id': str(i)} for i in range(5)]
+
+    errors = batch_put_items(usage.meta.client, usage.name, items, ('organization_id', 'record_id'),
+                             max_attempts=3, base_delay=0)
+
+    assert all(errors)
+    assert usage.items == {}
+
+def test_non_retryable_error_fails_the_chunk():
+    class BrokenClient:
+        def batch_write_item(self, RequestItems):
+            raise FakeClientError('ValidationException', 'bad item')
+
+    errors = batch_put_items(BrokenClient(), 'usage', [{'organization_id': 'o', 'record_id': 'r'}],
+                             ('organization_id', 'record_id'))
+
+    assert 'bad item' in errors[0]
+
+def test_unserializable_items_fail_on_their_own():
+    _, usage, _ = make_tables()
+    items = [{'organization_id': 'org_1', 'record_id': str(i)} for i in range(3)]
+    items[1]['temperature'] = 0.7
+
+    errors = batch_put_items(usage.meta.client, usage.name, items, ('organization_id', 'record_id'))
+
+    assert errors[0] is None and errors[2] is None
+    assert errors[1].startswith('Invalid item: Float types are not supported')
+    assert sorted(usage.items) == [('org_1', '0'), ('org_1', '2')]
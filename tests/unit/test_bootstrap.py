@@ -0,0 +1,64 @@
+import pytest
+import json
+import subprocess
+import os
+import sys
+from decimal import Decimal
+
+# Add the project root to the Python path
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(ROOT)
+
+import bootstrap
+from benchmarks import startup
+
+@pytest.fixture
+def fresh_bootstrap():
+    bootstrap.reset()
+    yield
+    bootstrap.reset()
+
+def test_handlers_create_no_clients_at_import():
+    script = (
+        'import sys, bootstrap, lambda_function, get_costs_function, get_org_costs_function, '
+        'register_org_function, rollup_function, ingest_worker, archive_function, router\n'
+        'print(len(bootstrap._resources) + len(bootstrap._clients), "botocore" in sys.modules)'
+    )
+    output = subprocess.run([sys.executable, '-c', script], cwd=ROOT, capture_output=True, text=True, check=True)
+    assert output.stdout.strip() == '0 False'
+
+def test_attribute_values_convert_both_ways():
+    value = {'cost': Decimal('0.06'), 'models': ['gpt-4'], 'shard': 2}
+    serialized = bootstrap.serialize(value)
+
+    assert serialized == {'M': {'cost': {'N': '0.06'}, 'models': {'L': [{'S': 'gpt-4'}]}, 'shard': {'N': '2'}}}
+    assert bootstrap.deserialize(serialized) == value
+
+def test_tables_share_one_lazily_created_resource(fresh_bootstrap):
+    usage = bootstrap.table('chatgpt_usage_tracking')
+    orgs = bootstrap.table('chatgpt_organizations')
+
+    assert usage.name == 'chatgpt_usage_tracking'
+    assert not bootstrap._resources
+
+    assert usage.meta.client is orgs.meta.client
+    assert bootstrap.client('dynamodb') is usage.meta.client
+    assert len(bootstrap._resources) == 1
+
+def test_config_is_tuned_and_pool_fits_the_largest_reservation(fresh_bootstrap):
+    bootstrap.reserve_connections(32)
+    bootstrap.reserve_connections(8)
+    config = bootstrap.resource('dynamodb').meta.client.meta.config
+
+    assert config.max_pool_connections == 32
+    assert config.tcp_keepalive is True
+    assert config.connect_timeout == bootstrap.CONNECT_TIMEOUT_SECONDS
+    assert config.retries['mode'] == 'standard'
+
+def test_startup_benchmark_runs(capsys):
+    assert startup.main(['--handlers', 'track', 'get_org_costs', '--runs', '1', '--json']) == 0
+    results = json.loads(capsys.readouterr().out)
+
+    assert set(results) == {'track', 'get_org_costs'}
+    for timings in results.values():
+        assert timings['cold_ms'] == pytest.approx(timings['import_ms'] + timings['first_request_ms'], abs=0.05)
@@ -0,0 +1,110 @@
+import pytest
+import json
+from decimal import Decimal
+from unittest.mock import patch
+import os
+import sys
+
+# Add the project root to the Python path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+import get_costs_function
+import result_cache
+import sharding
+import storage
+from tests.fake_dynamodb import FakeContext, FixedShard, hourly_item, make_tables
+
+RANGE = {'organization_id': 'org_1', 'start_date': '2025-03-01', 'end_date': '2025-03-31'}
+
+@pytest.fixture
+def store():
+    """60 hourly records of three users, spread over two write shards."""
+    _, usage, orgs = make_tables(page_size=7)
+    for i in range(60):
+        usage.put_item(Item=sharding.shard_item(hourly_item(i), 2, rng=FixedShard(i % 2)))
+    store = storage.DynamoDBStorage(usage, orgs)
+    with patch.object(get_costs_function, 'store', store), \
+            patch.object(sharding, 'WRITE_SHARDING', True), \
+            patch.object(store, 'write_shards', return_value=2):
+        yield store
+
+def bulk(body, context=None):
+    event = {'resource': '/costs/batch', 'headers': {'Authorization': 'token'}, 'body': json.dumps(body)}
+    response = get_costs_function.lambda_handler(event, context or FakeContext())
+    return response['statusCode'], json.loads(response['body'])
+
+def single(user_id):
+    event = {'headers': {'Authorization': 'token'}, 'queryStringParameters': dict(RANGE, user_id=user_id)}
+    return json.loads(get_costs_function.lambda_handler(event, FakeContext())['body'])
+
+def test_bulk_lookup_answers_every_user_with_one_authorization(store):
+    with patch.object(get_costs_function, 'authorize_request', return_value=True) as authorize:
+        status, body = bulk(dict(RANGE, user_ids=['user_0', 'user_1', 'user_2', 'user_9', 'user_1']))
+        singles = {user_id: single(user_id) for user_id in ('user_0', 'user_1', 'user_2')}
+    assert status == 200 and body['complete'] and body['errors'] == []
+    assert authorize.call_count == 1 + 3
+
+    # Duplicates are answered once, in the order asked
+    assert [user['user_id'] for user in body['users']] == ['user_0', 'user_1', 'user_2', 'user_9']
+    for user in body['users'][:3]:
+        assert user['usage_count'] == singles[user['user_id']]['usage_count'] == 20
+        assert user['total_cost'] == singles[user['user_id']]['total_cost']
+    assert body['users'][3] == {'user_id': 'user_9', 'total_cost': 0.0, 'usage_count': 0}
+    assert body['total_cost'] == pytest.approx(float(sum(Decimal(i + 1).scaleb(-4) for i in range(60))))
+
+def test_bulk_lookup_shares_the_result_cache(store):
+    cache = result_cache.ResultCache(1024 * 1024)
+    with patch.object(get_costs_function, 'authorize_request', return_value=True), \
+            patch.object(result_cache, 'cache', cache), \
+            patch.object(result_cache, 'settled_before', return_value='2025-03-09T12'):
+        expected = single('user_1')
+        with patch.object(store, 'query_usage', side_effect=store.query_usage) as query:
+            _, body = bulk(dict(RANGE, user_ids=['user_1']))
+    user, = body['users']
+    assert (user['total_cost'], user['usage_count']) == (expected['total_cost'], expected['usage_count'])
+    # Only the live tail after the cached settled part is read by time
+    reads = [call.args[0] for call in query.call_args_list if call.args[0]['kind'] != 'ingest']
+    assert reads and all(source['low'] >= '2025-03-09T12' for source in reads)
+
+def test_bulk_lookup_counts_only_the_organizations_records(store):
+    # user_1 also tracks usage in another organization
+    store.table.put_item(Item=hourly_item(100, organization_id='org_2'))
+    with patch.object(get_costs_function, 'authorize_request', return_value=True), \
+            patch.object(store, 'query_usage', side_effect=store.query_usage) as query:
+        _, body = bulk(dict(RANGE, user_ids=['user_1']))
+    user, = body['users']
+    assert user['usage_count'] == 20
+    # Users are read on worker threads, through the shared client
+    assert query.call_count and all(call.kwargs['shared'] for call in query.call_args_list)
+
+def test_failed_and_unfinished_users_are_reported_apart(store):
+    user_costs = get_costs_function.user_costs
+    def failing(organization_id, user_id, *args):
+        if user_id == 'user_2':
+            raise RuntimeError('throttled')
+        return user_costs(organization_id, user_id, *args)
+
+    with patch.object(get_costs_function, 'authorize_request', return_value=True):
+        with patch.object(get_costs_function, 'user_costs', side_effect=failing):
+            status, body = bulk(dict(RANGE, user_ids=['user_0', 'user_2']))
+        assert status == 200 and not body['complete']
+        assert [user['user_id'] for user in body['users']] == ['user_0']
+        assert body['errors'] == [{'user_id': 'user_2', 'error': 'Internal server error: throttled'}]
+
+        # Users that time ran out for are named so they can be asked again
+        status, body = bulk(dict(RANGE, user_ids=['user_0', 'user_1']), FakeContext(remaining_ms=1000))
+    assert status == 200 and body['users'] == []
+    assert [error['user_id'] for error in body['errors']] == ['user_0', 'user_1']
+    assert all('request this user again' in error['error'] for error in body['errors'])
+
+def test_bulk_requests_are_validated(store):
+    with patch.object(get_costs_function, 'authorize_request', return_value=True):
+        assert bulk({'user_ids': ['user_1'], 'start_date': '2025-03-01', 'end_date': '2025-03-31'}) == \
+            (400, {'error': 'Missing required field: organization_id'})
+        assert bulk(dict(RANGE, user_ids='user_1'))[0] == 400
+        assert bulk(dict(RANGE, user_ids=['user_1', '']))[0] == 400
+        with patch.object(get_costs_function, 'MAX_BULK_USERS', 2):
+            status, body = bulk(dict(RANGE, user_ids=['user_0', 'user_1', 'user_2']))
+        assert status == 400 and body['error'].startswith('Too many users: 3')
+    with patch.object(get_costs_function, 'authorize_request', return_value=False):
+        assert bulk(dict(RANGE, user_ids=['user_1'])) == (403, {'error': 'Unauthorized access'})
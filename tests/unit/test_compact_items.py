@@ -0,0 +1,172 @@
+import pytest
+import json
+import random
+from decimal import Decimal
+from unittest.mock import patch
+import os
+import sys
+
+# Add the project root to the Python path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+import get_costs_function
+import get_org_costs_function
+import item_schema
+import lambda_function
+import migrate_compact_items
+import migrate_record_ids
+import raw_export
+import record_keys
+import rollups
+import sharding
+import storage
+import usage_queries
+from local_stream import LocalStream
+from tests.fake_dynamodb import FakeContext, FixedShard, make_rollup_table, make_tables
+
+PARAMS = {'organization_id': 'org_1', 'start_date': '2025-03-01', 'end_date': '2025-03-31'}
+
+def usage_item(i, **extra):
+    ts = 1741428000000 + i * 60000
+    item = {
+        'organization_id': 'org_1',
+        'record_id': record_keys.new_record_id(ts),
+        'user_id': f'user_{i % 3}',
+        'timestamp': f'2025-03-08T10:{i % 60:02d}:00.000000+00:00',
+        'ts': ts,
+        'model_name': ('gpt-4', 'o1')[i % 2],
+        'total_cost': Decimal(i + 1).scaleb(-4),
+        'ingest_key': record_keys.new_record_id(ts + 5)
+    }
+    item.update(extra)
+    return item
+
+def call(module, params):
+    event = {'headers': {'Authorization': 'token'}, 'queryStringParameters': params}
+    return json.loads(module.lambda_handler(event, FakeContext())['body'])
+
+def test_compact_items_expand_to_the_original():
+    item = sharding.shard_item(usage_item(1, session='s1', tags=['a', 'b']), 4, rng=FixedShard(2))
+    compact = item_schema.compact_item(item)
+
+    assert set(compact) == {'organization_id', 'record_id', 'user_id', 'timestamp', 'ingest_key', 'c', 'm', 's', 'x'}
+    assert compact['c'] == 2 * 10 ** 5 and compact['x'] == {'session': 's1', 'tags': ['a', 'b']}
+    assert item_schema.expand_item(compact) == item
+    assert item_schema.item_size(compact) < item_schema.item_size(item) - 25
+    # Compact and older items pass through unchanged
+    assert item_schema.compact_item(compact) is compact
+    assert item_schema.expand_item(item) is item
+
+    # ts is kept when the record id doesn't hold it
+    legacy = dict(usage_item(2), record_id='3f1c4b7e-uuid')
+    assert item_schema.compact_item(legacy)['t'] == legacy['ts']
+    assert item_schema.expand_item(item_schema.compact_item(legacy)) == legacy
+
+def test_extra_fields_follow_the_allow_list_and_budget():
+    record = {'session': 's' * 10, 'client': 'cli', 'notes': 'n' * 2000, 'user_id': 'user_1'}
+    assert item_schema.extra_fields(record) == ({'session': 's' * 10, 'client': 'cli'}, ['notes'])
+    with patch.object(item_schema, 'EXTRA_FIELDS', ['client', 'missing']):
+        assert item_schema.extra_fields(record) == ({'client': 'cli'}, ['session', 'notes'])
+    with patch.object(item_schema, 'EXTRA_FIELDS_MAX_BYTES', 12):
+        assert item_schema.extra_fields(record) == ({}, ['session', 'client', 'notes'])
+
+def test_tracked_records_are_stored_compact_and_counted_alike():
+    resource, usage, orgs = make_tables(page_size=5)
+    rollup_table = make_rollup_table(resource)
+    stream = LocalStream(usage, ('organization_id', 'record_id'))
+    store = storage.DynamoDBStorage(stream, orgs)
+    # Records stored before and after the change
+    for i in range(20):
+        stream.put_item(Item=usage_item(i) if i < 10 else item_schema.compact_item(usage_item(i)))
+    body = {'model_name': 'gpt-4', 'input_tokens': 1000, 'output_tokens': 500, 'user_id': 'user_1',
+            'organization_id': 'org_1', 'timestamp': '2025-03-08T11:00:00Z', 'session': 's1'}
+    with patch.object(item_schema, 'COMPACT_ITEMS', True), \
+            patch.object(lambda_function, 'store', store), \
+            patch.object(lambda_function, 'authorize_request', return_value=True):
+        assert lambda_function.lambda_handler({'body': json.dumps(body)}, None)['statusCode'] == 200
+
+    stored = list(usage.items.values())
+    assert sum(1 for item in stored if item_schema.is_compact(item)) == 11
+    tracked, = [item for item in stored if item.get('x')]
+    assert tracked['c'] == 60000000 and tracked['x'] == {'session': 's1'} and 'ts' not in tracked
+    assert store.get_usage('org_1', tracked['record_id'])['total_cost'] == Decimal('0.06')
+
+    expected = sum(Decimal(i + 1).scaleb(-4) for i in range(20)) + Decimal('0.06')
+    with patch.object(get_costs_function, 'store', store), \
+            patch.object(get_org_costs_function, 'store', store), \
+            patch.object(get_costs_function, 'authorize_request', return_value=True), \
+            patch.object(get_org_costs_function, 'authorize_request', return_value=True):
+        org = call(get_org_costs_function, dict(PARAMS, group_by='model'))
+        user = call(get_costs_function, dict(PARAMS, user_id='user_1'))
+    assert org['total_organization_cost'] == pytest.approx(float(expected))
+    assert {group['model_name'] for group in org['groups']} == {'gpt-4', 'o1'}
+    assert user['usage_count'] == 7 + 1
+
+    # The stream consumer rolls up both forms
+    rollups.apply_stream_records(stream.drain()['Records'], rollup_table)
+    rows = [item for item in rollup_table.items.values() if item['rollup_key'] == 'org_1#D']
+    assert sum(row['total_cost'] for row in rows) == expected
+
+def test_migration_compacts_records_and_reports_the_savings():
+    resource, usage, _ = make_tables()
+    rng = random.Random(5)
+    for i in range(40):
+        item = usage_item(i, session=f's{i}', client='dashboard ' * 100)
+        usage.put_item(Item=sharding.shard_item(item, 2, rng=rng))
+    usage.put_item(Item=item_schema.compact_item(usage_item(99)))
+    before = {key: item_schema.expand_item(item) for key, item in usage.items.items()}
+
+    with patch.object(item_schema, 'EXTRA_FIELDS', ['session']):
+        assert migrate_compact_items.migrate_table(resource.client, usage.name, segments=4, dry_run=True)['migrated'] == 40
+        assert not item_schema.is_compact(next(iter(usage.items.values())))
+        totals = migrate_compact_items.migrate_table(resource.client, usage.name, segments=4)
+
+    assert {name: totals[name] for name in migrate_compact_items.COUNTS} == \
+        {'scanned': 41, 'migrated': 40, 'compact': 1, 'failed': 0}
+    assert all(item_schema.is_compact(item) for item in usage.items.values())
+    after = {key: item_schema.expand_item(item) for key, item in usage.items.items()}
+    assert after == {key: {k: v for k, v in item.items() if k != 'client'} for key, item in before.items()}
+
+    report = migrate_compact_items.report(totals)['per_record']
+    # The dropped field took records past 1 KB, which the table and both
+    # timestamp indexes billed as two write units each
+    assert report['bytes']['saved'] > 900
+    assert report['write_units'] == {'before': 7.0, 'after': 4.0, 'saved': 3.0, 'saved_percent': 42.9}
+    assert report['storage_bytes']['saved_percent'] > 70
+    # Rerunning finds nothing to do, and the record id migration leaves compact items alone
+    assert migrate_compact_items.migrate_table(resource.client, usage.name, segments=4)['migrated'] == 0
+    assert migrate_record_ids.migrate_table(resource.client, usage.name, segments=4)['migrated'] == 0
+
+def test_exports_through_slim_indexes_read_whole_items():
+    resource, usage, orgs = make_tables(page_size=4)
+    store = storage.DynamoDBStorage(usage, orgs)
+    with patch.object(item_schema, 'COMPACT_ITEMS', True):
+        store.put_usage_batch([usage_item(i, session=f's{i}') for i in range(9)])
+
+    with patch.object(item_schema, 'SLIM_INDEXES', ('UserTimestampIndex',)):
+        sources = raw_export.export_sources('org_1', '2025-03-01', '2025-03-31', user_id='user_1')
+        body, records, _ = raw_export.export(sources, store, 'org_1')
+    assert {source['query']['IndexName'] for source in sources} == {'UserTimestampSlimIndex'}
+
+    lines = [json.loads(line) for line in body.decode('utf-8').splitlines()]
+    assert records == 3 and [line['session'] for line in lines] == ['s1', 's4', 's7']
+    assert all(line['total_cost'] == float(Decimal(int(line['session'][1:]) + 1).scaleb(-4)) for line in lines)
+    assert sum(1 for call in resource.client.calls if call[0] == 'batch_get_item') == 1
+
+@pytest.mark.parametrize('setting, indexes', [
+    ('none', ('UserTimestampIndex', 'OrgTimestampIndex', 'OrgIngestIndex')),
+    ('user', ('UserTimestampSlimIndex', 'OrgTimestampIndex', 'OrgIngestIndex')),
+    ('org', ('UserTimestampSlimIndex', 'OrgTimestampSlimIndex', 'OrgIngestIndex')),
+    ('all', ('UserTimestampSlimIndex', 'OrgTimestampSlimIndex', 'OrgIngestSlimIndex')),
+])
+def test_readers_move_to_slim_indexes_one_step_at_a_time(setting, indexes):
+    with patch.object(item_schema, 'SLIM_INDEXES', item_schema._SLIM_INDEX_SETTINGS[setting]):
+        sources = [
+            usage_queries.raw_source('user', 'user_1', '2025-03-01', '2025-03-02'),
+            usage_queries.raw_source('organization', 'org_1', '2025-03-01', '2025-03-02'),
+            usage_queries.ingest_source('org_1', '0', '1', '2025-03-01', '2025-03-02')
+        ]
+    assert tuple(source['query']['IndexName'] for source in sources) == indexes
+    # Only the original timestamp indexes hold whole items
+    assert [name for name in item_schema.INDEX_KEYS if item_schema.projects_whole_items(name)] == \
+        ['OrgTimestampIndex', 'UserTimestampIndex']
@@ -0,0 +1,85 @@
+import pytest
+import json
+from decimal import Decimal
+from unittest.mock import patch
+import os
+import sys
+
+# Add the project root to the Python path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+import get_costs_function
+import get_org_costs_function
+import storage
+from tests.fake_dynamodb import FakeContext, cost_event, make_tables
+
+@pytest.fixture
+def usage_table():
+    """Usage table with 100 records for 3 users, returned 7 per page."""
+    _, usage, orgs = make_tables(page_size=7)
+    for i in range(100):
+        usage.put_item(Item={
+            'organization_id': 'org_1',
+            'record_id': f'rec_{i:03d}',
+            'user_id': f'user_{i % 3}',
+            'timestamp': f'2025-03-08T{i % 24:02d}:00:00',
+            'model_name': 'gpt-4',
+            'total_cost': Decimal('0.01') * (i + 1),
+            'prompt': 'x' * 100
+        })
+    with patch.object(get_costs_function, 'store', storage.DynamoDBStorage(usage, orgs)), \
+            patch.object(get_org_costs_function, 'store', storage.DynamoDBStorage(usage, orgs)), \
+            patch.object(get_costs_function, 'authorize_request', return_value=True), \
+            patch.object(get_org_costs_function, 'authorize_request', return_value=True):
+        yield usage
+
+ORG_PARAMS = {'organization_id': 'org_1', 'start_date': '2025-03-01', 'end_date': '2025-03-31'}
+USER_PARAMS = dict(ORG_PARAMS, user_id='user_1')
+
+def test_org_costs_follow_every_page(usage_table):
+    body = json.loads(get_org_costs_function.lambda_handler(cost_event(ORG_PARAMS), FakeContext())['body'])
+
+    assert body['complete'] is True
+    assert sum(user['usage_count'] for user in body['user_costs']) == 100
+    assert body['total_organization_cost'] == pytest.approx(50.5)
+    assert len(usage_table.query_calls) == 15
+    assert all(call['ProjectionExpression'] for call in usage_table.query_calls)
+
+def test_user_costs_follow_every_page(usage_table):
+    body = json.loads(get_costs_function.lambda_handler(cost_event(USER_PARAMS), FakeContext())['body'])
+
+    assert body['usage_count'] == 33
+    assert body['total_cost'] == pytest.approx(sum(0.01 * (i + 1) for i in range(100) if i % 3 == 1))
+
+@pytest.mark.parametrize('module, params', [
+    (get_org_costs_function, ORG_PARAMS),
+    (get_costs_function, USER_PARAMS),
+])
+def test_early_stop_returns_token_and_resumes_to_same_total(usage_table, module, params):
+    expected = json.loads(module.lambda_handler(cost_event(params), FakeContext())['body'])
+
+    # Each time check costs 2.5s, so every invocation reads only a few pages
+    responses = []
+    token = None
+    while True:
+        request = dict(params, continuation_token=token) if token else params
+        body = json.loads(module.lambda_handler(cost_event(request), FakeContext(10000, 2500))['body'])
+        responses.append(body)
+        if body['complete']:
+            break
+        assert 'total_cost' not in body and 'total_organization_cost' not in body
+        token = body['continuation_token']
+
+    assert len(responses) > 1
+    assert body == pytest.approx(expected)
+
+def test_bad_or_mismatched_tokens_are_rejected(usage_table):
+    body = json.loads(get_org_costs_function.lambda_handler(
+        cost_event(ORG_PARAMS), FakeContext(10000, 4000))['body'])
+    token = body['continuation_token']
+
+    other_range = dict(ORG_PARAMS, start_date='2025-02-01', continuation_token=token)
+    assert get_org_costs_function.lambda_handler(cost_event(other_range), FakeContext())['statusCode'] == 400
+
+    garbage = dict(ORG_PARAMS, continuation_token='not-a-token')
+    assert get_org_costs_function.lambda_handler(cost_event(garbage), FakeContext())['statusCode'] == 400
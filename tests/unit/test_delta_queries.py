@@ -0,0 +1,166 @@
+import pytest
+import json
+import sqlite3
+from datetime import datetime, timezone
+from decimal import Decimal
+from unittest.mock import patch
+import os
+import sys
+
+# Add the project root to the Python path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+import get_costs_function
+import get_org_costs_function
+import ingest_worker
+import lambda_function
+import record_keys
+import sharding
+import storage
+import usage_queries
+from tests.fake_dynamodb import FakeContext, FixedShard, make_tables
+
+ORG_PARAMS = {'organization_id': 'org_1', 'start_date': '2025-03-08', 'end_date': '2025-03-08T23:59:59'}
+USER_PARAMS = dict(ORG_PARAMS, user_id='user_1')
+
+def stored_at(minute):
+    """Epoch milliseconds of 13:MM on 2025-03-08, when records are stored."""
+    return int(datetime(2025, 3, 8, 13, minute, tzinfo=timezone.utc).timestamp() * 1000)
+
+def watermark(minute):
+    return record_keys.upper_bound(record_keys.canonical(datetime(2025, 3, 8, 13, minute, tzinfo=timezone.utc)))
+
+def usage_item(i, hour, minute=None, user_id='user_1', model_name='gpt-4', cost='0.01', day='08'):
+    item = {
+        'organization_id': 'org_1',
+        'record_id': f'rec_{i:04d}',
+        'user_id': user_id,
+        'timestamp': f'2025-03-{day}T{hour:02d}:30:00',
+        'model_name': model_name,
+        'total_cost': Decimal(cost)
+    }
+    if minute is not None:
+        item['ingest_key'] = record_keys.new_record_id(stored_at(minute))
+    return item
+
+@pytest.fixture(params=['dynamodb', 'sqlite'])
+def usage(request, tmp_path):
+    """Records stored before ingest keys existed and from 13:00 to 13:19 on 2025-03-08."""
+    if request.param == 'sqlite':
+        store = storage.SQLiteStorage(str(tmp_path / 'usage.db'), page_items=7)
+    else:
+        _, table, orgs = make_tables(page_size=7)
+        store = storage.DynamoDBStorage(table, orgs)
+    store.put_usage_batch([usage_item(i, i % 12) for i in range(10)])
+    store.put_usage_batch([
+        usage_item(100 + i, i % 12, minute=i, user_id=f'user_{i % 2}', model_name=('gpt-4', 'o1')[i % 3 == 0])
+        for i in range(20)
+    ])
+    with patch.object(get_costs_function, 'store', store), \
+            patch.object(get_org_costs_function, 'store', store), \
+            patch.object(get_costs_function, 'authorize_request', return_value=True), \
+            patch.object(get_org_costs_function, 'authorize_request', return_value=True):
+        yield store
+    if request.param == 'sqlite':
+        store.close()
+
+def call(module, params, through_minute, context=None):
+    event = {'headers': {'Authorization': 'token'}, 'queryStringParameters': params}
+    with patch.object(usage_queries, 'current_watermark', return_value=watermark(through_minute)):
+        response = module.lambda_handler(event, context or FakeContext())
+    return response['statusCode'], json.loads(response['body'])
+
+def test_deltas_add_up_to_the_full_total(usage):
+    # The baseline counts old records and those stored up to the watermark
+    status, baseline = call(get_org_costs_function, dict(ORG_PARAMS, watermark='0'), through_minute=10)
+    assert status == 200 and baseline['since'] == '0' and baseline['watermark'] == watermark(10)
+    assert sum(user['usage_count'] for user in baseline['user_costs']) == 10 + 11
+
+    # A late record with a timestamp in the past, and one outside the range
+    usage.put_usage_batch([usage_item(900, 2, minute=30, cost='1.5'), usage_item(901, 2, minute=31, day='09')])
+    _, delta = call(get_org_costs_function, dict(ORG_PARAMS, watermark=baseline['watermark']), through_minute=40)
+    assert delta['watermark'] == watermark(40)
+    assert {user['user_id']: user['usage_count'] for user in delta['user_costs']} == {'user_0': 4, 'user_1': 5 + 1}
+
+    full = json.loads(get_org_costs_function.lambda_handler(
+        {'headers': {'Authorization': 'token'}, 'queryStringParameters': ORG_PARAMS}, FakeContext()
+    )['body'])
+    assert baseline['total_organization_cost'] + delta['total_organization_cost'] == \
+        pytest.approx(full['total_organization_cost'])
+
+    # Nothing new was stored since
+    _, empty = call(get_org_costs_function, dict(ORG_PARAMS, watermark=delta['watermark']), through_minute=50)
+    assert empty['total_organization_cost'] == 0 and empty['user_costs'] == []
+
+def test_user_deltas_read_only_the_users_records(usage):
+    _, baseline = call(get_costs_function, dict(USER_PARAMS, watermark='0'), through_minute=19)
+    assert baseline['usage_count'] == 10 + 10
+
+    # A record stored on another write shard of the organization
+    usage.put_usage_batch([sharding.shard_item(usage_item(900, 4, minute=25, cost='2'), 2, rng=FixedShard(1))])
+    with patch.object(sharding, 'WRITE_SHARDING', True), patch.object(usage, 'write_shards', return_value=2):
+        _, delta = call(get_costs_function, dict(USER_PARAMS, watermark=baseline['watermark']), through_minute=30)
+    assert delta['usage_count'] == 1 and delta['total_cost'] == pytest.approx(2.0)
+
+def test_grouped_deltas_list_only_the_changed_groups(usage):
+    params = dict(ORG_PARAMS, group_by='model,hour', watermark=watermark(19))
+    usage.put_usage_batch([usage_item(900, 3, minute=21, model_name='o1'), usage_item(901, 3, minute=22, model_name='o1')])
+    _, delta = call(get_org_costs_function, params, through_minute=30)
+    assert delta['groups'] == [
+        {'model_name': 'o1', 'hour': '2025-03-08T03', 'total_cost': pytest.approx(0.02), 'usage_count': 2}
+    ]
+
+def test_resumed_deltas_keep_their_watermark(usage):
+    expected = call(get_org_costs_function, dict(ORG_PARAMS, watermark='0'), through_minute=12)[1]
+    token = None
+    responses = 0
+    while True:
+        params = dict(ORG_PARAMS, watermark='0', continuation_token=token) if token else dict(ORG_PARAMS, watermark='0')
+        # Time moves on between invocations; the token keeps the first watermark
+        _, body = call(get_org_costs_function, params, through_minute=12 + responses, context=FakeContext(10000, 3000))
+        responses += 1
+        if body['complete']:
+            break
+        token = body['continuation_token']
+    assert responses > 1
+    assert body == expected
+
+def test_invalid_watermarks_are_rejected(usage):
+    for module, params in ((get_costs_function, USER_PARAMS), (get_org_costs_function, ORG_PARAMS)):
+        status, body = call(module, dict(params, watermark='yesterday'), through_minute=10)
+        assert status == 400 and body['error'] == 'Invalid watermark'
+
+def test_watermarks_trail_the_clock():
+    now = datetime(2025, 3, 8, 13, 20, tzinfo=timezone.utc)
+    with patch.object(usage_queries, 'DELTA_SETTLE_SECONDS', 600):
+        assert usage_queries.current_watermark(now) == watermark(10)
+    assert record_keys.record_id_ms(watermark(10)) == stored_at(10)
+
+def test_redelivered_records_keep_their_ingest_key():
+    _, table, orgs = make_tables()
+    body = {'model_name': 'gpt-4', 'input_tokens': 1000, 'output_tokens': 500,
+            'user_id': 'user_1', 'organization_id': 'org_1'}
+    message = {'id': 'm1', 'body': json.dumps({'record_id': record_keys.new_record_id(stored_at(0)), 'record': body})}
+    with patch.object(lambda_function, 'store', storage.DynamoDBStorage(table, orgs)):
+        assert ingest_worker.process_messages([dict(message, receive_count=1)]) == (1, 0, [])
+        item, = table.items.values()
+        assert ingest_worker.process_messages([dict(message, receive_count=2)]) == (1, 0, [])
+    assert list(table.items.values()) == [item]
+
+def test_sqlite_databases_from_before_ingest_keys_are_upgraded(tmp_path):
+    path = str(tmp_path / 'usage.db')
+    db = sqlite3.connect(path)
+    db.executescript(storage.SQLITE_SCHEMA.replace('    ingest_key TEXT,\n', ''))
+    db.execute(
+        "INSERT INTO usage (organization_id, record_id, user_id, timestamp, total_cost) VALUES (?, ?, ?, ?, ?)",
+        ('org_1', 'rec_0001', 'user_1', '2025-03-08T01:30:00', '0.5')
+    )
+    db.commit()
+    db.close()
+
+    store = storage.SQLiteStorage(path)
+    store.put_usage_batch([usage_item(2, 2, minute=5)])
+    sources = usage_queries.delta_sources('organization', 'org_1', 'org_1', '2025-03-08', '2025-03-09', '0', watermark(10))
+    items = [item for source in sources for item in store.query_usage(source)['Items']]
+    store.close()
+    assert sorted(item['timestamp'] for item in items) == ['2025-03-08T01:30:00', '2025-03-08T02:30:00']
@@ -0,0 +1,160 @@
+import pytest
+import json
+import random
+from decimal import Decimal
+from unittest.mock import patch
+import os
+import sys
+
+# Add the project root to the Python path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+import aggregation
+import get_org_costs_function
+import rollup_function
+import storage
+from local_stream import LocalStream
+from tests.fake_dynamodb import FakeContext, cost_event, make_rollup_table, make_tables
+
+def usage_item(i, timestamp, user_id, model_name, cost):
+    return {
+        'organization_id': 'org_1',
+        'record_id': f'rec_{i:05d}',
+        'user_id': user_id,
+        'timestamp': timestamp,
+        'model_name': model_name,
+        'total_cost': Decimal(cost)
+    }
+
+def random_items(count=300, seed=3):
+    rng = random.Random(seed)
+    items = []
+    for i in range(count):
+        timestamp = f'2025-03-{rng.randint(5, 9):02d}T{rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}:00+00:00'
+        items.append(usage_item(i, timestamp, f'user_{rng.randint(1, 3)}', rng.choice(['gpt-4', 'gpt-4o']),
+                                str(Decimal(rng.randint(1, 999)).scaleb(-6))))
+    return items
+
+def expected_groups(items, fields, start, end):
+    groups = {}
+    for item in items:
+        if not start <= item['timestamp'] <= end:
+            continue
+        values = {'user_id': item['user_id'], 'model_name': item['model_name'],
+                  'day': item['timestamp'][:10], 'hour': item['timestamp'][:13]}
+        key = tuple(values[field] for field in fields)
+        cost, count = groups.get(key, (Decimal(0), 0))
+        groups[key] = (cost + item['total_cost'], count + 1)
+    return groups
+
+def org_costs(params, context=None):
+    params = dict({'organization_id': 'org_1', 'start_date': '2025-03-05', 'end_date': '2025-03-09T12:00:00'}, **params)
+    with patch.object(get_org_costs_function, 'authorize_request', return_value=True):
+        response = get_org_costs_function.lambda_handler(cost_event(params), context)
+    return response['statusCode'], json.loads(response['body'])
+
+@pytest.fixture(params=['dynamodb', 'sqlite'])
+def items(request, tmp_path):
+    items = random_items()
+    if request.param == 'sqlite':
+        store = storage.SQLiteStorage(str(tmp_path / 'usage.db'), page_items=20)
+    else:
+        _, usage, orgs = make_tables(page_size=20)
+        store = storage.DynamoDBStorage(usage, orgs)
+    store.put_usage_batch(items)
+    with patch.object(get_org_costs_function, 'store', store):
+        yield items
+    if request.param == 'sqlite':
+        store.close()
+
+def group_key(group, fields):
+    return tuple(group[field] for field in fields)
+
+def test_groups_by_any_mix_of_dimensions(items):
+    for group_by, fields in [('model,day', ('model_name', 'day')),
+                             ('user, hour', ('user_id', 'hour')),
+                             ('day,model,user', ('day', 'model_name', 'user_id'))]:
+        status, body = org_costs({'group_by': group_by})
+        assert status == 200 and body['complete'] is True
+        assert body['group_by'] == [part.strip() for part in group_by.split(',')]
+
+        expected = expected_groups(items, fields, '2025-03-05', '2025-03-09T12:00:00')
+        assert body['total_groups'] == len(expected)
+        assert {group_key(group, fields): group['usage_count'] for group in body['groups']} == \
+            {key: count for key, (cost, count) in expected.items()}
+        for group in body['groups']:
+            assert group['total_cost'] == pytest.approx(float(expected[group_key(group, fields)][0]))
+        costs = [group['total_cost'] for group in body['groups']]
+        assert costs == sorted(costs, reverse=True)
+
+def test_default_grouping_keeps_the_user_report(items):
+    status, body = org_costs({})
+    assert set(body) == {'organization_id', 'start_date', 'end_date', 'total_organization_cost',
+                         'total_users', 'user_costs', 'complete'}
+    expected = expected_groups(items, ('user_id',), '2025-03-05', '2025-03-09T12:00:00')
+    assert {user['user_id']: user['usage_count'] for user in body['user_costs']} == \
+        {key[0]: count for key, (cost, count) in expected.items()}
+    assert body['total_organization_cost'] == pytest.approx(float(sum(cost for cost, _ in expected.values())))
+
+def test_grouped_scan_resumes_from_continuation_tokens(items):
+    status, complete = org_costs({'group_by': 'model,day'})
+
+    responses = 0
+    token = None
+    while True:
+        extra = {'continuation_token': token} if token else {}
+        status, body = org_costs(dict({'group_by': 'model,day'}, **extra), FakeContext(remaining_ms=10000, step_ms=3000))
+        responses += 1
+        if body['complete']:
+            break
+        token = body['continuation_token']
+        # A token only resumes the grouping it was issued for
+        assert org_costs({'group_by': 'user', 'continuation_token': token})[0] == 400
+
+    assert responses > 1
+    assert body['groups'] == complete['groups']
+
+def test_unknown_or_repeated_dimensions_are_rejected(items):
+    for group_by in ('team', 'user,user', ','):
+        status, body = org_costs({'group_by': group_by})
+        assert status == 400 and 'error' in body
+
+def test_hourly_groups_from_rollups_match_raw_records():
+    resource, usage, orgs = make_tables()
+    rollup_table = make_rollup_table(resource)
+    stream = LocalStream(usage, ('organization_id', 'record_id'))
+    for item in random_items(seed=11):
+        stream.put_item(Item=item)
+    with patch.object(rollup_function, 'rollup_table', rollup_table):
+        assert rollup_function.lambda_handler(stream.drain(), None) == {'batchItemFailures': []}
+
+    params = {'group_by': 'hour,model', 'start_date': '2025-03-05T10:30:00', 'end_date': '2025-03-09T06:15:00'}
+    with patch.object(get_org_costs_function, 'store', storage.DynamoDBStorage(usage, orgs)):
+        raw = org_costs(params)[1]
+    with patch.object(get_org_costs_function, 'store', storage.DynamoDBStorage(usage, orgs, rollup_table)):
+        usage.query_calls.clear()
+        rolled = org_costs(params)[1]
+
+    # Whole days are read from hourly rollups, and only the edges raw
+    assert len(usage.query_calls) <= 2
+    by_key = lambda body: {(group['hour'], group['model_name']): group for group in body['groups']}
+    assert by_key(rolled).keys() == by_key(raw).keys()
+    for key, group in by_key(raw).items():
+        assert by_key(rolled)[key]['usage_count'] == group['usage_count']
+        assert by_key(rolled)[key]['total_cost'] == pytest.approx(group['total_cost'])
+
+def test_group_totals_are_exact_and_survive_partials():
+    source = {'kind': 'raw'}
+    page = [{'user_id': 'user_1', 'model_name': 'gpt-4', 'timestamp': '2025-03-05T10:00:00', 'total_cost': Decimal('0.000000001')}
+            for _ in range(10)]
+    first = aggregation.GroupedCosts(('user', 'model'))
+    first.add_page(source, page)
+
+    second = aggregation.GroupedCosts(('user', 'model'))
+    second.add_partial(json.loads(json.dumps(first.partial())))
+    second.add_page(source, page)
+
+    assert second.cost_nanos.tolist() == [20] and second.counts.tolist() == [20]
+    assert second.total_cost() == Decimal('0.000000020')
+    with pytest.raises(ValueError):
+        aggregation.GroupedCosts(('user',)).add_partial(first.partial())
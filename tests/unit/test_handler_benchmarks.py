@@ -0,0 +1,54 @@
+import pytest
+import json
+import os
+import sys
+
+# Add the project root to the Python path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from benchmarks import handlers
+
+def test_fake_query_pages_in_key_order():
+    usage, _ = handlers.load_tables(50, page_items=7)
+    kwargs = {'KeyConditionExpression': 'organization_id = :org',
+              'ExpressionAttributeValues': {':org': 'org_bench'}}
+
+    ids, response = [], {}
+    while True:
+        if response.get('LastEvaluatedKey'):
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+        response = usage.query(**kwargs)
+        assert response['Count'] <= 7
+        ids.extend(item['record_id'] for item in response['Items'])
+        if 'LastEvaluatedKey' not in response:
+            break
+    assert ids == sorted(item['record_id'] for item in usage.items.values())
+
+def test_every_handler_runs(capsys, tmp_path):
+    saved = tmp_path / 'baseline.json'
+    assert handlers.main(['--sizes', '200', '--requests', '5', '--page-items', '50', '--save', str(saved)]) == 0
+
+    results = json.loads(saved.read_text())
+    assert set(results) == {f'{name}@200' for name in handlers.HANDLERS}
+    for result in results.values():
+        assert result['requests'] == 5
+        assert result['rps'] > 0 and result['p99_ms'] >= result['p50_ms'] > 0
+    assert 'get_org_costs@200' in capsys.readouterr().out
+
+def test_compare_flags_only_large_regressions():
+    baseline = {'track@1000': {'rps': 1000.0, 'p50_ms': 1.0, 'p99_ms': 2.0, 'peak_kb': 10.0},
+                'get_costs@1000': {'rps': 500.0, 'p50_ms': 2.0, 'p99_ms': 4.0, 'peak_kb': 10.0}}
+    results = {'track@1000': {'rps': 900.0, 'p50_ms': 1.1, 'p99_ms': 2.2, 'peak_kb': 30.0},
+               'get_costs@1000': {'rps': 300.0, 'p50_ms': 2.0, 'p99_ms': 6.0, 'peak_kb': 10.0},
+               'get_org_costs@1000': {'rps': 1.0, 'p50_ms': 9.0, 'p99_ms': 9.0, 'peak_kb': 9.0}}
+
+    rows, regressions = handlers.compare(results, baseline, 0.25)
+
+    assert len(rows) == 8
+    assert [(case, field) for case, field, *_ in regressions] == [('get_costs@1000', 'rps'), ('get_costs@1000', 'p99_ms')]
+    assert regressions[0][4] == pytest.approx(-0.4)
+
+def test_baseline_regression_sets_exit_status(tmp_path):
+    baseline = tmp_path / 'baseline.json'
+    baseline.write_text(json.dumps({'track@100': {'rps': 1e9, 'p50_ms': 1e-6, 'p99_ms': 1e-6, 'peak_kb': 1.0}}))
+    assert handlers.main(['--handlers', 'track', '--sizes', '100', '--requests', '5', '--baseline', str(baseline)]) == 1
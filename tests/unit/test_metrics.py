@@ -0,0 +1,115 @@
+import pytest
+import json
+import logging
+import random
+from unittest.mock import patch
+import os
+import sys
+
+# Add the project root to the Python path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+import auth
+import get_org_costs_function
+import lambda_function
+import metrics
+import storage
+import usage_queries
+from tests.fake_dynamodb import make_tables
+
+def track_event(token='secret-token', **overrides):
+    body = {'model_name': 'gpt-4', 'input_tokens': 100, 'output_tokens': 50,
+            'user_id': 'user_1', 'organization_id': 'org_1'}
+    body.update(overrides)
+    return {'headers': {'Authorization': f'Bearer {token}'}, 'body': json.dumps(body)}
+
+@pytest.fixture
+def sink():
+    memory = metrics.MemorySink()
+    with patch.object(metrics, 'sink', memory):
+        yield memory
+
+@pytest.fixture
+def tables():
+    """Fake tables with one active organization, and a cold token cache."""
+    _, usage, orgs = make_tables()
+    orgs.put_item(Item={'organization_id': 'org_1', 'auth_token': 'secret-token', 'status': 'active'})
+    with patch.object(auth, 'store', storage.DynamoDBStorage(org_table=orgs)), \
+            patch.object(auth, 'token_cache', auth.TokenCache(100, 60, 10)), \
+            patch.object(lambda_function, 'store', storage.DynamoDBStorage(usage, orgs)), \
+            patch.object(lambda_function, 'queue', None), \
+            patch.object(get_org_costs_function, 'store', storage.DynamoDBStorage(usage, orgs)):
+        yield usage, orgs
+
+def test_track_emits_stage_timings_with_dimensions(sink, tables):
+    response = lambda_function.lambda_handler(track_event(), None)
+    assert response['statusCode'] == 200
+
+    document, = sink.documents
+    assert document['function'] == 'track'
+    assert document['organization_id'] == 'org_1' and document['model_name'] == 'gpt-4'
+    assert document['status_code'] == 200
+    for stage in ('parse', 'auth', 'pricing', 'write'):
+        assert document[f'{stage}_ms'] >= 0
+    assert document['total_ms'] >= document['write_ms']
+
+    definition, = document['_aws']['CloudWatchMetrics']
+    assert definition['Dimensions'] == metrics.DIMENSION_SETS
+    assert {'Name': 'auth_ms', 'Unit': 'Milliseconds'} in definition['Metrics']
+
+def test_rejected_requests_are_measured_too(sink, tables):
+    lambda_function.lambda_handler(track_event(token='wrong'), None)
+    lambda_function.lambda_handler(track_event(model_name='gpt-5'), None)
+
+    assert [document['status_code'] for document in sink.documents] == [403, 400]
+    # Without an organization only the per-function dimension set applies
+    assert sink.documents[1]['_aws']['CloudWatchMetrics'][0]['Dimensions'] == [['function']]
+
+def test_org_costs_times_query_pages(sink, tables):
+    usage, _ = tables
+    for i in range(40):
+        lambda_function.lambda_handler(track_event(user_id=f'user_{i % 4}', timestamp=f'2025-03-08T{i % 24:02d}:00:00'), None)
+    usage.page_size = 7
+    sink.documents.clear()
+
+    event = {'headers': {'Authorization': 'secret-token'}, 'queryStringParameters': {
+        'organization_id': 'org_1', 'start_date': '2025-03-01', 'end_date': '2025-03-31'}}
+    with patch.object(usage_queries, 'QUERY_SLICE_ITEMS', 10):
+        assert get_org_costs_function.lambda_handler(event, None)['statusCode'] == 200
+
+    document, = sink.documents
+    assert document['function'] == 'get_org_costs'
+    assert document['query_pages'] > 1
+    # 40 records in slices of about 10
+    assert document['query_slices'] > 1
+    assert {'Name': 'query_slices', 'Unit': 'Count'} in document['_aws']['CloudWatchMetrics'][0]['Metrics']
+    assert document['query_page_ms'] > 0
+    for stage in ('auth', 'plan', 'query', 'serialize'):
+        assert f'{stage}_ms' in document
+
+def test_tokens_and_events_are_not_logged(sink, tables, caplog):
+    with caplog.at_level(logging.INFO):
+        lambda_function.lambda_handler(track_event(), None)
+    assert 'secret-token' not in caplog.text
+    assert 'Authorization' not in caplog.text
+
+def test_debug_logs_are_sampled(caplog):
+    with caplog.at_level(logging.INFO):
+        invocation = metrics.start('track', sample_rate=0.5, rng=random.Random(1))
+        sampled = invocation.sampled
+        metrics.debug("Usage recorded: %s", 'org_1')
+        metrics.finish(invocation)
+        metrics.debug("Outside any invocation")
+
+    assert ('Usage recorded: org_1' in caplog.text) == sampled
+    assert 'Outside any invocation' not in caplog.text
+
+def test_emit_failures_never_reach_the_caller():
+    class BrokenSink:
+        def emit(self, document):
+            raise IOError('stdout closed')
+
+    with patch.object(metrics, 'sink', BrokenSink()):
+        handler = metrics.instrumented('test')(lambda event, context: {'statusCode': 200})
+        assert handler({}, None) == {'statusCode': 200}
+    assert metrics.current() is None
@@ -0,0 +1,93 @@
+import pytest
+import json
+import logging
+from decimal import Decimal
+from unittest.mock import patch
+import os
+import sys
+
+# Add the project root to the Python path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+import get_org_costs_function
+import storage
+import usage_queries
+from tests.fake_dynamodb import FakeContext, cost_event, make_tables
+
+ORG_PARAMS = {'organization_id': 'org_1', 'start_date': '2025-03-01', 'end_date': '2025-03-31T23:59:59'}
+
+@pytest.fixture
+def dense_org():
+    """An organization with 600 records spread over March, returned 20 per page."""
+    _, usage, orgs = make_tables(page_size=20)
+    for i in range(600):
+        usage.put_item(Item={
+            'organization_id': 'org_1',
+            'record_id': f'rec_{i:04d}',
+            'user_id': f'user_{i % 5}',
+            'timestamp': f'2025-03-{1 + i // 20:02d}T{i % 20:02d}:15:00+00:00',
+            'total_cost': Decimal('0.001') * (i + 1)
+        })
+    with patch.object(get_org_costs_function, 'store', storage.DynamoDBStorage(usage, orgs)), \
+            patch.object(get_org_costs_function, 'authorize_request', return_value=True), \
+            patch.object(usage_queries, 'QUERY_SLICE_ITEMS', 100):
+        yield usage
+
+def run(params, context=None, workers=4):
+    with patch.object(usage_queries, 'QUERY_WORKERS', workers):
+        return json.loads(get_org_costs_function.lambda_handler(cost_event(params), context or FakeContext())['body'])
+
+def test_slice_boundaries_follow_data_density():
+    sparse_page = [{'timestamp': '2025-03-20T00:00:00'}] * 20
+    assert usage_queries.slice_boundaries('2025-03-01', '2025-03-31', sparse_page) == []
+
+    dense_page = [{'timestamp': '2025-03-01T12:00:00'}] * 20
+    with patch.object(usage_queries, 'QUERY_SLICE_ITEMS', 100):
+        boundaries = usage_queries.slice_boundaries('2025-03-01', '2025-03-31', dense_page)
+    assert len(boundaries) == 11
+    assert boundaries == sorted(set(boundaries))
+    assert '2025-03-01T12:00:00' < boundaries[0] and boundaries[-1] < '2025-03-31'
+
+    # Timestamps are parsed like client timestamps, whatever the Python version
+    zulu_page = [{'timestamp': '2025-03-01T12:00:00.5Z'}] * 20
+    with patch.object(usage_queries, 'QUERY_SLICE_ITEMS', 100):
+        assert len(usage_queries.slice_boundaries('2025-03-01', '2025-03-31', zulu_page)) == 11
+
+def test_slices_partition_the_range():
+    source = usage_queries.raw_source('organization', 'org_1', '2025-03-01', '2025-03-31')
+    slices = usage_queries.split_sources([source], [[0, ['2025-03-10', '2025-03-20']]])
+
+    assert [s['query']['ExpressionAttributeValues'][':start'] for s in slices] == ['2025-03-01', '2025-03-10', '2025-03-20']
+    assert [s['exclude_from'] for s in slices] == ['2025-03-10', '2025-03-20', None]
+
+def test_parallel_scan_matches_sequential_scan(dense_org, caplog):
+    sequential = run(ORG_PARAMS, workers=1)
+    sequential_pages = len(dense_org.query_calls)
+    dense_org.query_calls.clear()
+
+    with caplog.at_level(logging.INFO):
+        parallel = run(ORG_PARAMS)
+
+    assert parallel == pytest.approx(sequential)
+    assert sum(user['usage_count'] for user in parallel['user_costs']) == 600
+    stats = json.loads(caplog.text.split('Cost query stats: ')[-1].splitlines()[0])
+    assert stats['slices'] > 1 and stats['workers'] == 4
+    assert stats['pages'] == len(dense_org.query_calls)
+    # Slicing adds at most one partial page per slice
+    assert len(dense_org.query_calls) <= sequential_pages + stats['slices']
+
+def test_parallel_scan_stops_and_resumes_without_double_counting(dense_org):
+    expected = run(ORG_PARAMS)
+
+    invocations = 0
+    token = None
+    while True:
+        params = dict(ORG_PARAMS, continuation_token=token) if token else ORG_PARAMS
+        body = run(params, FakeContext(10000, 3000))
+        invocations += 1
+        if body['complete']:
+            break
+        token = body['continuation_token']
+
+    assert invocations > 1
+    assert body == pytest.approx(expected)
@@ -0,0 +1,57 @@
+import pytest
+from decimal import Decimal
+import os
+import sys
+
+# Add the project root to the Python path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+import pricing
+
+def reference_cost(model_name, input_tokens, output_tokens, cached_input_tokens=0, reasoning_tokens=0):
+    """The original per-request Decimal formula the engine replaces."""
+    rates = pricing.MODEL_PRICING[model_name]
+    million = Decimal('1000000')
+    cost = (Decimal(str(input_tokens)) / million) * rates['input']
+    cost += (Decimal(str(output_tokens)) / million) * rates['output']
+    if cached_input_tokens > 0 and 'cached_input' in rates:
+        cost += (Decimal(str(cached_input_tokens)) / million) * rates['cached_input']
+    if reasoning_tokens > 0 and 'reasoning' in rates:
+        cost += (Decimal(str(reasoning_tokens)) / million) * rates['reasoning']
+    return cost
+
+@pytest.mark.parametrize('model_name', pricing.SUPPORTED_MODELS)
+def test_engine_matches_decimal_formula(model_name):
+    for tokens in [(0, 0, 0, 0), (1, 1, 1, 1), (1000, 500, 200, 300), (987654321, 123456789, 5555, 77)]:
+        nanos = pricing.price(model_name, *tokens)
+        assert isinstance(nanos, int)
+        assert pricing.to_decimal(nanos) == reference_cost(model_name, *tokens)
+
+def test_rates_are_integer_nano_dollars():
+    assert pricing.COMPILED_RATES['gpt-4'] == (30000, 60000, 0, 0)
+    assert pricing.COMPILED_RATES['mistral-tiny'] == (140, 420, 0, 0)
+    assert pricing.COMPILED_RATES['gpt-4o'] == (5000, 15000, 750, 0)
+
+def test_price_many_matches_single_pricing():
+    records = [
+        {'model_name': 'gpt-4o', 'input_tokens': 1200, 'output_tokens': 300, 'cached_input_tokens': 50},
+        {'model_name': 'unknown-model', 'input_tokens': 1, 'output_tokens': 1},
+        {'model_name': 'mistral-large', 'input_tokens': 10, 'output_tokens': 20, 'reasoning_tokens': 30},
+    ]
+
+    costs = pricing.price_many(records)
+
+    assert costs == [
+        pricing.price('gpt-4o', 1200, 300, 50),
+        None,
+        pricing.price('mistral-large', 10, 20, 0, 30),
+    ]
+
+def test_unsupported_model_raises_key_error():
+    assert not pricing.is_supported('gpt-5')
+    with pytest.raises(KeyError):
+        pricing.price('gpt-5', 1, 1)
+
+def test_sub_nano_rates_are_rejected():
+    with pytest.raises(ValueError):
+        pricing._compile_rates({'tiny': {'input': Decimal('0.0001'), 'output': Decimal('1')}})
@@ -0,0 +1,199 @@
+import pytest
+import json
+from datetime import datetime, timezone
+from unittest.mock import patch
+import os
+import sys
+
+# Add the project root to the Python path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+import lambda_function
+import rate_limits
+import storage
+from tests.fake_dynamodb import FakeClientError, FakeDynamoDB, batch_event, make_tables, usage_record
+
+MARCH_8 = datetime(2025, 3, 8, 12, tzinfo=timezone.utc).timestamp()
+
+class FakeClock:
+    def __init__(self, now=MARCH_8):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+def counter_table():
+    return FakeDynamoDB().create_table('chatgpt_usage_tracking_rate_limits', 'counter_key')
+
+def limiter(clock, table=None, **limits):
+    return rate_limits.RateLimiter(rate_limits.Limits(**limits), table, sync_seconds=1, clock=clock)
+
+def test_requests_are_refused_past_the_burst_until_it_refills():
+    clock = FakeClock()
+    limits = limiter(clock, org_requests=(2, 4))
+    assert [limits.acquire('org_1', {'user_1': (1, 0)}) for _ in range(5)] == [0, 0, 0, 0, 1]
+    # A batch of three needs 1.5 seconds of refill
+    assert limits.acquire('org_1', {'user_1': (3, 0)}) == 2
+    clock.now += 1.5
+    assert limits.acquire('org_1', {'user_1': (3, 0)}) == 0
+    # Other organizations have buckets of their own
+    assert limits.acquire('org_2', {'user_1': (4, 0)}) == 0
+
+def test_user_and_token_limits():
+    clock = FakeClock()
+    limits = limiter(clock, user_requests=(1, 2), user_tokens=(1000 / 60, 1000), org_tokens=(2500 / 60, 2500))
+    assert limits.acquire('org_1', {'user_1': (1, 100)}) == 0
+    assert limits.acquire('org_1', {'user_1': (1, 100)}) == 0
+    assert limits.acquire('org_1', {'user_1': (1, 100)}) == 1
+    # Each user has a bucket, the organization's is shared
+    assert limits.acquire('org_1', {'user_2': (1, 900)}) == 0
+    assert limits.acquire('org_1', {'user_3': (1, 900)}) == 0
+    # 500 tokens are left and 400 more take 9.6 seconds
+    assert limits.acquire('org_1', {'user_4': (1, 900)}) == 10
+    # Nothing was taken from the refused calls
+    assert limits.acquire('org_1', {'user_4': (1, 300)}) == 0
+
+def test_instances_share_their_counts_through_batched_adds():
+    clock = FakeClock()
+    table = counter_table()
+    one = {'user_1': (1, 0)}
+    with patch.object(table, 'update_item', wraps=table.update_item) as update_item:
+        first, second = limiter(clock, table, org_requests=(1, 100)), limiter(clock, table, org_requests=(1, 100))
+        first.acquire('org_1', one)
+        second.acquire('org_1', one)
+        clock.now += 1
+        first.acquire('org_1', one)
+        second.acquire('org_1', one)
+        assert update_item.call_count == 2
+
+        # Counts are only added to the shared table once per sync interval
+        for _ in range(60):
+            assert first.acquire('org_1', one) == 0
+        assert update_item.call_count == 2
+        clock.now += 1
+        first.acquire('org_1', one)
+        assert update_item.call_count == 3
+        assert table.items[('org#org_1#requests#2025-03-08', None)]['total'] == 65
+
+        # The second instance learns what the first used when it syncs, and
+        # no longer has the 50 requests it would have on its own
+        second.acquire('org_1', one)
+        assert second.acquire('org_1', {'user_1': (50, 0)}) > 0
+        assert second.acquire('org_1', {'user_1': (30, 0)}) == 0
+
+def test_spend_caps_start_from_the_shared_monthly_total():
+    clock = FakeClock()
+    table = counter_table()
+    table.put_item(Item={'counter_key': 'org#org_1#spend#2025-03', 'total': 4 * 10 ** 9})
+    limits = limiter(clock, table, org_spend_cap=5 * 10 ** 9, user_spend_cap=2 * 10 ** 9)
+
+    assert limits.acquire('org_1', {'user_1': (1, 0)}) == 0
+    limits.record_spend('org_1', {'user_1': 2 * 10 ** 9})
+    # The user reached their cap, and the organization its own
+    expected = rate_limits.seconds_to_next_month(clock.now)
+    assert limits.acquire('org_1', {'user_1': (1, 0)}) == pytest.approx(expected, abs=1)
+    assert limits.acquire('org_1', {'user_2': (1, 0)}) == pytest.approx(expected, abs=1)
+
+    # A new month starts from nothing
+    clock.now = datetime(2025, 4, 1, tzinfo=timezone.utc).timestamp()
+    assert limits.acquire('org_1', {'user_1': (1, 0)}) == 0
+
+def test_syncs_are_bounded_and_catch_up_in_turn():
+    clock = FakeClock()
+    table = counter_table()
+    limits = rate_limits.RateLimiter(rate_limits.Limits(user_requests=(1, 10)), table, sync_seconds=1, clock=clock,
+                                     max_sync_counters=4)
+    with patch.object(table, 'update_item', wraps=table.update_item) as update_item:
+        limits.acquire('org_1', {f'user_{i}': (1, 0) for i in range(10)})
+        clock.now += 1
+        limits.acquire('org_1', {'user_0': (1, 0)})
+        assert update_item.call_count == 4
+        # Counters left over go first at the next syncs
+        for _ in range(2):
+            clock.now += 1
+            limits.acquire('org_2', {'user_0': (1, 0)})
+        assert update_item.call_count == 4 + 4 + 3
+    assert sum(item['total'] for item in table.items.values()) == 13
+
+def test_spend_totals_of_new_users_are_read_once_in_one_batch():
+    clock = FakeClock()
+    table = counter_table()
+    table.put_item(Item={'counter_key': 'user#org_1/user_2#spend#2025-03', 'total': 10 ** 9})
+    limits = limiter(clock, table, org_spend_cap=5 * 10 ** 9, user_spend_cap=10 ** 9)
+    calls = table.meta.client.calls
+    with patch.object(table, 'update_item', wraps=table.update_item) as update_item:
+        usage = {f'user_{i}': (1, 0) for i in range(20)}
+        # user_2 already spent their cap on another instance
+        assert limits.acquire('org_1', usage) == pytest.approx(rate_limits.seconds_to_next_month(clock.now), abs=1)
+        del usage['user_2']
+        assert limits.acquire('org_1', usage) == 0
+        assert update_item.call_count == 0
+    assert [call[0] for call in calls] == ['batch_get_item']
+
+def test_unstored_records_give_their_tokens_back():
+    clock = FakeClock()
+    limits = limiter(clock, org_requests=(1, 3), user_tokens=(1, 100))
+    assert limits.acquire('org_1', {'user_1': (2, 80)}) == 0
+    limits.release('org_1', {'user_1': (2, 80)})
+    assert limits.acquire('org_1', {'user_1': (3, 100)}) == 0
+    clock.now += 1
+    limits.sync()
+    assert limits._counters['org#org_1#requests#2025-03-08'] == [0, 3]
+
+def test_unreachable_counters_leave_instances_limiting_alone():
+    clock = FakeClock()
+    table = counter_table()
+    with patch.object(table, 'update_item', side_effect=FakeClientError('ProvisionedThroughputExceededException', 'slow down')):
+        limits = limiter(clock, table, org_requests=(1, 2), org_spend_cap=10 ** 9)
+        assert limits.acquire('org_1', {'user_1': (1, 0)}) == 0
+        clock.now += 1
+        assert limits.acquire('org_1', {'user_1': (1, 0)}) == 0
+        assert limits.acquire('org_1', {'user_1': (1, 0)}) == 0
+        assert limits.acquire('org_1', {'user_1': (1, 0)}) == 1
+
+@pytest.fixture
+def limited():
+    _, usage, _ = make_tables()
+    clock = FakeClock()
+    limits = limiter(clock, org_requests=(1, 3), org_spend_cap=10 ** 8)
+    with patch.object(lambda_function, 'store', storage.DynamoDBStorage(usage)), \
+            patch.object(lambda_function, 'authorize_request', return_value=True), \
+            patch.object(rate_limits, 'RATE_LIMITING', True), \
+            patch.object(rate_limits, 'limiter', limits):
+        yield usage
+
+def track_event(input_tokens=10, output_tokens=5):
+    record = usage_record(organization_id='org_1', input_tokens=input_tokens, output_tokens=output_tokens)
+    return {'headers': {'Authorization': 'Bearer token'}, 'body': json.dumps(record)}
+
+def test_track_calls_over_the_limit_get_429(limited):
+    statuses = [lambda_function.lambda_handler(track_event(), None)['statusCode'] for _ in range(3)]
+    response = lambda_function.lambda_handler(track_event(), None)
+    assert statuses == [200, 200, 200]
+    assert response['statusCode'] == 429 and response['headers']['Retry-After'] == '1'
+    assert json.loads(response['body'])['error'] == 'Rate limit exceeded. Retry after 1 seconds'
+    assert len(limited.items) == 3
+
+def test_batches_are_refused_as_a_whole(limited):
+    records = [usage_record(input_tokens=10, output_tokens=5)]
+    assert lambda_function.lambda_handler(batch_event(records * 2, 'org_1'), None)['statusCode'] == 200
+    response = lambda_function.lambda_handler(batch_event(records * 2, 'org_1'), None)
+    assert response['statusCode'] == 429 and response['headers']['Retry-After'] == '1'
+    assert len(limited.items) == 2
+
+def test_failed_writes_do_not_use_up_the_limits(limited):
+    with patch.object(limited, 'put_item', side_effect=ValueError('bad item')):
+        assert [lambda_function.lambda_handler(track_event(), None)['statusCode'] for _ in range(3)] == [500] * 3
+    statuses = [lambda_function.lambda_handler(track_event(), None)['statusCode'] for _ in range(4)]
+    assert statuses == [200, 200, 200, 429]
+
+def test_spend_counts_priced_records(limited):
+    # Each record costs $0.06, so the cap of $0.10 is crossed by the second one
+    big = dict(input_tokens=1000, output_tokens=500)
+    assert lambda_function.lambda_handler(track_event(**big), None)['statusCode'] == 200
+    assert lambda_function.lambda_handler(track_event(**big), None)['statusCode'] == 200
+    response = lambda_function.lambda_handler(track_event(**big), None)
+    assert response['statusCode'] == 429 and int(response['headers']['Retry-After']) > 86400
+
+def test_limits_are_off_by_default():
+    assert lambda_function.check_rate_limits('org_1', [{'user_id': 'user_1', 'input_tokens': 1, 'output_tokens': 1}]) is None
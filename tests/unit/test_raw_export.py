@@ -0,0 +1,126 @@
+import pytest
+import base64
+import gzip
+import json
+from decimal import Decimal
+from unittest.mock import patch
+import os
+import sys
+
+# Add the project root to the Python path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+import get_org_costs_function
+import raw_export
+import sharding
+import storage
+from tests.fake_dynamodb import FakeContext, FixedShard, make_tables
+
+PARAMS = {'organization_id': 'org_1', 'start_date': '2025-03-08', 'end_date': '2025-03-08T23:59:59'}
+
+def usage_item(i, organization_id='org_1', user_id=None, day='08'):
+    return {
+        'organization_id': organization_id,
+        'record_id': f'rec_{i:04d}',
+        'user_id': user_id or f'user_{i % 3}',
+        'timestamp': f'2025-03-{day}T{i % 24:02d}:{i % 60:02d}:00',
+        'model_name': 'gpt-4',
+        'total_cost': Decimal('0.000123'),
+        'input_tokens': i,
+        'ingest_key': f'ING{i:023d}'
+    }
+
+class FakeScan:
+    def cursor(self):
+        return {'splits': [], 'open': [[0, None]]}
+
+@pytest.fixture(params=['dynamodb', 'sqlite'])
+def usage(request, tmp_path):
+    """300 records of org_1 on 2025-03-08, half of them on a second write shard, and some others."""
+    if request.param == 'sqlite':
+        store = storage.SQLiteStorage(str(tmp_path / 'usage.db'), page_items=20)
+    else:
+        _, table, orgs = make_tables(page_size=20)
+        store = storage.DynamoDBStorage(table, orgs)
+    items = [sharding.shard_item(usage_item(i), 2, rng=FixedShard(i % 2)) for i in range(300)]
+    items += [usage_item(900, day='09'), usage_item(901, organization_id='org_2', user_id='user_1')]
+    store.put_usage_batch(items)
+    with patch.object(get_org_costs_function, 'store', store), \
+            patch.object(sharding, 'WRITE_SHARDING', True), \
+            patch.object(store, 'write_shards', return_value=2), \
+            patch.object(get_org_costs_function, 'authorize_request', return_value=True):
+        yield store
+    if request.param == 'sqlite':
+        store.close()
+
+def export(params, headers=None):
+    """Every part of an export, following its cursor."""
+    parts = []
+    cursor = None
+    while True:
+        query = dict(params, cursor=cursor) if cursor else params
+        event = {'resource': '/usage-export', 'headers': dict({'Authorization': 'token'}, **(headers or {})),
+                 'queryStringParameters': query}
+        response = get_org_costs_function.lambda_handler(event, FakeContext())
+        assert response['statusCode'] == 200
+        parts.append(response)
+        cursor = response['headers'].get('X-Export-Cursor')
+        if not cursor:
+            return parts
+
+def lines(response):
+    body = response['body']
+    if response.get('isBase64Encoded'):
+        body = gzip.decompress(base64.b64decode(body)).decode('utf-8')
+    return [json.loads(line) for line in body.splitlines()]
+
+def test_export_pages_through_every_record(usage):
+    with patch.object(raw_export, 'EXPORT_RESPONSE_BYTES', 4000):
+        parts = export(PARAMS)
+
+    records = [record for part in parts for record in lines(part)]
+    assert len(parts) > 5 and len(records) == 300
+    assert sorted(record['record_id'] for record in records) == [f'rec_{i:04d}' for i in range(300)]
+    # Each part stops at the first page past the limit
+    assert all(len(part['body']) < 4000 + 20 * 250 for part in parts)
+    assert parts[-1]['headers']['X-Export-Total-Records'] == '300'
+
+    record = next(record for record in records if record['record_id'] == 'rec_0001')
+    assert record == {
+        'organization_id': 'org_1', 'record_id': 'rec_0001', 'user_id': 'user_1',
+        'timestamp': '2025-03-08T01:01:00', 'model_name': 'gpt-4', 'total_cost': 0.000123, 'input_tokens': 1
+    }
+    assert parts[0]['headers']['Content-Type'] == 'application/x-ndjson'
+
+def test_gzip_export_matches_the_plain_one(usage):
+    plain = [record for part in export(PARAMS) for record in lines(part)]
+    compressed, = export(PARAMS, headers={'Accept-Encoding': 'gzip, deflate'})
+    assert compressed['isBase64Encoded'] and compressed['headers']['Content-Encoding'] == 'gzip'
+    assert lines(compressed) == plain
+    assert len(compressed['body']) < sum(len(json.dumps(record)) for record in plain) / 4
+
+def test_user_export_keeps_to_the_organization(usage):
+    records = [record for part in export(dict(PARAMS, user_id='user_1')) for record in lines(part)]
+    assert len(records) == 100
+    assert {(record['organization_id'], record['user_id']) for record in records} == {('org_1', 'user_1')}
+
+def test_invalid_cursors_are_rejected(usage):
+    first = export(dict(PARAMS, user_id='user_2'))[0]
+    for cursor in ('not-a-cursor', raw_export.encode_cursor(
+            raw_export.export_sources('org_1', '2025-03-01', '2025-03-02'), FakeScan(), 0)):
+        event = {'resource': '/usage-export', 'headers': {'Authorization': 'token'},
+                 'queryStringParameters': dict(PARAMS, cursor=cursor)}
+        response = get_org_costs_function.lambda_handler(event, FakeContext())
+        assert response['statusCode'] == 400 and json.loads(response['body'])['error'] == 'Invalid cursor'
+    assert 'X-Export-Cursor' not in first['headers']
+
+def test_pipeline_reads_pages_lazily():
+    pages_read = []
+    def pages():
+        for n in range(1000):
+            pages_read.append(n)
+            yield {'kind': 'raw'}, [usage_item(n)]
+    encoded = raw_export.ndjson_lines(raw_export.records(pages(), 'org_1'), {'records': 0, 'bytes': 0})
+    for _ in range(3):
+        next(encoded)
+    assert pages_read == [0, 1, 2]
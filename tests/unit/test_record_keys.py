@@ -0,0 +1,157 @@
+import pytest
+import json
+import random
+import uuid
+from decimal import Decimal
+from unittest.mock import patch
+import os
+import sys
+
+# Add the project root to the Python path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+import get_org_costs_function
+import lambda_function
+import migrate_record_ids
+import record_keys
+import rollups
+import storage
+import usage_queries
+from local_stream import LocalStream
+from tests.fake_dynamodb import make_rollup_table, make_tables
+
+def cost_event(params):
+    return {'headers': {'Authorization': 'token'}, 'queryStringParameters': params}
+
+@pytest.mark.parametrize('value, expected', [
+    ('2025-03-08T10:00:00Z', '2025-03-08T10:00:00.000000+00:00'),
+    ('2025-03-08T12:00:00+02:00', '2025-03-08T10:00:00.000000+00:00'),
+    ('2025-03-08T10:00:00.25', '2025-03-08T10:00:00.250000+00:00'),
+    ('2025-03-08T10:00:00,5+0000', '2025-03-08T10:00:00.500000+00:00'),
+    ('2025-03-08 04:30:00.1234567-05:30', '2025-03-08T10:00:00.123456+00:00'),
+    ('2025-03-08t10:00z', '2025-03-08T10:00:00.000000+00:00'),
+    ('2025-03-08', '2025-03-08T00:00:00.000000+00:00'),
+    (1741428000, '2025-03-08T10:00:00.000000+00:00'),
+    ('1741428000000', '2025-03-08T10:00:00.000000+00:00'),
+])
+def test_timestamps_are_normalized(value, expected):
+    timestamp, ts = record_keys.normalize_timestamp(value)
+    assert timestamp == expected
+    assert ts == record_keys.normalize_timestamp(expected)[1]
+
+@pytest.mark.parametrize('value', ['yesterday', '', None, True, '1e400', '2025-13-01', '2025-03-08T10:00:00+24:00', '2025-03-08T10:00:00.'])
+def test_bad_timestamps_are_rejected(value):
+    with pytest.raises(ValueError):
+        record_keys.normalize_timestamp(value)
+
+def test_record_ids_sort_by_time():
+    times = sorted(random.Random(5).sample(range(2 ** 42), 200))
+    ids = [record_keys.new_record_id(ms) for ms in times]
+
+    assert ids == sorted(ids)
+    assert [record_keys.record_id_ms(i) for i in ids] == times
+    assert all(record_keys.is_record_id(i) for i in ids)
+    assert record_keys.new_record_id(5, seed='a') == record_keys.new_record_id(5, seed='a')
+
+def test_record_id_bounds_cover_string_ranges():
+    rng = random.Random(11)
+    bounds = ['2025-03-08', '2025-03-08T10', '2025-03-08T10:30:00', '2025-03-08T24', '2025-03-09T00:00:00.000000+00:00']
+    for _ in range(300):
+        timestamp, ts = record_keys.normalize_timestamp(1741392000 + rng.randrange(0, 2 * 86400) + rng.random())
+        record_id = record_keys.new_record_id(ts)
+        for bound in bounds:
+            if timestamp >= bound:
+                assert record_id >= record_keys.lower_bound(bound), (timestamp, bound)
+            if timestamp <= bound:
+                assert record_id <= record_keys.upper_bound(bound), (timestamp, bound)
+
+def test_track_stores_time_ordered_ids_and_rejects_bad_timestamps():
+    _, usage, _ = make_tables()
+    body = {'model_name': 'gpt-4', 'input_tokens': 10, 'output_tokens': 5, 'user_id': 'user_1',
+            'organization_id': 'org_1', 'timestamp': '2025-03-08T12:00:00+02:00'}
+    with patch.object(lambda_function, 'store', storage.DynamoDBStorage(usage)), \
+            patch.object(lambda_function, 'authorize_request', return_value=True):
+        assert lambda_function.lambda_handler({'body': json.dumps(body)}, None)['statusCode'] == 200
+        bad = dict(body, timestamp='last tuesday')
+        assert lambda_function.lambda_handler({'body': json.dumps(bad)}, None)['statusCode'] == 400
+
+    item, = usage.items.values()
+    assert item['timestamp'] == '2025-03-08T10:00:00.000000+00:00'
+    assert item['ts'] == 1741428000000
+    assert record_keys.record_id_ms(item['record_id']) == item['ts']
+
+@pytest.fixture
+def mixed_usage():
+    """Usage records with uuid ids and assorted timestamp formats, as stored before ULIDs."""
+    resource, usage, orgs = make_tables(page_size=9)
+    rng = random.Random(3)
+    formats = [
+        lambda dt: dt + 'Z',
+        lambda dt: dt,
+        lambda dt: dt + '.123456+00:00',
+    ]
+    for i in range(120):
+        day, hour = rng.randint(1, 20), rng.randint(0, 23)
+        usage.put_item(Item={
+            'organization_id': 'org_1',
+            'record_id': str(uuid.UUID(int=rng.getrandbits(128))),
+            'user_id': f'user_{i % 4}',
+            'timestamp': rng.choice(formats)(f'2025-03-{day:02d}T{hour:02d}:{rng.randint(0, 59):02d}:00'),
+            'model_name': 'gpt-4',
+            'total_cost': Decimal(rng.randint(1, 500)) / 1000
+        })
+    usage.put_item(Item={'organization_id': 'org_1', 'record_id': 'broken', 'user_id': 'user_0',
+                         'timestamp': 'not a time', 'total_cost': Decimal('1')})
+    with patch.object(get_org_costs_function, 'store', storage.DynamoDBStorage(usage, orgs)), \
+            patch.object(get_org_costs_function, 'authorize_request', return_value=True):
+        yield resource, usage
+
+def test_migration_rewrites_ids_and_is_idempotent(mixed_usage):
+    resource, usage = mixed_usage
+    originals = {item['record_id'] for item in usage.items.values()}
+
+    totals = migrate_record_ids.migrate_table(resource.client, usage.name, segments=4)
+
+    assert totals == {'scanned': 121, 'migrated': 120, 'skipped': 1, 'failed': 0}
+    migrated = [item for item in usage.items.values() if 'migrated_from' in item]
+    assert len(migrated) == 120 and len(usage.items) == 121
+    assert {item['migrated_from'] for item in migrated} <= originals
+    assert all(record_keys.record_id_ms(item['record_id']) == item['ts'] for item in migrated)
+
+    # A run interrupted before its deletes leaves both copies; rerunning converges
+    stale = dict(migrated[0], record_id=migrated[0]['migrated_from'])
+    del stale['migrated_from'], stale['ts']
+    usage.put_item(Item=stale)
+    assert migrate_record_ids.migrate_table(resource.client, usage.name, segments=4)['migrated'] == 1
+    assert len(usage.items) == 121
+
+def test_base_table_queries_match_index_queries_after_migration(mixed_usage):
+    resource, usage = mixed_usage
+    migrate_record_ids.migrate_table(resource.client, usage.name, segments=4)
+
+    for start, end in [('2025-03-01', '2025-03-31'), ('2025-03-05T10:30:00', '2025-03-12T06'), ('2025-03-09', '2025-03-09')]:
+        params = {'organization_id': 'org_1', 'start_date': start, 'end_date': end}
+        with patch.object(usage_queries, 'RECORD_ID_QUERIES', False):
+            by_index = json.loads(get_org_costs_function.lambda_handler(cost_event(params), None)['body'])
+        usage.query_calls.clear()
+        with patch.object(usage_queries, 'RECORD_ID_QUERIES', True), \
+                patch.object(usage_queries, 'QUERY_SLICE_ITEMS', 10):
+            by_record_id = json.loads(get_org_costs_function.lambda_handler(cost_event(params), None)['body'])
+
+        assert by_record_id == pytest.approx(by_index), (start, end)
+        assert all(call['IndexName'] is None for call in usage.query_calls)
+
+def test_rollups_skip_migrated_inserts():
+    resource, usage, _ = make_tables()
+    rollup_table = make_rollup_table(resource)
+    stream = LocalStream(usage, ('organization_id', 'record_id'))
+    item = {'organization_id': 'org_1', 'record_id': 'old', 'user_id': 'user_1',
+            'timestamp': '2025-03-08T10:00:00', 'model_name': 'gpt-4', 'total_cost': Decimal('0.5')}
+    stream.put_item(Item=item)
+    stream.put_item(Item=migrate_record_ids.migrated_item(item))
+    stream.delete_item(Key={'organization_id': 'org_1', 'record_id': 'old'})
+
+    rollups.apply_stream_records(stream.drain()['Records'], rollup_table)
+
+    row = rollup_table.get_item(Key={'rollup_key': 'org_1#H', 'bucket_key': '2025-03-08T10#user_1#gpt-4'})['Item']
+    assert row['usage_count'] == 1
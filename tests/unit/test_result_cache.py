@@ -0,0 +1,209 @@
+import pytest
+import base64
+import json
+from datetime import datetime, timezone
+from decimal import Decimal
+from unittest.mock import patch
+import os
+import sys
+
+# Add the project root to the Python path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+import get_costs_function
+import get_org_costs_function
+import record_keys
+import result_cache
+import storage
+import usage_queries
+from tests.fake_dynamodb import FakeContext, make_tables
+
+ORG_PARAMS = {'organization_id': 'org_1', 'start_date': '2025-03-08', 'end_date': '2025-03-08T23:59:59'}
+USER_PARAMS = dict(ORG_PARAMS, user_id='user_1')
+BOUNDARY = '2025-03-08T12'
+
+def usage_item(i, hour, user_id='user_1', cost='0.01', stored=None):
+    item = {
+        'organization_id': 'org_1',
+        'record_id': f'rec_{i:04d}',
+        'user_id': user_id,
+        'timestamp': f'2025-03-08T{hour:02d}:30:00',
+        'total_cost': Decimal(cost)
+    }
+    if stored is not None:
+        item['ingest_key'] = record_keys.new_record_id(record_keys.normalize_timestamp(stored)[1])
+    return item
+
+@pytest.fixture(params=['dynamodb', 'sqlite'])
+def usage(request, tmp_path):
+    """96 records over 2025-03-08 with the cache settled up to noon."""
+    if request.param == 'sqlite':
+        store = storage.SQLiteStorage(str(tmp_path / 'usage.db'), page_items=7)
+    else:
+        _, table, orgs = make_tables(page_size=7)
+        store = storage.DynamoDBStorage(table, orgs)
+    store.put_usage_batch([usage_item(i, i % 24, f'user_{i % 3}') for i in range(96)])
+    with patch.object(result_cache, 'cache', result_cache.ResultCache(1024 * 1024)), \
+            patch.object(result_cache, 'settled_before', return_value=BOUNDARY), \
+            patch.object(get_costs_function, 'store', store), \
+            patch.object(get_org_costs_function, 'store', store), \
+            patch.object(get_costs_function, 'authorize_request', return_value=True), \
+            patch.object(get_org_costs_function, 'authorize_request', return_value=True):
+        yield store
+    if request.param == 'sqlite':
+        store.close()
+
+def call(module, params, headers=None, context=None):
+    event = {'headers': dict({'Authorization': 'token'}, **(headers or {})), 'queryStringParameters': params}
+    return module.lambda_handler(event, context or FakeContext())
+
+def counting_queries(store):
+    """Patch the store to record the low bound of every page it reads by time."""
+    lows = []
+    original = store.query_usage
+    def query_usage(source, start_key=None, shared=False):
+        if source['kind'] != 'ingest':
+            lows.append(source['query']['ExpressionAttributeValues'][':start'])
+        return original(source, start_key, shared)
+    return lows, patch.object(store, 'query_usage', side_effect=query_usage)
+
+@pytest.mark.parametrize('module, params', [
+    (get_org_costs_function, ORG_PARAMS),
+    (get_costs_function, USER_PARAMS),
+])
+def test_settled_hours_are_read_once(usage, module, params):
+    first = json.loads(call(module, params)['body'])
+    assert result_cache.cache.misses == 1
+
+    # Records of settled hours are no longer read; the live tail still is
+    usage.put_usage_batch([usage_item(901, 20)])
+    lows, patched = counting_queries(usage)
+    with patched:
+        second = json.loads(call(module, params)['body'])
+    assert result_cache.cache.hits == 1
+    assert lows and all(low >= BOUNDARY for low in lows)
+
+    # Only the record in the live tail is counted
+    user_count = lambda body: body.get('usage_count') or \
+        {user['user_id']: user['usage_count'] for user in body['user_costs']}['user_1']
+    assert user_count(second) == user_count(first) + 1
+
+@pytest.mark.parametrize('module, params', [
+    (get_org_costs_function, ORG_PARAMS),
+    (get_costs_function, USER_PARAMS),
+])
+def test_records_stored_late_make_cached_hours_stale(usage, module, params):
+    watermarks = [record_keys.upper_bound(f'2025-03-09T12:0{minute}') for minute in (1, 2, 3)]
+    user_count = lambda body: body.get('usage_count') or \
+        {user['user_id']: user['usage_count'] for user in body['user_costs']}['user_1']
+    with patch.object(usage_queries, 'current_watermark', side_effect=watermarks):
+        first = json.loads(call(module, params)['body'])
+
+        # A record of a settled hour stored after the totals were cached
+        usage.put_usage_batch([usage_item(900, 3, stored='2025-03-09T12:01:30Z')])
+        second = json.loads(call(module, params)['body'])
+        assert user_count(second) == user_count(first) + 1
+
+        # The totals read again are cached up to the newer watermark
+        lows, patched = counting_queries(usage)
+        with patched:
+            third = json.loads(call(module, params)['body'])
+    assert third == second
+    assert lows and all(low >= BOUNDARY for low in lows)
+
+def test_cached_and_uncached_answers_match(usage):
+    for params in (dict(ORG_PARAMS, group_by='model,hour'), dict(ORG_PARAMS, start_date='2025-03-08T05:10:00')):
+        cached = [json.loads(call(get_org_costs_function, params)['body']) for _ in range(2)]
+        with patch.object(result_cache, 'cache', result_cache.ResultCache(0)):
+            uncached = json.loads(call(get_org_costs_function, params)['body'])
+        assert cached[0] == cached[1] == pytest.approx(uncached)
+
+def test_resumed_queries_keep_their_split_and_fill_the_cache(usage):
+    expected = json.loads(call(get_costs_function, USER_PARAMS)['body'])
+    result_cache.cache.clear()
+
+    token = None
+    responses = 0
+    while True:
+        params = dict(USER_PARAMS, continuation_token=token) if token else USER_PARAMS
+        # The boundary moves on between invocations; the token keeps the first one
+        with patch.object(result_cache, 'settled_before', return_value=f'2025-03-08T{12 + responses:02d}'):
+            body = json.loads(call(get_costs_function, params, context=FakeContext(10000, 3000))['body'])
+        responses += 1
+        if body['complete']:
+            break
+        token = body['continuation_token']
+
+    assert responses > 1
+    assert body == pytest.approx(expected)
+    assert len(result_cache.cache._entries) == 1
+    assert json.loads(call(get_costs_function, USER_PARAMS)['body']) == pytest.approx(expected)
+    assert result_cache.cache.hits == 1
+
+def test_forged_continuation_tokens_cannot_fill_the_cache(usage):
+    expected = json.loads(call(get_costs_function, USER_PARAMS)['body'])
+    result_cache.cache.clear()
+    body = json.loads(call(get_costs_function, USER_PARAMS, context=FakeContext(10000, 3000))['body'])
+    token = body['continuation_token']
+
+    # A client rewrites the settled totals or the split of its token
+    payload, signature = token.rsplit('.', 1)
+    decoded = json.loads(base64.urlsafe_b64decode(payload))
+    for split in ({'at': BOUNDARY, 'cached': False, 'settled': ['999999', 1]}, dict(decoded['p']['split'], at='2099-01-01T00')):
+        decoded['p']['split'] = split
+        forged = base64.urlsafe_b64encode(json.dumps(decoded).encode('utf-8')).decode('ascii')
+        response = call(get_costs_function, dict(USER_PARAMS, continuation_token=f'{forged}.{signature}'))
+        assert response['statusCode'] == 400
+    assert call(get_costs_function, dict(USER_PARAMS, continuation_token=payload))['statusCode'] == 400
+
+    assert not result_cache.cache._entries
+    assert json.loads(call(get_costs_function, USER_PARAMS)['body']) == pytest.approx(expected)
+
+def test_etags_answer_repeat_polls_with_304(usage):
+    response = call(get_org_costs_function, ORG_PARAMS)
+    etag = response['headers']['ETag']
+    assert response['statusCode'] == 200
+    assert response['headers']['Cache-Control'] == 'private, no-cache'
+
+    repeat = call(get_org_costs_function, ORG_PARAMS, headers={'If-None-Match': f'"other", W/{etag}'})
+    assert repeat['statusCode'] == 304 and repeat['body'] == ''
+    assert repeat['headers']['ETag'] == etag
+
+    # A new record changes the report and its tag
+    usage.put_usage_batch([usage_item(900, 22)])
+    changed = call(get_org_costs_function, ORG_PARAMS, headers={'if-none-match': etag})
+    assert changed['statusCode'] == 200 and changed['headers']['ETag'] != etag
+
+    # Ranges that are wholly settled may be reused by clients
+    settled = call(get_org_costs_function, dict(ORG_PARAMS, end_date='2025-03-08T11:00:00'))
+    assert settled['headers']['Cache-Control'] == f'private, max-age={result_cache.RESULT_CACHE_MAX_AGE_SECONDS}'
+
+def test_memory_tier_evicts_least_recently_used_entries():
+    cache = result_cache.ResultCache(max_bytes=30)
+    cache.put('a', 'x' * 10)
+    cache.put('b', 'y' * 10)
+    assert cache.get('a') == 'x' * 10
+    cache.put('c', 'z' * 10)
+    assert cache.size <= 30
+    assert cache.get('b') is None and cache.get('a') == 'x' * 10 and cache.get('c') == 'z' * 10
+
+    # Entries larger than the whole cache are not kept
+    cache.put('d', 'w' * 100)
+    assert cache.get('d') is None and cache.size <= 30
+
+def test_shared_tier_is_read_by_other_instances():
+    resource, _, _ = make_tables()
+    table = resource.create_table('chatgpt_usage_result_cache', 'cache_key')
+    writer = result_cache.ResultCache(1024, table, clock=lambda: 1000.0)
+    reader = result_cache.ResultCache(1024, table)
+
+    writer.put('costs:abc', ['1.25', 3])
+    assert table.get_item(Key={'cache_key': 'costs:abc'})['Item']['expires_at'] == 1000 + 30 * 86400
+    assert reader.get('costs:abc') == ['1.25', 3]
+    assert reader.size > 0 and reader.hits == 1
+    assert reader.get('costs:missing') is None and reader.misses == 1
+
+def test_settled_boundary_trails_now_by_the_settle_window():
+    now = datetime(2025, 3, 8, 12, 30, tzinfo=timezone.utc)
+    assert result_cache.settled_before(now, settle_minutes=60) == '2025-03-08T11'
+    assert result_cache.settled_before(now, settle_minutes=20) == '2025-03-08T12'
@@ -0,0 +1,208 @@
+import pytest
+import json
+from decimal import Decimal
+from unittest.mock import patch
+import os
+import sys
+
+# Add the project root to the Python path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+import archive_function
+import get_costs_function
+import get_org_costs_function
+import item_schema
+import lambda_function
+import raw_export
+import retention
+import rollups
+import sharding
+import storage
+import usage_queries
+from local_stream import LocalStream
+from object_store import MemoryStore
+from tests.fake_dynamodb import FakeContext, FixedShard, hourly_item, make_rollup_table, make_tables
+
+PARAMS = {'organization_id': 'org_1', 'start_date': '2025-03-01', 'end_date': '2025-03-31'}
+
+def call(module, params, resource=None):
+    event = {'headers': {'Authorization': 'token'}, 'queryStringParameters': params}
+    if resource:
+        event['resource'] = resource
+    return json.loads(module.lambda_handler(event, FakeContext())['body'])
+
+@pytest.fixture
+def expired():
+    """
+    40 hourly records of org_1 from 2025-03-08T10:00, half of them on a
+    second shard. The first 25 have expired and their removals are pending
+    on the stream.
+    """
+    _, usage, orgs = make_tables(page_size=7)
+    stream = LocalStream(usage, ('organization_id', 'record_id'))
+    items = [sharding.shard_item(hourly_item(i), 2, rng=FixedShard(i % 2)) for i in range(40)]
+    for i, item in enumerate(items):
+        stream.put_item(Item=item_schema.compact_item(item) if i % 3 == 0 else item)
+    stream.put_item(Item=hourly_item(0, organization_id='org_2'))
+    stream.drain()
+    for item in items[:25]:
+        stream.delete_item(Key={'organization_id': item['organization_id'], 'record_id': item['record_id']}, expired=True)
+    store = storage.DynamoDBStorage(usage, orgs)
+    archive = MemoryStore()
+    with patch.object(retention, 'archive', archive), \
+            patch.object(archive_function, 'archive', archive), \
+            patch.object(sharding, 'WRITE_SHARDING', True), \
+            patch.object(store, 'write_shards', return_value=2):
+        yield stream, store, archive, items
+
+def archive_expiries(stream, archive):
+    records = stream.drain()['Records']
+    assert archive_function.lambda_handler({'Records': records}, None) == {'batchItemFailures': []}
+    return records
+
+def test_tracked_records_expire_after_the_retention_period():
+    _, usage, _ = make_tables()
+    body = {'model_name': 'gpt-4', 'input_tokens': 10, 'output_tokens': 5, 'user_id': 'user_1',
+            'organization_id': 'org_1', 'timestamp': '2025-03-08T10:00:00Z', 'expires_at': 1}
+    with patch.object(lambda_function, 'store', storage.DynamoDBStorage(usage)), \
+            patch.object(lambda_function, 'authorize_request', return_value=True):
+        with patch.object(retention, 'RETENTION_DAYS', 90):
+            assert lambda_function.lambda_handler({'body': json.dumps(body)}, None)['statusCode'] == 200
+        assert lambda_function.lambda_handler({'body': json.dumps(body)}, None)['statusCode'] == 200
+
+    with_ttl, without_ttl = sorted(usage.items.values(), key=lambda item: 'expires_at' not in item)
+    assert with_ttl['expires_at'] == with_ttl['ts'] // 1000 + 90 * 86400
+    # Clients can't set the TTL themselves, and compact items keep it as it is
+    assert 'expires_at' not in without_ttl
+    assert item_schema.compact_item(with_ttl)['expires_at'] == with_ttl['expires_at']
+
+def test_ttl_removals_are_archived_by_organization_and_day(expired):
+    stream, store, archive, items = expired
+    # Deletions made by anything but TTL are not archived
+    other, = [item for item in store.table.items.values() if item['organization_id'] == 'org_2']
+    stream.delete_item(Key={'organization_id': 'org_2', 'record_id': other['record_id']})
+    assert len(stream.records) == 26
+    records = archive_expiries(stream, archive)
+
+    keys = archive.list()
+    assert len(keys) == 2 and all(key.startswith('organization_id=org_1/date=2025-03-0') for key in keys)
+    day_one = retention.read_day(archive, 'org_1', '2025-03-08')
+    expected = [
+        {k: v for k, v in sharding.unshard_item(item).items() if k not in ('write_shard', 'expires_at')}
+        for item in items[:14]
+    ]
+    assert day_one == expected
+
+    # A retried batch writes the same segments again
+    assert retention.archive_records(records, archive) == {'batchItemFailures': []}
+    assert archive.list() == keys
+    # Records archived twice are read once
+    retention.archive_records(records[-2:], archive)
+    assert len(archive.list()) == 3
+    assert len(retention.read_day(archive, 'org_1', '2025-03-09')) == 11
+
+def test_failed_segments_are_retried_from_their_first_record(expired):
+    stream, _, archive, items = expired
+    records = stream.drain()['Records']
+    put = archive.put
+    def put_first_only(key, data):
+        if '2025-03-09' in key:
+            raise IOError('disk full')
+        put(key, data)
+    with patch.object(archive, 'put', side_effect=put_first_only):
+        response = retention.archive_records(records, archive)
+    # Record 14 is the first one of the second day
+    first_failed = next(
+        record['dynamodb']['SequenceNumber'] for record in records
+        if record['eventName'] == 'REMOVE' and record['dynamodb']['OldImage']['record_id']['S'] == items[14]['record_id']
+    )
+    assert response == {'batchItemFailures': [{'itemIdentifier': first_failed}]}
+    assert len(archive.list()) == 1
+
+def test_cost_handlers_read_the_archive_for_old_ranges(expired):
+    stream, store, archive, items = expired
+    archive_expiries(stream, archive)
+    assert len(store.table.items) == 16
+
+    expected = sum(Decimal(i + 1).scaleb(-4) for i in range(40))
+    with patch.object(get_costs_function, 'store', store), \
+            patch.object(get_org_costs_function, 'store', store), \
+            patch.object(get_costs_function, 'authorize_request', return_value=True), \
+            patch.object(get_org_costs_function, 'authorize_request', return_value=True):
+        org = call(get_org_costs_function, dict(PARAMS, group_by='day'))
+        user = call(get_costs_function, dict(PARAMS, user_id='user_1'))
+        delta = call(get_costs_function, dict(PARAMS, user_id='user_1', watermark='0'))
+        stats = call(get_org_costs_function, PARAMS, resource='/organization-stats')
+        export = get_org_costs_function.lambda_handler(
+            {'resource': '/usage-export', 'headers': {'Authorization': 'token'}, 'queryStringParameters': PARAMS},
+            FakeContext()
+        )
+
+    assert org['total_organization_cost'] == pytest.approx(float(expected))
+    assert sorted((group['day'], group['usage_count']) for group in org['groups']) == \
+        [('2025-03-08', 14), ('2025-03-09', 24), ('2025-03-10', 2)]
+    user_1 = sum(Decimal(i + 1).scaleb(-4) for i in range(40) if i % 3 == 1)
+    assert user['usage_count'] == delta['usage_count'] == 13
+    assert user['total_cost'] == delta['total_cost'] == pytest.approx(float(user_1))
+    assert stats['usage_count'] == 40
+    exported = [json.loads(line) for line in export['body'].splitlines()]
+    assert sorted(record['session'] for record in exported) == sorted(f's{i}' for i in range(40))
+    assert all('expires_at' not in record and 'ingest_key' not in record for record in exported)
+
+def test_only_ranges_older_than_the_hot_window_read_the_archive(expired):
+    def kinds(*args, **kwargs):
+        return [source['kind'] for source in usage_queries.build_sources(*args, **kwargs)]
+
+    assert kinds('organization', 'org_1', '2025-03-01', '2025-03-31', shards=2) == ['raw', 'raw', 'archive']
+    with patch.object(retention, 'hot_window_start', return_value='2025-02-01'):
+        assert kinds('organization', 'org_1', '2025-03-01', '2025-03-31') == ['raw']
+    # Users are archived with their organization
+    assert kinds('user', 'user_1', '2025-03-01', '2025-03-31') == ['raw']
+    assert kinds('user', 'user_1', '2025-03-01', '2025-03-31', organization_id='org_1') == ['raw', 'archive']
+    # Rollups still answer whole buckets; only the raw edges read the archive
+    sources = usage_queries.build_sources(
+        'organization', 'org_1', '2025-03-01T10:30', '2025-03-31', use_rollups=True
+    )
+    archived = [source for source in sources if source['kind'] == 'archive']
+    assert [(source['low'], source['high']) for source in archived] == \
+        [('2025-03-01T10:30', '2025-03-01T11'), ('2025-03-30T24', '2025-03-31')]
+    with patch.object(retention, 'archive', None):
+        assert kinds('organization', 'org_1', '2025-03-01', '2025-03-31') == ['raw']
+
+    # Rolled up records stay counted after they expire
+    rollup_table = make_rollup_table(make_tables()[0])
+    stream, _, _, _ = expired
+    assert rollups.apply_stream_records(stream.drain()['Records'], rollup_table) == {'batchItemFailures': []}
+    assert raw_export.export_sources('org_1', '2025-03-01', '2025-03-31')[-1]['kind'] == 'archive'
+
+def usage_export_row(day):
+    codec = retention._codec()
+    return codec.export_row(dict(hourly_item(0), timestamp=f'2025-03-{day:02d}T12:00:00.000000+00:00'))
+
+def encode_rows(rows):
+    codec = retention._codec()
+    encode = codec.FORMATS[retention.SEGMENT_FORMAT][1]
+    return encode({name: [row[name] for row in rows] for name in codec.EXPORT_COLUMNS})
+
+def test_archive_queries_list_each_day_once():
+    archive = MemoryStore()
+    rows = [usage_export_row(day) for day in range(1, 31)]
+    for day, row in enumerate(rows, start=1):
+        archive.put(retention.segment_key('org_1', f'2025-03-{day:02d}', f'{day}'), encode_rows([row]))
+        archive.put(retention.segment_key('org_2', f'2025-03-{day:02d}', f'{day}'), encode_rows([row]))
+    source = usage_queries.archive_source('organization', 'org_1', 'org_1', '2025-03-05', '2025-03-24T23')
+
+    with patch.object(archive, 'list', wraps=archive.list) as listed:
+        pages, start_key = [], None
+        while True:
+            response = retention.query_archive(source, start_key, archive)
+            pages.append(response['Items'])
+            start_key = response.get('LastEvaluatedKey')
+            if not start_key:
+                break
+
+    assert [item['timestamp'][:10] for page in pages for item in page] == [f'2025-03-{day:02d}' for day in range(5, 25)]
+    # The first day is found, then each page lists its day and the first key after it
+    assert listed.call_count == 1 + 2 * 20
+    assert all(call.kwargs.get('limit') == 1 or call.args[0].endswith('/') and 'date=' in call.args[0]
+               for call in listed.call_args_list)
@@ -0,0 +1,155 @@
+import pytest
+import json
+import random
+from decimal import Decimal
+from unittest.mock import patch
+import os
+import sys
+
+# Add the project root to the Python path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+import get_costs_function
+import get_org_costs_function
+import rollup_function
+import rollups
+import storage
+from local_stream import LocalStream
+from tests.fake_dynamodb import make_rollup_table, make_tables
+
+def usage_item(i, timestamp, user_id='user_1', org_id='org_1', model_name='gpt-4', cost='0.25'):
+    return {
+        'organization_id': org_id,
+        'record_id': f'rec_{i:05d}',
+        'user_id': user_id,
+        'timestamp': timestamp,
+        'model_name': model_name,
+        'total_cost': Decimal(cost)
+    }
+
+def cost_event(params):
+    return {'headers': {'Authorization': 'token'}, 'queryStringParameters': params}
+
+@pytest.fixture
+def tables():
+    resource, usage, orgs = make_tables()
+    rollup_table = make_rollup_table(resource)
+    stream = LocalStream(usage, ('organization_id', 'record_id'))
+    with patch.object(get_costs_function, 'store', storage.DynamoDBStorage(usage, orgs)), \
+            patch.object(get_org_costs_function, 'store', storage.DynamoDBStorage(usage, orgs)):
+        yield usage, rollup_table, stream
+
+def test_plan_uses_days_hours_and_raw_edges():
+    plan = rollups.plan_range('2025-03-07T22:30:00', '2025-03-10T01:15:00')
+
+    assert plan['days'] == ('2025-03-08', '2025-03-09')
+    assert plan['hours'] == [('2025-03-07T23', '2025-03-07T23'), ('2025-03-10T00', '2025-03-10T00')]
+    assert plan['raw'] == [
+        ('2025-03-07T22:30:00', '2025-03-07T23', True),
+        ('2025-03-10T01', '2025-03-10T01:15:00', False),
+    ]
+
+def test_plan_for_date_only_range_matches_string_semantics():
+    # BETWEEN '2025-03-07' AND '2025-03-09' covers all of the 7th and 8th
+    plan = rollups.plan_range('2025-03-07', '2025-03-09')
+
+    assert plan['days'] == ('2025-03-07', '2025-03-08')
+    assert plan['hours'] == []
+    assert plan['raw'] == [
+        ('2025-03-07', '2025-03-07T00', True),
+        ('2025-03-08T24', '2025-03-09', False),
+    ]
+
+def test_plan_falls_back_to_raw_for_short_or_unparseable_ranges():
+    assert rollups.plan_range('2025-03-07T10:10', '2025-03-07T10:50')['raw'] == [
+        ('2025-03-07T10:10', '2025-03-07T10:50', False)
+    ]
+    assert rollups.plan_range('yesterday', 'today')['days'] is None
+
+def test_plan_reads_buckets_before_rollup_start_raw():
+    plan = rollups.plan_range('2025-03-01', '2025-03-09', rollup_start='2025-03-05T12:10:00')
+
+    assert plan['days'] == ('2025-03-06', '2025-03-08')
+    assert plan['hours'] == [('2025-03-05T13', '2025-03-05T23')]
+    assert plan['raw'][0] == ('2025-03-01', '2025-03-05T13', True)
+
+def test_rollup_answers_match_raw_answers(tables):
+    usage, rollup_table, stream = tables
+    rng = random.Random(7)
+    for i in range(400):
+        timestamp = f'2025-03-{rng.randint(5, 12):02d}T{rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}:00+00:00'
+        stream.put_item(Item=usage_item(
+            i, timestamp,
+            user_id=f'user_{rng.randint(1, 4)}',
+            model_name=rng.choice(['gpt-4', 'gpt-4o']),
+            cost=str(Decimal(rng.randint(1, 999)) / 1000)
+        ))
+    with patch.object(rollup_function, 'rollup_table', rollup_table):
+        assert rollup_function.lambda_handler(stream.drain(), None) == {'batchItemFailures': []}
+
+    ranges = [
+        ('2025-03-06', '2025-03-10'),
+        ('2025-03-05T07:45:00', '2025-03-11T19:05:00'),
+        ('2025-03-07T03:00:00', '2025-03-07T09:30:00'),
+        ('2025-03-01', '2025-03-31'),
+    ]
+    for start, end in ranges:
+        for module, params in [
+            (get_costs_function, {'user_id': 'user_2', 'organization_id': 'org_1'}),
+            (get_org_costs_function, {'organization_id': 'org_1'}),
+        ]:
+            params = dict(params, start_date=start, end_date=end)
+            with patch.object(module, 'authorize_request', return_value=True):
+                raw = json.loads(module.lambda_handler(cost_event(params), None)['body'])
+            usage.query_calls.clear()
+            with patch.object(module, 'authorize_request', return_value=True), \
+                    patch.object(module.store, 'rollup_table', rollup_table):
+                rolled = json.loads(module.lambda_handler(cost_event(params), None)['body'])
+
+            assert rolled == pytest.approx(raw), (module.__name__, start, end)
+            # Raw reads are limited to the edges of the range
+            assert len(usage.query_calls) <= 2
+
+def test_failed_chunk_is_retried_without_double_counting(tables):
+    usage, rollup_table, stream = tables
+    with patch.object(rollups, 'MAX_TRANSACTION_ROWS', 4):
+        for i in range(10):
+            stream.put_item(Item=usage_item(i, f'2025-03-08T{i:02d}:00:00'))
+        event = stream.drain()
+
+        # The second chunk fails; the first stays committed
+        original_commit = rollups._commit
+        calls = []
+
+        def flaky_commit(table, deltas, sketches):
+            calls.append(len(deltas))
+            if len(calls) == 2:
+                raise Exception('throttled')
+            original_commit(table, deltas, sketches)
+
+        with patch.object(rollups, '_commit', side_effect=flaky_commit):
+            response = rollups.apply_stream_records(event['Records'], rollup_table)
+        failed_from = response['batchItemFailures'][0]['itemIdentifier']
+
+        # Lambda resumes from the failed record
+        sequences = [record['dynamodb']['SequenceNumber'] for record in event['Records']]
+        retry = event['Records'][sequences.index(failed_from):]
+        assert rollups.apply_stream_records(retry, rollup_table) == {'batchItemFailures': []}
+
+    day_row = rollup_table.get_item(Key={'rollup_key': 'org_1#D', 'bucket_key': '2025-03-08#user_1#gpt-4'})['Item']
+    assert day_row['usage_count'] == 10
+    assert day_row['total_cost'] == Decimal('2.50')
+
+def test_updates_and_deletes_do_not_change_rollups(tables):
+    usage, rollup_table, stream = tables
+    item = usage_item(1, '2025-03-08T10:00:00')
+    stream.put_item(Item=item)
+    stream.put_item(Item=dict(item, note='edited'))
+    stream.delete_item(Key={'organization_id': 'org_1', 'record_id': 'rec_00001'}, expired=True)
+
+    event = stream.drain()
+    assert [record['eventName'] for record in event['Records']] == ['INSERT', 'MODIFY', 'REMOVE']
+    rollups.apply_stream_records(event['Records'], rollup_table)
+
+    hour_row = rollup_table.get_item(Key={'rollup_key': 'org_1#H', 'bucket_key': '2025-03-08T10#user_1#gpt-4'})['Item']
+    assert hour_row['usage_count'] == 1
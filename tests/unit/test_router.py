@@ -0,0 +1,102 @@
+import pytest
+import json
+import subprocess
+from unittest.mock import patch
+import os
+import sys
+
+# Add the project root to the Python path
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(ROOT)
+
+import auth
+import get_costs_function
+import get_org_costs_function
+import lambda_function
+import register_org_function
+import router
+import storage
+from auth import TokenCache
+from tests.fake_dynamodb import FakeContext, make_tables
+
+PARAMS = {'start_date': '2025-03-01', 'end_date': '2025-03-31'}
+
+@pytest.fixture
+def tables():
+    """Every handler and auth on one pair of fake tables, with an empty token cache."""
+    _, usage, orgs = make_tables()
+    store = storage.DynamoDBStorage(usage, orgs)
+    with patch.object(auth, 'store', store), \
+            patch.object(auth, 'token_cache', TokenCache(100, 60, 10)), \
+            patch.object(lambda_function, 'store', store), \
+            patch.object(lambda_function, 'queue', None), \
+            patch.object(get_costs_function, 'store', store), \
+            patch.object(get_org_costs_function, 'store', store), \
+            patch.object(register_org_function, 'store', store):
+        yield usage, orgs
+
+def request(method, resource, token=None, body=None, params=None):
+    event = {'httpMethod': method, 'resource': resource, 'headers': {'Authorization': f'Bearer {token}'} if token else {}}
+    if body is not None:
+        event['body'] = json.dumps(body)
+    if params is not None:
+        event['queryStringParameters'] = params
+    response = router.lambda_handler(event, FakeContext())
+    return response['statusCode'], response
+
+def test_every_route_reaches_its_handler(tables):
+    usage, orgs = tables
+    status, response = request('POST', '/register-organization', body={'organization_name': 'Acme'})
+    assert status == 200
+    org = json.loads(response['body'])
+    organization_id, token = org['organization_id'], org['auth_token']
+    assert organization_id in {item['organization_id'] for item in orgs.items.values()}
+
+    record = {'model_name': 'gpt-4', 'input_tokens': 1000, 'output_tokens': 500, 'user_id': 'user_1',
+              'organization_id': organization_id, 'timestamp': '2025-03-08T10:00:00Z'}
+    assert request('POST', '/track', token, record)[0] == 200
+    batch = {'organization_id': organization_id, 'records': [dict(record, user_id='user_2')] * 3}
+    status, response = request('POST', '/track/batch/', token, batch)
+    assert status == 200 and json.loads(response['body'])['succeeded'] == 3
+    assert len(usage.items) == 4
+
+    params = dict(PARAMS, organization_id=organization_id)
+    status, response = request('GET', '/costs', token, params=dict(params, user_id='user_2'))
+    assert status == 200 and json.loads(response['body'])['usage_count'] == 3
+    status, response = request('GET', '/organization-costs', token, params=params)
+    assert status == 200 and json.loads(response['body'])['total_users'] == 2
+    status, response = request('GET', '/organization-stats', token, params=params)
+    assert status == 200 and json.loads(response['body'])['usage_count'] == 4
+    status, response = request('GET', '/usage-export', token, params=params)
+    assert status == 200 and len(response['body'].splitlines()) == 4
+
+    # One token lookup served every route
+    assert auth.token_cache.misses == 1
+
+def test_route_matching():
+    handler, allowed = router.find_handler('GET', '/costs')
+    assert handler is get_costs_function.lambda_handler and allowed == ('GET',)
+    assert router.find_handler('POST', '/costs/batch')[0] is get_costs_function.lambda_handler
+    # Stage-prefixed paths and HTTP API events
+    assert router.find_handler('GET', '/Prod/organization-stats')[0] is get_org_costs_function.lambda_handler
+    event = {'requestContext': {'http': {'method': 'post'}}, 'rawPath': '/track/'}
+    assert router.request_route(event) == ('POST', '/track')
+
+def test_unknown_routes_and_methods_are_rejected():
+    response = router.lambda_handler({'httpMethod': 'GET', 'resource': '/billing'}, None)
+    assert response['statusCode'] == 404
+    assert json.loads(response['body']) == {'error': 'Not found'}
+
+    response = router.lambda_handler({'httpMethod': 'DELETE', 'resource': '/track'}, None)
+    assert response['statusCode'] == 405
+    assert response['headers'] == {'Allow': 'POST'}
+
+def test_router_creates_no_clients_at_import_and_keeps_table_names_apart():
+    script = (
+        'import bootstrap, router\n'
+        'print(len(bootstrap._resources) + len(bootstrap._clients), '
+        'router.register_org_function.table_name, router.lambda_function.table_name)'
+    )
+    env = dict(os.environ, DYNAMODB_TABLE='usage', ORG_TABLE_NAME='orgs')
+    output = subprocess.run([sys.executable, '-c', script], cwd=ROOT, env=env, capture_output=True, text=True, check=True)
+    assert output.stdout.split() == ['0', 'orgs', 'usage']
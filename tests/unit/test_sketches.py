@@ -0,0 +1,200 @@
+import pytest
+import json
+import random
+from decimal import Decimal
+from unittest.mock import patch
+import os
+import sys
+
+# Add the project root to the Python path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+import get_org_costs_function
+import pricing
+import rollup_function
+import rollups
+import sketches
+import storage
+from local_stream import LocalStream
+from tests.fake_dynamodb import make_rollup_table, make_tables
+
+def usage_item(i, timestamp, user_id, model_name='gpt-4', cost='0.25'):
+    return {
+        'organization_id': 'org_1',
+        'record_id': f'rec_{i:05d}',
+        'user_id': user_id,
+        'timestamp': timestamp,
+        'model_name': model_name,
+        'total_cost': Decimal(cost)
+    }
+
+def random_items(count=2000, seed=5):
+    """A few heavy users and models among many light ones, over 2025-03-05..09."""
+    rng = random.Random(seed)
+    items = []
+    for i in range(count):
+        heavy = rng.random() < 0.3
+        user_id = f'heavy_{rng.randint(1, 3)}' if heavy else f'user_{rng.randint(1, 400)}'
+        cost = Decimal(rng.randint(1000, 50000) if heavy else rng.randint(1, 2000)).scaleb(-6)
+        timestamp = f'2025-03-{rng.randint(5, 9):02d}T{rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}:00'
+        items.append(usage_item(i, timestamp, user_id, rng.choice(['gpt-4', 'gpt-4o', 'o1']), str(cost)))
+    return items
+
+def stats_event(params):
+    params = dict({'organization_id': 'org_1', 'start_date': '2025-03-05', 'end_date': '2025-03-09'}, **params)
+    return {'resource': '/organization-stats', 'headers': {'Authorization': 'token'}, 'queryStringParameters': params}
+
+def org_stats(params=None):
+    with patch.object(get_org_costs_function, 'authorize_request', return_value=True):
+        response = get_org_costs_function.lambda_handler(stats_event(params or {}), None)
+    return response['statusCode'], json.loads(response['body'])
+
+@pytest.fixture
+def rolled_up():
+    """Usage and rollup tables fed from the same records through the stream."""
+    resource, usage, orgs = make_tables()
+    rollup_table = make_rollup_table(resource)
+    stream = LocalStream(usage, ('organization_id', 'record_id'))
+    items = random_items(count=1000)
+    for item in items:
+        stream.put_item(Item=item)
+    with patch.object(rollup_function, 'rollup_table', rollup_table):
+        assert rollup_function.lambda_handler(stream.drain(), None) == {'batchItemFailures': []}
+    return items, usage, orgs, rollup_table
+
+def test_distinct_count_is_within_the_standard_error():
+    first, second = sketches.HyperLogLog(), sketches.HyperLogLog()
+    for i in range(30000):
+        (first if i % 2 else second).add(f'user_{i}')
+        first.add(f'user_{i % 100}')
+    first.merge(second)
+    error = first.relative_error()
+    assert error == pytest.approx(0.01625)
+    assert abs(first.estimate() - 30000) <= 3 * error * 30000
+    small = sketches.HyperLogLog()
+    for i in range(50):
+        small.add(f'user_{i}')
+    assert round(small.estimate()) == 50
+
+def test_percentiles_are_within_the_rank_error():
+    rng = random.Random(1)
+    values = [rng.lognormvariate(0, 1.5) for _ in range(20000)]
+    digests = [sketches.TDigest() for _ in range(4)]
+    for i, value in enumerate(values):
+        digests[i % 4].add(value)
+    merged = sketches.TDigest()
+    for digest in digests:
+        merged.merge(digest)
+
+    ordered = sorted(values)
+    assert len(merged.centroids) < 10 * merged.compression
+    for q in (0.01, 0.5, 0.9, 0.99, 0.999):
+        estimate = merged.quantile(q)
+        rank = sum(1 for value in ordered if value <= estimate) / len(ordered)
+        assert abs(rank - q) <= 2 * merged.rank_error(q) + 1 / len(ordered), q
+    assert merged.quantile(0) == ordered[0] and merged.quantile(1) == ordered[-1]
+
+def test_top_spenders_never_undercount_and_stay_within_the_bound():
+    items = random_items()
+    parts = [sketches.UsageSketch() for _ in range(3)]
+    spend = {}
+    for i, item in enumerate(items):
+        nanos = pricing.to_nanos(item['total_cost'])
+        parts[i % 3].add(item['user_id'], item['model_name'], nanos)
+        spend[item['user_id']] = spend.get(item['user_id'], 0) + nanos
+    merged = sketches.UsageSketch.from_bytes(parts[0].to_bytes())
+    for part in parts[1:]:
+        merged.merge(part)
+
+    assert merged.count == len(items)
+    assert merged.cost_nanos == sum(spend.values())
+    top_users, top_models = merged.top_spenders(3)
+    assert {user_id for user_id, _ in top_users} == {'heavy_1', 'heavy_2', 'heavy_3'}
+    bound = merged.spend.error(merged.cost_nanos)
+    for user_id, estimate in top_users:
+        assert spend[user_id] <= estimate <= spend[user_id] + bound
+    assert {model for model, _ in top_models} == {'gpt-4', 'gpt-4o', 'o1'}
+
+def test_serialized_sketches_round_trip():
+    sketch = sketches.UsageSketch()
+    for i in range(300):
+        sketch.add(f'user_{i % 17}', 'gpt-4', 1000 + i)
+    data = sketch.to_bytes()
+    copy = sketches.UsageSketch.from_bytes(data)
+    assert copy.to_bytes() == data
+    assert copy.users.registers == sketch.users.registers
+    assert copy.costs.quantile(0.5) == sketch.costs.quantile(0.5)
+    assert len(data) < 20000
+
+def test_stats_come_from_daily_sketches(rolled_up):
+    items, usage, orgs, rollup_table = rolled_up
+    with patch.object(get_org_costs_function, 'store', storage.DynamoDBStorage(usage, orgs, rollup_table)):
+        usage.query_calls.clear()
+        status, body = org_stats({'percentiles': '50,99', 'top': '3'})
+
+    # Five sketch rows are read instead of 1000 raw records
+    assert status == 200 and usage.query_calls == []
+    assert body['usage_count'] == len(items)
+    assert body['total_organization_cost'] == pytest.approx(float(sum(item['total_cost'] for item in items)))
+    users = {item['user_id'] for item in items}
+    assert abs(body['distinct_users'] - len(users)) <= 3 * body['distinct_users_relative_error'] * len(users)
+    assert [p['percentile'] for p in body['cost_percentiles']] == [50, 99]
+    assert {user['user_id'] for user in body['top_users']} == {'heavy_1', 'heavy_2', 'heavy_3'}
+    assert len(body['top_models']) == 3 and body['top_cost_max_overestimate'] > 0
+
+def test_days_before_sketch_start_are_sketched_from_raw_records(rolled_up):
+    items, usage, orgs, rollup_table = rolled_up
+    with patch.object(get_org_costs_function, 'store', storage.DynamoDBStorage(usage, orgs)):
+        raw = org_stats()[1]
+    with patch.object(get_org_costs_function, 'store', storage.DynamoDBStorage(usage, orgs, rollup_table)), \
+            patch.object(get_org_costs_function, 'SKETCH_START', '2025-03-07T10:00:00'):
+        usage.query_calls.clear()
+        mixed = org_stats()[1]
+
+    # 03-05..03-07 raw, 03-08..03-09 from sketches
+    assert len(usage.query_calls) >= 1
+    assert mixed['usage_count'] == raw['usage_count'] == len(items)
+    assert mixed['total_organization_cost'] == pytest.approx(raw['total_organization_cost'])
+    assert mixed['distinct_users'] == raw['distinct_users']
+    assert mixed['top_users'] == raw['top_users']
+
+def test_stats_on_sqlite_read_raw_records(tmp_path):
+    items = random_items(count=300)
+    store = storage.SQLiteStorage(str(tmp_path / 'usage.db'), page_items=50)
+    store.put_usage_batch(items)
+    with patch.object(get_org_costs_function, 'store', store):
+        status, body = org_stats({'start_date': '2025-03-06', 'end_date': '2025-03-07T08:00:00'})
+    store.close()
+
+    expected = [item for item in items if '2025-03-06' <= item['timestamp'][:10] <= '2025-03-07']
+    assert status == 200 and body['end_date'] == '2025-03-07'
+    assert body['usage_count'] == len(expected)
+
+def test_invalid_stats_parameters_are_rejected(rolled_up):
+    for params in ({'percentiles': '0,50'}, {'percentiles': 'median'}, {'top': '50'},
+                   {'start_date': '2025-03-09', 'end_date': '2025-03-05'}, {'start_date': 'yesterday'}):
+        status, body = org_stats(params)
+        assert status == 400 and 'error' in body
+
+def test_concurrent_sketch_updates_fail_the_chunk(rolled_up):
+    items, usage, orgs, rollup_table = rolled_up
+    stream = LocalStream(usage, ('organization_id', 'record_id'))
+    stream.put_item(Item=usage_item(90001, '2025-03-05T10:00:00', 'user_new'))
+    event = stream.drain()
+
+    # Another consumer commits between this one's read and write
+    original_get = rollup_table.get_item
+    def racing_get(**kwargs):
+        response = original_get(**kwargs)
+        row = dict(response['Item'], sketch_version=response['Item']['sketch_version'] + 1)
+        rollup_table.put_item(Item=row)
+        return response
+
+    with patch.object(rollup_table, 'get_item', side_effect=racing_get):
+        response = rollups.apply_stream_records(event['Records'], rollup_table)
+    assert response['batchItemFailures'] == [{'itemIdentifier': event['Records'][0]['dynamodb']['SequenceNumber']}]
+
+    assert rollups.apply_stream_records(event['Records'], rollup_table) == {'batchItemFailures': []}
+    row = rollup_table.get_item(Key={'rollup_key': f'org_1#{rollups.SKETCH}', 'bucket_key': '2025-03-05'})['Item']
+    day_count = sum(1 for item in items if item['timestamp'].startswith('2025-03-05'))
+    assert sketches.UsageSketch.from_bytes(rollups.sketch_bytes(row['sketch'])).count == day_count + 1
@@ -0,0 +1,146 @@
+import pytest
+import json
+from decimal import Decimal
+from unittest.mock import patch
+import os
+import sys
+
+# Add the project root to the Python path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+import auth
+import get_costs_function
+import get_org_costs_function
+import lambda_function
+import sharding
+import storage
+import usage_queries
+from tests.fake_dynamodb import FakeContext, make_tables
+
+HEADERS = {'Authorization': 'Bearer secret-token'}
+
+def open_store(backend, tmp_path, page_items):
+    if backend == 'sqlite':
+        store = storage.SQLiteStorage(str(tmp_path / 'usage.db'), page_items=page_items, batch_rows=10)
+    else:
+        _, usage, orgs = make_tables(page_size=page_items)
+        store = storage.DynamoDBStorage(usage, orgs)
+    store.put_organization({'organization_id': 'org_1', 'auth_token': 'secret-token', 'status': 'active',
+                            'organization_name': 'Acme'})
+    return store
+
+@pytest.fixture(params=['dynamodb', 'sqlite'])
+def store(request, tmp_path):
+    """The same organization on either backend, wired into every handler."""
+    store = open_store(request.param, tmp_path, page_items=7)
+    with patch.object(auth, 'store', store), \
+            patch.object(auth, 'token_cache', auth.TokenCache(100, 60, 10)), \
+            patch.object(lambda_function, 'store', store), \
+            patch.object(lambda_function, 'queue', None), \
+            patch.object(get_costs_function, 'store', store), \
+            patch.object(get_org_costs_function, 'store', store):
+        yield store
+    if request.param == 'sqlite':
+        store.close()
+
+def track(record):
+    body = dict({'model_name': 'gpt-4', 'input_tokens': 1000, 'output_tokens': 500, 'organization_id': 'org_1'}, **record)
+    return lambda_function.lambda_handler({'headers': HEADERS, 'body': json.dumps(body)}, None)
+
+def costs(module, context=None, **params):
+    params = dict({'organization_id': 'org_1', 'start_date': '2025-03-01', 'end_date': '2025-03-31'}, **params)
+    response = module.lambda_handler({'headers': HEADERS, 'queryStringParameters': params}, context)
+    return response['statusCode'], json.loads(response['body'])
+
+def test_handlers_answer_alike_on_both_backends(store):
+    for i in range(30):
+        assert track({'user_id': f'user_{i % 3}', 'timestamp': f'2025-03-{1 + i % 28:02d}T10:00:00Z'})['statusCode'] == 200
+    batch = [{'user_id': 'user_9', 'model_name': 'gpt-4', 'input_tokens': 10, 'output_tokens': 5,
+              'timestamp': f'2025-03-15T{i:02d}:00:00Z'} for i in range(24)]
+    event = {'resource': '/track/batch', 'headers': HEADERS, 'body': json.dumps({'organization_id': 'org_1', 'records': batch})}
+    assert lambda_function.lambda_handler(event, None)['statusCode'] == 200
+
+    status, body = costs(get_costs_function, user_id='user_1')
+    assert status == 200 and body['usage_count'] == 10
+    assert body['total_cost'] == pytest.approx(10 * 0.06)
+
+    # Stored times are normalized, so "12:00:00" ends before the record at 12:00
+    status, body = costs(get_org_costs_function, start_date='2025-03-15', end_date='2025-03-15T12:00:00')
+    assert {user['user_id']: user['usage_count'] for user in body['user_costs']} == {'user_9': 12, 'user_2': 1}
+
+    status, body = costs(get_org_costs_function)
+    assert body['total_users'] == 4
+    assert sum(user['usage_count'] for user in body['user_costs']) == 54
+
+def test_continuation_resumes_on_both_backends(store):
+    for i in range(40):
+        track({'user_id': f'user_{i % 2}', 'timestamp': f'2025-03-08T{i % 24:02d}:{i:02d}:00Z'})
+
+    responses = 0
+    counts = {}
+    token = None
+    while True:
+        extra = {'continuation_token': token} if token else {}
+        status, body = costs(get_org_costs_function, FakeContext(remaining_ms=10000, step_ms=3000), **extra)
+        responses += 1
+        if body['complete']:
+            counts = {user['user_id']: user['usage_count'] for user in body['user_costs']}
+            break
+        token = body['continuation_token']
+
+    assert responses > 1
+    assert counts == {'user_0': 20, 'user_1': 20}
+
+def test_write_shards_only_grow(store):
+    assert store.write_shards('org_1') == 1
+    assert store.raise_write_shards('org_1', 3) == 3
+    assert store.raise_write_shards('org_1', 2) == 3
+    assert store.write_shards('org_1') == 3
+    assert store.raise_write_shards('org_missing', 2) == 1
+
+def test_sharded_records_are_summed_under_their_real_ids(store):
+    store.raise_write_shards('org_1', 4)
+    with patch.object(sharding, 'WRITE_SHARDING', True):
+        for i in range(20):
+            track({'user_id': 'user_1', 'timestamp': f'2025-03-08T10:{i:02d}:00Z'})
+
+        status, body = costs(get_costs_function, user_id='user_1')
+        assert body['user_id'] == 'user_1' and body['usage_count'] == 20
+        status, body = costs(get_org_costs_function)
+        assert [user['user_id'] for user in body['user_costs']] == ['user_1']
+
+def test_sqlite_prefetch_and_extra_attributes(tmp_path):
+    store = open_store('sqlite', tmp_path, page_items=100)
+    store.put_organization({'organization_id': 'org_2', 'auth_token': 'other', 'status': 'suspended'})
+
+    assert store.find_organization('secret-token')['organization_name'] == 'Acme'
+    assert store.find_organization('unknown') is None
+
+    cache = auth.TokenCache(100, 60, 10)
+    assert auth.prefetch_active_organizations(cache, store) == 1
+    assert cache.get('secret-token') == (True, {'organization_id': 'org_1', 'status': 'active'})
+
+def test_sqlite_batch_failures_stay_in_their_transaction(tmp_path):
+    store = storage.SQLiteStorage(str(tmp_path / 'usage.db'), batch_rows=2)
+    items = [{'organization_id': 'org_1', 'record_id': f'r{i}', 'user_id': 'user_1',
+              'timestamp': '2025-03-08T10:00:00', 'total_cost': Decimal('0.5')} for i in range(5)]
+    del items[3]['user_id']
+
+    errors = store.put_usage_batch(items)
+
+    assert [error is None for error in errors] == [True, True, False, False, True]
+    source = usage_queries.raw_source('organization', 'org_1', '2025-03-01', '2025-03-31')
+    stored = store.query_usage(source)['Items']
+    assert len(stored) == 3
+    assert all(item['total_cost'] == Decimal('0.5') for item in stored)
+
+def test_sqlite_uses_wal_and_covering_range_indexes(tmp_path):
+    store = open_store('sqlite', tmp_path, page_items=100)
+    with store._connection() as db:
+        assert db.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+        for index, key in (('usage_org_timestamp', 'organization_id'), ('usage_user_timestamp', 'user_id')):
+            plan = db.execute(
+                f"EXPLAIN QUERY PLAN SELECT user_id, total_cost, timestamp, write_shard FROM usage "
+                f"WHERE {key} = 'x' AND timestamp BETWEEN 'a' AND 'b' ORDER BY timestamp, record_id"
+            ).fetchall()
+            assert f'COVERING INDEX {index}' in plan[0][-1]
@@ -0,0 +1,169 @@
+import pytest
+import json
+from datetime import datetime, timezone
+from decimal import Decimal
+import os
+import sys
+
+# Add the project root to the Python path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+import object_store
+import record_keys
+import sharding
+import storage
+import usage_export
+from tests.fake_dynamodb import make_tables
+
+NOW = datetime(2025, 3, 10, 12, 0, tzinfo=timezone.utc)
+
+def usage_item(organization_id, user_id, timestamp, cost='0.25', stored=None, **extra):
+    """A usage item, stored at its own time unless `stored` is given."""
+    timestamp, ts = record_keys.normalize_timestamp(timestamp)
+    return dict({
+        'organization_id': organization_id,
+        'record_id': record_keys.new_record_id(ts),
+        'user_id': user_id,
+        'timestamp': timestamp,
+        'ts': ts,
+        'model_name': 'gpt-4',
+        'total_cost': Decimal(cost),
+        'ingest_key': record_keys.new_record_id(record_keys.normalize_timestamp(stored)[1] if stored else ts)
+    }, **extra)
+
+@pytest.fixture(params=['dynamodb', 'sqlite'])
+def usage_store(request, tmp_path):
+    if request.param == 'sqlite':
+        store = storage.SQLiteStorage(str(tmp_path / 'usage.db'), page_items=5)
+    else:
+        _, usage, orgs = make_tables(page_size=5)
+        store = storage.DynamoDBStorage(usage, orgs)
+    for organization_id in ('org_1', 'org_2'):
+        store.put_organization({'organization_id': organization_id, 'auth_token': f'token-{organization_id}', 'status': 'active'})
+    yield store
+    if request.param == 'sqlite':
+        store.close()
+
+def test_compaction_partitions_by_org_and_day(usage_store):
+    items = [usage_item('org_1', f'user_{i % 2}', f'2025-03-0{1 + i % 3}T10:{i:02d}:00Z', session=f's{i}') for i in range(12)]
+    items.append(usage_item('org_2', 'user_9', '2025-03-02T08:00:00Z', cost='1.5'))
+    usage_store.put_usage_batch(items)
+    exports = object_store.MemoryStore()
+
+    # The default format needs no packages beyond requirements.txt
+    stats = usage_export.compact(usage_store, exports, now=NOW)
+
+    assert stats['records'] == 13 and stats['partitions'] == 4
+    assert usage_export.partitions(exports) == [
+        'organization_id=org_1/date=2025-03-01/usage.ucol',
+        'organization_id=org_1/date=2025-03-02/usage.ucol',
+        'organization_id=org_1/date=2025-03-03/usage.ucol',
+        'organization_id=org_2/date=2025-03-02/usage.ucol',
+    ]
+    rows = list(usage_export.scan(exports, organization_id='org_1'))
+    assert sorted(row['record_id'] for row in rows) == sorted(item['record_id'] for item in items[:12])
+    assert rows[0]['cost_nanos'] == 250000000
+    assert json.loads(rows[0]['attributes']) == {'session': 's0', 'ingest_key': items[0]['ingest_key']}
+
+def test_compaction_is_incremental(usage_store):
+    exports = object_store.MemoryStore()
+    usage_store.put_usage_batch([usage_item('org_1', 'user_1', '2025-03-09T09:00:00Z')])
+    usage_export.compact(usage_store, exports, 'columns', now=NOW)
+
+    # One record after the mark, one still inside the lag window
+    usage_store.put_usage_batch([
+        usage_item('org_1', 'user_1', '2025-03-10T11:30:00Z'),
+        usage_item('org_1', 'user_1', '2025-03-10T12:40:00Z'),
+    ])
+    later = datetime(2025, 3, 10, 13, 0, tzinfo=timezone.utc)
+    stats = usage_export.compact(usage_store, exports, 'columns', now=later)
+    assert stats['records'] == 1
+    assert stats['watermark'] == record_keys.upper_bound('2025-03-10T12:00:00.000000+00:00')
+
+    # Nothing new to read, and rerunning from an older mark adds no duplicates
+    assert usage_export.compact(usage_store, exports, 'columns', now=later)['records'] == 0
+    exports.put(usage_export.STATE_KEY, b'{}')
+    assert usage_export.compact(usage_store, exports, 'columns', now=later)['records'] == 0
+    assert len(list(usage_export.scan(exports))) == 2
+
+def test_late_records_are_exported_into_their_day(usage_store):
+    exports = object_store.MemoryStore()
+    usage_store.put_usage_batch([usage_item('org_1', 'user_1', '2025-03-09T09:00:00Z')])
+    usage_export.compact(usage_store, exports, 'columns', now=NOW)
+
+    # Sent after the first run with a timestamp long before it
+    late = usage_item('org_1', 'user_1', '2025-03-01T10:00:00Z', stored='2025-03-10T11:30:00Z')
+    usage_store.put_usage_batch([late])
+    stats = usage_export.compact(usage_store, exports, 'columns', now=datetime(2025, 3, 10, 13, 0, tzinfo=timezone.utc))
+
+    assert stats['records'] == 1 and stats['partitions'] == 1
+    row, = usage_export.scan(exports, '2025-03-01', '2025-03-02')
+    assert row['record_id'] == late['record_id']
+
+def test_exports_with_a_timestamp_mark_continue_from_it(usage_store):
+    exports = object_store.MemoryStore()
+    exports.put(usage_export.STATE_KEY, json.dumps(
+        {'format': 'columns', 'high_water_mark': '2025-03-09T00:00:00.000000+00:00'}
+    ).encode())
+    usage_store.put_usage_batch([
+        usage_item('org_1', 'user_1', '2025-03-08T09:00:00Z'),
+        usage_item('org_1', 'user_1', '2025-03-09T09:00:00Z'),
+    ])
+
+    stats = usage_export.compact(usage_store, exports, 'columns', now=NOW)
+    assert stats['records'] == 1
+    assert json.loads(exports.get(usage_export.STATE_KEY)) == {'format': 'columns', 'watermark': stats['watermark']}
+
+def test_sharded_records_are_exported_under_their_real_ids(usage_store):
+    usage_store.raise_write_shards('org_1', 3)
+    items = [sharding.shard_item(usage_item('org_1', 'user_1', f'2025-03-0{1 + i % 2}T10:{i:02d}:00Z'), 3) for i in range(20)]
+    assert any(item.get('write_shard') for item in items)
+    usage_store.put_usage_batch(items)
+    exports = object_store.MemoryStore()
+
+    usage_export.compact(usage_store, exports, 'columns', now=NOW)
+
+    rows = list(usage_export.scan(exports, columns=['organization_id', 'user_id', 'record_id']))
+    assert len(rows) == 20
+    assert {(row['organization_id'], row['user_id']) for row in rows} == {('org_1', 'user_1')}
+    assert all('write_shard' not in (row.get('attributes') or '') for row in rows)
+
+def test_report_prunes_partitions_by_date(tmp_path):
+    exports = object_store.DirectoryStore(str(tmp_path / 'exports'))
+    for day in range(1, 29):
+        rows = [usage_export.export_row(usage_item('org_1', user, f'2025-02-{day:02d}T12:00:00Z', cost='0.1'))
+                for user in ('user_1', 'user_2', 'user_2')]
+        usage_export.write_partition(exports, 'columns', 'org_1', f'2025-02-{day:02d}', rows)
+
+    assert len(usage_export.partitions(exports, '2025-02-10', '2025-02-12')) == 3
+    report = usage_export.cost_report(exports, '2025-02-10', '2025-02-12T12:00:00.000000+00:00')
+    assert report['org_1']['usage_count'] == 9
+    assert report['org_1']['total_cost'] == Decimal('0.9')
+    assert [user['user_id'] for user in report['org_1']['user_costs']] == ['user_2', 'user_1']
+
+    # The end bound is compared with the stored timestamps, like the cost endpoints
+    assert usage_export.cost_report(exports, '2025-02-10', '2025-02-12')['org_1']['usage_count'] == 6
+
+def test_destination_keeps_one_format():
+    exports = object_store.MemoryStore()
+    exports.put(usage_export.STATE_KEY, json.dumps({'format': 'columns', 'high_water_mark': '2025-03-01'}).encode())
+    with pytest.raises(ValueError):
+        usage_export.compact(None, exports, 'parquet', now=NOW)
+
+def test_directory_store_rejects_keys_outside_its_root(tmp_path):
+    exports = object_store.DirectoryStore(str(tmp_path))
+    exports.put('a/b.bin', b'data')
+    assert exports.get('a/b.bin') == b'data' and exports.get('missing') is None
+    assert exports.list() == ['a/b.bin']
+    with pytest.raises(ValueError):
+        exports.put('../outside', b'data')
+
+def test_parquet_round_trip(usage_store):
+    pytest.importorskip('pyarrow')
+    usage_store.put_usage_batch([usage_item('org_1', 'user_1', '2025-03-01T10:00:00Z')])
+    exports = object_store.MemoryStore()
+
+    usage_export.compact(usage_store, exports, 'parquet', now=NOW)
+
+    assert usage_export.partitions(exports) == ['organization_id=org_1/date=2025-03-01/usage.parquet']
+    assert usage_export.cost_report(exports)['org_1']['total_cost'] == Decimal('0.25')
@@ -0,0 +1,144 @@
+import pytest
+import json
+from unittest.mock import patch
+import os
+import sys
+
+# Add the project root to the Python path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+import batch_write
+import ingest_queue
+import ingest_worker
+import lambda_function
+import metrics
+import storage
+import write_guard
+from tests.fake_dynamodb import FakeContext, batch_event, make_tables, usage_record
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+class FailingSQS:
+    """SQS client whose every message fails to send."""
+    def send_message_batch(self, QueueUrl, Entries):
+        return {'Successful': [], 'Failed': [{'Id': entry['Id'], 'Code': 'ServiceUnavailable'} for entry in Entries]}
+
+@pytest.fixture
+def saturated():
+    """The track handler on a usage table that throttles every write until told otherwise, spilling to memory."""
+    _, usage, _ = make_tables()
+    usage.throttle_next = 10 ** 6
+    clock = FakeClock()
+    delays = []
+    guard = write_guard.WriteGuard(
+        write_guard.CircuitBreaker(threshold=3, cooldown=5, clock=clock), attempts=2, sleep=delays.append
+    )
+    spillover = ingest_queue.MemoryQueue()
+    sink = metrics.MemorySink()
+    with patch.object(lambda_function, 'store', storage.DynamoDBStorage(usage)), \
+            patch.object(lambda_function, 'authorize_request', return_value=True), \
+            patch.object(lambda_function, 'spillover', spillover), \
+            patch.object(write_guard, 'guard', guard), \
+            patch.object(metrics, 'sink', sink), \
+            patch.object(batch_write.time, 'sleep'):
+        yield usage, guard, clock, delays, sink, spillover
+
+def track(**overrides):
+    event = {'headers': {'Authorization': 'Bearer token'}, 'body': json.dumps(usage_record(organization_id='org_123', **overrides))}
+    return lambda_function.lambda_handler(event, FakeContext())
+
+def test_throttled_writes_are_retried_with_jittered_backoff(saturated):
+    usage, guard, _, delays, sink, spillover = saturated
+    usage.throttle_next = 2
+
+    response = track()
+    assert response['statusCode'] == 200
+    assert len(usage.items) == 1 and len(spillover) == 0
+    assert len(delays) == 2 and delays[0] <= 0.025 and delays[1] <= 0.05
+    assert sink.values('write_throttles') == [2] and sink.values('write_retries') == [2]
+    assert guard.breaker.closed and guard.breaker.throttles == 0
+
+def test_saturated_table_opens_the_breaker_and_spills_to_the_queue(saturated):
+    usage, guard, clock, delays, sink, spillover = saturated
+
+    # Three throttles open the breaker and the record is queued
+    response = track(user_id='user_1', timestamp='2025-03-08T10:00:00Z')
+    assert response['statusCode'] == 202
+    assert json.loads(response['body'])['message'] == 'Usage data accepted'
+    assert not guard.breaker.closed and len(spillover) == 1
+
+    # While it is open, records skip the table altogether
+    left = usage.throttle_next
+    assert [track(user_id=f'user_{i}')['statusCode'] for i in range(2, 5)] == [202] * 3
+    assert usage.throttle_next == left and len(delays) == 2
+    assert sink.values('spilled_records') == [1, 1, 1, 1]
+
+    # The ingest worker stores them under their time once capacity returns
+    usage.throttle_next = 0
+    assert ingest_worker.drain(spillover) == {'stored': 4, 'dead_lettered': 0, 'failed': 0}
+    assert sorted(item['user_id'] for item in usage.items.values()) == [f'user_{i}' for i in range(1, 5)]
+    assert '2025-03-08T10:00:00.000000+00:00' in {item['timestamp'] for item in usage.items.values()}
+
+def test_records_that_cannot_be_spilled_are_refused(saturated):
+    usage, guard, clock, _, sink, _ = saturated
+    with patch.object(lambda_function, 'spillover', None):
+        track(user_id='user_1')
+        clock.now = 2
+        response = track(user_id='user_2')
+    assert response['statusCode'] == 503 and response['headers'] == {'Retry-After': '3'}
+    assert sink.values('rejected_records') == [1, 1]
+
+    # A queue that can't be reached is answered the same way
+    with patch.object(lambda_function, 'spillover', ingest_queue.SQSQueue('queue', client=FailingSQS())):
+        assert track(user_id='user_3')['statusCode'] == 503
+    assert usage.items == {} and sink.values('rejected_records') == [1, 1, 1]
+
+def test_batches_spill_throttled_records(saturated):
+    usage, _, _, _, _, spillover = saturated
+
+    response = lambda_function.lambda_handler(batch_event([usage_record(user_id=f'user_{i}') for i in range(3)]), None)
+    body = json.loads(response['body'])
+    assert response['statusCode'] == 200 and body['succeeded'] == 3
+    assert [result['status'] for result in body['results']] == ['accepted'] * 3
+    assert usage.items == {} and len(spillover) == 3
+
+    # Without a queue they are reported as failed
+    with patch.object(lambda_function, 'spillover', None):
+        response = lambda_function.lambda_handler(batch_event([usage_record(user_id=f'user_{i}') for i in range(3, 5)]), None)
+    body = json.loads(response['body'])
+    assert response['statusCode'] == 207
+    assert [result['status'] for result in body['results']] == ['error', 'error']
+    assert body['results'][0]['error'].startswith('Usage storage is saturated')
+
+    usage.throttle_next = 0
+    ingest_worker.drain(spillover)
+    assert sorted(item['user_id'] for item in usage.items.values()) == ['user_0', 'user_1', 'user_2']
+
+def test_other_write_errors_are_not_retried(saturated):
+    usage, guard, _, delays, _, spillover = saturated
+    usage.throttle_next = 0
+    with patch.object(usage, 'put_item', side_effect=ValueError('bad item')):
+        response = track()
+    assert response['statusCode'] == 500
+    assert delays == [] and len(spillover) == 0 and guard.breaker.closed
+
+def test_breaker_probes_once_per_cooldown():
+    clock = FakeClock()
+    breaker = write_guard.CircuitBreaker(threshold=2, cooldown=5, clock=clock)
+    breaker.record_throttle()
+    assert breaker.allow()
+    breaker.record_throttle()
+    assert not breaker.allow() and breaker.retry_after() == 5
+
+    clock.now = 5
+    assert breaker.allow() and not breaker.allow()
+    breaker.record_throttle()
+    clock.now = 10
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.closed and breaker.allow()
@@ -0,0 +1,137 @@
+import pytest
+import json
+from contextlib import ExitStack
+import logging
+import random
+from decimal import Decimal
+from unittest.mock import patch
+import os
+import sys
+
+# Add the project root to the Python path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+import get_costs_function
+import get_org_costs_function
+import lambda_function
+import rollups
+import sharding
+import storage
+from local_stream import LocalStream
+from tests.fake_dynamodb import make_rollup_table, make_tables
+
+def batch_event(records, organization_id='org_1'):
+    return {
+        'resource': '/track/batch',
+        'headers': {'Authorization': 'Bearer token'},
+        'body': json.dumps({'organization_id': organization_id, 'records': records})
+    }
+
+def cost_event(params):
+    return {'headers': {'Authorization': 'token'}, 'queryStringParameters': params}
+
+@pytest.fixture
+def sharded_tables():
+    """Usage and organization tables with sharding on and a low shard threshold."""
+    _, usage, orgs = make_tables()
+    orgs.put_item(Item={'organization_id': 'org_1', 'auth_token': 'token', 'status': 'active'})
+    with patch.object(sharding, 'WRITE_SHARDING', True), \
+            patch.object(sharding, 'WRITE_SHARD_RATE', 1), \
+            patch.object(sharding, 'MAX_WRITE_SHARDS', 4), \
+            patch.object(sharding, 'write_rates', sharding.WriteRateTracker(window=60)), \
+            patch.object(sharding, '_shard_counts', {}), \
+            ExitStack() as stack:
+        for module in (lambda_function, get_costs_function, get_org_costs_function):
+            stack.enter_context(patch.object(module, 'store', storage.DynamoDBStorage(usage, orgs)))
+            stack.enter_context(patch.object(module, 'authorize_request', return_value=True))
+        yield usage, orgs
+
+def test_shard_keys_round_trip():
+    item = {'organization_id': 'org_1', 'user_id': 'user#7', 'record_id': 'r'}
+    sharded = sharding.shard_item(item, 4, rng=random.Random(3))
+
+    assert sharded['write_shard'] in (1, 2, 3)
+    assert sharded['organization_id'] in sharding.shard_keys('org_1', 4)
+    assert sharding.unshard_item(sharded) == dict(item, write_shard=sharded['write_shard'])
+    # Shard 0 leaves the item untouched, so existing data reads as before
+    assert sharding.shard_keys('org_1', 1) == ['org_1']
+
+def test_busy_organization_is_sharded_and_read_back_whole(sharded_tables):
+    usage, orgs = sharded_tables
+    records = [
+        {'model_name': 'gpt-4', 'input_tokens': 1000, 'output_tokens': 500,
+         'user_id': f'user_{i % 3}', 'timestamp': f'2025-03-08T{i % 24:02d}:00:00'}
+        for i in range(300)
+    ]
+    response = lambda_function.lambda_handler(batch_event(records), None)
+    assert response['statusCode'] == 200
+
+    # 300 records a minute at 1 record/s per shard needs more than the maximum
+    assert orgs.get_item(Key={'organization_id': 'org_1'})['Item']['write_shards'] == 4
+    partition_keys = {item['organization_id'] for item in usage.items.values()}
+    assert partition_keys <= set(sharding.shard_keys('org_1', 4)) and len(partition_keys) > 1
+
+    params = {'organization_id': 'org_1', 'start_date': '2025-03-01', 'end_date': '2025-03-31'}
+    org_body = json.loads(get_org_costs_function.lambda_handler(cost_event(params), None)['body'])
+    assert sorted(user['user_id'] for user in org_body['user_costs']) == ['user_0', 'user_1', 'user_2']
+    assert sum(user['usage_count'] for user in org_body['user_costs']) == 300
+    assert org_body['total_organization_cost'] == pytest.approx(18.0)
+
+    user_body = json.loads(get_costs_function.lambda_handler(cost_event(dict(params, user_id='user_1')), None)['body'])
+    assert user_body['usage_count'] == 100
+    assert user_body['total_cost'] == pytest.approx(6.0)
+
+def test_shard_count_never_goes_down(sharded_tables):
+    _, orgs = sharded_tables
+    assert sharding.raise_write_shards(orgs, 'org_1', 3) == 3
+    assert sharding.raise_write_shards(orgs, 'org_1', 2) == 3
+    assert sharding.org_write_shards(orgs, 'org_1') == 3
+    # Unknown organizations are never created by a raise
+    assert sharding.raise_write_shards(orgs, 'org_missing', 2) == 1
+    assert 'Item' not in orgs.get_item(Key={'organization_id': 'org_missing'})
+
+def test_rollups_use_the_real_ids():
+    resource, usage, _ = make_tables()
+    rollup_table = make_rollup_table(resource)
+    stream = LocalStream(usage, ('organization_id', 'record_id'))
+    item = {
+        'organization_id': 'org_1', 'record_id': 'rec_1', 'user_id': 'user_1',
+        'timestamp': '2025-03-08T10:00:00', 'model_name': 'gpt-4', 'total_cost': Decimal('0.5')
+    }
+    stream.put_item(Item=sharding.shard_item(item, 4, rng=random.Random(1)))
+
+    rollups.apply_stream_records(stream.drain()['Records'], rollup_table)
+
+    row = rollup_table.get_item(Key={'rollup_key': 'org_1#H', 'bucket_key': '2025-03-08T10#user_1#gpt-4'})['Item']
+    assert row['user_id'] == 'user_1' and row['total_cost'] == Decimal('0.5')
+
+def test_write_rate_is_reported_once_per_window(caplog):
+    now = [0.0]
+    tracker = sharding.WriteRateTracker(window=10, clock=lambda: now[0])
+    with patch.object(sharding, 'write_rates', tracker), caplog.at_level(logging.INFO):
+        for _ in range(5):
+            sharding.write_shards_for(None, 'org_1', 20)
+        now[0] = 11.0
+        sharding.write_shards_for(None, 'org_1', 20)
+
+    reports = [json.loads(r.getMessage()) for r in caplog.records if 'org_write_rate' in r.getMessage()]
+    assert [report['records_per_second'] for report in reports] == [2.0, 2.0]
+    assert all(report['write_shards'] == 1 for report in reports)
+
+def test_readers_cache_the_shard_count_briefly():
+    _, usage, orgs = make_tables()
+    store = storage.DynamoDBStorage(usage, orgs)
+    now = [0.0]
+    with patch.object(store, 'write_shards', return_value=3) as write_shards, \
+            patch.object(sharding.time, 'monotonic', lambda: now[0]):
+        # Nothing is read while sharding is off
+        assert sharding.read_shards(store, 'org_1') == 1
+        assert write_shards.call_count == 0
+
+        with patch.object(sharding, 'WRITE_SHARDING', True):
+            assert [sharding.read_shards(store, 'org_1') for _ in range(3)] == [3, 3, 3]
+            assert write_shards.call_count == 1
+            now[0] = sharding.READ_SHARD_COUNT_TTL_SECONDS + 1
+            write_shards.return_value = 4
+            assert sharding.read_shards(store, 'org_1') == 4
+            assert write_shards.call_count == 2
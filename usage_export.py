@@ -0,0 +1,393 @@
+"""
+Columnar exports of usage records, partitioned by organization and day.
+
+compact() copies usage records out of a store (see storage) into compressed
+columnar files in an object store (see object_store), one per organization
+and UTC day:
+
+    organization_id=<org>/date=<YYYY-MM-DD>/usage.<extension>
+
+Runs are incremental. `_state.json` holds a watermark on the time records
+were stored: their ingest_key (see usage_queries), not their timestamp. Each
+run reads the records stored after it from OrgIngestIndex, up to
+COMPACTION_LAG_MINUTES before now, so records still arriving are left for
+the next run. A record sent late with an old timestamp is therefore
+exported by the next run, into the day it belongs to. The first run reads
+by time instead, from `start`. A day written again is merged with its file
+by record_id, so an interrupted run can simply be started again. Records
+without an ingest_key, such as those stored before it existed, are only
+exported by a first run.
+
+Files hold these columns:
+
+    organization_id, record_id, user_id, timestamp, ts, model_name
+    cost_nanos   total_cost in nano-dollars (see pricing)
+    attributes   any other record fields as JSON, or null
+
+Two formats are supported:
+
+    columns   the default: a JSON header followed by one zlib-compressed block
+              per column, with repeated strings dictionary-encoded. Needs no
+              packages
+    parquet   zstd-compressed Parquet; needs pyarrow, which is not part of the
+              Lambda packages
+
+partitions(), scan() and cost_report() read the files back for offline
+reports. Only the files of the days in the requested range are opened, and
+only the requested columns are decoded.
+
+    python usage_export.py compact --dest exports/
+    python usage_export.py report --dest exports/ --start 2025-01-01 --end 2025-12-31
+"""
+import argparse
+import heapq
+import io
+import itertools
+import json
+import logging
+import os
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+from urllib.parse import quote, unquote
+
+import object_store
+import pricing
+import record_keys
+import sharding
+import storage
+import usage_queries
+
+# Initialize logging
+logger = logging.getLogger()
+
+# Records newer than this are left for the next run
+COMPACTION_LAG_MINUTES = float(os.environ.get('COMPACTION_LAG_MINUTES', '60'))
+EXPORT_FORMAT = os.environ.get('EXPORT_FORMAT', 'columns')
+
+EXPORT_COLUMNS = ('organization_id', 'record_id', 'user_id', 'timestamp', 'ts', 'model_name', 'cost_nanos', 'attributes')
+# Item fields with a column of their own; write_shard is dropped with the shard suffixes
+_ITEM_FIELDS = ('organization_id', 'record_id', 'user_id', 'timestamp', 'ts', 'model_name', 'total_cost', 'write_shard')
+# The TTL of retention is not part of the record
+_DROPPED_FIELDS = ('expires_at',)
+_INTEGER_COLUMNS = ('ts', 'cost_nanos')
+_DICTIONARY_COLUMNS = ('organization_id', 'user_id', 'model_name')
+
+STATE_KEY = '_state.json'
+# Lower bound of the first run when no start is given
+EARLIEST = record_keys.canonical(datetime(1970, 1, 1, tzinfo=timezone.utc))
+LATEST = record_keys.canonical(datetime(9999, 12, 31, 23, 59, 59, 999999, tzinfo=timezone.utc))
+
+_MAGIC = b'UCOL1'
+
+
+def _json_value(value):
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    return str(value)
+
+
+def export_row(item):
+    """The export columns of a stored usage item."""
+    item = sharding.unshard_item(item)
+    rest = {k: v for k, v in item.items() if k not in _ITEM_FIELDS and k not in _DROPPED_FIELDS}
+    return {
+        'organization_id': item['organization_id'],
+        'record_id': item['record_id'],
+        'user_id': item['user_id'],
+        'timestamp': item['timestamp'],
+        'ts': int(item['ts']) if item.get('ts') is not None else None,
+        'model_name': item.get('model_name'),
+        'cost_nanos': pricing.to_nanos(item['total_cost']),
+        'attributes': json.dumps(rest, default=_json_value, sort_keys=True) if rest else None
+    }
+
+
+def _encode_columns(columns):
+    header = {'rows': len(columns['record_id']), 'columns': {}}
+    blocks = []
+    offset = 0
+    for name, values in columns.items():
+        if name in _DICTIONARY_COLUMNS:
+            dictionary = list(dict.fromkeys(values))
+            codes = {value: code for code, value in enumerate(dictionary)}
+            payload, encoding = {'dictionary': dictionary, 'codes': [codes[value] for value in values]}, 'dictionary'
+        else:
+            payload, encoding = values, 'plain'
+        block = zlib.compress(json.dumps(payload, separators=(',', ':')).encode('utf-8'))
+        header['columns'][name] = {'offset': offset, 'length': len(block), 'encoding': encoding}
+        blocks.append(block)
+        offset += len(block)
+    header_bytes = json.dumps(header, separators=(',', ':')).encode('utf-8')
+    return _MAGIC + struct.pack('>I', len(header_bytes)) + header_bytes + b''.join(blocks)
+
+
+def _decode_columns(data, names):
+    if not data.startswith(_MAGIC):
+        raise ValueError('Not a usage column file')
+    start = len(_MAGIC) + 4
+    (header_length,) = struct.unpack('>I', data[len(_MAGIC):start])
+    header = json.loads(data[start:start + header_length])
+    body = start + header_length
+    columns = {}
+    for name in names:
+        info = header['columns'][name]
+        block = data[body + info['offset']:body + info['offset'] + info['length']]
+        payload = json.loads(zlib.decompress(block))
+        if info['encoding'] == 'dictionary':
+            payload = [payload['dictionary'][code] for code in payload['codes']]
+        columns[name] = payload
+    return columns
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError('The parquet export format needs pyarrow. Install it or use the columns format') from None
+    return pyarrow
+
+
+def _encode_parquet(columns):
+    pa = _pyarrow()
+    table = pa.table({
+        name: pa.array(values, type=pa.int64() if name in _INTEGER_COLUMNS else pa.string())
+        for name, values in columns.items()
+    })
+    buffer = io.BytesIO()
+    pa.parquet.write_table(table, buffer, compression='zstd')
+    return buffer.getvalue()
+
+
+def _decode_parquet(data, names):
+    pa = _pyarrow()
+    return pa.parquet.read_table(pa.BufferReader(data), columns=list(names)).to_pydict()
+
+
+# Format name: (file extension, encode(columns) -> bytes, decode(bytes, names) -> columns)
+FORMATS = {
+    'parquet': ('parquet', _encode_parquet, _decode_parquet),
+    'columns': ('ucol', _encode_columns, _decode_columns),
+}
+_EXTENSIONS = {extension: name for name, (extension, _, _) in FORMATS.items()}
+
+
+def partition_key(organization_id, day, fmt):
+    return f"organization_id={quote(organization_id, safe='')}/date={day}/usage.{FORMATS[fmt][0]}"
+
+
+def _parse_key(key):
+    """(organization_id, day, format) of a partition key, or None for other objects."""
+    parts = key.split('/')
+    if len(parts) != 3 or not parts[0].startswith('organization_id=') or not parts[1].startswith('date='):
+        return None
+    fmt = _EXTENSIONS.get(parts[2].rpartition('.')[2])
+    if fmt is None:
+        return None
+    return unquote(parts[0][len('organization_id='):]), parts[1][len('date='):], fmt
+
+
+def load_state(store):
+    data = store.get(STATE_KEY)
+    return json.loads(data) if data else {}
+
+
+def write_partition(store, fmt, organization_id, day, rows):
+    """Merge rows into one day's file by record_id. Returns how many were new."""
+    _, encode, decode = FORMATS[fmt]
+    key = partition_key(organization_id, day, fmt)
+    merged = {}
+    existing = store.get(key)
+    if existing is not None:
+        columns = decode(existing, EXPORT_COLUMNS)
+        for values in zip(*(columns[name] for name in EXPORT_COLUMNS)):
+            row = dict(zip(EXPORT_COLUMNS, values))
+            merged[row['record_id']] = row
+    added = sum(1 for row in rows if row['record_id'] not in merged)
+    merged.update((row['record_id'], row) for row in rows)
+    ordered = sorted(merged.values(), key=lambda row: (row['timestamp'], row['record_id']))
+    store.put(key, encode({name: [row[name] for row in ordered] for name in EXPORT_COLUMNS}))
+    return added
+
+
+def _day(item):
+    return item['timestamp'][:10]
+
+
+def _source_items(usage_store, source):
+    """Every item of a source, page by page."""
+    if source['empty']:
+        return
+    start_key = None
+    while True:
+        response = usage_store.query_usage(source, start_key)
+        yield from response['Items']
+        start_key = response.get('LastEvaluatedKey')
+        if not start_key:
+            return
+
+
+def _days_by_time(usage_store, keys, low, through, after=None):
+    """
+    (day, items) of the records under shard keys with timestamps from `low`
+    (after `after`, the timestamp mark of older exports, when given), stored
+    up to the watermark `through`. The shards are merged in day order, so one
+    day is held in memory at a time.
+    """
+    streams = [_source_items(usage_store, usage_queries.export_source(key, low, LATEST)) for key in keys]
+    items = (
+        item for item in heapq.merge(*streams, key=_day)
+        if item.get('ingest_key', '') <= through and (after is None or item['timestamp'] > after)
+    )
+    return itertools.groupby(items, key=_day)
+
+
+def _days_by_ingest(usage_store, keys, watermark, through):
+    """(day, items) of the records under shard keys stored after `watermark` and up to `through`."""
+    days = {}
+    for key in keys:
+        for item in _source_items(usage_store, usage_queries.ingest_export_source(key, watermark, through)):
+            days.setdefault(_day(item), []).append(item)
+    return sorted(days.items())
+
+
+def compact(usage_store, store, fmt=EXPORT_FORMAT, now=None, lag_minutes=COMPACTION_LAG_MINUTES, start=None):
+    """
+    Export the records stored since the last run and return counts.
+    `start` bounds the first run only; later runs continue from the
+    watermark. The records one run reads for an organization are held in
+    memory, grouped by day.
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f'Unknown export format: {fmt}')
+    state = load_state(store)
+    if state.get('format', fmt) != fmt:
+        raise ValueError(f"The destination holds {state['format']} exports")
+    watermark = state.get('watermark')
+    # Exports from before the watermark kept a timestamp mark; the run after
+    # them reads by time once more
+    high_water_mark = state.get('high_water_mark') if watermark is None else None
+    low = high_water_mark or (record_keys.normalize_timestamp(start)[0] if start else EARLIEST)
+    now = now or datetime.now(timezone.utc)
+    through = record_keys.upper_bound(record_keys.canonical(now - timedelta(minutes=lag_minutes)))
+
+    stats = {'organizations': 0, 'partitions': 0, 'records': 0, 'watermark': watermark}
+    if watermark is not None and watermark >= through:
+        return stats
+    for organization in usage_store.organizations():
+        organization_id = organization['organization_id']
+        keys = sharding.shard_keys(organization_id, usage_store.write_shards(organization_id))
+        if watermark is None:
+            days = _days_by_time(usage_store, keys, low, through, high_water_mark)
+        else:
+            days = _days_by_ingest(usage_store, keys, watermark, through)
+        for day, day_items in days:
+            stats['records'] += write_partition(store, fmt, organization_id, day, [export_row(item) for item in day_items])
+            stats['partitions'] += 1
+        stats['organizations'] += 1
+
+    # The watermark moves only once every organization is written
+    store.put(STATE_KEY, json.dumps({'format': fmt, 'watermark': through}).encode('utf-8'))
+    stats['watermark'] = through
+    logger.info(dict(stats, action='usage_export'))
+    return stats
+
+
+def partitions(store, start=None, end=None, organization_id=None):
+    """Keys of the partition files whose day falls in [start, end], by path alone."""
+    prefix = f"organization_id={quote(organization_id, safe='')}/" if organization_id else ''
+    keys = []
+    for key in store.list(prefix):
+        parsed = _parse_key(key)
+        if parsed is None:
+            continue
+        day = parsed[1]
+        if (start and day < start[:10]) or (end and day > end[:10]):
+            continue
+        keys.append(key)
+    return keys
+
+
+def scan(store, start=None, end=None, organization_id=None, columns=None, max_workers=8):
+    """
+    Yield the exported rows with timestamps in [start, end], as dicts of
+    `columns` (all by default). Files are fetched and decoded max_workers at
+    a time.
+    """
+    names = list(columns or EXPORT_COLUMNS)
+    read = names if 'timestamp' in names else names + ['timestamp']
+
+    def load(key):
+        return FORMATS[_parse_key(key)[2]][2](store.get(key), read)
+
+    keys = partitions(store, start, end, organization_id)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for first in range(0, len(keys), max_workers):
+            for loaded in executor.map(load, keys[first:first + max_workers]):
+                for values in zip(*(loaded[name] for name in read)):
+                    row = dict(zip(read, values))
+                    if (start and row['timestamp'] < start) or (end and row['timestamp'] > end):
+                        continue
+                    yield {name: row[name] for name in names}
+
+
+def cost_report(store, start=None, end=None, organization_id=None, max_workers=8):
+    """Total cost and usage count per organization and user in [start, end]."""
+    totals = {}
+    rows = scan(store, start, end, organization_id, ('organization_id', 'user_id', 'cost_nanos'), max_workers)
+    for row in rows:
+        organization = totals.setdefault(row['organization_id'], {'cost_nanos': 0, 'usage_count': 0, 'users': {}})
+        user = organization['users'].setdefault(row['user_id'], {'cost_nanos': 0, 'usage_count': 0})
+        for entry in (organization, user):
+            entry['cost_nanos'] += row['cost_nanos']
+            entry['usage_count'] += 1
+
+    report = {}
+    for org_id, organization in sorted(totals.items()):
+        report[org_id] = {
+            'total_cost': pricing.to_decimal(organization['cost_nanos']),
+            'usage_count': organization['usage_count'],
+            'user_costs': [
+                {'user_id': user_id, 'total_cost': pricing.to_decimal(user['cost_nanos']), 'usage_count': user['usage_count']}
+                for user_id, user in sorted(organization['users'].items(), key=lambda entry: -entry[1]['cost_nanos'])
+            ]
+        }
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Export usage records to columnar files and report on them.')
+    parser.add_argument('command', choices=('compact', 'report'))
+    parser.add_argument('--dest', help='Local export directory')
+    parser.add_argument('--s3-bucket', help='Export to this S3 bucket instead of --dest')
+    parser.add_argument('--s3-prefix', default='')
+    parser.add_argument('--format', default=EXPORT_FORMAT, choices=sorted(FORMATS))
+    parser.add_argument('--lag-minutes', type=float, default=COMPACTION_LAG_MINUTES)
+    parser.add_argument('--start', help='compact: first run only; report: start of the range')
+    parser.add_argument('--end', help='End of the report range')
+    parser.add_argument('--organization-id', help='Report on one organization')
+    parser.add_argument('--workers', type=int, default=8, help='Files read in parallel by report')
+    args = parser.parse_args(argv)
+    if bool(args.dest) == bool(args.s3_bucket):
+        parser.error('Give one of --dest or --s3-bucket')
+
+    logging.basicConfig(level=logging.INFO)
+    store = object_store.S3Store(args.s3_bucket, args.s3_prefix) if args.s3_bucket \
+        else object_store.DirectoryStore(args.dest)
+    if args.command == 'compact':
+        usage_store = storage.open_storage(
+            os.environ.get('DYNAMODB_TABLE', 'chatgpt_usage_tracking'),
+            os.environ.get('ORG_TABLE_NAME', 'chatgpt_organizations')
+        )
+        result = compact(usage_store, store, args.format, lag_minutes=args.lag_minutes, start=args.start)
+    else:
+        result = cost_report(store, args.start, args.end, args.organization_id, args.workers)
+    print(json.dumps(result, default=str, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,645 @@
+"""
+Paginated, projection-limited usage queries for the cost endpoints.
+
+A cost request is planned as a list of query sources (raw usage ranges and,
+when enabled, rollup ranges). UsageScan walks them page by page, following
+LastEvaluatedKey, and yields (user_id, cost, count) rows, or whole pages for
+aggregation (see aggregation), so callers can sum as they go. Large raw ranges can be split into time slices and read
+concurrently. When the Lambda is close to its timeout the scan stops between
+pages and its position can be handed back to the client as a continuation
+token. Tokens carry partial totals that handlers trust and cache, so they
+are signed with CONTINUATION_TOKEN_KEY and rejected if altered.
+
+Delta queries (delta_sources) answer what changed in a range since a
+watermark. Every record carries an ingest_key, a ULID of the time it was
+stored, and OrgIngestIndex orders an organization's records by it. A
+watermark is an ingest_key bound: the client has counted every record stored
+up to it. Records with client timestamps in the past are stored late, so
+they sort after older watermarks and show up in the next delta, whatever
+their timestamp. Watermarks trail the clock by DELTA_SETTLE_SECONDS, longer
+than any write can take, so no record is stored behind one that was handed out.
+
+With retention (see retention), records older than the hot window may have
+moved from the table to the archive. Raw ranges starting before it are read
+from both, through an archive source per organization next to the raw ones.
+"""
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import math
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+
+import bootstrap
+import item_schema
+import metrics
+import record_keys
+import retention
+import rollups
+import sharding
+
+# Initialize logging
+logger = logging.getLogger()
+
+# Stop reading pages once less than this much of the Lambda's time remains
+QUERY_TIME_RESERVE_MS = int(os.environ.get('QUERY_TIME_RESERVE_MS', '1500'))
+
+# Only the attributes the cost endpoints aggregate are read, in their long and
+# compact names (see item_schema)
+RAW_PROJECTION = 'user_id, total_cost, #ts, write_shard, model_name, c, m, s'
+ROLLUP_PROJECTION = 'user_id, total_cost, usage_count, model_name, bucket_key'
+
+# Parallel scans split large raw ranges into time slices of about
+# QUERY_SLICE_ITEMS records and query up to QUERY_WORKERS of them at once
+QUERY_WORKERS = int(os.environ.get('QUERY_WORKERS', '8'))
+QUERY_SLICE_ITEMS = int(os.environ.get('QUERY_SLICE_ITEMS', '50000'))
+MAX_QUERY_SLICES = int(os.environ.get('MAX_QUERY_SLICES', '64'))
+
+# Key signing continuation tokens. Every instance of a function must share
+# it; without one, tokens only resume on the instance that issued them.
+CONTINUATION_TOKEN_KEY = os.environ.get('CONTINUATION_TOKEN_KEY', '').encode('utf-8') or os.urandom(32)
+
+# Delta watermarks stay this far behind now; more than the slowest write
+# (the ingest worker's timeout) plus index propagation
+DELTA_SETTLE_SECONDS = float(os.environ.get('DELTA_SETTLE_SECONDS', '120'))
+# Watermark of a client that has counted nothing yet
+BASELINE_WATERMARK = '0'
+INGEST_PROJECTION = RAW_PROJECTION + ', ingest_key'
+
+# After the record id migration, organization ranges are read from the base
+# table by record_id instead of through OrgTimestampIndex
+RECORD_ID_QUERIES = os.environ.get('RECORD_ID_QUERIES', 'false').lower() == 'true'
+
+# Sorts after the '#' separator, so "<bucket>$" bounds every rollup key in a bucket
+_BUCKET_KEY_END = '$'
+
+
+
+def _with_range(source, low, high, exclude_from):
+    """Copy of a raw source narrowed to timestamps in [low, high]."""
+    values = dict(source['query']['ExpressionAttributeValues'])
+    if source['by'] == 'record_id':
+        values[':start'], values[':end'] = record_keys.lower_bound(low), record_keys.upper_bound(high)
+    else:
+        values[':start'], values[':end'] = low, high
+    # DynamoDB rejects BETWEEN with its bounds reversed, so such ranges are never queried
+    empty = low > high or values[':start'] is None or values[':end'] is None or values[':start'] > values[':end']
+    return dict(
+        source, low=low, high=high, exclude_from=exclude_from, empty=empty,
+        query=dict(source['query'], ExpressionAttributeValues=values)
+    )
+
+
+def raw_source(scope, key, low, high, high_exclusive=False):
+    """
+    Query source for raw usage records of a user or organization in [low, high].
+    Organizations are read from the base table by record_id when
+    RECORD_ID_QUERIES is set, otherwise through OrgTimestampIndex (or its
+    slim replacement, see item_schema). User records carry their
+    organization_id, as user indexes span organizations.
+    """
+    query = {
+        'ProjectionExpression': RAW_PROJECTION + ', organization_id' if scope == 'user' else RAW_PROJECTION,
+        'ExpressionAttributeNames': {'#ts': 'timestamp'},
+        'ExpressionAttributeValues': {':key': key}
+    }
+    if scope != 'user' and RECORD_ID_QUERIES:
+        by = 'record_id'
+        query['KeyConditionExpression'] = 'organization_id = :key AND record_id BETWEEN :start AND :end'
+    else:
+        by = 'timestamp'
+        index, key_name = ('UserTimestampIndex', 'user_id') if scope == 'user' \
+            else ('OrgTimestampIndex', 'organization_id')
+        query['IndexName'] = item_schema.index_name(index)
+        query['KeyConditionExpression'] = f'{key_name} = :key AND #ts BETWEEN :start AND :end'
+    source = {'kind': 'raw', 'scope': scope, 'by': by, 'query': query}
+    return _with_range(source, low, high, high if high_exclusive else None)
+
+
+def ingest_source(key, after, through, low, high, user_id=None):
+    """
+    Query source for the records of an organization (or one of its shard
+    keys) stored after the watermark `after` and up to `through`, read from
+    OrgIngestIndex. Only records with timestamps in [low, high], and of
+    `user_id` when given, are counted.
+    """
+    query = {
+        'IndexName': item_schema.index_name('OrgIngestIndex'),
+        'KeyConditionExpression': 'organization_id = :key AND ingest_key BETWEEN :start AND :end',
+        'ProjectionExpression': INGEST_PROJECTION,
+        'ExpressionAttributeNames': {'#ts': 'timestamp'},
+        'ExpressionAttributeValues': {':key': key, ':start': after, ':end': through}
+    }
+    return {
+        'kind': 'ingest', 'low': low, 'high': high, 'after': after, 'user_id': user_id,
+        'exclude_from': None, 'empty': after >= through or low > high, 'query': query
+    }
+
+
+def export_source(key, low, high, scope='organization'):
+    """
+    Raw source reading whole usage items of an organization or user (or one
+    of its shard keys) in [low, high], in time order, for usage_export and
+    raw_export.
+    """
+    source = raw_source(scope, key, low, high)
+    query = dict(source['query'])
+    del query['ProjectionExpression']
+    if source['by'] == 'record_id':
+        # Only the projection used the #ts placeholder
+        del query['ExpressionAttributeNames']
+    return dict(source, full=True, query=query)
+
+
+def ingest_export_source(key, after, through):
+    """
+    Source reading whole usage items of an organization (or one of its shard
+    keys) stored after the watermark `after` and up to `through`, whatever
+    their timestamps, for usage_export.
+    """
+    query = {
+        'IndexName': item_schema.index_name('OrgIngestIndex'),
+        'KeyConditionExpression': 'organization_id = :key AND ingest_key BETWEEN :start AND :end',
+        'ExpressionAttributeValues': {':key': key, ':start': after, ':end': through}
+    }
+    return {'kind': 'ingest', 'after': after, 'empty': after >= through, 'full': True, 'query': query}
+
+
+def archive_source(scope, key, organization_id, low, high, high_exclusive=False):
+    """
+    Source for the archived records of a user (`key` is the user id) or an
+    organization in [low, high]. Pages are whole records, one day each.
+    """
+    return {
+        'kind': 'archive', 'scope': scope, 'key': key, 'organization_id': organization_id,
+        'low': low, 'high': high, 'exclude_from': high if high_exclusive else None, 'empty': low > high, 'full': True
+    }
+
+
+def archived_sources(scope, key, organization_id, ranges):
+    """Archive sources for the (low, high, high_exclusive) ranges that start before the hot window."""
+    if retention.archive is None or organization_id is None:
+        return []
+    hot_window_start = retention.hot_window_start()
+    return [
+        archive_source(scope, key, organization_id, low, high, high_exclusive)
+        for low, high, high_exclusive in ranges if low < hot_window_start
+    ]
+
+
+def rollup_source(scope, key, granularity, low, high):
+    """Query source for rollup rows of a user or organization between two buckets."""
+    query = {
+        'KeyConditionExpression': 'rollup_key = :key AND bucket_key BETWEEN :low AND :high',
+        'ProjectionExpression': ROLLUP_PROJECTION,
+        'ExpressionAttributeValues': {
+            ':key': f'{key}#{granularity}',
+            ':low': low,
+            ':high': high + _BUCKET_KEY_END
+        }
+    }
+    if scope == 'user':
+        query['IndexName'] = 'UserRollupIndex'
+        query['ProjectionExpression'] += ', organization_id'
+        query['KeyConditionExpression'] = 'user_rollup_key = :key AND bucket_key BETWEEN :low AND :high'
+    return {'kind': 'rollup', 'granularity': granularity, 'exclude_from': None, 'query': query}
+
+
+def build_sources(scope, key, start, end, use_rollups=False, rollup_start=None, shards=1, hourly=False,
+                  end_exclusive=False, organization_id=None):
+    """
+    Plan the queries answering [start, end] for a user or organization.
+    With rollups, whole buckets come from the rollup table and only the
+    partial buckets at the edges are read raw. With `hourly`, whole days are
+    read from hourly rollups too, for reports broken down by hour. Raw ranges
+    are read from every write shard of the key, and from the archive when
+    they start before the hot window; user archives are found through
+    `organization_id`. With `end_exclusive`, `end` is an hour bucket and the
+    range is [start, end).
+    """
+    keys = sharding.shard_keys(key, shards)
+    if scope != 'user':
+        organization_id = key
+    if not use_rollups:
+        sources = [raw_source(scope, shard_key, start, end, end_exclusive) for shard_key in keys]
+        return sources + archived_sources(scope, key, organization_id, [(start, end, end_exclusive)])
+    plan = rollups.plan_range(start, end, rollup_start, end_exclusive)
+    sources = []
+    if plan['days'] and hourly:
+        first_day, last_day = plan['days']
+        sources.append(rollup_source(scope, key, rollups.HOURLY, f'{first_day}T00', f'{last_day}T23'))
+    elif plan['days']:
+        sources.append(rollup_source(scope, key, rollups.DAILY, *plan['days']))
+    for low, high in plan['hours']:
+        sources.append(rollup_source(scope, key, rollups.HOURLY, low, high))
+    for low, high, high_exclusive in plan['raw']:
+        sources.extend(raw_source(scope, shard_key, low, high, high_exclusive) for shard_key in keys)
+    sources.extend(archived_sources(scope, key, organization_id, plan['raw']))
+    return sources
+
+
+def current_watermark(now=None):
+    """The watermark a delta query reads up to: DELTA_SETTLE_SECONDS ago."""
+    now = now or datetime.now(timezone.utc)
+    return record_keys.upper_bound(record_keys.canonical(now - timedelta(seconds=DELTA_SETTLE_SECONDS)))
+
+
+def parse_watermark(value):
+    """A watermark from a request parameter. Raises ValueError."""
+    if value != BASELINE_WATERMARK and not record_keys.is_record_id(value):
+        raise ValueError('Invalid watermark')
+    return value
+
+
+def delta_sources(scope, key, organization_id, start, end, watermark, through, shards=1):
+    """
+    Plan the queries for the change in [start, end] between two watermarks,
+    for a user (`key` is the user id) or an organization. From
+    BASELINE_WATERMARK the records are read by time like a full query, and
+    those stored after `through` are left for the next delta. Otherwise only
+    the records stored after `watermark` are read, whatever their time.
+    """
+    if watermark == BASELINE_WATERMARK:
+        return [
+            dict(source, through=through, query=dict(
+                source['query'], ProjectionExpression=source['query']['ProjectionExpression'] + ', ingest_key'
+            )) if source['kind'] == 'raw' else dict(source, through=through)
+            for source in build_sources(scope, key, start, end, shards=shards, organization_id=organization_id)
+        ]
+    user_id = key if scope == 'user' else None
+    return [
+        ingest_source(shard_key, watermark, through, start, end, user_id)
+        for shard_key in sharding.shard_keys(organization_id, shards)
+    ]
+
+
+def deadline_reached(context, reserve_ms=None):
+    """Return a callable telling whether the Lambda is close to its timeout."""
+    reserve_ms = QUERY_TIME_RESERVE_MS if reserve_ms is None else reserve_ms
+    if context is None or not hasattr(context, 'get_remaining_time_in_millis'):
+        return lambda: False
+    return lambda: context.get_remaining_time_in_millis() < reserve_ms
+
+
+def _parse_time(value):
+    """
+    Naive UTC datetime for an ISO timestamp or date, parsed like client
+    timestamps (see record_keys), or None if it isn't one.
+    """
+    try:
+        _, ms = record_keys.normalize_timestamp(value)
+    except (TypeError, ValueError):
+        return None
+    return datetime(1970, 1, 1) + timedelta(milliseconds=ms)
+
+
+def slice_boundaries(low, high, first_page):
+    """
+    Split the rest of a raw range after its first page into time slices of
+    about QUERY_SLICE_ITEMS records. The first page tells how dense the data
+    is. Returns the boundaries between slices, or [] when splitting isn't
+    worth it.
+    """
+    if not first_page:
+        return []
+    last_seen = first_page[-1]['timestamp']
+    start, seen_until, end = _parse_time(low), _parse_time(last_seen), _parse_time(high)
+    if start is None or seen_until is None or end is None or end <= seen_until:
+        return []
+    covered = max((seen_until - start).total_seconds(), 1)
+    remaining = (end - seen_until).total_seconds()
+    estimated_items = len(first_page) * remaining / covered
+    slices = min(MAX_QUERY_SLICES, math.ceil(estimated_items / QUERY_SLICE_ITEMS))
+    boundaries = []
+    for n in range(1, slices):
+        boundary = (seen_until + timedelta(seconds=remaining * n / slices)).isoformat()
+        if last_seen < boundary < high and (not boundaries or boundary > boundaries[-1]):
+            boundaries.append(boundary)
+    return boundaries
+
+
+def split_sources(sources, splits):
+    """
+    Expand sources into time slices. `splits` lists [source_index, boundaries]
+    pairs. Each slice covers [boundary, next boundary), and the last slice keeps
+    the source's own upper bound.
+    """
+    boundaries_of = {index: boundaries for index, boundaries in splits}
+    slices = []
+    for index, source in enumerate(sources):
+        boundaries = boundaries_of.get(index)
+        if not boundaries:
+            slices.append(source)
+            continue
+        edges = [source['low']] + list(boundaries) + [source['high']]
+        for n in range(len(edges) - 1):
+            last = n == len(edges) - 2
+            slices.append(_with_range(source, edges[n], edges[n + 1], source['exclude_from'] if last else edges[n + 1]))
+    return slices
+
+
+class UsageScan:
+    """
+    Stream (user_id, cost, count) rows from a list of sources, one page at a time.
+
+    Pages are read from `store` (see storage). `cursor` resumes a previous
+    scan. `should_stop` is checked before every page after
+    the first, so each invocation always makes progress. When it fires the
+    scan ends early with `complete` False and `cursor()` describing where to
+    resume.
+
+    With `max_workers` above one, the first page of each raw source is used to
+    split the rest of it into time slices sized to the data. The slices run
+    concurrently on a thread pool sharing the store's connections, and their
+    pages are handed back to the caller's thread as they arrive. Scans run on
+    worker threads of their own pass `shared` for the same connections.
+    """
+
+    def __init__(self, sources, store, cursor=None, should_stop=None, max_workers=1, shared=False):
+        self.sources = sources
+        self.store = store
+        self.should_stop = should_stop or (lambda: False)
+        self.max_workers = max_workers
+        self.shared = shared or max_workers > 1
+        self.splits = cursor['splits'] if cursor else None
+        self.open = [list(position) for position in cursor['open']] if cursor else None
+        self.slices = split_sources(sources, self.splits) if cursor else sources
+        self.finished = set()
+        self.complete = False
+        self.stopped = False
+        self.abandoned = False
+        self.pages = 0
+        self.workers = 1
+        self._lock = threading.Lock()
+        # Captured here because pages may be read on worker threads
+        self.invocation = metrics.current()
+
+    def _query(self, source, start_key):
+        started = time.perf_counter()
+        if source['kind'] == 'archive':
+            response = retention.query_archive(source, start_key)
+        else:
+            response = self.store.query_usage(source, start_key, shared=self.shared)
+        metrics.add_time('query_page', (time.perf_counter() - started) * 1000, self.invocation)
+        with self._lock:
+            self.pages += 1
+        return response
+
+    def pages_of(self, position):
+        """Yield the item lists of one slice, following LastEvaluatedKey."""
+        source = self.slices[position[0]]
+        if source.get('empty'):
+            self.finished.add(position[0])
+            return
+        while True:
+            if self.abandoned or (self.pages and self.should_stop()):
+                self.stopped = True
+                return
+            response = self._query(source, position[1])
+            position[1] = response.get('LastEvaluatedKey')
+            yield response['Items']
+            if not position[1]:
+                self.finished.add(position[0])
+                return
+
+    @staticmethod
+    def _in_range(source, items):
+        """The items of a page that belong to its source's range."""
+        if source['kind'] == 'rollup':
+            return items
+        low, high, exclude_from = source['low'], source['high'], source['exclude_from']
+        # Record id ranges are only exact to the millisecond
+        items = [
+            item for item in items
+            if low <= item['timestamp'] <= high and not (exclude_from and item['timestamp'] >= exclude_from)
+        ]
+        if source['kind'] == 'ingest':
+            # The watermark itself was counted by the previous delta
+            user_id = source['user_id']
+            return [
+                item for item in items
+                if item['ingest_key'] > source['after'] and (
+                    user_id is None or sharding.base_key(item['user_id'], int(item.get('write_shard') or 0)) == user_id
+                )
+            ]
+        if source.get('through'):
+            # Records stored before ingest keys existed predate every watermark
+            return [item for item in items if item.get('ingest_key', '') <= source['through']]
+        return items
+
+    @staticmethod
+    def rows_of(source, items):
+        """(user_id, cost, count) rows of one page."""
+        for item in items:
+            if source['kind'] == 'rollup':
+                yield item['user_id'], Decimal(str(item['total_cost'])), int(item['usage_count'])
+            else:
+                user_id = sharding.base_key(item['user_id'], int(item.get('write_shard') or 0))
+                yield user_id, Decimal(str(item['total_cost'])), 1
+
+    def _plan(self):
+        """Read the first page of every raw source and slice what remains."""
+        probed = [
+            index for index, source in enumerate(self.sources)
+            if source['kind'] == 'raw' and not source['empty']
+        ]
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(probed) or 1)) as executor:
+            responses = dict(zip(probed, executor.map(lambda index: self._query(self.sources[index], None), probed)))
+        self.splits = []
+        for index, response in responses.items():
+            if response.get('LastEvaluatedKey'):
+                source = self.sources[index]
+                boundaries = slice_boundaries(source['low'], source['high'], response['Items'])
+                if boundaries:
+                    self.splits.append([index, boundaries])
+        self.slices = split_sources(self.sources, self.splits)
+
+        # The probe is the first page of each source's first slice
+        self.open = []
+        boundaries_of = dict((index, boundaries) for index, boundaries in self.splits)
+        offset = 0
+        for index, source in enumerate(self.sources):
+            response = responses.get(index)
+            if response is None:
+                self.open.append([offset, None])
+            else:
+                yield source, self._in_range(source, response['Items'])
+                if response.get('LastEvaluatedKey'):
+                    self.open.append([offset, response['LastEvaluatedKey']])
+                else:
+                    self.finished.add(offset)
+            for n in range(1, len(boundaries_of.get(index, ())) + 1):
+                self.open.append([offset + n, None])
+            offset += 1 + len(boundaries_of.get(index, ()))
+
+    def item_pages(self):
+        """Yield (source, items) for every page, with items outside the source's range dropped."""
+        if self.open is None:
+            if self.max_workers > 1:
+                yield from self._plan()
+            else:
+                self.splits = []
+                self.open = [[index, None] for index in range(len(self.slices))]
+        self.workers = max(1, min(self.max_workers, len(self.open)))
+        if self.workers == 1:
+            for position in self.open:
+                source = self.slices[position[0]]
+                for items in self.pages_of(position):
+                    yield source, self._in_range(source, items)
+                if self.stopped:
+                    break
+        else:
+            yield from self._parallel_pages()
+        self.open = [position for position in self.open if position[0] not in self.finished]
+        self.complete = not self.open
+
+    def rows(self):
+        for source, items in self.item_pages():
+            yield from self.rows_of(source, items)
+
+    def _parallel_pages(self):
+        # Workers wait once a few pages are queued, so a slow consumer keeps
+        # memory at a few pages rather than the whole range
+        pages = queue.Queue(maxsize=2 * self.workers)
+
+        def drain(position):
+            try:
+                for items in self.pages_of(position):
+                    pages.put((position[0], items))
+            finally:
+                pages.put(None)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [executor.submit(drain, position) for position in self.open]
+            running = len(futures)
+            try:
+                while running:
+                    page = pages.get()
+                    if page is None:
+                        running -= 1
+                        continue
+                    source = self.slices[page[0]]
+                    yield source, self._in_range(source, page[1])
+            finally:
+                if running:
+                    # The caller stopped early: let the workers finish their current page and exit
+                    self.abandoned = True
+                    while running:
+                        if pages.get() is None:
+                            running -= 1
+            for future in futures:
+                future.result()
+
+    def cursor(self):
+        """Position to resume from, or None once the scan is complete."""
+        if self.complete:
+            return None
+        return {'splits': self.splits, 'open': self.open}
+
+    def stats(self):
+        """How much work the scan did, for logging."""
+        return {
+            'sources': len(self.sources),
+            'slices': len(self.slices),
+            'workers': self.workers,
+            'pages': self.pages,
+            'complete': self.complete
+        }
+
+    def count_metrics(self, invocation=None):
+        """Count the pages and slices read as metrics, and return stats()."""
+        stats = self.stats()
+        invocation = invocation or self.invocation
+        metrics.count('query_pages', stats['pages'], invocation=invocation)
+        metrics.count('query_slices', stats['slices'], invocation=invocation)
+        return stats
+
+
+def query_fingerprint(sources):
+    """Short hash identifying a planned query, used to bind continuation tokens."""
+    digest = hashlib.sha256(json.dumps(sources, sort_keys=True, default=str).encode('utf-8'))
+    return digest.hexdigest()[:16]
+
+
+def _typed_key(key):
+    return {k: bootstrap.serialize(v) for k, v in key.items()} if key else None
+
+
+def _plain_key(key):
+    return {k: bootstrap.deserialize(v) for k, v in key.items()} if key else None
+
+
+def _signature(body):
+    digest = hmac.new(CONTINUATION_TOKEN_KEY, body.encode('ascii'), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).decode('ascii').rstrip('=')
+
+
+def _token_payload(token):
+    """The payload of a token this server signed. Raises ValueError otherwise."""
+    try:
+        body, signature = token.rsplit('.', 1)
+        if not hmac.compare_digest(signature, _signature(body)):
+            raise ValueError('Bad signature')
+        return json.loads(base64.urlsafe_b64decode(body.encode('ascii')))
+    except Exception:
+        raise ValueError('Invalid continuation token')
+
+
+def encode_continuation(sources, cursor, partial):
+    """
+    Build an opaque, signed continuation token from a scan cursor and the
+    partial aggregate computed so far. Keys are stored in DynamoDB's typed
+    form so numeric key attributes survive the JSON round trip.
+    """
+    payload = {
+        'q': query_fingerprint(sources),
+        'b': cursor['splits'],
+        'o': [[index, _typed_key(key)] for index, key in cursor['open']],
+        'p': partial
+    }
+    body = base64.urlsafe_b64encode(json.dumps(payload, separators=(',', ':')).encode('utf-8')).decode('ascii')
+    return f'{body}.{_signature(body)}'
+
+
+def peek_continuation(token):
+    """
+    The partial aggregate of a continuation token, before its sources are
+    known. Callers that plan differently depending on it must still check the
+    token with decode_continuation. Raises ValueError if it is malformed or
+    not signed by this server.
+    """
+    try:
+        return _token_payload(token)['p']
+    except (KeyError, TypeError):
+        raise ValueError('Invalid continuation token')
+
+
+def decode_continuation(token, sources):
+    """
+    Return (cursor, partial) from a continuation token.
+    Raises ValueError if the token is malformed or belongs to a different query.
+    """
+    payload = _token_payload(token)
+    try:
+        cursor = {
+            'splits': [[int(index), [str(b) for b in boundaries]] for index, boundaries in payload['b']],
+            'open': [[int(index), _plain_key(key)] for index, key in payload['o']]
+        }
+        partial = payload['p']
+    except Exception:
+        raise ValueError('Invalid continuation token')
+    if payload.get('q') != query_fingerprint(sources):
+        raise ValueError('Continuation token does not match this query')
+    if any(not 0 <= index < len(sources) or sources[index]['kind'] != 'raw' for index, _ in cursor['splits']):
+        raise ValueError('Continuation token does not match this query')
+    slice_count = len(split_sources(sources, cursor['splits']))
+    if not cursor['open'] or any(not 0 <= index < slice_count for index, _ in cursor['open']):
+        raise ValueError('Continuation token does not match this query')
+    return cursor, partial
@@ -0,0 +1,184 @@
+"""
+Throttling-aware writes for the track endpoints.
+
+Under a burst DynamoDB throttles writes. botocore retries a throttled call a
+few times, and with AWS_RETRY_MODE=adaptive it also slows the client down
+(see bootstrap). A write still throttled after that is handled here instead
+of failing the request:
+
+- It is retried up to WRITE_RETRY_ATTEMPTS more times, with full jitter
+  exponential backoff from WRITE_RETRY_BASE_MS up to WRITE_RETRY_MAX_MS,
+  while the Lambda has time left.
+- After BREAKER_THRESHOLD throttles in a row a circuit breaker opens. Writes
+  then skip the table for BREAKER_COOLDOWN_SECONDS, after which one write
+  probes it. The breaker closes again once a write gets through.
+- Records that could not be written, and records that arrive while the
+  breaker is open, come back as THROTTLED. The track endpoint spills them to
+  the ingest queue, where ingest_worker stores them once the table has
+  capacity again, and answers 202. Without a queue it answers 503 with
+  Retry-After.
+
+Nothing is held in the function's memory, so a record is either stored, on
+the queue or refused. Throttles and retries are counted as the
+write_throttles and write_retries metrics.
+"""
+import logging
+import math
+import os
+import random
+import threading
+import time
+
+import metrics
+from batch_write import THROTTLING_ERRORS, UNPROCESSED_ERROR, error_code
+
+# Initialize logging
+logger = logging.getLogger()
+
+WRITE_RETRY_ATTEMPTS = int(os.environ.get('WRITE_RETRY_ATTEMPTS', '3'))
+WRITE_RETRY_BASE_MS = float(os.environ.get('WRITE_RETRY_BASE_MS', '25'))
+WRITE_RETRY_MAX_MS = float(os.environ.get('WRITE_RETRY_MAX_MS', '1000'))
+BREAKER_THRESHOLD = int(os.environ.get('BREAKER_THRESHOLD', '5'))
+BREAKER_COOLDOWN_SECONDS = float(os.environ.get('BREAKER_COOLDOWN_SECONDS', '5'))
+
+# Retries stop once less Lambda time than this remains
+_TIME_RESERVE_MS = 1000
+
+# Outcome of a write the table throttled past every retry
+THROTTLED = 'throttled'
+
+
+def is_throttle(error):
+    return error_code(error) in THROTTLING_ERRORS
+
+
+def is_throttle_message(message):
+    """True for the error message of a batch item that failed on throttling."""
+    return message == UNPROCESSED_ERROR or any(code in message for code in THROTTLING_ERRORS)
+
+
+class CircuitBreaker:
+    """
+    Opens after `threshold` throttles in a row. Once open, allow() refuses
+    writes for `cooldown` seconds and then lets one probe through per
+    cooldown, until a write succeeds and closes it again.
+    """
+
+    def __init__(self, threshold, cooldown, clock=time.monotonic):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.clock = clock
+        self.throttles = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def closed(self):
+        return self.opened_at is None
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            now = self.clock()
+            if now - self.opened_at < self.cooldown:
+                return False
+            # The next probe waits for another cooldown
+            self.opened_at = now
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.throttles = 0
+            self.opened_at = None
+
+    def record_throttle(self):
+        with self._lock:
+            self.throttles += 1
+            if self.opened_at is None and self.throttles >= self.threshold:
+                self.opened_at = self.clock()
+                logger.warning({'action': 'write_breaker_open', 'throttles': self.throttles})
+
+    def retry_after(self):
+        """Whole seconds until the breaker next lets a write through."""
+        with self._lock:
+            if self.opened_at is None:
+                return 1
+            return max(1, math.ceil(self.cooldown - (self.clock() - self.opened_at)))
+
+
+class WriteGuard:
+    """
+    Writes usage items to a store, retrying throttled writes. It keeps the
+    breaker, and lives at module level so it survives warm invocations; the
+    store is passed to every call.
+    """
+
+    def __init__(self, breaker=None, attempts=WRITE_RETRY_ATTEMPTS, base_ms=WRITE_RETRY_BASE_MS,
+                 max_ms=WRITE_RETRY_MAX_MS, sleep=time.sleep, rng=random):
+        self.breaker = breaker or CircuitBreaker(BREAKER_THRESHOLD, BREAKER_COOLDOWN_SECONDS)
+        self.attempts = attempts
+        self.base_ms = base_ms
+        self.max_ms = max_ms
+        self.sleep = sleep
+        self.rng = rng
+
+    def _backoff_ms(self, attempt):
+        return self.rng.uniform(0, min(self.max_ms, self.base_ms * (2 ** attempt)))
+
+    def _throttled(self, count=1):
+        metrics.count('write_throttles', count)
+        self.breaker.record_throttle()
+
+    def put(self, store, item, context=None):
+        """
+        Write one item. Returns None once it is stored, or THROTTLED when
+        the table throttled it past every retry or the breaker is open.
+        Raises any error other than throttling as it is.
+        """
+        if self.breaker.allow():
+            for attempt in range(self.attempts + 1):
+                try:
+                    store.put_usage(item)
+                except Exception as e:
+                    if not is_throttle(e):
+                        raise
+                    self._throttled()
+                    delay_ms = self._backoff_ms(attempt)
+                    if attempt == self.attempts or not self.breaker.closed or not _time_left(context, delay_ms):
+                        break
+                    metrics.count('write_retries')
+                    self.sleep(delay_ms / 1000)
+                else:
+                    self.breaker.record_success()
+                    return None
+        return THROTTLED
+
+    def put_batch(self, store, items, max_workers=8):
+        """
+        Write items with batch writes, which retry unprocessed items on their
+        own. Returns a list aligned with `items`: None for a stored item,
+        THROTTLED for a throttled one and an error message otherwise.
+        """
+        if not items:
+            return []
+        if not self.breaker.allow():
+            errors = [UNPROCESSED_ERROR] * len(items)
+        else:
+            errors = store.put_usage_batch(items, max_workers=max_workers)
+            throttled = sum(1 for error in errors if error and is_throttle_message(error))
+            if throttled:
+                self._throttled(throttled)
+            elif any(error is None for error in errors):
+                self.breaker.record_success()
+        return [THROTTLED if error and is_throttle_message(error) else error for error in errors]
+
+
+def _time_left(context, delay_ms):
+    """Whether the Lambda can wait `delay_ms` and still write."""
+    if context is None or not hasattr(context, 'get_remaining_time_in_millis'):
+        return True
+    return context.get_remaining_time_in_millis() > delay_ms + _TIME_RESERVE_MS
+
+
+guard = WriteGuard()